@@ -505,6 +505,28 @@ class CmdLine(object):
                                                    'server_secure_port']))
         co.write("    Client HTTPS port:  %s"%(info[
                                                       'client_secure_port']))
+        if 'state_save' in info:
+            st=info['state_save']
+            co.write("\n    State saves:            %d\n"%st['saves'])
+            co.write("    State save time:        %.3fs last, %.3fs max, "
+                     "%.3fs total\n"%(st['last_duration'], st['max_duration'],
+                                      st['total_duration']))
+            co.write("    Dataflow held up:       %.3fs last, %.3fs max, "
+                     "%.3fs total"%(st['last_blocked'], st['max_blocked'],
+                                    st['total_blocked']))
+        if 'task_queue' in info:
+            tq=info['task_queue']
+            co.write("\n    Task queue:             %d queued (%d max, "
+                     "limit %d)\n"%(tq['depth'], tq['max_depth'],
+                                    tq['max_size']))
+            co.write("    Task queue wait:        %.3fs avg, %.3fs max over "
+                     "%d tasks\n"%(tq['avg_wait'], tq['max_wait'],
+                                   tq['handled']))
+            co.write("    Task queue full:        %d times, %.3fs total"%
+                     (tq['blocked_puts'], tq['blocked_time']))
+            for prj in sorted(tq['projects'].keys()):
+                co.write("\n      %-20s  %d queued"%(prj,
+                                                     tq['projects'][prj]))
         return co.getvalue()
     
     @staticmethod   
@@ -691,6 +713,13 @@ class CmdLine(object):
                     co.write("        %s get %s%s.msg.warning\n"%('cpcc', 
                                                                   projectGetStr,
                                                                   inst))
+            if 'locks' in prj_obj and prj_obj['locks']['transactions'] > 0:
+                locks=prj_obj['locks']
+                co.write("   %d transactions; lock wait %.3fs total, %.3fs "
+                         "max; lock hold %.3fs total, %.3fs max\n"%(
+                         locks['transactions'], locks['total_wait'],
+                         locks['max_wait'], locks['total_hold'],
+                         locks['max_hold']))
             # queue
             if True: 
                 if(len(prj_obj['queue']['queue']) > 0):
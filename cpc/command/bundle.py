@@ -0,0 +1,277 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+# 
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published 
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+
+"""Command bundles: the tar streams in which commands and their input files
+   are sent to workers.
+
+   A bundle is an uncompressed tar stream, so it can be written, forwarded
+   and extracted sequentially, without first buffering it completely.
+   Files are compressed individually instead: files that compress well are
+   stored gzipped (marked with a pax header), while files that are already
+   compressed, such as compressed trajectories and run input files, are
+   stored unchanged.
+
+   Workers with an input cache (see cpc.worker.input_cache) tell the server
+   the content hashes of the files they have cached. Files of at least
+   minHashSize are then marked with their SHA1 hash (in a pax header), so
+   the worker can cache them, and files that the worker already has are
+   sent as references to the cached content instead of in full.
+
+   extractBundle() also reads the gzipped tar files that older servers
+   send."""
+
+
+import collections
+import hashlib
+import os
+import tarfile
+import tempfile
+import threading
+import zlib
+import logging
+
+import cpc.util
+
+
+log=logging.getLogger(__name__)
+
+class BundleError(cpc.util.CpcError):
+    pass
+
+
+# the content type of bundles
+contentType='application/x-cpc-bundle'
+# the content type of the gzipped tar files of older servers
+tarContentType='application/x-tar'
+
+# the pax header that marks individually compressed files
+compressionHeader='CPC.compression'
+# the pax header with the content hash of a file the worker can cache
+hashHeader='CPC.hash'
+# the pax header of a file that isn't sent because the worker has it cached:
+# the content hash
+refHeader='CPC.ref'
+
+# the file extensions of files that are stored unchanged because they are
+# already compressed, or don't compress well.
+compressedExtensions=frozenset([ '.xtc', '.tng', '.tpr', '.cpt', '.gz',
+                                 '.tgz', '.bz2', '.xz', '.zip' ])
+
+# the size of the chunks in which files are (de)compressed and copied
+chunkSize=1024*1024
+# the max. size of a compressed file to keep in memory
+maxMemSize=4*1024*1024
+# the min. size of files that workers cache
+minHashSize=64*1024
+# the max. number of file hashes to keep
+maxHashCacheEntries=4096
+
+_hashCache=collections.OrderedDict()
+_hashCacheLock=threading.Lock()
+
+def isContentType(contentTypeStr):
+    """Check whether a content type is that of a bundle or tar file."""
+    return contentTypeStr == contentType or contentTypeStr == tarContentType
+
+def _shouldCompress(filename):
+    return not (os.path.splitext(filename)[1].lower() in compressedExtensions)
+
+def _compressFile(inf):
+    """Compress a file to a gzip stream; returns a file object positioned
+       at its start and the compressed size."""
+    outf=tempfile.SpooledTemporaryFile(max_size=maxMemSize)
+    comp=zlib.compressobj(6, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+    while True:
+        buf=inf.read(chunkSize)
+        if len(buf) == 0:
+            break
+        outf.write(comp.compress(buf))
+    outf.write(comp.flush())
+    size=outf.tell()
+    outf.seek(0)
+    return (outf, size)
+
+def getFileHash(filename):
+    """Get the SHA1 hash of a file's contents. Hashes are cached by file
+       name, and validated against the file's size and modification time."""
+    path=os.path.abspath(filename)
+    st=os.stat(path)
+    stamp=(st.st_size, st.st_mtime)
+    with _hashCacheLock:
+        entry=_hashCache.pop(path, None)
+        if entry is not None and entry[0] == stamp:
+            _hashCache[path]=entry
+            return entry[1]
+    sha=hashlib.sha1()
+    inf=open(path, 'rb')
+    try:
+        while True:
+            buf=inf.read(chunkSize)
+            if len(buf) == 0:
+                break
+            sha.update(buf)
+    finally:
+        inf.close()
+    ret=sha.hexdigest()
+    with _hashCacheLock:
+        _hashCache[path]=(stamp, ret)
+        while len(_hashCache) > maxHashCacheEntries:
+            _hashCache.popitem(last=False)
+    return ret
+
+def writeBundle(outf, dirs, compress=True, haveHashes=None):
+    """Write a bundle to a file object.
+
+       outf = the file object to write to. It is written sequentially.
+       dirs = a list of (directory, archive name) tuples of the directories
+              to add
+       compress = whether to compress files that aren't already compressed
+       haveHashes = the set of content hashes of the files in the worker's
+                    input cache, or None if the worker has no input cache.
+    """
+    tf=tarfile.open(fileobj=outf, mode='w|', format=tarfile.PAX_FORMAT)
+    try:
+        for (topdir, arcdir) in dirs:
+            for (dirpath, dirnames, filenames) in os.walk(topdir):
+                dirnames.sort()
+                relpath=os.path.relpath(dirpath, topdir)
+                if relpath == os.curdir:
+                    arcpath=arcdir
+                else:
+                    arcpath=os.path.join(arcdir, relpath)
+                tf.addfile(tf.gettarinfo(dirpath, arcpath))
+                for filename in sorted(filenames):
+                    _addFile(tf, os.path.join(dirpath, filename),
+                             os.path.join(arcpath, filename), compress,
+                             haveHashes)
+    finally:
+        tf.close()
+
+def _addFile(tf, filename, arcname, compress, haveHashes):
+    """Add a single file to an open bundle."""
+    ti=tf.gettarinfo(filename, arcname)
+    if not ti.isreg():
+        tf.addfile(ti)
+        return
+    paxHeaders=dict()
+    if haveHashes is not None and ti.size >= minHashSize:
+        contentHash=getFileHash(filename)
+        if contentHash in haveHashes:
+            ti.size=0
+            ti.pax_headers={ refHeader : unicode(contentHash) }
+            tf.addfile(ti)
+            return
+        paxHeaders[hashHeader]=unicode(contentHash)
+    ti.pax_headers=paxHeaders
+    inf=open(filename, 'rb')
+    try:
+        if compress and _shouldCompress(filename):
+            (cf, ti.size)=_compressFile(inf)
+            paxHeaders[compressionHeader]=u'gzip'
+            try:
+                tf.addfile(ti, cf)
+            finally:
+                cf.close()
+        else:
+            tf.addfile(ti, inf)
+    finally:
+        inf.close()
+
+def _isSafe(member):
+    return (not os.path.isabs(member.name) and
+            not os.path.normpath(member.name).startswith(".."))
+
+def extractBundle(destdir, fileobj, inputCache=None):
+    """Extract a bundle (or a gzipped tar file) from a file object into
+       destdir. The file object is read sequentially, so extraction can start
+       before the whole bundle has been received.
+
+       inputCache = the worker's input cache, if it has one: files marked
+                    with their hash are added to it, and referenced files
+                    are taken from it.
+
+       Returns the list of names of the members that referenced cached
+       inputs that weren't found (because they were removed from the cache
+       after the request was sent). These members are left out, and the
+       rest of the bundle is extracted."""
+    missing=[]
+    try:
+        tf=tarfile.open(fileobj=fileobj, mode='r|*')
+    except tarfile.TarError:
+        raise BundleError("Couldn't read command bundle")
+    try:
+        for member in tf:
+            if not _isSafe(member):
+                log.info("Skipping unsafe bundle member %s"%member.name)
+                continue
+            filename=os.path.join(destdir, member.name)
+            ref=member.pax_headers.get(refHeader)
+            if ref is not None:
+                if inputCache is None or not member.isreg():
+                    raise BundleError("Unexpected cache reference for %s"%
+                                      member.name)
+                dirname=os.path.dirname(filename)
+                if not os.path.exists(dirname):
+                    os.makedirs(dirname)
+                if not inputCache.link(ref, filename):
+                    log.info("Cached input for %s not found"%member.name)
+                    missing.append(member.name)
+                continue
+            compression=member.pax_headers.get(compressionHeader)
+            if compression is None:
+                tf.extract(member, destdir)
+            elif compression == 'gzip' and member.isreg():
+                _extractCompressed(tf, member, destdir)
+            else:
+                raise BundleError("Unknown compression %s for %s"%
+                                  (compression, member.name))
+            contentHash=member.pax_headers.get(hashHeader)
+            if (inputCache is not None and contentHash is not None and
+                member.isreg()):
+                inputCache.add(contentHash, filename)
+    except OSError as e:
+        raise BundleError("%s: %s"%(destdir, e.strerror))
+    except tarfile.TarError:
+        raise BundleError("Couldn't read command bundle")
+    finally:
+        tf.close()
+    return missing
+
+def _extractCompressed(tf, member, destdir):
+    """Extract and decompress an individually compressed bundle member."""
+    filename=os.path.join(destdir, member.name)
+    dirname=os.path.dirname(filename)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    inf=tf.extractfile(member)
+    decomp=zlib.decompressobj(16+zlib.MAX_WBITS)
+    outf=open(filename, 'wb')
+    try:
+        while True:
+            buf=inf.read(chunkSize)
+            if len(buf) == 0:
+                break
+            outf.write(decomp.decompress(buf))
+        outf.write(decomp.flush())
+    except zlib.error:
+        raise BundleError("Corrupt compressed file %s in bundle"%member.name)
+    finally:
+        outf.close()
+    os.chmod(filename, member.mode)
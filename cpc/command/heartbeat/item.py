@@ -20,6 +20,7 @@
 import logging
 import os
 import xml.sax
+import xml.sax.saxutils
 
 try:
     from cStringIO import StringIO
@@ -178,3 +179,62 @@ class HeartbeatItemReader(xml.sax.handler.ContentHandler):
         if name == "worker":
             self.curWorker=None
 
+
+class HeartbeatBatch(object):
+    """A batch of heartbeat signals from different workers, as relayed
+       between servers in a single request."""
+    def __init__(self):
+        # the list of (worker ID, worker dir, iteration, items) tuples
+        self.heartbeats=[]
+
+    def add(self, workerID, workerDir, iteration, items):
+        """Add a worker's heartbeat signal. Returns its index in the batch."""
+        self.heartbeats.append( (workerID, workerDir, iteration, items) )
+        return len(self.heartbeats)-1
+
+    def getHeartbeats(self):
+        """Get the list of (worker ID, worker dir, iteration, items)
+           tuples."""
+        return self.heartbeats
+
+    def writeXML(self, outf, workerServer):
+        """Write the batch as xml."""
+        outf.write('<heartbeat-batch worker_server_id=%s>\n'%
+                   xml.sax.saxutils.quoteattr(workerServer))
+        for workerID, workerDir, iteration, items in self.heartbeats:
+            outf.write('  <heartbeat worker_id=%s worker_dir=%s '
+                       'iteration=%s>\n'%
+                       (xml.sax.saxutils.quoteattr(workerID),
+                        xml.sax.saxutils.quoteattr(workerDir),
+                        xml.sax.saxutils.quoteattr(iteration)))
+            for item in items:
+                item.writeXML(outf)
+            outf.write('  </heartbeat>\n')
+        outf.write('</heartbeat-batch>\n')
+
+
+class HeartbeatBatchReader(HeartbeatItemReader):
+    """XML reader for a heartbeat batch."""
+    def __init__(self):
+        HeartbeatItemReader.__init__(self)
+        self.batch=HeartbeatBatch()
+
+    def getBatch(self):
+        """Get the HeartbeatBatch object read."""
+        return self.batch
+
+    def startElement(self, name, attrs):
+        if name == "heartbeat-batch":
+            pass
+        elif name == "heartbeat":
+            for attr in [ "worker_id", "worker_dir", "iteration" ]:
+                if not attrs.has_key(attr):
+                    raise HeartbeatReaderError("heartbeat has no %s"%attr,
+                                               self.loc)
+            # items are read into a new list for each heartbeat
+            self.items=[]
+            self.batch.add(attrs.getValue("worker_id"),
+                           attrs.getValue("worker_dir"),
+                           attrs.getValue("iteration"), self.items)
+        else:
+            HeartbeatItemReader.startElement(self, name, attrs)
@@ -29,7 +29,16 @@ log=logging.getLogger(__name__)
 class CommandWorkerMatcher(object):
     """Object that stores information about a worker for the 
        matchCommandWorker() function that is used in queue.getUntil()"""
-    def __init__(self, platforms, executableList, workerReqDict):
+    def __init__(self, platforms, executableList, workerReqDict,
+                 execIDs=None):
+        """Initialize the matcher for one worker request.
+
+           platforms = the worker's platforms, with the remaining resources
+           executableList = the worker's executable list
+           workerReqDict = the worker requirements
+           execIDs = an optional dict of executable lookups to share with
+                     other matchers for the same executables (see
+                     cpc.server.state.worker_capabilities)."""
         self.platforms=platforms
         self.executableList=executableList
         self.workerReqDict=workerReqDict
@@ -50,6 +59,14 @@ class CommandWorkerMatcher(object):
             self.used[rsrc.name]=resource.Resource(rsrc.name, 0)
         self.type=None
         self.depleted=False
+        # cached results of the executable lookups, indexed by
+        # (platform name, executable name, min. version, max. version)
+        if execIDs is None:
+            execIDs=dict()
+        self.execIDs=execIDs
+        # cached results of the worker requirement checks, indexed by
+        # project name
+        self.projectAllowed=dict()
 
     def checkType(self, type):
         """Check whether the command type is the same as one used before in the
@@ -61,8 +78,18 @@ class CommandWorkerMatcher(object):
 
     def getExecID(self, cmd):
         """Check whether the worker has the right executable."""
+        key=(self.usePlatform.name, cmd.executable,
+             cmd.minVersion.getStr() if cmd.minVersion is not None else None,
+             cmd.maxVersion.getStr() if cmd.maxVersion is not None else None)
+        if key in self.execIDs:
+            return self.execIDs[key]
+        ret=self._findExecID(cmd)
+        self.execIDs[key]=ret
+        return ret
+
+    def _findExecID(self, cmd):
+        """Search the executable list for the command's executable."""
         # first try the usePlatform
-        
         ret=self.executableList.find(cmd.executable, self.usePlatform,
                                      cmd.minVersion, cmd.maxVersion)
         if ret is not None:
@@ -78,13 +105,26 @@ class CommandWorkerMatcher(object):
         #Check if worker is project dedicated
         if 'project' in self.workerReqDict:
             name=cmd.getTask().getProject().getName()
+            if name in self.projectAllowed:
+                return self.projectAllowed[name]
             reqName=self.workerReqDict['project']
             log.debug("Worker is dedicated to proj. %s, command belongs to %s"%
                       (reqName, name))
-            if name != reqName:
-                return False
+            self.projectAllowed[name] = (name == reqName)
+            return self.projectAllowed[name]
         return True
 
+    def canRun(self, cmd):
+        """Check whether the worker can run the command at all, based only
+           on the properties in the command's capability key (see
+           CmdQueue.getCapabilityKey()). Available resources are not
+           checked."""
+        if ( self.type is not None and
+             cmd.getTask().getFunctionName() != self.type ):
+            return False
+        return ( self.getExecID(cmd) is not None and
+                 self.checkWorkerRequirements(cmd) )
+
     def checkAddResources(self, cmd):
         """Check whether a command falls within the current resource allocation
            and add its requirements to the used resources if it does.
@@ -132,7 +172,14 @@ class CommandWorkerMatcher(object):
     def getWork(self, cmdQueue):
         """Get work from a command queue until the worker is filled or there is
            no more work."""
-        return cmdQueue.getUntil(matchCommandWorker, self)
+        return cmdQueue.getUntil(matchCommandWorker, self,
+                                 matchCommandCapabilities)
+
+
+def matchCommandCapabilities(matcher, command):
+    """Function to use in queue.getUntil() to skip all queued commands
+       that share a capability key the worker can't run."""
+    return matcher.canRun(command)
 
 
 def matchCommandWorker(matcher, command):
@@ -25,6 +25,7 @@ import threading
 import os
 import sys
 import copy
+import itertools
 import xml.sax.saxutils
 
 
@@ -47,6 +48,9 @@ from cpc.dataflow.value import ValError
 class ActiveError(apperror.ApplicationError):
     pass
 
+# the source of the global lock order of active instances.
+_lockOrderCounter=itertools.count()
+
 
 class ActiveInstanceState:
     """The state of an active instance with its associated string."""
@@ -71,7 +75,8 @@ class ActiveInstance(value.ValueBase):
                'inputAcps', 'outputAcps', 'subnetInputAcps', 'subnetOutputAcps',
                'baseDir', 'persDir', 'msg', 'outputDirNr', 'genTasks', 'updated',
                'inputLock', 'outputLock', 'lock', 'state', 'tasks', 'subnet',
-               'inputListeners', 'lastUpdateAI', 'lastUpdateSource', 'lastUpdateSeqNr']
+               'inputListeners', 'lastUpdateAI', 'lastUpdateSource', 'lastUpdateSeqNr',
+               'lockOrder']
     # The initial state: will not run, until activated.
     held=ActiveInstanceState("held")
     # The active state where it's waiting for inputs to complete
@@ -228,15 +233,17 @@ class ActiveInstance(value.ValueBase):
         # The default lock protects single-instance non-constant data such
         # as its state, etc.
         self.lock=threading.Lock()
-        # All network connectivity is locked with a global lock:
-        # project.networkLock
-        # NOTE: only when this global lock is locked, is the locking of more
+        # The connectivity of each active network is locked with its network
+        # lock (the top-level network's lock is project.updateLock).
+        # NOTE: only when a network lock is locked, is the locking of more
         # than one instance's outputLock or inputLock allowed. In any other
         # case, only one outputLock is allowed, and simultaneously only one
         # inputLock (which must be locked after the outputLock, and unlocked
         # before the outputLock is unlocked).
-        # When the global project.networkLock is locked, multiple outputLocks
-        # may be locked, after which, multiple inputLocks may be locked.
+        # When a network lock is locked, multiple outputLocks may be locked
+        # in the order given by lockOrder, after which, multiple inputLocks
+        # may be locked.
+        self.lockOrder=_lockOrderCounter.next()
 
         # whether the instance has already been called with all required inputs:
         self.state=ActiveInstance.held
@@ -245,11 +252,12 @@ class ActiveInstance(value.ValueBase):
         # activate that network if needed.
         subnet=inst.getSubnet()
         if subnet is not None:
+            # the subnet gets its own network lock, so that transactions in
+            # different subnets don't block each other.
             self.subnet=active_network.ActiveNetwork(self.project, subnet,
                                                      activeNetwork.taskQueue,
                                                      dirName,
-                                                     activeNetwork.\
-                                                        getNetworkLock(),
+                                                     threading.RLock(),
                                                      self)
         # the list of listeners (ActiveConnectionPoints) for inputs
         self.inputListeners=[]
@@ -263,6 +271,12 @@ class ActiveInstance(value.ValueBase):
         # this.
         self.lastUpdateAI=None
         self.lastUpdateSeqNr=-1
+        self.markChanged()
+
+    def markChanged(self):
+        """Mark the state of this active instance as changed, so that it
+           is saved with the next project state save."""
+        self.project.stateChanged(self)
 
     def writeDebug(self, outf):
         outf.write("Active instance %s\n"%self.getCanonicalName())
@@ -316,6 +330,7 @@ class ActiveInstance(value.ValueBase):
         """add used cpu time to this active instance."""
         with self.outputLock:
             self.cputime+=cputime
+        self.markChanged()
 
     def getCputime(self):
         with self.outputLock:
@@ -325,6 +340,7 @@ class ActiveInstance(value.ValueBase):
         """set used cpu time to this active instance."""
         with self.outputLock:
             self.cputime=cputime
+        self.markChanged()
 
     def getCumulativeCputime(self):
         """Get the total CPU time used by active instance and its
@@ -393,7 +409,8 @@ class ActiveInstance(value.ValueBase):
     def getInputACP(self, itemList):
         """Get or make an active connection point in the input.
 
-           It is assumed project.networkLock is locked when using this
+           It is assumed the network lock of this instance's network
+           (see ActiveNetwork.getNetworkLock()) is locked when using this
            function."""
         val=self.stagedInputVal.getCreateSubValue(itemList)
         if val is None:
@@ -411,7 +428,8 @@ class ActiveInstance(value.ValueBase):
     def getOutputACP(self, itemList):
         """Get or make an active connection point in the output.
 
-           It is assumed project.networkLock is locked when using this
+           It is assumed the network lock of this instance's network
+           (see ActiveNetwork.getNetworkLock()) is locked when using this
            function."""
         val=self.outputVal.getCreateSubValue(itemList)
         #log.debug("->%s, %s"%(str(type(self.outputVal)), str(type(val))))
@@ -430,7 +448,8 @@ class ActiveInstance(value.ValueBase):
     def getSubnetInputACP(self, itemList):
         """Get or make an active connection point in the subnet input.
 
-           It is assumed project.networkLock is locked when using this
+           It is assumed the network lock of this instance's network
+           (see ActiveNetwork.getNetworkLock()) is locked when using this
            function."""
         val=self.stagedSubnetInputVal.getCreateSubValue(itemList)
         if val is None:
@@ -448,7 +467,8 @@ class ActiveInstance(value.ValueBase):
     def getSubnetOutputACP(self, itemList):
         """Get or make an active connection point in the subnet output.
 
-           It is assumed project.networkLock is locked when using this
+           It is assumed the network lock of this instance's network
+           (see ActiveNetwork.getNetworkLock()) is locked when using this
            function."""
         val=self.subnetOutputVal.getCreateSubValue(itemList)
         if val is None:
@@ -495,6 +515,7 @@ class ActiveInstance(value.ValueBase):
         """Remove a task from the list"""
         with self.inputLock:
            self.tasks.remove(task)
+        self.markChanged()
 
     def handleTaskOutput(self, sourceTag, seqNr, output, subnetOutput,
                          warnMsg):
@@ -555,6 +576,7 @@ class ActiveInstance(value.ValueBase):
         self.outputVal.setUpdated(False)
         self.subnetOutputVal.setUpdated(False)
         self.msg.setWarning(warnMsg)
+        self.markChanged()
 
     def handleNewInput(self, sourceTag, seqNr, noNewTasks=False):
         """Process new input based on the changing of values.
@@ -568,7 +590,9 @@ class ActiveInstance(value.ValueBase):
 
            NOTE: If sourceAI is None, this function assumes that there is
                  some global lock preventing concurrent updates, and
-                 that it is locked. This normally is project.networkLock.
+                 that it is locked. This normally is the network lock of
+                 this instance's network, which transactions hold for all
+                 the active instances whose input they handle.
            """
         #log.debug("handleNewInput in %s: %s"%(self.getCanonicalName(),
         #                                      sourceTag))
@@ -596,6 +620,8 @@ class ActiveInstance(value.ValueBase):
                                                     sourceTag, True)
             # now merge it with whether we should already update
             self.updated = self.updated or (upd1 or upd2)
+            if upd1 or upd2:
+                self.markChanged()
             if noNewTasks:
                 # don't set updated flag if it's not needed; noNewTasks
                 # is true when reading in current state, and setting updated
@@ -635,12 +661,13 @@ class ActiveInstance(value.ValueBase):
 
            NOTE: This function assumes that self.outputLock is locked and
                  that there is some global lock preventing concurrent updates,
-                 and that it is locked. This normally is project.networkLock.
+                 and that it is locked. This normally is the network lock of
+                 this instance's network.
            """
         #log.debug("%s: Processing new connections"%(self.getCanonicalName()))
         # regenerate the output listeners' list of connected active
-        # instances and other listeners. We rely on a global network
-        # update lock to prevent multiple threads from adding connections
+        # instances and other listeners. We rely on the network locks
+        # to prevent multiple threads from adding connections
         # concurrently.
         listeners=[]
         self.outputVal.findListeners(listeners)
@@ -678,7 +705,7 @@ class ActiveInstance(value.ValueBase):
            This function assumes that there is some kind of lock between
            setNamedInput() and handleNewInput() so that no network-wide update
            from another source can take place in the mean time.
-           Normally, this is project.networkLock
+           Normally, this is the network lock of this instance's network.
           """
         #log.debug("3 - Marking update for %s"%newVal.getFullName())
         newVal.markUpdated(True)
@@ -720,6 +747,8 @@ class ActiveInstance(value.ValueBase):
                 for task in self.tasks:
                     task.activateCommands()
                 self._reactivate()
+        if changed:
+            self.markChanged()
         return changed
 
 
@@ -737,6 +766,8 @@ class ActiveInstance(value.ValueBase):
                     self.state=ActiveInstance.held
                     for task in self.tasks:
                         task.deactivateCommands()
+        if changed:
+            self.markChanged()
         return changed
 
     def unblock(self):
@@ -752,6 +783,8 @@ class ActiveInstance(value.ValueBase):
                     changed=True
             if changed:
                 self._reactivate()
+        if changed:
+            self.markChanged()
 
     def _reactivate(self):
         """Check for new inputs, and run if there are any."""
@@ -764,6 +797,7 @@ class ActiveInstance(value.ValueBase):
         """Cancel all tasks (and commands) with sequence number before
            the given seqNr.
            Returns a list of cancelled commands."""
+        changed=False
         with self.lock:
             tsk=copy.copy(self.tasks)
             ret=[]
@@ -774,7 +808,10 @@ class ActiveInstance(value.ValueBase):
                         ret.extend(cmds)
                     task.cancel()
                     self.tasks.remove(task)
-            return ret
+                    changed=True
+        if changed:
+            self.markChanged()
+        return ret
 
     def _canRun(self):
         """Whether all inputs are there for the instance to be run.
@@ -792,8 +829,10 @@ class ActiveInstance(value.ValueBase):
         # prepare inputs
         log.debug("Generating task for %s (of fn %s)"%
                   (self.getCanonicalName(), self.function.getName()))
-        inputs=value.Value(self.inputVal, self.inputVal.type)
-        subnetInputs=value.Value(self.subnetInputVal, self.subnetInputVal.type)
+        # the task gets read-only snapshots of the inputs; these share all
+        # sub-values that haven't changed since the previous task.
+        inputs=self.inputVal.getSnapshot()
+        subnetInputs=self.subnetInputVal.getSnapshot()
         # reset the status of the inputs, subnetInputs
         self.inputVal.setUpdated(False)
         self.subnetInputVal.setUpdated(False)
@@ -819,8 +858,7 @@ class ActiveInstance(value.ValueBase):
             outputs=value.Value(self.subnetOutputVal, self.outputVal.type)
         subnetOutputs=None
         if self.function.accessSubnetOutputs():
-            subnetOutputs=value.Value(self.subnetOutputVal,
-                                      self.subnetOutputVal.type)
+            subnetOutputs=self.subnetOutputVal.getSnapshot()
         fnInput=run.FunctionRunInput(inputs, subnetInputs,
                                      outputs, subnetOutputs,
                                      outputDirName, self.persDir,
@@ -831,6 +869,7 @@ class ActiveInstance(value.ValueBase):
         self.activeNetwork.taskQueue.put(tsk)
         self.tasks.append(tsk)
         self.updated=False
+        self.markChanged()
 
     def addTask(self, tsk):
         """Append an existing task to the task list. Useful for reading in"""
@@ -851,12 +890,14 @@ class ActiveInstance(value.ValueBase):
                 log.error(u"Instance %s (fn %s): %s"%(self.instance.getName(),
                                                       self.function.getName(),
                                                       self.msg.getError()))
+        self.markChanged()
 
 
     def setWarning(self, msg):
         """Set warning message."""
         with self.lock:
             self.msg.setWarning(msg)
+        self.markChanged()
 
     def rerun(self, recursive, clearError, outf=None):
         """Force the rerun of this instance, or clear the error if in error
@@ -915,10 +956,12 @@ class ActiveInstance(value.ValueBase):
                     self._genTask()
                 else:
                     log.debug("Cannot do rerun on %s"%self.getCanonicalName())
+                self.markChanged()
         return ret
 
-    def writeXML(self, outf, indent=0):
-        """write out values as xml."""
+    def writeXML(self, outf, indent=0, writeSubnet=True):
+        """write out values as xml. If writeSubnet is False, the subnet
+           is left out."""
         indstr=cpc.util.indStr*indent
         iindstr=cpc.util.indStr*(indent+1)
         with self.lock:
@@ -951,7 +994,7 @@ class ActiveInstance(value.ValueBase):
             self.subnetOutputVal.writeContentsXML(outf, indent+2)
             outf.write('%s</subnet-outputs>\n'%(iindstr))
 
-            if self.subnet is not None:
+            if writeSubnet and self.subnet is not None:
                 self.subnet.writeXML(outf, indent+1)
             if len(self.tasks) > 0:
                 outf.write('%s<tasks>\n'%iindstr)
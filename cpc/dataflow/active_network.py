@@ -66,6 +66,14 @@ class ActiveNetwork(network.Network):
         self.lock=threading.Lock()
         # and a global lock to prevent concurrent network mutations
         self.networkLock=networkLock
+        # the order in which network locks are locked: the lockOrder values
+        # of the instances on the path from the top-level network. Sorting by
+        # it locks parent networks before their subnetworks.
+        if inActiveInstance is None:
+            self.lockOrder=(0,)
+        else:
+            self.lockOrder=(inActiveInstance.activeNetwork.lockOrder +
+                            (inActiveInstance.lockOrder,))
         # add self
         if inActiveInstance is not None:
             instCopy=inActiveInstance.instance.copy()
@@ -123,7 +131,8 @@ class ActiveNetwork(network.Network):
         return self.inActiveInstance
 
     def getNetworkLock(self):
-        """Get the global network lock assigned to this active network."""
+        """Get the network lock assigned to this active network. Transactions
+           that change the network's connectivity hold this lock."""
         return self.networkLock
 
     def addInstance(self, inst):
@@ -139,6 +148,8 @@ class ActiveNetwork(network.Network):
             log.debug("Adding active instance %s"%ai.name)
             self.activeInstances[name]=ai
             network.Network.addInstance(self, inst)
+        if not inst.isImplicit():
+            self.project.networkChanged(self, inst)
         return ai
 
     #def removeInstance(self, instance):
@@ -373,6 +384,8 @@ class ActiveNetwork(network.Network):
                 #          (conn.dstAcp.value.getFullName(), val.value))
                 conn.dstAcp.update(val, sourceTag, None)
                 conn.dstAcp.propagate(sourceTag, None)
+        if not conn.isImplicit():
+            self.project.networkChanged(self, conn)
 
     def activateAll(self):
         """Activate all activeinstances in this network, starting them."""
@@ -103,8 +103,10 @@ class ActiveValue(value.Value):
                                  (self.getFullName(),
                                   self.basetype.getName(),
                                   srcVal.basetype.getName()))
+        self._invalidate()
         self.sourceTag=sourceTag
         if resetSourceTag:
+            srcVal._invalidate()
             srcVal.sourceTag=None
         #log.debug("Updating new value for %s: %s."% (self.getFullName(),
         #                                             self.sourceTag))
@@ -182,6 +184,7 @@ class ActiveValue(value.Value):
            cnst = whether it should be constant."""
         if self.type.isSubtype(vtype.recordType):
             self.type.addMember(name, tp, opt, cnst)
+            self._invalidate()
             self.value[name]=self._create(None, tp, name, None)
         else:
             raise ActiveValError("Tried to add member to non-list value")
@@ -238,6 +241,7 @@ class ActiveValue(value.Value):
                                         "Unknown base type for dict: %s"%
                                         (self.getFullName()) )
 
+                        self._invalidate()
                         self.value[name]=nv
                         ret=True
         elif isinstance(self.value, list):
@@ -264,6 +268,7 @@ class ActiveValue(value.Value):
                                 srct=None
                             nv=self._create(None, self.type.getMembers(), j,
                                             srct)
+                            self._invalidate()
                             self.value.append(nv)
                             j+=1
                         nv.update(val, val.seqNr, sourceTag,
@@ -275,6 +280,7 @@ class ActiveValue(value.Value):
 
     def setSourceTag(self, sourceTag):
         """Force the source tag to a certain value."""
+        self._invalidate()
         self.sourceTag=sourceTag
 
     def findListeners(self, listeners, omitSelf=None):
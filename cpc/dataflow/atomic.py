@@ -31,6 +31,7 @@ import apperror
 import function
 import run
 import network_function
+import controller_pool
 
 
 log=logging.getLogger(__name__)
@@ -68,6 +69,7 @@ class SimpleFunctionFunction(AtomicFunction):
            value = its value """
         AtomicFunction.__init__(self, name, lib)
         self.pyFunction=pyFunction
+        self.pyFunctionName=None
         self.pyImport=None
 
     def setFunction(self, pyFunctionName, importName=None):
@@ -105,11 +107,31 @@ class SimpleFunctionFunction(AtomicFunction):
         outFile.write('%s</function>\n'%indstr)
 
     def run(self, fnInputs):
-        """run this function, based on a list of input values."""
+        """run this function, based on a list of input values. CPU-bound
+           controllers are run in the controller process pool, if there is
+           one."""
+        if ( self.cpuBound and self.pyFunctionName is not None and
+             controller_pool.hasPool() ):
+            controller_pool.runInPool(self, fnInputs)
+        else:
+            self.runController(fnInputs)
+
+    def runController(self, fnInputs, inputNames=None):
+        """Call the controller function in this process.
+
+           inputNames = the names of the inputs, if the inputs have been
+                        read in without their type (in a controller
+                        process)."""
         inp=dict()
+        if inputNames is None:
+            inputNames=fnInputs.inputs.getSubValueIterList()
         #for name, val in fnInputs.inputs.iteritems():
-        for name in fnInputs.inputs.getSubValueIterList():
-            inp[str(name)] = fnInputs.inputs.getSubValue(name).value
+        for name in inputNames:
+            val=fnInputs.inputs.getSubValue([name])
+            if val is not None:
+                inp[str(name)] = val.value
+            else:
+                inp[str(name)] = None
         if fnInputs.outputDir is not None:
             inp["_outputDir"] = fnInputs.outputDir
         log.debug(str(inp))
@@ -143,6 +165,8 @@ class ExtendedFunctionFunction(SimpleFunctionFunction):
         """
         AtomicFunction.__init__(self, name, lib)
         self.pyFunction=pyFunction
+        self.pyFunctionName=None
+        self.pyImport=None
 
     def writeXML(self, outFile, indent=0):
         indstr=cpc.util.indStr*indent
@@ -177,9 +201,9 @@ class ExtendedFunctionFunction(SimpleFunctionFunction):
             self.stateMsg=fo.getvalue()
             self.state=function.Function.error
 
-    def run(self, fnInputs):
-        """run this function, based on a list of input values, and the run 
-            directory."""
+    def runController(self, fnInputs, inputNames=None):
+        """Call the controller function in this process, based on a list of
+           input values, and the run directory. inputNames is not used."""
         #log.debug("Basedir=%s"%(fnInputs.getBaseDir()))
         self.pyFunction(fnInputs)
         #return self.pyFunction(fnInputs)
@@ -0,0 +1,345 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Persistent interpreter processes for python external controllers.
+
+   Normally, an external function's controller is started as a new process
+   for every task. Python controllers that opt in with
+   persistent_process="true" in their controller tag are instead run in a
+   long-lived python process that is kept for each library, so that the
+   modules they import (cpc, numpy, the library's own modules) are only
+   imported once.
+
+   The server and a host process talk over the host's stdin and stdout
+   with a simple framed protocol: each frame is a line with the length of
+   its contents, followed by the contents. A request consists of a JSON
+   header frame (the script and working directory) and the input XML; the
+   reply is a JSON header frame (the return code), the script's stdout and
+   everything written to stderr or the standard file descriptors.
+
+   A host process that dies, or that runs a task for longer than the
+   configured timeout, only fails the task it was running; a host is
+   replaced with a new one after a configurable number of tasks, to limit
+   the effect of any state the controllers leave behind. The working
+   directory, environment variables and the sys module's streams, argv and
+   path are restored after each task."""
+
+import json
+import logging
+import os
+import runpy
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+import apperror
+
+
+log=logging.getLogger(__name__)
+
+class ControllerHostError(apperror.ApplicationError):
+    pass
+
+
+def writeFrame(outf, data):
+    """Write a frame with data (a string) to the file object outf."""
+    outf.write("%d\n"%len(data))
+    outf.write(data)
+
+def readFrame(inf):
+    """Read a frame from the file object inf.
+
+       Returns the frame contents, or None if the stream has ended."""
+    line=inf.readline()
+    if line == "":
+        return None
+    try:
+        size=int(line)
+    except ValueError:
+        raise ControllerHostError("Malformed frame header '%s'"%line.strip())
+    data=inf.read(size)
+    if len(data) != size:
+        raise ControllerHostError("Truncated frame")
+    return data
+
+
+def isPythonScript(filename):
+    """Check whether a controller executable is a python script, which can
+       be run in a host process."""
+    if filename.endswith('.py'):
+        return True
+    try:
+        inf=open(filename, 'r')
+        try:
+            line=inf.readline(256)
+        finally:
+            inf.close()
+    except IOError:
+        return False
+    return line.startswith('#!') and line.find('python') >= 0
+
+
+class ControllerHost(object):
+    """The server side of a persistent controller process."""
+    def __init__(self, lib):
+        """Start a new host process.
+
+           lib = the name of the library the process is for"""
+        self.lib=lib
+        self.nTasks=0
+        self.timedOut=False
+        # the host process must be able to import cpc.
+        env=dict(os.environ)
+        topDir=os.path.dirname(os.path.dirname(os.path.dirname(
+                                            os.path.abspath(__file__))))
+        pythonPath=env.get('PYTHONPATH')
+        if pythonPath:
+            env['PYTHONPATH']=os.pathsep.join([topDir, pythonPath])
+        else:
+            env['PYTHONPATH']=topDir
+        self.proc=subprocess.Popen([sys.executable, '-m',
+                                    'cpc.dataflow.controller_host'],
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   close_fds=True, env=env)
+        log.debug("Started controller process %d for %s"%(self.proc.pid,
+                                                            lib))
+
+    def run(self, script, cwd, inputXML, timeout=0):
+        """Run a controller script in the host process.
+
+           script = the full path of the controller script
+           cwd = the working directory for the controller, or None
+           inputXML = the controller's input
+           timeout = the max. time in seconds the script may run, or 0 for
+                     no limit. The host process is killed when it runs out.
+
+           Returns a tuple of the return code, stdout and stderr output, like
+           a controller that runs as a separate process."""
+        timer=None
+        if timeout > 0:
+            timer=threading.Timer(timeout, self._expire)
+            timer.daemon=True
+            timer.start()
+        try:
+            writeFrame(self.proc.stdin, json.dumps({ 'script' : script,
+                                                     'cwd' : cwd }))
+            writeFrame(self.proc.stdin, inputXML)
+            self.proc.stdin.flush()
+            header=readFrame(self.proc.stdout)
+            retstdout=readFrame(self.proc.stdout)
+            retstderr=readFrame(self.proc.stdout)
+        except (IOError, OSError) as e:
+            raise ControllerHostError("Lost controller process for %s: %s"%
+                                      (self.lib, str(e)))
+        finally:
+            if timer is not None:
+                timer.cancel()
+        if self.timedOut:
+            raise ControllerHostError("Controller process for %s timed out "
+                                      "after %d s"%(self.lib, timeout))
+        if header is None or retstdout is None or retstderr is None:
+            raise ControllerHostError("Controller process for %s died"%
+                                      self.lib)
+        self.nTasks+=1
+        return (json.loads(header)['returncode'], retstdout, retstderr)
+
+    def close(self):
+        """Stop the host process: it ends when its input is closed."""
+        try:
+            self.proc.stdin.close()
+            self.proc.wait()
+        except (IOError, OSError):
+            pass
+
+    def _expire(self):
+        self.timedOut=True
+        self.kill()
+
+    def kill(self):
+        """Kill the host process after an error."""
+        try:
+            self.proc.kill()
+            self.proc.wait()
+        except OSError:
+            pass
+
+
+# the idle host processes, as a dict of lists indexed by library name.
+_idleHosts=dict()
+_hostLock=threading.Lock()
+# the number of tasks after which a host process is replaced. 0 means that
+# no host processes are used.
+_maxTasks=0
+# the max. time in seconds a task may take in a host process; 0 means no
+# limit.
+_timeout=0
+
+def setMaxTasks(maxTasks):
+    """Set the number of tasks a host process runs before it is replaced.
+       If 0, controllers always run as separate processes."""
+    global _maxTasks
+    with _hostLock:
+        _maxTasks=maxTasks
+
+def setTimeout(timeout):
+    """Set the max. time in seconds a task may take in a host process. If 0,
+       there is no limit."""
+    global _timeout
+    with _hostLock:
+        _timeout=timeout
+
+def enabled():
+    """Check whether host processes are used."""
+    with _hostLock:
+        return _maxTasks > 0
+
+def run(lib, script, cwd, inputXML):
+    """Run a controller script in an idle host process for a library, or a
+       new one if there is none.
+
+       lib = the name of the controller's library
+       script = the full path of the controller script
+       cwd = the working directory for the controller, or None
+       inputXML = the controller's input
+
+       Returns a tuple of the return code, stdout and stderr output."""
+    host=None
+    with _hostLock:
+        idle=_idleHosts.get(lib)
+        if idle:
+            host=idle.pop()
+        timeout=_timeout
+    if host is None:
+        host=ControllerHost(lib)
+    try:
+        ret=host.run(script, cwd, inputXML, timeout)
+    except ControllerHostError as e:
+        log.error(str(e))
+        host.kill()
+        return (1, "", str(e))
+    with _hostLock:
+        if _maxTasks > 0 and host.nTasks < _maxTasks:
+            _idleHosts.setdefault(lib, []).append(host)
+            host=None
+    if host is not None:
+        log.debug("Replacing controller process for %s after %d tasks"%
+                  (lib, host.nTasks))
+        host.close()
+    return ret
+
+def stopHosts():
+    """Stop all idle host processes."""
+    global _idleHosts
+    with _hostLock:
+        idleHosts=_idleHosts
+        _idleHosts=dict()
+    for hosts in idleHosts.itervalues():
+        for host in hosts:
+            host.close()
+
+
+def _runScript(script, cwd, inputXML):
+    """The host process side of ControllerHost.run(): run a controller
+       script as if it were a new process.
+
+       Returns a tuple of the return code, stdout and stderr output."""
+    logf=tempfile.TemporaryFile()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # anything written to the standard file descriptors, including the
+    # output of sub-processes, is returned as stderr output.
+    savedFds=(os.dup(1), os.dup(2))
+    os.dup2(logf.fileno(), 1)
+    os.dup2(logf.fileno(), 2)
+    savedState=(sys.stdin, sys.stdout, list(sys.argv), list(sys.path),
+                os.getcwd())
+    # controllers set environment variables for the programs they run,
+    # such as OMP_NUM_THREADS.
+    savedEnv=dict(os.environ)
+    sys.stdin=StringIO(inputXML)
+    sys.stdout=StringIO()
+    sys.argv=[script]
+    sys.path.insert(0, os.path.dirname(script))
+    returncode=0
+    try:
+        if cwd is not None:
+            os.chdir(cwd)
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        if e.code is None:
+            returncode=0
+        elif isinstance(e.code, int):
+            returncode=e.code
+        else:
+            sys.stderr.write("%s\n"%str(e.code))
+            returncode=1
+    except:
+        traceback.print_exception(sys.exc_info()[0], sys.exc_info()[1],
+                                  sys.exc_info()[2], file=sys.stderr)
+        returncode=1
+    retstdout=sys.stdout.getvalue()
+    sys.stderr.flush()
+    (sys.stdin, sys.stdout, sys.argv, sys.path, oldCwd)=savedState
+    os.chdir(oldCwd)
+    os.environ.clear()
+    os.environ.update(savedEnv)
+    os.dup2(savedFds[0], 1)
+    os.dup2(savedFds[1], 2)
+    os.close(savedFds[0])
+    os.close(savedFds[1])
+    logf.seek(0)
+    retstderr=logf.read()
+    logf.close()
+    return (returncode, retstdout, retstderr)
+
+def _hostLoop():
+    """The main loop of a host process."""
+    # the protocol streams are the original stdin and stdout; controllers
+    # can't read from the real stdin.
+    inf=os.fdopen(os.dup(0), 'rb')
+    outf=os.fdopen(os.dup(1), 'wb')
+    devnull=os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    while True:
+        header=readFrame(inf)
+        if header is None:
+            break
+        request=json.loads(header)
+        inputXML=readFrame(inf)
+        if inputXML is None:
+            break
+        (returncode, retstdout, retstderr)=_runScript(request['script'],
+                                                      request['cwd'],
+                                                      inputXML)
+        writeFrame(outf, json.dumps({ 'returncode' : returncode }))
+        writeFrame(outf, retstdout)
+        writeFrame(outf, retstderr)
+        outf.flush()
+
+
+if __name__ == "__main__":
+    _hostLoop()
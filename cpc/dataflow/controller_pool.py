@@ -0,0 +1,133 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""A pool of processes to run CPU-bound python controller functions in, so
+   that they don't hold up the rest of the server.
+
+   Functions opt in with cpu_bound="true" in their controller tag. Their
+   run input is serialized to XML in the same way as for external
+   functions, the controller is called in a pool process, and its run
+   output is serialized back and read into the task's transaction, which is
+   then committed in the server as usual."""
+
+import logging
+import multiprocessing
+import threading
+import traceback
+import sys
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+import apperror
+import run
+
+
+log=logging.getLogger(__name__)
+
+class ControllerPoolError(apperror.ApplicationError):
+    pass
+
+
+_pool=None
+_poolLock=threading.Lock()
+
+def startPool(nProcesses):
+    """Start the controller process pool. This should be done before any
+       other threads are started, so the pool processes don't inherit locks
+       held by them.
+
+       nProcesses = the number of processes; if 0, no pool is started and
+                    all controllers run in the server process."""
+    global _pool
+    with _poolLock:
+        if _pool is None and nProcesses > 0:
+            log.info("Starting %d controller processes"%nProcesses)
+            if threading.activeCount() > 1:
+                log.warning("Controller processes started with %d threads "
+                            "running"%threading.activeCount())
+            _pool=multiprocessing.Pool(nProcesses)
+
+def stopPool():
+    """Stop the controller process pool."""
+    global _pool
+    with _poolLock:
+        if _pool is not None:
+            _pool.terminate()
+            _pool=None
+
+def hasPool():
+    """Check whether there is a controller process pool."""
+    with _poolLock:
+        return _pool is not None
+
+def runInPool(function, fnInput):
+    """Run a python controller function in the process pool. Blocks until
+       the controller has finished. The output is added to the function
+       output object of fnInput.
+
+       function = the SimpleFunctionFunction or ExtendedFunctionFunction
+       fnInput = the FunctionRunInput object"""
+    with _poolLock:
+        pool=_pool
+    if pool is None:
+        raise ControllerPoolError("No controller process pool")
+    inf=StringIO()
+    fnInput.writeRunXML(inf)
+    # the input types don't survive serialization, so the input names
+    # are passed separately.
+    inputNames=list(fnInput.inputs.getSubValueIterList())
+    (ok, ret)=pool.apply(_poolRun, (function.__class__.__name__,
+                                    function.getName(),
+                                    function.pyFunctionName,
+                                    function.pyImport,
+                                    inputNames,
+                                    inf.getvalue()))
+    if not ok:
+        raise ControllerPoolError("Error running %s in controller process: "
+                                  "%s"%(function.getName(), ret))
+    reader=run.IOReader(None, fnInput.getFunctionOutput())
+    reader.read(StringIO(ret), function.getName())
+
+
+def _poolRun(className, name, pyFunctionName, pyImport, inputNames,
+             inputXML):
+    """The pool process side of runInPool(): read the input, run the
+       controller and return a tuple of whether the run succeeded and the
+       output XML (or the error)."""
+    try:
+        # imported here to avoid a circular import.
+        import atomic
+        fnClass=getattr(atomic, className)
+        fn=fnClass(name)
+        fn.setFunction(pyFunctionName, pyImport)
+        if fn.getState() == fn.error:
+            return (False, fn.getStateMsg())
+        inp=run.readInput(StringIO(inputXML), name)
+        fn.runController(inp, inputNames)
+        outf=StringIO()
+        inp.getFunctionOutput().writeXML(outf)
+        return (True, outf.getvalue())
+    except:
+        fo=StringIO()
+        traceback.print_exception(sys.exc_info()[0], sys.exc_info()[1],
+                                  sys.exc_info()[2], file=fo)
+        return (False, fo.getvalue())
+
@@ -32,6 +32,7 @@ import apperror
 import function
 import run
 import atomic
+import controller_host
 
 
 log=logging.getLogger(__name__)
@@ -42,7 +43,10 @@ class ExternalFunctionError(apperror.ApplicationError):
 class ExternalFunction(atomic.AtomicFunction):
     """A function that has a controller that is an external command that
        can be called directly. The communication happens through XML 
-       to stdin, and reading XML from stdout."""
+       to stdin, and reading XML from stdout.
+
+       Python controllers that allow it are run in a persistent process
+       (see controller_host)."""
     def __init__(self, name, lib=None, controllerExec=None, basedir=None):
         """Initializes the function.
         """
@@ -115,6 +119,12 @@ class ExternalFunction(atomic.AtomicFunction):
 
         log.log(cpc.util.log.TRACE,outs.getvalue())
 
+        if self._usePersistentProcess():
+            ret=controller_host.run(self._getLibName(), self.fullpath,
+                                    inp.getOutputDir(), outs.getvalue())
+            outs.close()
+            return ret
+
         proc=subprocess.Popen(nargs,
                               stdin=subprocess.PIPE,
                               stdout=subprocess.PIPE,
@@ -126,6 +136,25 @@ class ExternalFunction(atomic.AtomicFunction):
         outs.close()
         return proc.returncode, retst[0], retst[1]
 
+    def _usePersistentProcess(self):
+        """Check whether the controller runs in a persistent process."""
+        if not (self.persistentProcess and controller_host.enabled()):
+            return False
+        try:
+            return self.pythonScript
+        except AttributeError:
+            self.pythonScript=controller_host.isPythonScript(self.fullpath)
+            if not self.pythonScript:
+                log.info("Controller %s is not a python script; not running "
+                         "it in a persistent process"%self.fullpath)
+            return self.pythonScript
+
+    def _getLibName(self):
+        """Get the name of the library for the persistent process."""
+        if self.lib is None:
+            return ""
+        return self.lib.getName()
+
     def run(self, inp):
         # run
         returncode, retstdout, retstderr=self._run(inp)
@@ -0,0 +1,289 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""A content-addressed store of a project's files.
+
+   Projects keep many identical files: the same run input files, topology
+   fragments and final coordinates are copied into the directories of
+   successive runs and outputs. With the file store, the files that are
+   referenced by values are kept once, as blobs named by their SHA1 hash
+   under the project's _file_store directory; the file names that values
+   refer to are hard links to these blobs.
+
+   Files are hashed and linked by a background thread, so that the
+   threads that bring files into use (typically while holding the dataflow
+   locks) don't wait for the hashing. Because the server reads its projects
+   before it forks, these threads are only started once startThreads() has
+   been called; until then, files are just queued.
+
+   A stored file and its blob are the same inode, so their permissions are
+   left as they are: making the blob read-only would make the project's own
+   file read-only too, and copies made with shutil.copy would inherit
+   that. Stored files must however be replaced (removed, or renamed over),
+   not rewritten in place, because an in-place write changes all files
+   with the same contents. The controllers write their outputs as new
+   files in new run and output directories; trajparts.linkFile() replaces
+   existing files. Blobs are removed when the last file linked to them is no
+   longer in use. The store's index of file names and their hashes is kept
+   in an append-only file, so this survives server restarts; the index is
+   checked against the files on disk when it is read in."""
+
+import os
+import stat
+import threading
+import Queue
+import weakref
+import logging
+
+from cpc.command.bundle import getFileHash
+
+
+log=logging.getLogger(__name__)
+
+
+# the name of the store directory, relative to the project directory
+storeDirName="_file_store"
+# the name of the index file in the store directory
+indexName="index"
+# the min. size of files to store: smaller files aren't worth the hashing.
+minStoreSize=4096
+
+# the file stores, and whether they may start their threads
+_stores=weakref.WeakSet()
+_threadsStarted=False
+_storesLock=threading.Lock()
+
+
+def startThreads():
+    """Start the threads of all file stores with queued files, and allow
+       stores to start their threads from now on. The server calls this once
+       it has forked, because threads don't survive a fork."""
+    global _threadsStarted
+    with _storesLock:
+        _threadsStarted=True
+        for store in list(_stores):
+            store._startThread()
+
+
+class FileStore(object):
+    """A project's content-addressed file store. Files are added by their
+       name relative to the project directory."""
+    def __init__(self, projectRoot):
+        """Initialize the file store of a project, reading its index if there
+           is one.
+
+           projectRoot = the project directory"""
+        self.root=projectRoot
+        self.dir=os.path.join(projectRoot, storeDirName)
+        self.indexFilename=os.path.join(self.dir, indexName)
+        self.lock=threading.Lock()
+        # the content hashes of the stored files, by file name
+        self.hashes=dict()
+        # the number of stored files linked to each blob, by content hash
+        self.refs=dict()
+        # the names of the files waiting to be stored, the queue they wait
+        # in, and the thread that stores them
+        self.pending=set()
+        self.queue=Queue.Queue()
+        self.thread=None
+        if not os.path.exists(self.dir):
+            os.mkdir(self.dir)
+        self._readIndex()
+        with _storesLock:
+            _stores.add(self)
+
+    def _blobPath(self, contentHash):
+        return os.path.join(self.dir, contentHash[:2], contentHash)
+
+    def _isLinked(self, filename, contentHash):
+        """Check whether a file is (still) a link to a blob."""
+        try:
+            return os.path.samefile(os.path.join(self.root, filename),
+                                    self._blobPath(contentHash))
+        except OSError:
+            return False
+
+    def _readIndex(self):
+        """Read the index, check it against the files on disk, remove the
+           blobs that are no longer used, and write out a compacted index."""
+        if os.path.exists(self.indexFilename):
+            inf=open(self.indexFilename, 'r')
+            try:
+                for line in inf:
+                    spl=line.rstrip('\n').split(' ', 2)
+                    if spl[0] == 'add' and len(spl) == 3:
+                        self.hashes[spl[2]]=spl[1]
+                    elif spl[0] == 'rm' and len(spl) == 2:
+                        self.hashes.pop(spl[1], None)
+            finally:
+                inf.close()
+        for filename, contentHash in self.hashes.items():
+            if self._isLinked(filename, contentHash):
+                self.refs[contentHash]=self.refs.get(contentHash, 0)+1
+            else:
+                log.debug("Stored file %s has been removed or replaced"%
+                          filename)
+                del self.hashes[filename]
+        # remove the blobs without files
+        for subdir in os.listdir(self.dir):
+            path=os.path.join(self.dir, subdir)
+            if not os.path.isdir(path):
+                continue
+            for contentHash in os.listdir(path):
+                if contentHash not in self.refs:
+                    log.debug("Removing unused stored file %s"%contentHash)
+                    os.remove(os.path.join(path, contentHash))
+        nfname="%s.new"%self.indexFilename
+        outf=open(nfname, 'w')
+        for filename, contentHash in self.hashes.iteritems():
+            outf.write('add %s %s\n'%(contentHash, filename))
+        outf.close()
+        os.rename(nfname, self.indexFilename)
+
+    def _appendIndex(self, line):
+        outf=open(self.indexFilename, 'a')
+        try:
+            outf.write(line)
+        finally:
+            outf.close()
+
+    def add(self, filename):
+        """Queue a file to be added to the store. If a file with the same
+           contents is already stored, the file is replaced by a link to it.
+           This returns immediately: the file is hashed and linked by the
+           store's thread.
+
+           filename = the file name relative to the project directory. Files
+                      that don't exist, are outside the project directory or
+                      are smaller than minStoreSize are not stored."""
+        if (os.path.isabs(filename) or
+            os.path.normpath(filename).startswith("..")):
+            return
+        with self.lock:
+            if filename in self.pending:
+                return
+            self.pending.add(filename)
+        self.queue.put(filename)
+        with _storesLock:
+            if _threadsStarted:
+                self._startThread()
+
+    def _startThread(self):
+        """Start the store's thread if it isn't running yet. Assumes
+           _storesLock is held."""
+        with self.lock:
+            if self.thread is None:
+                self.thread=threading.Thread(target=self._storeThread,
+                                             name="file store")
+                # queued files are stored again when the project is loaded.
+                self.thread.daemon=True
+                self.thread.start()
+
+    def wait(self):
+        """Wait until all queued files have been stored. The store's thread
+           must be able to run: see startThreads()."""
+        self.queue.join()
+
+    def _storeThread(self):
+        while True:
+            filename=self.queue.get()
+            try:
+                self._store(filename)
+            except:
+                log.exception("Error storing %s"%filename)
+            finally:
+                self.queue.task_done()
+
+    def _store(self, filename):
+        """Store a queued file. Files that were removed from the store
+           while they were queued or hashed are not stored."""
+        path=os.path.join(self.root, filename)
+        try:
+            with self.lock:
+                if filename not in self.pending:
+                    return
+            st=os.lstat(path)
+            if not stat.S_ISREG(st.st_mode) or st.st_size < minStoreSize:
+                with self.lock:
+                    self.pending.discard(filename)
+                return
+            with self.lock:
+                contentHash=self.hashes.get(filename)
+                if contentHash is not None:
+                    if self._isLinked(filename, contentHash):
+                        self.pending.discard(filename)
+                        return
+                    self._remove(filename)
+            contentHash=getFileHash(path)
+            with self.lock:
+                if filename not in self.pending:
+                    return
+                self.pending.discard(filename)
+                # the file may have changed while it was being hashed.
+                nst=os.lstat(path)
+                if (nst.st_size, nst.st_mtime) != (st.st_size, st.st_mtime):
+                    return
+                if filename in self.hashes:
+                    return
+                blob=self._blobPath(contentHash)
+                if os.path.exists(blob):
+                    if not os.path.samefile(path, blob):
+                        tmpPath="%s.store"%path
+                        os.link(blob, tmpPath)
+                        os.rename(tmpPath, path)
+                else:
+                    blobDir=os.path.dirname(blob)
+                    if not os.path.exists(blobDir):
+                        os.mkdir(blobDir)
+                    os.link(path, blob)
+                self.hashes[filename]=contentHash
+                self.refs[contentHash]=self.refs.get(contentHash, 0)+1
+                self._appendIndex('add %s %s\n'%(contentHash, filename))
+        except (OSError, IOError) as e:
+            # the file just isn't deduplicated.
+            with self.lock:
+                self.pending.discard(filename)
+            log.info("Can't store %s: %s"%(filename, e.strerror))
+
+    def remove(self, filename):
+        """Remove a file from the store, because it is no longer in use. The
+           blob is removed if no other files are linked to it. The file
+           itself is left in place."""
+        with self.lock:
+            self.pending.discard(filename)
+            self._remove(filename)
+
+    def _remove(self, filename):
+        contentHash=self.hashes.pop(filename, None)
+        if contentHash is None:
+            return
+        self._appendIndex('rm %s\n'%filename)
+        self.refs[contentHash]-=1
+        if self.refs[contentHash] <= 0:
+            del self.refs[contentHash]
+            try:
+                os.remove(self._blobPath(contentHash))
+            except OSError:
+                pass
+
+    def getHash(self, filename):
+        """Get the content hash of a stored file, or None if the file isn't
+           stored."""
+        with self.lock:
+            return self.hashes.get(filename)
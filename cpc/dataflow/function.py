@@ -89,6 +89,11 @@ class Function(description.Describable):
         # it is executed
         self.taskAccessOutputs=False
         self.taskAccessSubnetOutputs=False
+        # whether the controller is CPU-bound, and should run outside the
+        # server process if possible.
+        self.cpuBound=False
+        # whether an external controller may run in a persistent process.
+        self.persistentProcess=False
         #self.importLib=None
         self.state=Function.ok
         self.stateMsg=""
@@ -219,6 +224,22 @@ class Function(description.Describable):
         """Return whether a persistance scratch storage directory is needed."""
         return self.persistentDir
 
+    def setCpuBound(self, val):
+        """Set whether the controller is CPU-bound."""
+        self.cpuBound=val
+    def isCpuBound(self):
+        """Return whether the controller is CPU-bound."""
+        return self.cpuBound
+
+    def setPersistentProcess(self, val):
+        """Set whether an external controller may run in a persistent
+           process."""
+        self.persistentProcess=val
+    def usesPersistentProcess(self):
+        """Return whether an external controller may run in a persistent
+           process."""
+        return self.persistentProcess
+
     def _writeInputOutputXML(self, outf, indent=0):
         """Describe the inputs and outputs"""
         indstr=cpc.util.indStr*indent
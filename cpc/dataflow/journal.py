@@ -0,0 +1,330 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+
+import logging
+import threading
+import os
+import xml.sax.saxutils
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+import cpc.util.rng
+import apperror
+import keywords
+
+
+log=logging.getLogger(__name__)
+
+class JournalError(apperror.ApplicationError):
+    pass
+
+
+# the tags that start and end a journal entry
+entryStart='<journal-entry>\n'
+entryEnd='</journal-entry>\n'
+
+class StateJournal(object):
+    """An append-only journal of the changes to a project's state, relative
+       to the last full state snapshot (_state.xml).
+
+       Changes are tracked on two levels:
+       - active instances whose own state (values, state, tasks and
+         commands) has changed since the last save. These are written out
+         in full, without their subnet.
+       - instances and connections that have been added to an active
+         network.
+       Each save appends one journal entry with these changes. Reading the
+       state back in consists of applying all entries to the snapshot
+       (see replay()). Changes that can't be expressed this way (such as
+       new imports) require a new snapshot.
+
+       The journal file starts with the ID of the snapshot it applies to;
+       the same ID is written into the snapshot. A journal that doesn't
+       match the snapshot (because writing a new snapshot was interrupted
+       after the snapshot itself was written) is ignored."""
+    def __init__(self, filename):
+        """Initialize an empty journal.
+
+           filename = the journal file name."""
+        self.filename=filename
+        self.lock=threading.Lock()
+        # the set of changed active instances
+        self.changedAIs=set()
+        # the list of (network path, xml string) tuples of new network items
+        self.networkItems=[]
+        # whether a new snapshot is needed
+        self.snapshotNeeded=True
+        # the number of entries written since the last snapshot
+        self.nEntries=0
+
+    def markChanged(self, activeInstance):
+        """Mark an active instance as changed."""
+        with self.lock:
+            self.changedAIs.add(activeInstance)
+
+    def addNetworkItem(self, activeNetwork, item):
+        """Record a new (explicit) instance or connection in a network.
+
+           activeNetwork = the active network the item was added to
+           item = the instance or connection object"""
+        co=StringIO()
+        item.writeXML(co, 0)
+        path=getNetworkPath(activeNetwork)
+        with self.lock:
+            self.networkItems.append( (path, co.getvalue()) )
+
+    def requireSnapshot(self):
+        """Mark that the next save must be a full snapshot."""
+        with self.lock:
+            self.snapshotNeeded=True
+
+    def needsSnapshot(self, maxEntries):
+        """Check whether the next save should be a full snapshot.
+
+           maxEntries = the max. number of journal entries between snapshots
+        """
+        with self.lock:
+            return (self.snapshotNeeded or
+                    self.nEntries >= maxEntries or
+                    not os.path.exists(self.filename))
+
+    def clearChanges(self):
+        """Forget all changes that haven't been written yet. Called after the
+           state has been read in."""
+        with self.lock:
+            self.changedAIs=set()
+            self.networkItems=[]
+
+    def startSnapshot(self):
+        """Start writing a new snapshot: all changes up to now will be in the
+           snapshot.
+
+           Returns the new snapshot ID to write into the snapshot."""
+        with self.lock:
+            self.changedAIs=set()
+            self.networkItems=[]
+            self.snapshotNeeded=False
+            self.nEntries=0
+        return cpc.util.rng.getRandomHash()
+
+    def finishSnapshot(self, snapshotID):
+        """Start a new, empty journal after a snapshot with ID snapshotID has
+           been written."""
+        nfname="%s.new"%self.filename
+        outf=open(nfname, 'w')
+        outf.write('<journal snapshot="%s"/>\n'%snapshotID)
+        outf.close()
+        os.rename(nfname, self.filename)
+
+    def collectEntry(self):
+        """Serialize all changes since the last entry into a new journal
+           entry. The changes are cleared.
+
+           Returns a tuple of the entry (or None if there are no changes) and
+           the number of changed active instances in it."""
+        with self.lock:
+            changedAIs=self.changedAIs
+            networkItems=self.networkItems
+            self.changedAIs=set()
+            self.networkItems=[]
+        if len(changedAIs) == 0 and len(networkItems) == 0:
+            return (None, 0)
+        # parents must come first, so new sub-instances can be found.
+        ais=[ (ai.getCanonicalName(), ai) for ai in changedAIs ]
+        ais.sort(key=lambda x: len(x[0].split(keywords.InstSep)))
+        co=StringIO()
+        co.write(entryStart)
+        for path, itemXML in networkItems:
+            co.write('<network-update path=%s>\n'%
+                     xml.sax.saxutils.quoteattr(path).encode('utf-8'))
+            co.write(itemXML)
+            co.write('</network-update>\n')
+        for path, ai in ais:
+            co.write('<active-update path=%s>\n'%
+                     xml.sax.saxutils.quoteattr(path).encode('utf-8'))
+            ai.writeXML(co, 1, writeSubnet=False)
+            co.write('</active-update>\n')
+        co.write(entryEnd)
+        return (co.getvalue(), len(ais))
+
+    def appendEntry(self, entry):
+        """Append an entry created with collectEntry() to the journal file."""
+        outf=open(self.filename, 'a')
+        try:
+            outf.write(entry)
+            outf.flush()
+            os.fsync(outf.fileno())
+        finally:
+            outf.close()
+        with self.lock:
+            self.nEntries+=1
+
+    def hasEntries(self):
+        """Check whether the journal file has any entries."""
+        if not os.path.exists(self.filename):
+            return False
+        (snapshotID, content)=self._read()
+        return content.find(entryEnd) >= 0
+
+    def replay(self, snapshotFilename):
+        """Apply the journal to a state snapshot file.
+
+           Returns a file object with the resulting state XML, or None if
+           the journal doesn't belong to the snapshot."""
+        (snapshotID, content)=self._read()
+        tree=ElementTree.parse(snapshotFilename)
+        root=tree.getroot()
+        if snapshotID is None or root.get('journal') != snapshotID:
+            log.info("Ignoring journal %s: it doesn't match snapshot %s"%
+                     (self.filename, snapshotFilename))
+            return None
+        topNet=root.find('network')
+        if topNet is None:
+            topNet=ElementTree.SubElement(root, 'network')
+        nEntries=0
+        for entry in self._parseEntries(content):
+            for update in entry:
+                path=update.get('path')
+                if update.tag == 'network-update':
+                    net=_findNetwork(topNet, path)
+                    for item in update:
+                        if item.tag == 'instance':
+                            _insertBefore(net, item, ('active', 'connection',
+                                                      'assign'))
+                        else:
+                            net.append(item)
+                elif update.tag == 'active-update':
+                    names=_splitPath(path)
+                    net=_findNetwork(topNet,
+                                     keywords.InstSep.join(names[:-1]))
+                    newActive=update.find('active')
+                    if newActive is None:
+                        raise JournalError("Empty active update for %s"%path)
+                    _replaceActive(net, names[-1], newActive)
+                else:
+                    raise JournalError("Unknown journal item %s"%update.tag)
+            nEntries+=1
+        log.info("Replayed %d journal entries from %s"%(nEntries,
+                                                         self.filename))
+        ret=StringIO()
+        tree.write(ret, encoding='utf-8')
+        ret.seek(0)
+        return ret
+
+    def _read(self):
+        """Read the journal file.
+
+           Returns a tuple of the snapshot ID and the remaining contents."""
+        inf=open(self.filename, 'r')
+        try:
+            header=inf.readline()
+            content=inf.read()
+        finally:
+            inf.close()
+        snapshotID=None
+        if header.startswith('<journal '):
+            snapshotID=ElementTree.fromstring(header).get('snapshot')
+        return (snapshotID, content)
+
+    def _parseEntries(self, content):
+        """Generator for the parsed journal entries. An incomplete last
+           entry (from an interrupted write) is ignored."""
+        pos=0
+        while True:
+            end=content.find(entryEnd, pos)
+            if end < 0:
+                if content[pos:].strip() != "":
+                    log.info("Ignoring incomplete journal entry in %s"%
+                             self.filename)
+                return
+            end+=len(entryEnd)
+            yield ElementTree.fromstring(content[pos:end])
+            pos=end
+
+
+def getNetworkPath(activeNetwork):
+    """Get the path of an active network: the canonical name of the active
+       instance it belongs to, or an empty string for the top level."""
+    parent=activeNetwork.getParentInstance()
+    if parent is None:
+        return ""
+    return parent.getCanonicalName()
+
+def _splitPath(path):
+    if path is None or path == "":
+        return []
+    return path.split(keywords.InstSep)
+
+def _insertBefore(parent, elem, tags):
+    """Insert an element before the first child with one of the tags, or
+       append it if there is no such child."""
+    for i, child in enumerate(list(parent)):
+        if child.tag in tags:
+            parent.insert(i, elem)
+            return
+    parent.append(elem)
+
+def _findActive(net, name, create):
+    """Find the active element with a name in a network element."""
+    for child in net.findall('active'):
+        if child.get('id') == name:
+            return child
+    if not create:
+        return None
+    # the active instance doesn't exist yet: it will be filled in by a
+    # later update in the same entry.
+    active=ElementTree.Element('active', { 'id' : name, 'state' : 'held',
+                                           'seqnr' : '0' })
+    _insertBefore(net, active, ('connection', 'assign'))
+    return active
+
+def _findNetwork(topNet, path):
+    """Find the network element for a network path, creating any missing
+       elements."""
+    net=topNet
+    for name in _splitPath(path):
+        active=_findActive(net, name, True)
+        subnet=active.find('network')
+        if subnet is None:
+            subnet=ElementTree.Element('network')
+            _insertBefore(active, subnet, ('tasks',))
+        net=subnet
+    return net
+
+def _replaceActive(net, name, newActive):
+    """Replace the active element with a name in a network element by a new
+       one, retaining the old subnet."""
+    oldActive=_findActive(net, name, False)
+    if oldActive is None:
+        _insertBefore(net, newActive, ('connection', 'assign'))
+        return
+    subnet=oldActive.find('network')
+    if subnet is not None:
+        _insertBefore(newActive, subnet, ('tasks',))
+    children=list(net)
+    net.remove(oldActive)
+    net.insert(children.index(oldActive), newActive)
@@ -21,6 +21,7 @@
 import logging
 import threading
 import os
+import time
 
 try:
     from cStringIO import StringIO
@@ -36,6 +37,7 @@ except:
     profile=False
 
 import cpc.util
+import cpc.util.rwlock
 import apperror
 import keywords
 import instance
@@ -48,6 +50,8 @@ import task
 import transaction
 import lib
 import readxml
+import journal
+import file_store
 from cpc.dataflow.value import ValError
 
 log=logging.getLogger(__name__)
@@ -66,11 +70,11 @@ class Project(object):
            basedir = the full (existing) base directory of the project
            queue = an optional shared task queue
         """
-        # The Update lock prevents multiple threads from updating values
-        # in the same project. This probably has less impact on performance
-        # than it sounds: Python is single-threaded at its core, and only
-        # emulates multithreading. Also: this would only be a problem if
-        # updating values & scheduling tasks is the rate-limiting step.
+        # The Update lock prevents multiple threads from updating the
+        # project's imports and top-level network at the same time. It is the
+        # network lock of the top-level network; subnetworks have their own
+        # network locks, so transactions in different subnetworks can
+        # proceed concurrently.
         self.updateLock=threading.RLock()
         self.conf=conf
         self.name=name
@@ -80,12 +84,26 @@ class Project(object):
         log.debug("Creating project %s"%name)
         if queue is None:
             log.debug("Creating new task queue %s"%name)
-            self.queue=task.TaskQueue()
+            self.queue=task.TaskQueue(cmdQueue)
         else:
             self.queue=queue
         self.cmdQueue=cmdQueue
-        # the file list
-        self.fileList=value.FileList(basedir)
+        # the file list, with its optional content-addressed file store
+        if conf.getProjectFileStore():
+            fileStore=file_store.FileStore(basedir)
+        else:
+            fileStore=None
+        self.fileList=value.FileList(basedir, fileStore)
+        # held shared by transactions, and exclusively while the state to
+        # save is collected.
+        self.stateLock=cpc.util.rwlock.ReadWriteLock()
+        # the lock wait and hold times of transactions
+        self.lockStats=transaction.LockStats()
+        # serializes state writes
+        self.stateWriteLock=threading.Lock()
+        # the journal of state changes since the last state snapshot
+        self.journal=journal.StateJournal(os.path.join(self.basedir,
+                                                       "_state.journal"))
         # create the active network (the top-level network)
         self.network=active_network.ActiveNetwork(self, None, self.queue,
                                                  "", self.updateLock)
@@ -148,6 +166,7 @@ class Project(object):
             if self.functions.has_key(name):
                 raise ProjectError("function with name %s already exists."%name)
             self.functions[name]=function
+            self.journal.requireSnapshot()
 
     def getImportList(self):
         """Get the function import list."""
@@ -447,7 +466,8 @@ class Project(object):
                 nm=net.inActiveInstance.getCanonicalName()
             #log.debug("net=%s, instanceName=%s"%(nm, instanceName))
             inst=instance.Instance(instanceName, func, functionName)
-            net.addInstance(inst)
+            with net.getNetworkLock():
+                net.addInstance(inst)
 
     def importTopLevelFile(self, fileObject, filename):
         """Read a source file as a top-level description."""
@@ -455,6 +475,7 @@ class Project(object):
             reader=readxml.ProjectXMLReader(self.topLevelImport, self.imports,
                                             self)
             reader.readFile(fileObject, filename)
+            self.journal.requireSnapshot()
 
     def importName(self, name):
         """Import a named module."""
@@ -482,6 +503,7 @@ class Project(object):
                 reader=readxml.ProjectXMLReader(newlib, self.imports, self)
                 reader.read(filename)
                 self.imports.add(newlib)
+                self.journal.requireSnapshot()
                 return newlib
             else:
                 return self.imports.get(name)
@@ -546,12 +568,17 @@ class Project(object):
         """Get the task queue."""
         return self.queue
 
-    def writeXML(self, outf, indent=0):
+    def writeXML(self, outf, indent=0, snapshotID=None):
         """Write the function definitions and top-level network description
-           in XML to outf."""
+           in XML to outf. If given, snapshotID is the ID of the state
+           snapshot that the journal applies to."""
         indstr=cpc.util.indStr*indent
         iindstr=cpc.util.indStr*(indent+1)
-        outf.write('%s<cpc version="%d">\n'%(indstr, readxml.curVersion))
+        if snapshotID is None:
+            outf.write('%s<cpc version="%d">\n'%(indstr, readxml.curVersion))
+        else:
+            outf.write('%s<cpc version="%d" journal="%s">\n'%
+                       (indstr, readxml.curVersion, snapshotID))
         for name in self.imports.getLibNames():
             outf.write('%s<import name="%s" />\n'%(iindstr,name))
         outf.write('\n')
@@ -571,7 +598,18 @@ class Project(object):
                 reader=readxml.ProjectXMLReader(self.topLevelImport,
                                                 self.imports,
                                                 self)
-                reader.readFile(fname, fname)
+                inf=None
+                # the journal only applies to the current snapshot
+                if stateFile=="_state.xml" and self.journal.hasEntries():
+                    inf=self.journal.replay(fname)
+                if inf is not None:
+                    reader.readFile(inf, fname)
+                else:
+                    reader.readFile(fname, fname)
+                # the state that was just read is the saved state; the first
+                # save will write a new snapshot.
+                self.journal.clearChanges()
+                self.journal.requireSnapshot()
                 tasks=reader.getTaskList()
                 for tsk in tasks:
                     cmds=tsk.getCommands()
@@ -584,17 +622,71 @@ class Project(object):
                             self.cmdQueue.add(cmd)
 
 
-    def writeState(self):
-        with self.updateLock:
-            fname=os.path.join(self.basedir, "_state.xml")
-            nfname=os.path.join(self.basedir, "_state.xml.new")
-            fout=open(nfname, 'w')
-            fout.write('<?xml version="1.0"?>\n')
-            self.writeXML(fout, 0)
-            fout.close()
-            # now we use POSIX file renaming  atomicity to make sure the state
-            # is always a consistent file.
-            os.rename(nfname, fname)
+    def writeState(self, full=False):
+        """Save the project state. This appends the changes since the last
+           save to the state journal, or writes a full state snapshot if
+           full is True or the journal is due for compaction.
+
+           Transactions are only held up while the state is serialized in
+           memory; the files are written while they continue.
+           Returns the time in seconds that transactions were held up."""
+        with self.stateWriteLock:
+            snapshotID=None
+            entry=None
+            startTime=time.time()
+            self.stateLock.acquireExclusive()
+            try:
+                with self.updateLock:
+                    if ( full or
+                         self.journal.needsSnapshot(
+                                        self.conf.getStateJournalSize()) ):
+                        snapshotID=self.journal.startSnapshot()
+                        co=StringIO()
+                        co.write('<?xml version="1.0"?>\n')
+                        self.writeXML(co, 0, snapshotID)
+                    else:
+                        (entry, n)=self.journal.collectEntry()
+            finally:
+                self.stateLock.releaseExclusive()
+            blockedTime=time.time()-startTime
+            try:
+                if snapshotID is not None:
+                    self._writeSnapshot(co.getvalue(), snapshotID)
+                elif entry is not None:
+                    self.journal.appendEntry(entry)
+                    log.debug("Wrote %d changed active instances to "
+                              "journal of %s"%(n, self.name))
+            except:
+                # the collected changes are lost to the journal
+                self.journal.requireSnapshot()
+                raise
+        return blockedTime
+
+    def _writeSnapshot(self, state, snapshotID):
+        """Write a full state snapshot and start a new journal."""
+        fname=os.path.join(self.basedir, "_state.xml")
+        nfname=os.path.join(self.basedir, "_state.xml.new")
+        fout=open(nfname, 'w')
+        fout.write(state)
+        fout.close()
+        # now we use POSIX file renaming  atomicity to make sure the state
+        # is always a consistent file.
+        os.rename(nfname, fname)
+        self.journal.finishSnapshot(snapshotID)
+
+    def getLockStats(self):
+        """Get the transaction lock statistics."""
+        return self.lockStats
+
+    def stateChanged(self, activeInstance):
+        """Notify the project that the state of an active instance has
+           changed, so it will be saved with the next state save."""
+        self.journal.markChanged(activeInstance)
+
+    def networkChanged(self, activeNetwork, item):
+        """Notify the project that an explicit instance or connection has
+           been added to an active network."""
+        self.journal.addNetworkItem(activeNetwork, item)
 
     ########################################################
     # Member functions from the ValueBase interface:
@@ -520,6 +520,14 @@ class ProjectXMLReader(xml.sax.handler.ContentHandler):
                 log.debug("Controller uses current subnet outputs for %s"%
                           (self.function.getName()))
                 self.function.setAccessSubnetOutputs(True)
+            if cpc.util.getBooleanAttribute(attrs, "cpu_bound"):
+                log.debug("Controller is CPU-bound for %s"%
+                          (self.function.getName()))
+                self.function.setCpuBound(True)
+            if cpc.util.getBooleanAttribute(attrs, "persistent_process"):
+                log.debug("Controller runs in a persistent process for %s"%
+                          (self.function.getName()))
+                self.function.setPersistentProcess(True)
             # type-specific items
             if (self.functionType == "python" or
                 self.functionType == "python-extended"):
@@ -23,11 +23,16 @@ try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
-import Queue
+import collections
 import traceback
 import sys
 import os
 import threading
+import time
+try:
+    from collections import OrderedDict
+except ImportError:
+    from cpc.util.ordered_dict import OrderedDict
 
 
 import cpc.util
@@ -49,27 +54,222 @@ class TaskNoNetError(TaskError):
                   name)
 
 class TaskQueue(object):
-    """A task queue holds the a list of tasks to execute in order."""
+    """A task queue holds the tasks to execute.
+
+       Tasks are taken out by priority (the highest first). Within a
+       priority level, the projects with queued tasks take turns, so that a
+       project that queues many tasks at once can't starve the others;
+       the tasks of each project are executed in order.
+
+       The queue has a size bound (conf. option task_queue_size) that
+       applies backpressure: put() blocks while the queue is full, for at
+       most putTimeout seconds, after which the task is queued anyway.
+       Callers may hold dataflow locks that the threads emptying the queue
+       need, so put() must never block indefinitely. Threads that also take
+       tasks out of the queue (the task exec threads, see
+       registerConsumer()) don't wait at all if no other consumer is
+       running."""
+    # the max. time a thread waits for space in the queue
+    putTimeout=15
     def __init__(self, cmdQueue):
         log.debug("Creating new task queue.")
-        self.queue=Queue.Queue(maxsize=ServerConf().getTaskQueueSize())
         self.cmdQueue=cmdQueue
+        self.maxSize=ServerConf().getTaskQueueSize()
+        self.lock=threading.Lock()
+        self.notEmpty=threading.Condition(self.lock)
+        self.notFull=threading.Condition(self.lock)
+        # the priority levels: a dict of project name -> deque of
+        # (task, put time) tuples for each priority. The order of the
+        # dict is the project round-robin order.
+        self.levels=dict()
+        # the sorted priorities of self.levels, the highest first
+        self.priorities=[]
+        # the number of None items queued with putNone()
+        self.nNones=0
+        # the number of queued tasks
+        self.size=0
+        # the number of tasks that are queued or being handled
+        self.unfinished=0
+        # the number of queued tasks per project
+        self.projectSizes=dict()
+        # the consumer threads
+        self.local=threading.local()
+        self.nConsumers=0
+        self.nBlockedConsumers=0
+        # statistics
+        self.nPut=0
+        self.nGet=0
+        self.maxDepth=0
+        self.totalWait=0.
+        self.maxWait=0.
+        self.nBlockedPuts=0
+        self.totalBlockedTime=0.
+
+    def registerConsumer(self):
+        """Register the calling thread as a consumer of this queue."""
+        with self.lock:
+            self.local.consumer=True
+            self.nConsumers+=1
+
+    def unregisterConsumer(self):
+        """Unregister the calling thread as a consumer of this queue."""
+        with self.lock:
+            self.local.consumer=False
+            self.nConsumers-=1
+            self.notFull.notifyAll()
+
+    def _mustWait(self, isConsumer):
+        """Check whether a producer must wait for space in the queue.
+           Assumes self.lock is locked, and that a calling consumer is
+           counted in nBlockedConsumers."""
+        if self.maxSize <= 0 or self.size < self.maxSize:
+            return False
+        if isConsumer:
+            # a consumer may only wait as long as another consumer is
+            # running to empty the queue
+            return self.nBlockedConsumers < self.nConsumers
+        return True
 
     def put(self, task):
         """Put a task in the queue."""
-        # Use a timeout in order to avoid freezing the server completely
-        # if the queue is full.
-        self.queue.put(task, timeout=15)
+        prjName=task.project.getName()
+        with self.lock:
+            isConsumer=getattr(self.local, 'consumer', False)
+            if isConsumer:
+                self.nBlockedConsumers+=1
+            try:
+                if self._mustWait(isConsumer):
+                    startTime=time.time()
+                    deadline=startTime+TaskQueue.putTimeout
+                    while self._mustWait(isConsumer):
+                        remaining=deadline-time.time()
+                        if remaining <= 0:
+                            log.info("Task queue full; queuing task of %s "
+                                     "anyway"%prjName)
+                            break
+                        self.notFull.wait(remaining)
+                    self.nBlockedPuts+=1
+                    self.totalBlockedTime+=time.time()-startTime
+            finally:
+                if isConsumer:
+                    self.nBlockedConsumers-=1
+            level=self.levels.get(task.priority)
+            if level is None:
+                level=OrderedDict()
+                self.levels[task.priority]=level
+                self.priorities.append(task.priority)
+                self.priorities.sort(reverse=True)
+            dq=level.get(prjName)
+            if dq is None:
+                dq=collections.deque()
+                level[prjName]=dq
+            dq.append( (task, time.time()) )
+            self.size+=1
+            self.unfinished+=1
+            self.projectSizes[prjName]=self.projectSizes.get(prjName, 0)+1
+            self.nPut+=1
+            self.maxDepth=max(self.maxDepth, self.size)
+            self.notEmpty.notify()
 
     def putNone(self):
         """Put a none into the queue to make sure threads are reading it."""
-        self.queue.put(None)
+        with self.lock:
+            self.nNones+=1
+            self.unfinished+=1
+            self.notEmpty.notify()
 
     def get(self):
-        return self.queue.get()
+        """Get the next task, blocking until there is one. Returns None if
+           a None was put in the queue with putNone()."""
+        with self.lock:
+            while self.size == 0 and self.nNones == 0:
+                self.notEmpty.wait()
+            if self.nNones > 0:
+                self.nNones-=1
+                return None
+            prio=self.priorities[0]
+            level=self.levels[prio]
+            # take the first project in turn, and move it to the back
+            (prjName, dq)=level.popitem(last=False)
+            (task, putTime)=dq.popleft()
+            if len(dq) > 0:
+                level[prjName]=dq
+            elif len(level) == 0:
+                del self.levels[prio]
+                self.priorities.pop(0)
+            self.size-=1
+            n=self.projectSizes[prjName]-1
+            if n > 0:
+                self.projectSizes[prjName]=n
+            else:
+                del self.projectSizes[prjName]
+            waitTime=time.time()-putTime
+            self.nGet+=1
+            self.totalWait+=waitTime
+            self.maxWait=max(self.maxWait, waitTime)
+            self.notFull.notify()
+            return task
+
+    def taskDone(self):
+        """Signal that an item obtained with get() has been handled."""
+        with self.lock:
+            self.unfinished-=1
 
     def empty(self):
-        return self.queue.empty()
+        with self.lock:
+            return self.size == 0 and self.nNones == 0
+
+    def hasPending(self):
+        """Return whether there are tasks that are queued or that are
+           still being handled."""
+        with self.lock:
+            return self.unfinished > 0
+
+    def getProjectSize(self, projectName):
+        """Get the number of queued tasks of a project."""
+        with self.lock:
+            return self.projectSizes.get(projectName, 0)
+
+    def getStats(self):
+        """Get a dict with the queue statistics."""
+        with self.lock:
+            ret=dict()
+            ret['depth']=self.size
+            ret['max_size']=self.maxSize
+            ret['max_depth']=self.maxDepth
+            ret['queued']=self.nPut
+            ret['handled']=self.nGet
+            if self.nGet > 0:
+                ret['avg_wait']=self.totalWait/self.nGet
+            else:
+                ret['avg_wait']=0.
+            ret['max_wait']=self.maxWait
+            ret['blocked_puts']=self.nBlockedPuts
+            ret['blocked_time']=self.totalBlockedTime
+            ret['projects']=dict(self.projectSizes)
+            return ret
+
+
+def removePersistenceSubdirs(fullPersDir):
+    """Remove the files in the subdirectories of a persistence directory,
+       and the subdirectories themselves. This is done when a task has
+       finished."""
+    log.debug("Removing files in persistence subdirectories")
+    if os.path.isdir(fullPersDir):
+        for d in os.listdir(fullPersDir):
+            dir_path = os.path.join(fullPersDir, d)
+            if os.path.isdir(dir_path):
+                for f in os.listdir(dir_path):
+                    file_path = os.path.join(dir_path, f)
+                    try:
+                        if os.path.isfile(file_path):
+                            os.remove(file_path)
+                    except Exception, e:
+                        log.error("Error deleting persistent data file: %s" % file_path)
+                try:
+                    os.rmdir(dir_path)
+                except Exception, e:
+                    log.error("Error removing subdir in persistence directory: %s" % dir_path)
 
 
 class Task(object):
@@ -169,44 +369,51 @@ class Task(object):
                 # now actually run
                 #self.ret=self.function.run(self.fnInput)
                 self.function.run(self.fnInput)
-                # and we're done.
-                if self.fnOutput.cancelCmds:
-                    # cancel all outstanding commands.
-                    canceled=self.activeInstance.cancelTasks(self.seqNr)
-                if self.activeInstance.runLock is not None:
-                    self.activeInstance.runLock.release()
-                    locked=False
-
-                # the commands must be handled here because they're really
-                # a property of the task
-                self.fnInput.cmd=None
-                if cmd is not None:
-                    self.cmds.remove(cmd)
-                    # do cpu time accounting.
-                    cputime=cmd.getCputime()
-                    if cputime > 0:
-                        self.activeInstance.addCputime(cputime)
-
-                # handle things that can throw exceptions:
-                haveRetcmds=( (self.fnOutput.cmds is not None) and
-                              (len(self.fnOutput.cmds)>0) )
-
-                if ( (self.fnOutput.hasOutputs() or
-                      self.fnOutput.hasSubnetOutputs()) and
-                     ( haveRetcmds or len(self.cmds)>0 ) ):
-                    raise TaskError(
-                       "Task returned both outputs: %s, %s and commands %s,%s"%
-                       (str(self.fnOutput.outputs),
-                        str(self.fnOutput.subnetOutputs),
-                        str(self.cmds),str(self.fnOutput.cmds)))
-
-                if self.fnOutput.cmds is not None:
-                    for cmd in self.fnOutput.cmds:
-                        cmd.setTask(self)
-                        self.cmds.append(cmd)
-                    finished=False
-                else:
-                    finished=True
+                # and we're done. The controller itself ran without the
+                # project's state lock; the rest changes the project state,
+                # so a state snapshot must not split it.
+                with self.project.stateLock.shared:
+                    if self.fnOutput.cancelCmds:
+                        # cancel all outstanding commands.
+                        canceled=self.activeInstance.cancelTasks(self.seqNr)
+                    if self.activeInstance.runLock is not None:
+                        self.activeInstance.runLock.release()
+                        locked=False
+
+                    # the commands must be handled here because they're really
+                    # a property of the task
+                    self.fnInput.cmd=None
+                    if cmd is not None:
+                        self.cmds.remove(cmd)
+                        # do cpu time accounting.
+                        cputime=cmd.getCputime()
+                        if cputime > 0:
+                            self.activeInstance.addCputime(cputime)
+
+                    # handle things that can throw exceptions:
+                    haveRetcmds=( (self.fnOutput.cmds is not None) and
+                                  (len(self.fnOutput.cmds)>0) )
+
+                    if ( (self.fnOutput.hasOutputs() or
+                          self.fnOutput.hasSubnetOutputs()) and
+                         ( haveRetcmds or len(self.cmds)>0 ) ):
+                        raise TaskError(
+                            "Task returned both outputs: %s, %s and "
+                            "commands %s,%s"%
+                            (str(self.fnOutput.outputs),
+                             str(self.fnOutput.subnetOutputs),
+                             str(self.cmds),str(self.fnOutput.cmds)))
+
+                    if self.fnOutput.cmds is not None:
+                        for cmd in self.fnOutput.cmds:
+                            cmd.setTask(self)
+                            self.cmds.append(cmd)
+                        finished=False
+                    else:
+                        finished=True
+                    if self.fnOutput.cmds is not None or cmd is not None:
+                        # the task's command list changed
+                        self.activeInstance.markChanged()
 
             except cpc.util.CpcError as e:
                 if locked:
@@ -244,23 +451,8 @@ class Task(object):
                 self.fnInput.destroy()
                 self.fnInput=None
 
-                log.debug("Removing files in persistence subdirectories")
                 fullPersDir=os.path.join(self.project.basedir, self.activeInstance.persDir)
-                if os.path.isdir(fullPersDir):
-                    for d in os.listdir(fullPersDir):
-                        dir_path = os.path.join(fullPersDir, d)
-                        if os.path.isdir(dir_path):
-                            for f in os.listdir(dir_path):
-                                file_path = os.path.join(dir_path, f)
-                                try:
-                                    if os.path.isfile(file_path):
-                                        os.remove(file_path)
-                                except Exception, e:
-                                    log.error("Error deleting persistent data file: %s" % file_path)
-                            try:
-                                os.rmdir(dir_path)
-                            except Exception, e:
-                                log.error("Error removing subdir in persistence directory: %s" % dir_path)
+                removePersistenceSubdirs(fullPersDir)
 
 
     def getID(self):
@@ -27,6 +27,7 @@ except ImportError:
 import threading
 import traceback
 import sys
+import time
 
 import apperror
 import connection
@@ -42,6 +43,40 @@ log=logging.getLogger(__name__)
 class SetError(apperror.ApplicationError):
     pass
 
+
+class LockStats(object):
+    """Statistics of the time transactions spend waiting for and holding
+       their network and active instance locks."""
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.nTransactions=0
+        self.totalWait=0.
+        self.maxWait=0.
+        self.totalHold=0.
+        self.maxHold=0.
+
+    def add(self, waitTime, holdTime):
+        """Add the lock timings of a single transaction.
+           waitTime = the time spent waiting for locks
+           holdTime = the time the locks were held"""
+        with self.lock:
+            self.nTransactions+=1
+            self.totalWait+=waitTime
+            self.maxWait=max(self.maxWait, waitTime)
+            self.totalHold+=holdTime
+            self.maxHold=max(self.maxHold, holdTime)
+
+    def toJSON(self):
+        with self.lock:
+            ret=dict()
+            ret['transactions']=self.nTransactions
+            ret['total_wait']=self.totalWait
+            ret['max_wait']=self.maxWait
+            ret['total_hold']=self.totalHold
+            ret['max_hold']=self.maxHold
+            return ret
+
+
 class SetValue(object):
     def __init__(self, project, itemName, 
                  #activeInstance, direction, ioItemList, 
@@ -161,16 +196,43 @@ class Transaction(run.FunctionRunOutput):
                                                      newConnection.val)
         newConnection.conn=conn
 
+    def _addInstances(self):
+        """Make the new instances, and return their active instances."""
+        addedInstances=[]
+        for newInstance in self.newInstances:
+            log.debug("Making new instance %s of fn %s"%
+                      (newInstance.name, newInstance.functionName))
+            fn=self.project.imports.getFunctionByFullName(
+                                            newInstance.functionName,
+                                            self.lib)
+            inst=instance.Instance(newInstance.name, fn,
+                                   fn.getFullName())
+            # for later activation
+            addedInstances.append(self.activeNetwork.addInstance(inst))
+        return addedInstances
+
     def check(self, outf=None):
         """Check the transaction items for any errors."""
         # TODO: implement!!
         pass
 
     def run(self, outf=None):
-        """Do a transaction."""
+        """Do a transaction. The project's state lock is held as a reader
+           while doing so, so that state snapshots contain either all or
+           none of the transaction's changes."""
+        with self.project.stateLock.shared:
+            self._run(outf)
+
+    def _run(self, outf):
+        """Do a transaction; assumes the project's state lock is held."""
         # we start out with 'none' objects, and initialize them to sets if
         # there's a need for it.
         locked=False
+        lockedNetworks=[]
+        lockedAIs=None
+        lockStartTime=time.time()
+        waitTime=0.
+        holdStartTime=None
         addedInstances=None
         affectedOutputAIs=None
         affectedInputAIs=None
@@ -186,51 +248,78 @@ class Transaction(run.FunctionRunOutput):
                 # In this case, there is only one active instance to lock
                 pass
             else:
-                # there are multiple updates, so we must lock a network lock
-                self.project.updateLock.acquire()
-                # these are the active instances for which output locks are set
-                affectedOutputAIs=set()
-                # these are active instances for which handleNewInput() is 
-                # called
-                affectedInputAIs=set()
-                if self.activeInstance is not None: 
-                    affectedOutputAIs.add(self.activeInstance)
-            # now make the new instances
-            if self.newInstances is not None:
-                addedInstances=[]
-                for newInstance in self.newInstances:
-                    log.debug("Making new instance %s of fn %s"%
-                              (newInstance.name, newInstance.functionName))
-                    fn=self.project.imports.getFunctionByFullName(
-                                                    newInstance.functionName,
-                                                    self.lib)
-                    inst=instance.Instance(newInstance.name, fn, 
-                                           fn.getFullName())
-                    # for later activation
-                    addedInstances.append(self.activeNetwork.addInstance(inst))
-            # make the new connections
-            if self.newConnections is not None:
-                # Make the connections
-               for newConnection in self.newConnections:
-                    if newConnection.conn is None:
-                        self._makeConn(newConnection)
-                    self.activeNetwork.findConnectionSrcDest(
-                                                        newConnection.conn, 
+                # there are multiple updates, so we must lock the network
+                # locks of the network we're changing, and of all networks
+                # with affected input active instances: connections through
+                # subnet inputs and outputs reach into parent networks and
+                # subnetworks. Transactions in other networks can proceed
+                # concurrently. The affected instances are only known with
+                # the network locked, so if they turn out to be in networks
+                # that aren't locked yet, all locks are released and taken
+                # again in lockOrder.
+                if self.activeNetwork is not None:
+                    networks=set([self.activeNetwork])
+                else:
+                    networks=set([self.project.network])
+                while True:
+                    lockedNetworks=sorted(networks,
+                                          key=lambda net: net.lockOrder)
+                    for net in lockedNetworks:
+                        net.getNetworkLock().acquire()
+                    # these are the active instances for which output locks
+                    # are set
+                    affectedOutputAIs=set()
+                    # these are active instances for which handleNewInput()
+                    # is called
+                    affectedInputAIs=set()
+                    if self.activeInstance is not None:
+                        affectedOutputAIs.add(self.activeInstance)
+                    # now make the new instances
+                    if (self.newInstances is not None and
+                        addedInstances is None):
+                        addedInstances=self._addInstances()
+                    # find the instances affected by the new connections
+                    if self.newConnections is not None:
+                        for newConnection in self.newConnections:
+                            if newConnection.conn is None:
+                                self._makeConn(newConnection)
+                            self.activeNetwork.findConnectionSrcDest(
+                                                        newConnection.conn,
                                                         affectedInputAIs,
                                                         affectedOutputAIs)
-            if self.setValues is not None:
-                for val in self.setValues:
-                    log.debug("Setting new value %s"%(val.itemName))
-                    val.findAffected(affectedOutputAIs, affectedInputAIs)
+                    if self.setValues is not None:
+                        for val in self.setValues:
+                            log.debug("Setting new value %s"%(val.itemName))
+                            val.findAffected(affectedOutputAIs,
+                                             affectedInputAIs)
+                    needed=set([ ai.activeNetwork for ai in
+                                 affectedInputAIs ])
+                    if needed <= networks:
+                        break
+                    for net in reversed(lockedNetworks):
+                        net.getNetworkLock().release()
+                    lockedNetworks=[]
+                    networks |= needed
+                waitTime+=time.time()-lockStartTime
+            # now make the new instances
+            if self.newInstances is not None and addedInstances is None:
+                addedInstances=self._addInstances()
+            lockStartTime=time.time()
             if affectedOutputAIs is None:
                 if self.activeInstance is not None: 
                     self.activeInstance.outputLock.acquire()
                     locked=True
             else:
-                for ai in affectedOutputAIs:
+                # always lock in the same global order, so that concurrent
+                # transactions can't deadlock.
+                lockedAIs=sorted(affectedOutputAIs,
+                                 key=lambda ai: ai.lockOrder)
+                for ai in lockedAIs:
                     ai.outputLock.acquire()
                 locked=True
                 log.debug("Locked.")
+            holdStartTime=time.time()
+            waitTime+=holdStartTime-lockStartTime
             # now do the transaction
             # new values
             if self.setValues is not None:
@@ -274,72 +363,19 @@ class Transaction(run.FunctionRunOutput):
                 log.error(errmsg)
         finally:
             if locked:
-                if affectedOutputAIs is None:
+                if lockedAIs is None:
                     self.activeInstance.outputLock.release()
                 else:
-                    for ai in affectedOutputAIs:
+                    for ai in reversed(lockedAIs):
                         ai.outputLock.release()
-            #if affectedOutputAIs is not None:
-            if not (self.newConnections is None and self.setValues is None):
-                self.project.updateLock.release() 
+            for net in reversed(lockedNetworks):
+                net.getNetworkLock().release()
+            if holdStartTime is not None and (locked or
+                                              len(lockedNetworks) > 0):
+                self.project.lockStats.add(waitTime,
+                                           time.time()-holdStartTime)
         log.debug("Finished transaction locks")
         if addedInstances is not None:
             for inst in addedInstances: 
                 inst.activate()
         #log.debug("TRANSACTION ENDING *****************")
-            
-
- 
-class TransactionList(object):
-    """A list of transaction items (TransactionItem objects)"""
-    def __init__(self, networkLock, autoCommit):
-        """Initialize, with autocommit flag.
-           networkLock = the projecct's network lock
-           autoCommit = whether to autocommit every added item immediately"""
-        self.lst=[]
-        self.lock=threading.Lock()
-        self.autoCommit=autoCommit
-        self.networkLock=networkLock
-
-    def addItem(self, transactionItem, project, outf):
-        """Add a single transaction item to the list."""
-        with self.lock:
-            self.lst.append(transactionItem)
-        if self.autoCommit:
-            self.commit(project, outf)
-        else:
-            outf.write("Scheduled to ")
-            transactionItem.describe(outf)
-            outf.write(" at commit")
-
-    def commit(self, project, outf):
-        """Commit all items of the transaction in one step."""
-        affectedInputAIs=set()
-        affectedOutputAIs=set()
-        outputsLocked=False
-        outf.write("Committing scheduled changes:\n")
-        with self.lock:
-            with self.networkLock:
-                try:
-                    # first get all affected active instances.
-                    for item in self.lst:
-                        item.getAffected(project, affectedInputAIs, 
-                                         affectedOutputAIs)
-                    # lock all affected I/O active instances
-                    for ai in affectedOutputAIs:
-                        ai.outputLock.acquire()
-                    outputsLocked=True
-                    # now run the transaction
-                    for item in self.lst:
-                        outf.write("- ")
-                        item.run(project, project, outf)
-                    for ai in affectedInputAIs:
-                        ai.handleNewInput(project, 0)
-                finally:
-                    # make sure everything is released.
-                    if outputsLocked:
-                        for ai in affectedOutputAIs:
-                            ai.outputLock.release()
-                    self.lst=[]
-
-
@@ -20,6 +20,7 @@
 
 import logging
 import os
+import threading
 import xml.sax
 
 
@@ -126,12 +127,19 @@ class ValueBase(object):
         return None
 
 
+# protects the use counts of value snapshots
+_snapshotLock=threading.Lock()
+
 class Value(ValueBase):
     """The class describing a data value. Value classes hold function input
-       and output data, and are used to transmit external i/o data."""
+       and output data, and are used to transmit external i/o data.
+
+       A value tree can hand out read-only snapshots of itself (see
+       getSnapshot()), which share the snapshots of unchanged sub-values
+       with earlier snapshots."""
     __slots__=['type', 'basetype', 'createObject', 'parent', 'owner',
                'fileValue', 'fileList', 'updated', 'selfName', 'seqNr',
-               'sourceTag', 'value']
+               'sourceTag', 'value', 'snapshot', 'snapUsers']
     def __init__(self, value, tp, parent=None, owner=None, selfName=None,
                  createObject=None, fileList=None, sourceTag=None):
         """Initializes an new value, with no references
@@ -156,6 +164,10 @@ class Value(ValueBase):
         self.fileValue=None
         self.fileList=fileList
         self.updated=False # whether this value has been updated
+        # the cached snapshot of this value, and the number of users of
+        # this value if it is a snapshot itself.
+        self.snapshot=None
+        self.snapUsers=0
         self.copy(value)
         self.selfName=selfName
         self.seqNr=0
@@ -173,6 +185,7 @@ class Value(ValueBase):
 
     def copy(self, val):
         """Copy a value object or None"""
+        self._invalidate()
         # now do something for composites
         # copy this value for later
         rmref=self.fileValue
@@ -247,6 +260,11 @@ class Value(ValueBase):
     def destroy(self):
         """Destroy the contents of this value. Only relevant for values
            that keep File objects."""
+        if self.snapUsers > 0:
+            # a snapshot: other users may share it.
+            with _snapshotLock:
+                self._releaseSnapshot()
+            return
         if self.fileValue is not None:
             self.fileValue.rmRef()
         if isinstance(self.value, dict):
@@ -258,6 +276,7 @@ class Value(ValueBase):
 
     def _set(self, literalValue, basetype=None):
         """Set a value: a value without subtypes."""
+        self._invalidate()
         rmref=self.fileValue
         self.value=literalValue
         if ( (self.fileList is not None ) and
@@ -345,6 +364,7 @@ class Value(ValueBase):
                     itemList[0]=len(self.value)
                     nval=self._create(None, ntp, len(self.value),
                                       setCreateSourceTag)
+                    self._invalidate()
                     self.value.append(nval)
             else:
                 raise ValError("Array type not a list.")
@@ -369,6 +389,7 @@ class Value(ValueBase):
                         # and make it
                         nval=self._create(None, ntp, itemList[0],
                                           setCreateSourceTag)
+                        self._invalidate()
                         self.value[itemList[0]] = nval
                     else:
                         # it is a list. Only create a subitem if we know what
@@ -376,6 +397,7 @@ class Value(ValueBase):
                         if createType is not None:
                             nval=self._create(None, createType, itemList[0],
                                               setCreateSourceTag)
+                            self._invalidate()
                             self.value[itemList[0]] = nval
                         else:
                             return None
@@ -541,7 +563,9 @@ class Value(ValueBase):
            to 'updated'"""
         #if updated:
         #    log.debug("**Setting %s to updated"%self.getFullName())
-        self.updated=updated
+        if self.updated != updated:
+            self._invalidate()
+            self.updated=updated
         if isinstance(self.value, list):
             for val in self.value:
                 val.setUpdated(updated)
@@ -553,7 +577,9 @@ class Value(ValueBase):
         """Set the updated field for this value and its parents."""
         #if updated:
         #    log.debug("Setting %s to updated"%self.getFullName())
-        self.updated=updated
+        if self.updated != updated:
+            self._invalidate()
+            self.updated=updated
         if self.parent is not None:
             self.parent.markUpdated(updated)
 
@@ -577,6 +603,101 @@ class Value(ValueBase):
 
 
 
+    def getSnapshot(self):
+        """Get a read-only copy of this value tree, as it is now. The
+           snapshot must be released with destroy() when it is no longer
+           needed.
+
+           Snapshots are cached: the snapshot of a sub-value is shared by
+           all snapshots taken until that sub-value changes, so taking a
+           snapshot only copies the parts of the tree that have changed since
+           the last one."""
+        with _snapshotLock:
+            snap=self._getSnapshot()
+            snap.snapUsers+=1
+        return snap
+
+    def _getSnapshot(self):
+        """Get the cached snapshot of this value, making it if needed.
+           Assumes _snapshotLock is locked."""
+        if self.snapshot is not None:
+            return self.snapshot
+        snap=Value.__new__(Value)
+        snap.type=self.type
+        snap.basetype=self.basetype
+        snap.createObject=Value
+        snap.parent=None
+        snap.owner=None
+        snap.fileList=None
+        snap.updated=self.updated
+        snap.seqNr=0
+        snap.snapshot=None
+        # the cache holds one use
+        snap.snapUsers=1
+        if self.parent is None:
+            # this is the top level of the snapshot
+            snap.selfName=None
+            snap.sourceTag=None
+        else:
+            snap.selfName=self.selfName
+            if isinstance(self.parent.value, list):
+                snap.sourceTag=self.sourceTag
+            else:
+                snap.sourceTag=None
+        snap.fileValue=self.fileValue
+        if snap.fileValue is not None:
+            snap.fileValue.addRef()
+        if isinstance(self.value, dict):
+            snap.value=dict()
+            for name, val in self.value.iteritems():
+                snap.value[name]=val._getSubSnapshot(snap)
+        elif isinstance(self.value, list):
+            snap.value=[ val._getSubSnapshot(snap) for val in self.value ]
+        else:
+            snap.value=self.value
+        self.snapshot=snap
+        return snap
+
+    def _getSubSnapshot(self, parentSnapshot):
+        """Get the snapshot of this value for use in the snapshot of its
+           parent. Assumes _snapshotLock is locked."""
+        snap=self._getSnapshot()
+        snap.snapUsers+=1
+        if snap.parent is None:
+            # all parent snapshots that share this one have the same name.
+            snap.parent=parentSnapshot
+        return snap
+
+    def _releaseSnapshot(self):
+        """Release one use of a snapshot, and release its contents if it is no
+           longer used. Assumes _snapshotLock is locked."""
+        self.snapUsers-=1
+        if self.snapUsers > 0:
+            return
+        if self.fileValue is not None:
+            self.fileValue.rmRef()
+            self.fileValue=None
+        if isinstance(self.value, dict):
+            for val in self.value.itervalues():
+                val._releaseSnapshot()
+        elif isinstance(self.value, list):
+            for val in self.value:
+                val._releaseSnapshot()
+
+    def _invalidate(self):
+        """Drop the cached snapshots of this value and its parents, because
+           this value is about to change."""
+        if self.snapshot is None:
+            # no parent can have a snapshot if this value has none.
+            return
+        with _snapshotLock:
+            val=self
+            while val is not None and val.snapshot is not None:
+                snap=val.snapshot
+                val.snapshot=None
+                snap._releaseSnapshot()
+                val=val.parent
+
     def writeXML(self, outf, indent=0, fieldName=None):
         """Write out this value as XML"""
         indstr=cpc.util.indStr*indent
@@ -682,6 +803,8 @@ class File(object):
         self.refs -= 1
         if self.refs <= 0:
             log.debug("Removing %s because it is no longer in use."%self.name)
+            if self.fileList.fileStore is not None:
+                self.fileList.fileStore.remove(self.name)
             try:
                 d = os.path.dirname(os.path.join(self.fileList.root, self.name, self.name))
                 os.remove( os.path.join(self.fileList.root, self.name ) )
@@ -702,10 +825,14 @@ class File(object):
 
 class FileList(object):
     """Contains a list of all files referenced in a project."""
-    def __init__(self, projectRoot):
-        """Initialize a list given a project root directory."""
+    def __init__(self, projectRoot, fileStore=None):
+        """Initialize a list given a project root directory.
+
+           fileStore = an optional file_store.FileStore to deduplicate the
+                       files through."""
         self.files=dict()
         self.root=projectRoot
+        self.fileStore=fileStore
 
     def getFile(self, name):
         """Get a file object by a file name relative to the project root.
@@ -716,6 +843,11 @@ class FileList(object):
         else:
             ret=self.files[name]
             ret.addRef()
+            if ret.refs > 1:
+                return ret
+        # the file is new, or back in use.
+        if self.fileStore is not None:
+            self.fileStore.add(name)
         return ret
 
     def getAbsoluteFile(self, name):
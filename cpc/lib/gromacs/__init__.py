@@ -24,5 +24,6 @@ from mdrun import *
 from grompp import *
 from tools import *
 from bar import *
+from trajparts import concat_parts
 #from tune import *
 
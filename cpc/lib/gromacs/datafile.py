@@ -0,0 +1,207 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Readers for Gromacs .xvg data files and .itp restraint sections that
+   return NumPy arrays.
+
+   Files are parsed in bulk: the data lines are picked out of the file with
+   a single regular expression search, and the columns are converted to
+   numbers as whole arrays. Files larger than mmapSize are memory-mapped
+   instead of read into memory.
+
+   Parsed results are cached per file, keyed by the absolute file name and
+   validated against the file's modification time and size, so a file that
+   is read several times in the same process (e.g. the start and end points
+   of a string, or by a controller that runs in a persistent process) is
+   only parsed once. The returned arrays are shared with the cache and are
+   therefore read-only."""
+
+import collections
+import mmap
+import os
+import re
+import threading
+
+import numpy
+
+import cpc.util
+
+
+class DataFileError(cpc.util.CpcError):
+    pass
+
+
+# the file size above which files are memory-mapped
+mmapSize=1024*1024
+# the max. number of parsed files to keep
+maxCacheEntries=64
+
+_cache=collections.OrderedDict()
+_cacheLock=threading.Lock()
+
+# xvg data lines are all lines that are not empty, comments or directives
+_xvgDataRe=re.compile(r'^[ \t]*[^@#&\s][^\n]*', re.MULTILINE)
+# itp section headers
+_itpSectionRe=re.compile(r'^[ \t]*\[[ \t]*(\w+)[ \t]*\][^\n]*', re.MULTILINE)
+# itp data lines: not empty, comments or preprocessor directives
+_itpDataRe=re.compile(r'^[ \t]*[^;#\s][^\n]*', re.MULTILINE)
+
+
+def _cached(kind, filename, parseFn):
+    """Get a parsed file from the cache, or parse it and cache the result.
+
+       kind = the kind of parse, as part of the cache key
+       filename = the file name
+       parseFn = the function that parses the file contents
+
+       Returns the result of parseFn."""
+    path=os.path.abspath(filename)
+    try:
+        st=os.stat(path)
+    except OSError as e:
+        raise DataFileError("Can't read %s: %s"%(filename, e.strerror))
+    key=(kind, path)
+    stamp=(st.st_mtime, st.st_size)
+    with _cacheLock:
+        entry=_cache.get(key)
+        if entry is not None and entry[0] == stamp:
+            # move to the end: the most recently used entry
+            del _cache[key]
+            _cache[key]=entry
+            return entry[1]
+    ret=_withContents(path, st.st_size, parseFn)
+    with _cacheLock:
+        _cache.pop(key, None)
+        _cache[key]=(stamp, ret)
+        while len(_cache) > maxCacheEntries:
+            _cache.popitem(last=False)
+    return ret
+
+def _withContents(path, size, parseFn):
+    """Call parseFn with the contents of a file: a string, or a memory map
+       for large files."""
+    inf=open(path, 'rb')
+    try:
+        if size < mmapSize or size == 0:
+            return parseFn(inf.read())
+        mm=mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return parseFn(mm)
+        finally:
+            mm.close()
+    finally:
+        inf.close()
+
+def clearCache():
+    """Forget all cached parsed files."""
+    with _cacheLock:
+        _cache.clear()
+
+def _readOnly(arr):
+    arr.flags.writeable=False
+    return arr
+
+def _columns(lines, minCols, ragged=False):
+    """Split data lines into a 2D array of strings, one row per line.
+
+       All lines must have the same number of fields, and at least minCols
+       fields. A last line with fewer fields is left out: it belongs to a
+       file that is still being written. If ragged is True, the lines may
+       have different numbers of fields, and only the first minCols fields
+       of each line are used."""
+    if len(lines) == 0:
+        return numpy.empty((0, minCols), dtype=str)
+    rows=[ line.split() for line in lines ]
+    if ragged:
+        ncols=minCols
+    else:
+        ncols=len(rows[0])
+        if len(rows) > 1 and len(rows[-1]) < ncols:
+            rows.pop()
+    for i, row in enumerate(rows):
+        if len(row) < minCols:
+            raise DataFileError("Too few fields in line '%s'"%lines[i])
+        if not ragged and len(row) != ncols:
+            raise DataFileError("Line '%s' has %d fields instead of %d"%
+                                (lines[i], len(row), ncols))
+    if ragged:
+        rows=[ row[:ncols] for row in rows ]
+    return numpy.array(rows)
+
+def _toFloat(strings):
+    try:
+        return strings.astype(numpy.float64)
+    except ValueError as e:
+        raise DataFileError("Non-numeric data: %s"%str(e))
+
+
+def readXvg(filename):
+    """Read the numeric data in an .xvg file.
+
+       Returns a read-only 2D float array with one row per data line and
+       one column per data set (the first column is usually time)."""
+    def parse(contents):
+        return _readOnly(_toFloat(_columns(_xvgDataRe.findall(contents), 1)))
+    return _cached('xvg', filename, parse)
+
+def readDihedralXvg(filename):
+    """Read a dihedral .xvg file, as written by g_rama: each data line has a
+       phi and a psi value and a residue label like ARG-8. After all
+       residues, the residues can repeat for each chain.
+
+       Returns a tuple of a read-only Nx2 float array of phi/psi pairs and a
+       read-only int array of the N residue numbers."""
+    def parse(contents):
+        cols=_columns(_xvgDataRe.findall(contents), 3)
+        angles=_toFloat(cols[:,0:2])
+        try:
+            residues=numpy.char.rpartition(cols[:,2], '-')[:,2].astype(int)
+        except ValueError as e:
+            raise DataFileError("Malformed residue label: %s"%str(e))
+        return (_readOnly(angles), _readOnly(residues))
+    return _cached('dihxvg', filename, parse)
+
+def selectResidues(residues, rsel):
+    """Get a boolean mask of the entries of an array of residue numbers that
+       are in the residue selection rsel."""
+    return numpy.in1d(residues, numpy.asarray(list(rsel), dtype=int))
+
+def readItpSection(filename, section, column):
+    """Read one column of the data lines in a section of an .itp file, for
+       example the dihedral angles (column 5) of the dihedral_restraints
+       section. The section ends at the next section header.
+
+       Returns a read-only 1D float array with the values."""
+    def parse(contents):
+        start=None
+        end=len(contents)
+        for match in _itpSectionRe.finditer(contents):
+            if start is not None:
+                end=match.start()
+                break
+            if match.group(1) == section:
+                start=match.end()
+        if start is None:
+            return _readOnly(numpy.empty(0))
+        # without trailing comments
+        lines=[ line.split(';', 1)[0] for line in
+                _itpDataRe.findall(contents[start:end]) ]
+        return _readOnly(_toFloat(_columns(lines, column+1,
+                                           True)[:,column]))
+    return _cached('itp:%s:%d'%(section, column), filename, parse)
@@ -246,7 +246,8 @@ def tune_fn(inp):
         return fo
     rsrc=Resources()
     tune.tune(rsrc, inp.getInput('conf'), 
-              os.path.join(inp.getOutputDir(), 'topol.tpr'), persDir)
+              os.path.join(inp.getOutputDir(), 'topol.tpr'), persDir,
+              cacheDir=inp.getBaseDir())
     fo.setOut('mdp', FileValue(mdpfile))
     fo.setOut('resources', rsrc.setOutputValue())
     return fo
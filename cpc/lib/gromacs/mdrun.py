@@ -46,6 +46,8 @@ import cpc.util
 import tune
 import iterate
 import cmds
+import trajparts
+import metadata
 
 class MdrunError(cpc.util.CpcError):
     pass
@@ -240,55 +242,16 @@ class TrajFileCollection(object):
 
     def getFractionCompleted(self, tpr):
         """Get the fraction of steps completed."""
-        # also check whether we need to check file numbers:
-        checkFileNumbers=False
-        if self.lastTrajNr is None:
-            checkFileNumbers=True
-        newFileNumber=0
         if self.lastcpt is not None:
-            stepnr=0
-            firststep=0
-            nsteps=1
             # now check how far along the run is by inspecting the
             # step number we're at.
-            cmd = self.cmdnames.gmxdump.split() + ['-cp', self.lastcpt]
-            sp=subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT)
-            stepline=re.compile('step = .*')
-            outfileline=re.compile('output filename = .*')
-            for line in sp.stdout:
-                if stepline.match(line):
-                    stepnr=int(line.split('=')[1])
-                    if not checkFileNumbers:
-                        break
-                elif checkFileNumbers and outfileline.match(line):
-                    filename=line.split('=')[1]
-                    nrs=re.findall(r'\d+', filename)
-                    #log.debug("**NRS=%s, line=%s"%(nrs, line))
-                    #for nr in nrs:
-                    if len(nrs)>0:
-                        nr=int(nrs[-1])
-                        if nr > newFileNumber:
-                            #log.debug("found new file number: %d"%(nr))
-                            newFileNumber = nr
-            sp.stdout.close()
-            if checkFileNumbers:
-                self.lastTrajNr=newFileNumber
-            #sp.communicate()
+            stepnr=metadata.getCheckpointStep(self.cmdnames, self.lastcpt)
+            # also check whether we need to check file numbers:
+            if self.lastTrajNr is None:
+                self.lastTrajNr=metadata.getCheckpointFileNumber(
+                                                self.cmdnames, self.lastcpt)
             # and get the total step number
-            cmd = self.cmdnames.gmxdump.split() + ['-s', tpr]
-            sp=subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT)
-            stepline=re.compile('[ ]*nsteps.*')
-            firststepline=re.compile('[ ]*init-step.*')
-            for line in sp.stdout:
-                if stepline.match(line):
-                    nsteps=int(line.split()[2])
-                elif firststepline.match(line):
-                    firststep=int(line.split()[2])
-                    break
-            sp.stdout.close()
-            #sp.communicate()
+            (nsteps, firststep)=metadata.getTprSteps(self.cmdnames, tpr)
             return float(stepnr-firststep)/nsteps
         return 0
 
@@ -312,7 +275,7 @@ class TrajFileCollection(object):
 
 
 
-def checkErr(stde, rsrc, tpr, persDir):
+def checkErr(stde, rsrc, tpr, persDir, cacheDir=None):
     """Check whether an error condition is recoverable.
 
        Returns True if there is an issue, False if the error is recoverable"""
@@ -333,123 +296,54 @@ def checkErr(stde, rsrc, tpr, persDir):
                 log.debug("Found domain decomp error")
                 confFile=os.path.join(persDir, 'conf.gro')
                 extractConf(tpr, confFile)
-                tune.tune(rsrc, confFile, tpr, persDir, rsrc.max.get('cores')-1)
+                tune.tune(rsrc, confFile, tpr, persDir, rsrc.max.get('cores')-1,
+                          cacheDir)
                 OK=True
                 break
     inf.close()
     return not OK
 
 
-def extractData(confout, outDir, persDir, fo):
-    """Concatenate all output data from the partial runs into the end results"""
-    cmdnames = cmds.GromacsCommands()
+def extractData(confout, outDir, persDir, fo, concat=True):
+    """Collect all output data from the partial runs into the end results.
+
+       If concat is False, the trajectory and energy parts are only listed
+       in the parts output, and not concatenated."""
     #outputs=dict()
     # Concatenate stuff
     confoutPath=os.path.join(outDir, "confout.gro")
-    shutil.copy(confout[0], confoutPath )
+    trajparts.linkFile(confout[0], confoutPath)
     #outputs['conf'] = Value(confoutPath,
     #                        inp.function.getOutput('conf').getType())
     fo.setOut('conf', FileValue(confoutPath))
-    # fix the xtc files
-    xtcso = sorted(glob.glob(os.path.join(persDir, "run_???",
-                                          "traj.*xtc")))
-    # cull empty files and duplicate trajectory names
-    xtcs=[]
-    xtcbase=[]
-    try:
-        for file in xtcso:
-            st=os.stat(file)
-            base=os.path.split(file)[1]
-            if st.st_size>0:
-                if base not in xtcbase:
-                    xtcs.append(file)
-                    xtcbase.append(base)
-                else:
-                    # there already was a file with this name. Overwrite
-                    # it because mdrun wasn't aware of it when writing.
-                    ind=xtcbase.index(base)
-                    xtcs[ind]=file
-    except OSError:
-        pass
-
-    # concatenate them
-    xtcoutname=os.path.join(outDir, "traj.xtc")
-    if len(xtcs) > 0:
-        cmd = cmdnames.trjcat.split() + ["-f"]
-        cmd.extend(xtcs)
-        cmd.extend(["-o", xtcoutname])
-        stdo=open(os.path.join(persDir,"trjcat_xtc.out"),"w")
-        sp=subprocess.Popen(cmd, stdout=stdo, stderr=subprocess.STDOUT)
-        sp.communicate(None)
-        stdo.close()
-        fo.setOut('xtc', FileValue(xtcoutname))
-    # do the trrs
-    trrso = sorted(glob.glob(os.path.join(persDir, "run_???",
-                                          "traj.*trr")))
-    # cull empty files and duplicate trajectory names
-    trrs=[]
-    trrbase=[]
-    try:
-        for file in trrso:
-            st=os.stat(file)
-            base=os.path.split(file)[1]
-            if st.st_size>0:
-                if base not in trrbase:
-                    trrs.append(file)
-                    trrbase.append(base)
-                else:
-                    # there already was a file with this name. Overwrite
-                    # it because mdrun wasn't aware of it when writing.
-                    ind=trrbase.index(base)
-                    trrs[ind]=file
-    except OSError:
-        pass
-    # concatenate them
-    trroutname=os.path.join(outDir, "traj.trr")
-    if len(trrs) > 0:
-        cmd = cmdnames.trjcat.split() + ["-f"]
-        cmd.extend(trrs)
-        cmd.extend(["-o", trroutname])
-        stdo=open(os.path.join(persDir,"trjcat_trr.out"),"w")
-        sp=subprocess.Popen(cmd, stdout=stdo, stderr=subprocess.STDOUT)
-        sp.communicate(None)
-        stdo.close()
-        fo.setOut('trr', FileValue(trroutname))
-    # and the edrs
-    edrso = glob.glob(os.path.join(persDir, "run_???", "ener.*edr"))
-    # cull empty files and duplicate trajectory names
-    edrs=[]
-    edrbase=[]
-    try:
-        for file in edrso:
-            st=os.stat(file)
-            base=os.path.split(file)[1]
-            if st.st_size>0:
-                if base not in edrbase:
-                    edrs.append(file)
-                    edrbase.append(base)
-                else:
-                    # there already was a file with this name. Overwrite
-                    # it because mdrun wasn't aware of it when writing.
-                    ind=edrbase.index(base)
-                    log.debug("Overwriting existing edr file %s with %s" % (edrs[ind], file))
-                    edrs[ind]=file
-    except OSError:
-        pass
-    edroutname=os.path.join(outDir, "ener.edr")
-    if len(edrs) > 1:
-        log.debug("Concatenating edr files: %s" % edrs)
-    # concatenate them
-    if len(edrs) > 0:
-        cmd = cmdnames.eneconv.split() + ["-f"]
-        cmd.extend(edrs)
-        cmd.extend(["-o", edroutname])
-        stdo=open(os.path.join(persDir,"eneconv.out"),"w")
-        sp=subprocess.Popen(cmd, stdout=stdo, stderr=subprocess.STDOUT)
-        sp.communicate(None)
-        stdo.close()
-        log.debug("Setting edr output to %s" % edroutname)
-        fo.setOut('edr', FileValue(edroutname))
+    # the trajectory and energy parts are listed in a manifest; they are
+    # only concatenated if asked for. The run directories are removed when
+    # the run is finished, so the manifest lists links to the parts in the
+    # output directory.
+    manifest=trajparts.updateManifest(persDir)
+    manifest.linkParts(os.path.join(outDir, trajparts.partsDirName))
+    partsName=os.path.join(outDir, trajparts.manifestName)
+    manifest.write(partsName)
+    fo.setOut('parts', FileValue(partsName))
+    if concat:
+        xtcoutname=trajparts.concatenate(manifest, 'xtc',
+                                         os.path.join(outDir, "traj.xtc"),
+                                         os.path.join(persDir,
+                                                      "trjcat_xtc.out"))
+        if xtcoutname is not None:
+            fo.setOut('xtc', FileValue(xtcoutname))
+        trroutname=trajparts.concatenate(manifest, 'trr',
+                                         os.path.join(outDir, "traj.trr"),
+                                         os.path.join(persDir,
+                                                      "trjcat_trr.out"))
+        if trroutname is not None:
+            fo.setOut('trr', FileValue(trroutname))
+        edroutname=trajparts.concatenate(manifest, 'edr',
+                                         os.path.join(outDir, "ener.edr"),
+                                         os.path.join(persDir, "eneconv.out"))
+        if edroutname is not None:
+            log.debug("Setting edr output to %s" % edroutname)
+            fo.setOut('edr', FileValue(edroutname))
     # do the stdout
     stdouto = glob.glob(os.path.join(persDir, "run_???", "stdout"))
     stdoutname=os.path.join(outDir, "stdout")
@@ -534,7 +428,8 @@ def mdrun(inp):
         if rsrc.max.get('cores') is None:
             confFile=os.path.join(persDir, 'conf.gro')
             extractConf(newtpr, confFile)
-            tune.tune(rsrc, confFile, newtpr, persDir)
+            tune.tune(rsrc, confFile, newtpr, persDir,
+                      cacheDir=inp.getBaseDir())
         if inp.cmd is not None:
             log.debug("Canceling commands")
             fo.cancelPrevCommands()
@@ -553,17 +448,20 @@ def mdrun(inp):
             log.debug("Extracting data. ")
             # confout exists. we're finished. Concatenate all the runs if
             # we need to, but first create the output dict
-            extractData(confout, outDir, persDir, fo)
+            extractData(confout, outDir, persDir, fo,
+                        inp.getInput('concatenate') is not False)
             return fo
 
     tfc=TrajFileCollection(persDir)
+    # list any new trajectory parts
+    trajparts.updateManifest(persDir)
     lastDir = tfc.getLastDir()
     # first check whether we got an error code back
     if (inp.cmd is not None) and inp.cmd.getReturncode()!=0:
         # there was a problem. Check the log
         if lastDir:
             stde=os.path.join(lastDir, "stderr")
-            if checkErr(stde, rsrc, newtpr, persDir):
+            if checkErr(stde, rsrc, newtpr, persDir, inp.getBaseDir()):
                 if os.path.exists(stde):
                     stdef=open(stde, 'r')
                     errmsg=unicode(stdef.read(), errors='ignore')
@@ -632,7 +530,8 @@ def mdrun(inp):
                 confout=tfc.checkpointToConfout()
                 if confout:
                     log.debug("Extracting data.")
-                    extractData([confout], outDir, persDir, fo)
+                    extractData([confout], outDir, persDir, fo,
+                                inp.getInput('concatenate') is not False)
                     return fo
             else:
                 log.debug("Last run did not produce any output files. Cannot generate coordinates from checkpoint.")
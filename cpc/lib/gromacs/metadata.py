@@ -0,0 +1,219 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Cached metadata of checkpoint and run input (tpr) files.
+
+   The mdrun controllers need the step number of the last checkpoint, the
+   number of steps and initial step of the run input and sometimes the
+   output file numbers in the checkpoint, every time they run. These are
+   cached per file, keyed by the absolute file name and validated against
+   the file's size and modification time.
+
+   The checkpoint step number is read directly from the checkpoint header
+   when possible; everything else comes from gmxdump, which is then only
+   run once per file version."""
+
+import collections
+import os
+import re
+import struct
+import subprocess
+import threading
+import logging
+
+
+log=logging.getLogger(__name__)
+
+
+# the max. number of files to keep metadata for
+maxCacheEntries=256
+
+_cache=collections.OrderedDict()
+_cacheLock=threading.Lock()
+
+# the magic number at the start of a checkpoint file
+cptMagic=171817
+
+
+def _getEntry(filename):
+    """Get the cached metadata dict for a file, or a new empty one if the
+       file isn't known or has changed. Metadata can be added to the
+       returned dict."""
+    path=os.path.abspath(filename)
+    st=os.stat(path)
+    stamp=(st.st_size, st.st_mtime)
+    with _cacheLock:
+        entry=_cache.get(path)
+        if entry is not None and entry[0] == stamp:
+            del _cache[path]
+            _cache[path]=entry
+            return entry[1]
+        data=dict()
+        _cache[path]=(stamp, data)
+        while len(_cache) > maxCacheEntries:
+            _cache.popitem(last=False)
+        return data
+
+def clearCache():
+    """Forget all cached metadata."""
+    with _cacheLock:
+        _cache.clear()
+
+
+class _XdrReader(object):
+    """Reader for the XDR items in a string."""
+    def __init__(self, data):
+        self.data=data
+        self.pos=0
+
+    def readInt(self):
+        ret=struct.unpack('>i', self.data[self.pos:self.pos+4])[0]
+        self.pos+=4
+        return ret
+
+    def readUInt(self):
+        ret=struct.unpack('>I', self.data[self.pos:self.pos+4])[0]
+        self.pos+=4
+        return ret
+
+    def readString(self):
+        length=self.readUInt()
+        if length > 1024:
+            raise ValueError("String too long")
+        ret=self.data[self.pos:self.pos+length]
+        self.pos+=(length+3) & ~3
+        return ret
+
+def readCheckpointStep(cptFile):
+    """Read the step number from the header of a checkpoint file.
+
+       Returns the step number, or None if the header couldn't be read."""
+    try:
+        inf=open(cptFile, 'rb')
+        try:
+            rd=_XdrReader(inf.read(16384))
+        finally:
+            inf.close()
+        if rd.readInt() != cptMagic:
+            return None
+        # version, build time, build user, build host, generating program
+        # and generation time
+        for i in range(6):
+            rd.readString()
+        fileVersion=rd.readInt()
+        if fileVersion >= 13:
+            rd.readInt() # double precision
+        if fileVersion >= 12:
+            rd.readString() # generating host
+        rd.readInt() # number of atoms
+        rd.readInt() # number of T-coupling groups
+        if fileVersion >= 10:
+            rd.readInt() # Nose-Hoover T-chains
+        if fileVersion >= 11:
+            rd.readInt() # Nose-Hoover T-chains for the barostat
+        if fileVersion >= 14:
+            rd.readInt() # number of lambda states
+        integrator=rd.readInt()
+        if fileVersion >= 3:
+            simulationPart=rd.readInt()
+        else:
+            simulationPart=1
+        if fileVersion >= 5:
+            step=(rd.readInt() << 32) | rd.readUInt()
+        else:
+            step=rd.readInt()
+    except (IOError, ValueError, struct.error):
+        return None
+    # a header layout we don't know shifts the fields: check that they
+    # make sense.
+    if integrator < 0 or integrator > 64 or simulationPart < 1 or step < 0:
+        log.debug("Unexpected checkpoint header in %s"%cptFile)
+        return None
+    return step
+
+def _dumpCheckpoint(cmdnames, cptFile):
+    """Run gmxdump on a checkpoint file.
+
+       Returns a tuple of the step number and the highest output file
+       number."""
+    stepnr=0
+    newFileNumber=0
+    cmd = cmdnames.gmxdump.split() + ['-cp', cptFile]
+    sp=subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT)
+    stepline=re.compile('step = .*')
+    outfileline=re.compile('output filename = .*')
+    for line in sp.stdout:
+        if stepline.match(line):
+            stepnr=int(line.split('=')[1])
+        elif outfileline.match(line):
+            filename=line.split('=')[1]
+            nrs=re.findall(r'\d+', filename)
+            if len(nrs)>0:
+                nr=int(nrs[-1])
+                if nr > newFileNumber:
+                    newFileNumber = nr
+    sp.stdout.close()
+    sp.wait()
+    return (stepnr, newFileNumber)
+
+def getCheckpointStep(cmdnames, cptFile):
+    """Get the step number of a checkpoint file."""
+    data=_getEntry(cptFile)
+    if 'step' not in data:
+        step=readCheckpointStep(cptFile)
+        if step is not None:
+            data['step']=step
+        else:
+            (data['step'], data['file_number'])=_dumpCheckpoint(cmdnames,
+                                                                cptFile)
+    return data['step']
+
+def getCheckpointFileNumber(cmdnames, cptFile):
+    """Get the highest output file number in a checkpoint file."""
+    data=_getEntry(cptFile)
+    if 'file_number' not in data:
+        (data['step'], data['file_number'])=_dumpCheckpoint(cmdnames,
+                                                            cptFile)
+    return data['file_number']
+
+def getTprSteps(cmdnames, tprFile):
+    """Get the number of steps and the initial step of a run input file.
+
+       Returns a tuple of nsteps and init-step."""
+    data=_getEntry(tprFile)
+    if 'nsteps' not in data:
+        nsteps=1
+        firststep=0
+        cmd = cmdnames.gmxdump.split() + ['-s', tprFile]
+        sp=subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+        stepline=re.compile('[ ]*nsteps.*')
+        firststepline=re.compile('[ ]*init-step.*')
+        for line in sp.stdout:
+            if stepline.match(line):
+                nsteps=int(line.split()[2])
+            elif firststepline.match(line):
+                firststep=int(line.split()[2])
+                break
+        sp.stdout.close()
+        sp.wait()
+        data['init_step']=firststep
+        data['nsteps']=nsteps
+    return (data['nsteps'], data['init_step'])
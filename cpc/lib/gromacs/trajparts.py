@@ -0,0 +1,417 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Multi-part trajectory output of segmented mdrun runs.
+
+   A segmented run leaves its trajectory and energy output as part files in
+   the run_??? directories of its persistence directory. Instead of
+   concatenating these into new files whenever a run finishes, the parts are
+   listed in a manifest: a JSON file with, for each output kind (xtc, trr,
+   edr), the list of part files with their size, modification time, and
+   (where it can be read from the file headers) the number of frames and the
+   time range. The manifest is updated incrementally as parts arrive: parts
+   that haven't changed are not read again.
+
+   Downstream code can read the parts directly (see readManifest() and
+   TrajManifest.getParts()), or concatenate them into a single file on
+   demand with concatenate() or the concat_parts function."""
+
+import os
+import glob
+import json
+import shutil
+import struct
+import subprocess
+import logging
+
+
+log=logging.getLogger(__name__)
+
+
+from cpc.dataflow import FileValue
+import cpc.util
+import cmds
+
+
+class TrajPartsError(cpc.util.CpcError):
+    pass
+
+
+# the name of the manifest in an mdrun persistence directory
+manifestName="traj_parts.json"
+
+# the directory in an mdrun output directory that holds the parts listed in
+# its manifest
+partsDirName="parts"
+
+# the part file patterns for the output kinds
+partPatterns={ 'xtc' : "traj.*xtc",
+               'trr' : "traj.*trr",
+               'edr' : "ener.*edr" }
+
+
+def collectParts(persDir, pattern):
+    """Get the non-empty part files matching a pattern in the run
+       directories of persDir, in order. If a later run directory has a part
+       with the same name as an earlier one, it replaces the earlier one,
+       because mdrun wasn't aware of it when writing."""
+    partso = sorted(glob.glob(os.path.join(persDir, "run_???", pattern)))
+    parts=[]
+    partbase=[]
+    for file in partso:
+        try:
+            st=os.stat(file)
+        except OSError:
+            continue
+        base=os.path.split(file)[1]
+        if st.st_size>0:
+            if base not in partbase:
+                parts.append(file)
+                partbase.append(base)
+            else:
+                ind=partbase.index(base)
+                log.debug("Overwriting existing part %s with %s"%
+                          (parts[ind], file))
+                parts[ind]=file
+    return parts
+
+
+def _xdrPad(n):
+    return (n+3) & ~3
+
+def scanXtc(filename):
+    """Read the frame headers of an xtc file.
+
+       Returns a tuple of the number of frames, the first and the last time,
+       or None if the file couldn't be read."""
+    nframes=0
+    firstTime=None
+    lastTime=None
+    inf=open(filename, 'rb')
+    try:
+        while True:
+            header=inf.read(56)
+            if len(header) == 0:
+                break
+            if len(header) < 56:
+                return None
+            (magic, natoms, step, time)=struct.unpack('>iiif', header[0:16])
+            if magic != 1995:
+                return None
+            if natoms <= 9:
+                inf.seek(natoms*12, os.SEEK_CUR)
+            else:
+                comp=inf.read(36)
+                if len(comp) < 36:
+                    return None
+                nbytes=struct.unpack('>i', comp[32:36])[0]
+                inf.seek(_xdrPad(nbytes), os.SEEK_CUR)
+            if firstTime is None:
+                firstTime=time
+            lastTime=time
+            nframes+=1
+    except struct.error:
+        return None
+    finally:
+        inf.close()
+    return (nframes, firstTime, lastTime)
+
+def scanTrr(filename):
+    """Read the frame headers of a trr file.
+
+       Returns a tuple of the number of frames, the first and the last time,
+       or None if the file couldn't be read."""
+    nframes=0
+    firstTime=None
+    lastTime=None
+    inf=open(filename, 'rb')
+    try:
+        while True:
+            start=inf.read(12)
+            if len(start) == 0:
+                break
+            if len(start) < 12:
+                return None
+            (magic, slen, strlen)=struct.unpack('>iii', start)
+            if magic != 1993:
+                return None
+            inf.seek(_xdrPad(strlen), os.SEEK_CUR)
+            sizes=struct.unpack('>13i', inf.read(52))
+            (ir_size, e_size, box_size, vir_size, pres_size, top_size,
+             sym_size, x_size, v_size, f_size, natoms, step, nre)=sizes
+            # the precision follows from the size of the data
+            if box_size > 0:
+                realSize=box_size/9
+            elif x_size > 0:
+                realSize=x_size/(3*natoms)
+            elif v_size > 0:
+                realSize=v_size/(3*natoms)
+            elif f_size > 0:
+                realSize=f_size/(3*natoms)
+            else:
+                return None
+            if realSize == 8:
+                (time, lam)=struct.unpack('>dd', inf.read(16))
+            elif realSize == 4:
+                (time, lam)=struct.unpack('>ff', inf.read(8))
+            else:
+                return None
+            inf.seek(ir_size + e_size + box_size + vir_size + pres_size +
+                     top_size + sym_size + x_size + v_size + f_size,
+                     os.SEEK_CUR)
+            if firstTime is None:
+                firstTime=time
+            lastTime=time
+            nframes+=1
+    except (struct.error, ZeroDivisionError):
+        return None
+    finally:
+        inf.close()
+    return (nframes, firstTime, lastTime)
+
+_scanners={ 'xtc' : scanXtc,
+            'trr' : scanTrr }
+
+
+class TrajManifest(object):
+    """The manifest of the part files of a segmented run's output."""
+    def __init__(self, filename):
+        """Read a manifest, or start an empty one if it doesn't exist.
+
+           filename = the manifest file name"""
+        self.filename=os.path.abspath(filename)
+        # a dict of lists of part dicts, indexed by kind
+        self.parts=dict()
+        try:
+            inf=open(self.filename, 'r')
+            try:
+                data=json.load(inf)
+            finally:
+                inf.close()
+        except IOError:
+            data=dict()
+        except ValueError:
+            log.info("Ignoring unreadable trajectory manifest %s"%filename)
+            data=dict()
+        baseDir=os.path.dirname(self.filename)
+        for kind, parts in data.get('parts', dict()).iteritems():
+            for part in parts:
+                part['file']=os.path.normpath(os.path.join(baseDir,
+                                                           part['file']))
+            self.parts[kind]=parts
+
+    def update(self, persDir):
+        """Update the manifest with the part files in persDir's run
+           directories. Only new or changed parts are read.
+
+           Returns whether the manifest changed."""
+        changed=False
+        for kind, pattern in partPatterns.iteritems():
+            known=dict([ (part['file'], part) for part in
+                         self.parts.get(kind, []) ])
+            newParts=[]
+            for filename in collectParts(persDir, pattern):
+                filename=os.path.abspath(filename)
+                try:
+                    st=os.stat(filename)
+                    part=known.get(filename)
+                    if (part is None or part['size'] != st.st_size or
+                        part['mtime'] != st.st_mtime):
+                        part=self._scanPart(kind, filename, st)
+                        changed=True
+                except (OSError, IOError):
+                    # the part was removed after it was listed
+                    log.debug("Part %s disappeared"%filename)
+                    continue
+                newParts.append(part)
+            if len(newParts) != len(self.parts.get(kind, [])):
+                changed=True
+            if len(newParts) > 0:
+                self.parts[kind]=newParts
+            elif kind in self.parts:
+                del self.parts[kind]
+        return changed
+
+    def _scanPart(self, kind, filename, st):
+        """Make the manifest entry for a part file."""
+        part={ 'file' : filename,
+               'size' : st.st_size,
+               'mtime' : st.st_mtime,
+               'frames' : None,
+               'start_time' : None,
+               'end_time' : None }
+        scanner=_scanners.get(kind)
+        if scanner is not None:
+            ret=scanner(filename)
+            if ret is None:
+                log.debug("Couldn't read frame headers of %s"%filename)
+            else:
+                (part['frames'], part['start_time'], part['end_time'])=ret
+        return part
+
+    def write(self, filename=None):
+        """Write the manifest to its file, or to another file name. Part file
+           names are written relative to the manifest's directory."""
+        if filename is None:
+            filename=self.filename
+        baseDir=os.path.dirname(os.path.abspath(filename))
+        data={ 'parts' : dict() }
+        for kind, parts in self.parts.iteritems():
+            outParts=[]
+            for part in parts:
+                outPart=dict(part)
+                outPart['file']=os.path.relpath(part['file'], baseDir)
+                outParts.append(outPart)
+            data['parts'][kind]=outParts
+        tmpFilename="%s.tmp"%filename
+        outf=open(tmpFilename, 'w')
+        try:
+            json.dump(data, outf, indent=1)
+        finally:
+            outf.close()
+        os.rename(tmpFilename, filename)
+
+    def linkParts(self, dirname):
+        """Put all part files in place in dirname with linkFile(), and list
+           those files in the manifest instead. The run directories of a
+           persistence directory are removed once a run is finished, so an
+           output manifest must not point into them.
+
+           dirname = the directory to put the part files in"""
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        for kind, parts in self.parts.iteritems():
+            for part in parts:
+                filename=os.path.join(dirname,
+                                      os.path.basename(part['file']))
+                linkFile(part['file'], filename)
+                st=os.stat(filename)
+                part['file']=os.path.abspath(filename)
+                part['size']=st.st_size
+                part['mtime']=st.st_mtime
+
+    def getKinds(self):
+        """Get the list of output kinds that have parts."""
+        return self.parts.keys()
+
+    def getParts(self, kind):
+        """Get the list of part file names of an output kind."""
+        return [ part['file'] for part in self.parts.get(kind, []) ]
+
+    def getPartInfo(self, kind):
+        """Get the list of part dicts (with the keys file, size, mtime,
+           frames, start_time and end_time) of an output kind."""
+        return [ dict(part) for part in self.parts.get(kind, []) ]
+
+    def getTimeRange(self, kind):
+        """Get the time range of an output kind as a tuple of start and end
+           time, or None if it isn't known."""
+        parts=self.parts.get(kind, [])
+        if len(parts) == 0:
+            return None
+        for part in parts:
+            if part['start_time'] is None:
+                return None
+        return (min([ part['start_time'] for part in parts ]),
+                max([ part['end_time'] for part in parts ]))
+
+
+def updateManifest(persDir):
+    """Update the manifest in an mdrun persistence directory with any new
+       parts.
+
+       Returns the TrajManifest."""
+    manifest=TrajManifest(os.path.join(persDir, manifestName))
+    if manifest.update(persDir) or not os.path.exists(manifest.filename):
+        manifest.write()
+    return manifest
+
+def readManifest(filename):
+    """Read a manifest file, as written into an mdrun output directory."""
+    return TrajManifest(filename)
+
+
+def linkFile(src, dst):
+    """Put a file in place as dst: a hard link to src if possible, or else a
+       copy. An existing dst is replaced rather than written to, because it
+       may itself be a link."""
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+def concatenate(manifest, kind, outFilename, logFilename=None):
+    """Concatenate the parts of an output kind into a single file with
+       trjcat or eneconv. A single part is linked (or copied) instead.
+
+       manifest = the TrajManifest
+       kind = the output kind (xtc, trr or edr)
+       outFilename = the output file name
+       logFilename = the file name for the tool's output, or None
+
+       Returns outFilename, or None if there are no parts."""
+    parts=manifest.getParts(kind)
+    if len(parts) == 0:
+        return None
+    if os.path.exists(outFilename):
+        os.remove(outFilename)
+    if len(parts) == 1:
+        linkFile(parts[0], outFilename)
+        return outFilename
+    cmdnames = cmds.GromacsCommands()
+    if kind == 'edr':
+        cmd = cmdnames.eneconv.split()
+    else:
+        cmd = cmdnames.trjcat.split()
+    cmd += ["-f"] + parts + ["-o", outFilename]
+    if logFilename is not None:
+        stdo=open(logFilename, "w")
+    else:
+        stdo=open(os.devnull, "w")
+    try:
+        sp=subprocess.Popen(cmd, stdout=stdo, stderr=subprocess.STDOUT)
+        sp.communicate(None)
+    finally:
+        stdo.close()
+    if sp.returncode != 0:
+        raise TrajPartsError("Error concatenating %s parts"%kind)
+    return outFilename
+
+
+def concat_parts(inp):
+    """Concatenate the parts of an output kind of a run's manifest on
+       demand."""
+    if inp.testing():
+        # if there are no inputs, we're testing wheter the command can run
+        return
+    fo=inp.getFunctionOutput()
+    manifest=readManifest(inp.getInput('parts'))
+    kind=inp.getInput('kind')
+    if kind not in partPatterns:
+        raise TrajPartsError("Unknown output kind '%s'"%kind)
+    outFilename=os.path.join(inp.getOutputDir(),
+                             "%s.%s"%("ener" if kind == 'edr' else "traj",
+                                      kind))
+    if concatenate(manifest, kind, outFilename,
+                   os.path.join(inp.getOutputDir(), "concat.out")):
+        fo.setOut('file', FileValue(outFilename))
+    return fo
@@ -28,6 +28,9 @@ import subprocess
 import logging
 import time
 import math
+import json
+import threading
+import multiprocessing
 
 
 log=logging.getLogger(__name__)
@@ -57,27 +60,42 @@ def primefactors(x):
     return factorlist
 
 
-def tryRun(tprFile, runDir, Ncores):
-    """Try to run mdrun with Ncores cores."""
-    cmdnames = cmds.GromacsCommands()
-    cmdlist = cmdnames.mdrun.split()
-    cmdlist += ["-nt", "%d"%Ncores, "-s", tprFile, "-rcon", "0.7",
-                "-maxh", "0.0005" ]
-    proc=subprocess.Popen(cmdlist, 
-                          stdin=None,
-                          stdout=subprocess.PIPE,
-                          stderr=subprocess.STDOUT,
-                          cwd=runDir)
-    (stdo, stde) = proc.communicate(None)
-    if proc.returncode != 0:
-        return (False, stdo)
-    return (True, stdo)
-
-def tune(rsrc, confFile, tprFile, testRunDir, Nmax=None):
-    """Set max. run based on configuration file."""
-    # TODO: fix this. For now, only count the number of particles and
-    # the system size.
-    # read the system size 
+# the name of the file in the project directory with the tuning results
+cacheFilename="_mdrun_tune.json"
+# the in-memory tuning results, as a dict of dicts: project directory to
+# (key string to number of cores)
+_cache=dict()
+_cacheLock=threading.Lock()
+# the mdrun version strings, indexed by mdrun command
+_versions=dict()
+
+
+def mdrunVersion(cmdnames):
+    """Get a string that identifies the mdrun executable's version."""
+    with _cacheLock:
+        if cmdnames.mdrun in _versions:
+            return _versions[cmdnames.mdrun]
+    version=cmdnames.mdrun
+    try:
+        proc=subprocess.Popen(cmdnames.mdrun.split() + ["-version"],
+                              stdin=None,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+        (stdo, stde) = proc.communicate(None)
+        match=re.search(r'VERSION\s+(\S+)', stdo)
+        if match is not None:
+            version="%s %s"%(cmdnames.mdrun, match.group(1))
+    except OSError:
+        pass
+    with _cacheLock:
+        _versions[cmdnames.mdrun]=version
+    return version
+
+def readConf(confFile):
+    """Read the number of atoms and the box size from a configuration file.
+
+       Returns a tuple of the number of atoms and a list of box vector
+       components."""
     inf=open(confFile, 'r')
     i=0
     for line in inf:
@@ -85,9 +103,152 @@ def tune(rsrc, confFile, tprFile, testRunDir, Nmax=None):
         if i==1:
             N=int(line)
         i+=1
-    sx=float(lastsplit[0])
-    sy=float(lastsplit[0])
-    sz=float(lastsplit[0])
+    inf.close()
+    return (N, [ float(x) for x in lastsplit ])
+
+def cacheKey(N, box, version):
+    """Make the key of a tuning result."""
+    return "%d %s %s"%(N, " ".join([ "%.3f"%x for x in box ]), version)
+
+def _readCache(cacheDir):
+    """Get the tuning results for a project directory. Must be called with
+       _cacheLock held."""
+    results=_cache.get(cacheDir)
+    if results is None:
+        results=dict()
+        try:
+            inf=open(os.path.join(cacheDir, cacheFilename), 'r')
+            try:
+                results=json.load(inf)
+            finally:
+                inf.close()
+        except (IOError, ValueError):
+            pass
+        _cache[cacheDir]=results
+    return results
+
+def getCached(cacheDir, key):
+    """Get the number of cores for a tuning key, or None if it isn't known.
+    """
+    with _cacheLock:
+        return _readCache(cacheDir).get(key)
+
+def setCached(cacheDir, key, Ncores):
+    """Store the number of cores for a tuning key in the project's tuning
+       results."""
+    with _cacheLock:
+        results=_readCache(cacheDir)
+        results[key]=Ncores
+        outFilename=os.path.join(cacheDir, cacheFilename)
+        tmpFilename="%s.%d.tmp"%(outFilename, os.getpid())
+        try:
+            outf=open(tmpFilename, 'w')
+            try:
+                json.dump(results, outf)
+            finally:
+                outf.close()
+            os.rename(tmpFilename, outFilename)
+        except (IOError, OSError) as e:
+            log.info("Couldn't write tuning results: %s"%str(e))
+
+def candidates(Nmax):
+    """Get the list of core counts to try, largest first."""
+    ret=[]
+    while Nmax >= 1:
+        # make sure we return a sane number:
+        # It's either 4 or smaller, 6, or has at least 3 prime factors. 
+        if (Nmax < 5 or Nmax == 6 or 
+            (Nmax < 32 and len(primefactors(Nmax)) > 2) or
+            (Nmax < 32 and len(primefactors(Nmax)) > 3) ): 
+            ret.append(Nmax)
+        Nmax -= 1 
+    return ret
+
+
+def startRun(tprFile, runDir, Ncores):
+    """Start a trial mdrun with Ncores cores in runDir.
+
+       Returns a tuple of the process and its output file name."""
+    cmdnames = cmds.GromacsCommands()
+    cmdlist = cmdnames.mdrun.split()
+    cmdlist += ["-nt", "%d"%Ncores, "-s", tprFile, "-rcon", "0.7",
+                "-maxh", "0.0005" ]
+    if not os.path.exists(runDir):
+        os.makedirs(runDir)
+    outFilename=os.path.join(runDir, "stdout")
+    outf=open(outFilename, 'w')
+    try:
+        proc=subprocess.Popen(cmdlist, 
+                              stdin=None,
+                              stdout=outf,
+                              stderr=subprocess.STDOUT,
+                              cwd=runDir)
+    finally:
+        outf.close()
+    return (proc, outFilename)
+
+def tryRuns(tprFile, testRunDir, candidateList, Navail):
+    """Try to run mdrun with the core counts in candidateList (largest
+       first), running as many trials at the same time as fit in Navail
+       cores.
+
+       Returns a tuple of the largest number of cores that works (or None)
+       and the output of the last failed run."""
+    stdo=""
+    remaining=list(candidateList)
+    while len(remaining) > 0:
+        # the next batch of trials: always at least one.
+        batch=[ remaining.pop(0) ]
+        used=batch[0]
+        while len(remaining) > 0 and used + remaining[0] <= Navail:
+            used += remaining[0]
+            batch.append(remaining.pop(0))
+        runs=[]
+        for Ncores in batch:
+            runDir=os.path.join(testRunDir, "tune_%d"%Ncores)
+            runs.append( (Ncores, runDir) + startRun(tprFile, runDir, Ncores) )
+        best=None
+        for (Ncores, runDir, proc, outFilename) in runs:
+            proc.wait()
+            if proc.returncode == 0:
+                if best is None or Ncores > best:
+                    best=Ncores
+            else:
+                stdo=open(outFilename, 'r').read()
+            shutil.rmtree(runDir, ignore_errors=True)
+        if best is not None:
+            return (best, stdo)
+    return (None, stdo)
+
+def tune(rsrc, confFile, tprFile, testRunDir, Nmax=None, cacheDir=None):
+    """Set max. run based on configuration file.
+
+       rsrc = the Resources object to set
+       confFile = the configuration file of the system
+       tprFile = the run input file to try
+       testRunDir = the directory to run the trials in
+       Nmax = the max. number of cores, or None to estimate it from the
+              system size. If given, any cached result is not used (it is
+              given after a run failed with the cached number of cores).
+       cacheDir = the directory (usually the project's base directory) to
+                  keep the tuning results in, or None"""
+    # TODO: fix this. For now, only count the number of particles and
+    # the system size.
+    # read the system size 
+    (N, box)=readConf(confFile)
+    key=None
+    if cacheDir is not None:
+        key=cacheKey(N, box, mdrunVersion(cmds.GromacsCommands()))
+        if Nmax is None:
+            Ncached=getCached(cacheDir, key)
+            if Ncached is not None:
+                log.debug("Using tuned number of cores %d"%Ncached)
+                rsrc.min.set('cores', 1)
+                rsrc.max.set('cores', Ncached)
+                return
+    sx=box[0]
+    sy=box[0]
+    sz=box[0]
     # as a rough estimate, the max. number of cells is 1 per rounded nm
     mincellsize=1.2
     Nsize = int(sx/mincellsize)*int(sy/mincellsize)*int(sz/mincellsize)
@@ -98,19 +259,15 @@ def tune(rsrc, confFile, tprFile, testRunDir, Nmax=None):
         Nmax = min(Nsize, NN)
     Nmax = max(1, Nmax)
 
-    while True:
-        # make sure we return a sane number:
-        # It's either 4 or smaller, 6, or has at least 3 prime factors. 
-        if (Nmax < 5 or Nmax == 6 or 
-            (Nmax < 32 and len(primefactors(Nmax)) > 2) or
-            (Nmax < 32 and len(primefactors(Nmax)) > 3) ): 
-            canRun, stdo=tryRun(tprFile, testRunDir, Nmax)
-            if canRun:
-                break
-        Nmax -= 1 
-        if Nmax < 1:
-            raise GromacsError("Can't run simulation: %s"%stdo)
+    try:
+        Navail=multiprocessing.cpu_count()
+    except NotImplementedError:
+        Navail=1
+    (Nbest, stdo)=tryRuns(tprFile, testRunDir, candidates(Nmax), Navail)
+    if Nbest is None:
+        raise GromacsError("Can't run simulation: %s"%stdo)
+    if key is not None:
+        setCached(cacheDir, key, Nbest)
     rsrc.min.set('cores', 1)
-    rsrc.max.set('cores', Nmax)
-
+    rsrc.max.set('cores', Nbest)
 
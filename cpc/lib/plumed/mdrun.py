@@ -45,13 +45,14 @@ import cpc.util
 import cpc.lib.gromacs.tune as tune
 import cpc.lib.gromacs.iterate as iterate
 from cpc.lib.gromacs import cmds
+from cpc.lib.gromacs import trajparts
 from cpc.lib.gromacs.mdrun import extractConf, TrajFileCollection, MdrunError
 
 class PLUMEDError(cpc.util.CpcError):
    pass
 
 
-def checkErr(stde, rsrc, tpr, persDir):
+def checkErr(stde, rsrc, tpr, persDir, cacheDir=None):
     """Check whether an error condition is recoverable. 
 
        Returns True if there is an issue, False if the error is recoverable"""
@@ -76,7 +77,8 @@ def checkErr(stde, rsrc, tpr, persDir):
                 log.debug("Found domain decomp error")
                 confFile=os.path.join(persDir, 'conf.gro')
                 extractConf(tpr, confFile)
-                tune.tune(rsrc, confFile, tpr, persDir, rsrc.max.get('cores')-1)
+                tune.tune(rsrc, confFile, tpr, persDir, rsrc.max.get('cores')-1,
+                          cacheDir)
                 OK=True
                 break
     inf.close()
@@ -84,103 +86,46 @@ def checkErr(stde, rsrc, tpr, persDir):
 
 
 
-def extractData(confout, outDir, persDir, fo):
-    """Concatenate all output data from the partial runs into the end results"""
-    cmdnames = cmds.GromacsCommands()
+def extractData(confout, outDir, persDir, fo, concat=True):
+    """Collect all output data from the partial runs into the end results.
+
+       If concat is False, the trajectory and energy parts are only listed
+       in the parts output, and not concatenated."""
     #outputs=dict()
     # Concatenate stuff
     confoutPath=os.path.join(outDir, "confout.gro")
-    shutil.copy(confout[0], confoutPath ) 
+    trajparts.linkFile(confout[0], confoutPath)
     #outputs['conf'] = Value(confoutPath, 
     #                        inp.function.getOutput('conf').getType())
     fo.setOut('conf', FileValue(confoutPath))
-    # fix the xtc files
-    xtcso = sorted(glob.glob(os.path.join(persDir, "run_???", 
-                                          "traj.part*.xtc")))
-    # cull empty files and duplicate trajectory names
-    xtcs=[]
-    xtcbase=[]
-    for file in xtcso:
-        st=os.stat(file)
-        base=os.path.split(file)[1]
-        if st.st_size>0:
-            if base not in xtcbase:
-                xtcs.append(file)
-                xtcbase.append(base) 
-            else:
-                # there already was a file with this name. Overwrite
-                # it because mdrun wasn't aware of it when writing.
-                ind=xtcbase.index(base)
-                xtcs[ind]=file
-
-    # concatenate them
-    xtcoutname=os.path.join(outDir, "traj.xtc")
-    if len(xtcs) > 0:
-        cmd = cmdnames.trjcat.split() + ["-f"]
-        cmd.extend(xtcs)
-        cmd.extend(["-o", xtcoutname])
-        stdo=open(os.path.join(persDir,"trjcat_xtc.out"),"w")
-        sp=subprocess.Popen(cmd, stdout=stdo, stderr=subprocess.STDOUT)
-        sp.communicate(None)
-        stdo.close()
-        fo.setOut('xtc', FileValue(xtcoutname))
-    # do the trrs
-    trrso = sorted(glob.glob(os.path.join(persDir, "run_???", 
-                                          "traj.part*.trr")))
-    # cull empty files and duplicate trajectory names
-    trrs=[]
-    trrbase=[]
-    for file in trrso:
-        st=os.stat(file)
-        base=os.path.split(file)[1]
-        if st.st_size>0:
-            if base not in trrbase:
-                trrs.append(file)
-                trrbase.append(base) 
-            else:
-                # there already was a file with this name. Overwrite
-                # it because mdrun wasn't aware of it when writing.
-                ind=trrbase.index(base)
-                trrs[ind]=file
-    # concatenate them
-    trroutname=os.path.join(outDir, "traj.trr")
-    if len(trrs) > 0:
-        cmd = cmdnames.trjcat + ["-f"]
-        cmd.extend(trrs)
-        cmd.extend(["-o", trroutname])
-        stdo=open(os.path.join(persDir,"trjcat_trr.out"),"w")
-        sp=subprocess.Popen(cmd, stdout=stdo, stderr=subprocess.STDOUT)
-        sp.communicate(None)
-        stdo.close()
-        fo.setOut('trr', FileValue(trroutname))
-    # and the edrs
-    edrso = glob.glob(os.path.join(persDir, "run_???", "ener.part*.edr"))
-    # cull empty files and duplicate trajectory names
-    edrs=[]
-    edrbase=[]
-    for file in edrso:
-        st=os.stat(file)
-        base=os.path.split(file)[1]
-        if st.st_size>0:
-            if base not in edrbase:
-                edrs.append(file)
-                edrbase.append(base) 
-            else:
-                # there already was a file with this name. Overwrite
-                # it because mdrun wasn't aware of it when writing.
-                ind=edrbase.index(base)
-                edrs[ind]=file
-    edroutname=os.path.join(outDir, "ener.edr")
-    # concatenate them
-    if len(edrs) > 0:
-        cmd = cmdnames.eneconv.split() + ["-f"]
-        cmd.extend(edrs)
-        cmd.extend(["-o", edroutname])
-        stdo=open(os.path.join(persDir,"eneconv.out"),"w")
-        sp=subprocess.Popen(cmd, stdout=stdo, stderr=subprocess.STDOUT)
-        sp.communicate(None)
-        stdo.close()
-        fo.setOut('edr', FileValue(edroutname))
+    # the trajectory and energy parts are listed in a manifest; they are
+    # only concatenated if asked for. The run directories are removed when
+    # the run is finished, so the manifest lists links to the parts in the
+    # output directory.
+    manifest=trajparts.updateManifest(persDir)
+    manifest.linkParts(os.path.join(outDir, trajparts.partsDirName))
+    partsName=os.path.join(outDir, trajparts.manifestName)
+    manifest.write(partsName)
+    fo.setOut('parts', FileValue(partsName))
+    if concat:
+        xtcoutname=trajparts.concatenate(manifest, 'xtc',
+                                         os.path.join(outDir, "traj.xtc"),
+                                         os.path.join(persDir,
+                                                      "trjcat_xtc.out"))
+        if xtcoutname is not None:
+            fo.setOut('xtc', FileValue(xtcoutname))
+        trroutname=trajparts.concatenate(manifest, 'trr',
+                                         os.path.join(outDir, "traj.trr"),
+                                         os.path.join(persDir,
+                                                      "trjcat_trr.out"))
+        if trroutname is not None:
+            fo.setOut('trr', FileValue(trroutname))
+        edroutname=trajparts.concatenate(manifest, 'edr',
+                                         os.path.join(outDir, "ener.edr"),
+                                         os.path.join(persDir, "eneconv.out"))
+        if edroutname is not None:
+            log.debug("Setting edr output to %s" % edroutname)
+            fo.setOut('edr', FileValue(edroutname))
     # do the stdout
     stdouto = glob.glob(os.path.join(persDir, "run_???", "stdout"))
     stdoutname=os.path.join(outDir, "stdout")
@@ -291,7 +236,8 @@ def mdrun(inp):
         if rsrc.max.get('cores') is None:
             confFile=os.path.join(persDir, 'conf.gro')
             extractConf(newtpr, confFile)
-            tune.tune(rsrc, confFile, newtpr, persDir)
+            tune.tune(rsrc, confFile, newtpr, persDir,
+                      cacheDir=inp.getBaseDir())
         if inp.cmd is not None:
             log.debug("Canceling commands")
             fo.cancelPrevCommands()
@@ -307,15 +253,18 @@ def mdrun(inp):
         log.debug("Extracting data. ")
         # confout exists. we're finished. Concatenate all the runs if
         # we need to, but first create the output dict
-        extractData(confout, outDir, persDir, fo)
+        extractData(confout, outDir, persDir, fo,
+                    inp.getInput('concatenate') is not False)
         return fo
     else:
         tfc=TrajFileCollection(persDir)
+        # list any new trajectory parts
+        trajparts.updateManifest(persDir)
         # first check whether we got an error code back
         if (inp.cmd is not None) and inp.cmd.getReturncode()!=0:
             # there was a problem. Check the log
             stde=os.path.join(tfc.getLastDir(), "stderr")
-            if checkErr(stde, rsrc, newtpr, persDir):
+            if checkErr(stde, rsrc, newtpr, persDir, inp.getBaseDir()):
                 if os.path.exists(stde):
                     stdef=open(stde, 'r')
                     errmsg=unicode(stdef.read(), errors='ignore')
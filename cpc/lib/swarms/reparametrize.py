@@ -61,79 +61,17 @@ def sub(x, y): return y - x
 def dist(v1, v2):
         return sum([x**2 for x in map(sub, v1, v2)])**(.5)
 
-# path length upto the nth interpolant
-# 1-based indexing following Maragliano
-def L(n, path):
-        if n==0: 
-                return 1
-        else:
-                pathlength = 0
-                for i in range(n - 1):
-                        pathlength += dist(path[i], path[i + 1])
-                return pathlength
-
-def s(m, path):
-        R = len(path) - 1
-        return (m - 1) * L(R, path) / (R - 1)
-
-def dir(v1, v2):
-        normed = []
-        d = dist(v1, v2)
-        for x in map(sub, v1, v2):
-                normed += [x / d]
-        return normed
-
-# Reparametrize the points
-# see Maragliano et al, J. Chem Phys (125), 2006
-# we use a linear interpolation in Euclidean space
-# adjusted to ensure equidistance points
-# each item in newpts is a K-length list corresponding to a point in the K-dimensional CV-space
+# The reparametrization itself is done by string_rep, with NumPy. If NumPy
+# isn't available, fall back to ext_rep_pts() below.
+try:
+    import string_rep
+except ImportError:
+    string_rep = None
+
+# Version of the reparametrization step which uses an external C-program (rep.cc) for the inner
+# loop, for when NumPy isn't available.
+# Each item in newpts is a K-length list corresponding to a point in the K-dimensional CV-space
 # (for example, K = 2*num_selected_residues for phi/psi dihedrals)
-#
-# TODO: evaluate if a spline-fit here produces a better reparametrization
-
-def rep_pts(newpts):
-    adjusted = [ newpts[0], newpts[ len(newpts) - 1 ] ]
-    for i in range(2, len(newpts)): 
-            k = 2
-            while (L(k - 1, newpts) >= s(i, newpts) or s(i, newpts) > L(k, newpts)):
-               k += 1
-            v = dir(newpts[k - 2], newpts[k - 1])
-            reppt = (map(add, newpts[k - 2], scale((s(i, newpts) - L(k - 1, newpts)), v)))
-            adjusted.insert(i - 1, reppt)
-            #sys.stderr.write('The swarm point %d is: %s'%(i,newpts[i-1]))
-            #print('The swarm point %d is: %s'%(i,newpts[i-1]))
-            #sys.stderr.write('The reparametrized point %d is: %s\n'%(i,reppt))
-            #print('The reparametrized point %d is: %s\n'%(i,reppt))
-
-    # Calculate the CV distance between the stringpoints (this is the thing we're trying to equalize
-    # during the reparametrization) and the average distance
-    dists = []
-    avgdist = 0.0
-    # Note: there is a zeroed padding-point appended on the end here, which we shouldn't
-    # consider (TODO: check if this is necessary due to the iterations above or why...)
-    for i in range(len(newpts) - 2):
-            d = dist(adjusted[i], adjusted[i + 1])
-            dists += [ d ]
-            avgdist += d
-            #sys.stderr.write('%d to %d: dist %f\n' % (i, i+1, d))
-    avgdist = avgdist / (len(newpts) - 1)
-
-    # Another pass to check the spread against the average, remember the largest diff
-    # Same note as above, re padding point
-    maxspread = 0.0
-    for i in range(len(newpts) - 2):
-            spread = abs(dists[i] - avgdist)   # L1 
-            if spread > maxspread:
-                    maxspread = spread
-
-    #sys.stderr.write('  => minspread is %f (average dist %f)\n' % (minspread, avgdist))
-
-    # Return the max spread and the adjusted points as elements in a list
-    return [ maxspread, adjusted ]
-
-# Version of the rep_pts() function which uses an external C-program for the inner loop, speeding
-# up the iteration severely.
 
 def ext_rep_pts(newpts):
         FNULL = open(os.devnull, 'w') # sink for output spam
@@ -269,34 +207,30 @@ def reparametrize(use_posres, fix_endpoints, cvs, ndx_file, Nchains,
     # rep_pts returns the maximum spread of the CV distances between points in [0] and the adjusted
     # points in [1]
 
-    # Initial iteration
-    rep_it1 = ext_rep_pts(newpts)
-    adjusted = rep_it1[1]   # get the points only, ignore the spread result
-
-    # Keep iterating, feeding the result of the previous result into rep_pts again
-    # Note that with long CV vectors (> 4000 dimensions) iterations takes a long time
-    # (at least 45 min for 25 iterations on a single-core 3.5 GHz) when using the python rep_pts.
+    # Iterate, feeding the result of the previous result into the reparametrization again.
     # We can abort early when the maximum spread between points in the updated string goes
-    # below a threshold
-    iters = [ adjusted ]
-    i = 0
-    maxspread = 100.0
-    # Do max 150 iterations even if we don't reach our goal
-    while i < 150 and maxspread > 0.012:
-        sys.stderr.write('Rep iter %d: \n' % i)
-        sys.stderr.flush()
-        rep_it = ext_rep_pts(iters[i])
-        maxspread = rep_it[0]
-        sys.stderr.write('  maxspread was %f\n' % maxspread)
-        # Remember the adjusted points
-        iters.append(rep_it[1])
-        i = i + 1
+    # below a threshold. Do max 150 iterations even if we don't reach our goal
+    if string_rep is not None:
+        (maxspread, i, adjusted) = string_rep.reparametrize_string(newpts, 150, 0.012, sys.stderr)
+        adjusted = adjusted.tolist()
+    else:
+        # Initial iteration
+        rep_it1 = ext_rep_pts(newpts)
+        adjusted = rep_it1[1]   # get the points only, ignore the spread result
+        i = 0
+        maxspread = 100.0
+        while i < 150 and maxspread > 0.012:
+            sys.stderr.write('Rep iter %d: \n' % i)
+            sys.stderr.flush()
+            rep_it = ext_rep_pts(adjusted)
+            maxspread = rep_it[0]
+            sys.stderr.write('  maxspread was %f\n' % maxspread)
+            # Remember the adjusted points
+            adjusted = rep_it[1]
+            i = i + 1
 
     sys.stderr.write('Final maximum spread %f after %d iterations.\n' % (maxspread, i))
 
-    # Get the final iteration's result
-    adjusted = iters[-1]
- 
     # delete the padding point
     adjusted = adjusted[:-1]
     newpts = newpts[:-1]
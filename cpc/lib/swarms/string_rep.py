@@ -0,0 +1,122 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Grant Rotskoff, Bjorn Wesen, Erik Lindahl and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Reparametrization of a string of points in collective variable space,
+   shared by the swarms scripts.
+
+   See Maragliano et al, J. Chem Phys (125), 2006: we use a linear
+   interpolation in Euclidean space, adjusted to ensure equidistant points.
+
+   The string is an array (or a list of lists) with one row per string
+   point, and one column per CV. As in the original swarms code, the last
+   row is a zeroed padding point that stays where it is: the points are
+   distributed over the path from the first to the second-to-last point.
+
+   The path length is computed once per call as a cumulative sum of the
+   segment lengths, and the segment for each new point is found with a
+   binary search, so a call is O(points*CVs) instead of the O(points^3*CVs)
+   of recomputing the path length for every candidate segment."""
+
+import numpy
+
+
+def arcLength(path):
+    """Get the cumulative path length at each point of a path.
+
+       path = the 2D array of points
+
+       Returns a tuple of the array of cumulative path lengths (starting at
+       0 for the first point) and the array of segment lengths."""
+    segLengths=numpy.sqrt(numpy.sum(numpy.diff(path, axis=0)**2, axis=1))
+    cumLengths=numpy.zeros(len(path))
+    numpy.cumsum(segLengths, out=cumLengths[1:])
+    return (cumLengths, segLengths)
+
+def spread(adjusted):
+    """Calculate the maximum spread of the distances between consecutive
+       points of a reparametrized string around their average: the quantity
+       that the reparametrization iterations try to bring to zero.
+
+       The distance to the padding point is not included, but the average is
+       taken over all points, as the original swarms code did, so that
+       existing convergence thresholds keep their meaning."""
+    npts=len(adjusted)
+    dists=numpy.sqrt(numpy.sum(numpy.diff(adjusted[:-1], axis=0)**2, axis=1))
+    if len(dists) == 0:
+        return 0.0
+    avgdist=numpy.sum(dists)/(npts-1)
+    return float(numpy.max(numpy.abs(dists-avgdist)))
+
+def rep_pts(newpts):
+    """Do one reparametrization step of a string.
+
+       newpts = the 2D array or list of lists of string points, ending with
+                the padding point
+
+       Returns a list of the maximum spread (see spread()) and the 2D array
+       of adjusted points, with the same shape as newpts."""
+    path=numpy.asarray(newpts, dtype=numpy.float64)
+    npts=len(path)
+    if npts < 4:
+        # nothing to redistribute between the endpoints
+        return [ 0.0, path.copy() ]
+    (cumLengths, segLengths)=arcLength(path)
+    # the total length runs up to the last real point, excluding the
+    # segment to the padding point.
+    total=cumLengths[npts-2]
+    # the path positions of the new interior points and the last point
+    targets=numpy.arange(1, npts-1)*(total/(npts-2))
+    # the segment each target is on: the first segment j with
+    # cumLengths[j] < target <= cumLengths[j+1]
+    segs=numpy.searchsorted(cumLengths, targets, side='left')-1
+    segs=numpy.clip(segs, 0, npts-2)
+    lengths=segLengths[segs]
+    # zero-length segments can only be selected through rounding at the
+    # ends; avoid dividing by zero for them.
+    lengths[lengths == 0.0]=0.0001
+    frac=(targets-cumLengths[segs])/lengths
+    adjusted=numpy.empty_like(path)
+    adjusted[0]=path[0]
+    adjusted[npts-1]=path[npts-1]
+    adjusted[1:npts-1]=(path[segs] +
+                        frac[:,numpy.newaxis]*(path[segs+1]-path[segs]))
+    return [ spread(adjusted), adjusted ]
+
+def reparametrize_string(newpts, maxIters, maxSpread, log=None):
+    """Iterate rep_pts() on a string until the maximum spread is no larger
+       than maxSpread, or for at most maxIters iterations after the first.
+
+       newpts = the 2D array or list of lists of string points, ending with
+                the padding point
+       maxIters = the maximum number of iterations
+       maxSpread = the spread at which to stop, or None to always do
+                   maxIters iterations
+       log = an optional file object to write progress to
+
+       Returns a tuple of the final maximum spread, the number of iterations
+       and the final 2D array of points."""
+    (maxspread, adjusted)=rep_pts(newpts)
+    i=0
+    while i < maxIters and (maxSpread is None or maxspread > maxSpread):
+        (maxspread, adjusted)=rep_pts(adjusted)
+        if log is not None:
+            log.write('Rep iter %d: maxspread was %f\n' % (i, maxspread))
+            log.flush()
+        i+=1
+    return (maxspread, i, adjusted)
@@ -17,6 +17,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import errno
 import httplib
 import socket
 import ssl
@@ -49,6 +50,23 @@ class ClientConnectionError(CpcError):
                %(self.host,self.port)
 
 
+def isClosedBeforeRequest(e):
+    """Check whether an error on a reused keep-alive connection means that
+       the server had closed the connection before reading the request:
+       the connection was reset, or closed without any response. Only then
+       can the request safely be sent again."""
+    if isinstance(e, httplib.BadStatusLine):
+        # an empty status line is stored as its repr(); newer python 2.7
+        # versions report it with a message.
+        return (e.line in ("", "''") or
+                e.line.startswith("No status line received"))
+    if isinstance(e, ssl.SSLError):
+        return e.errno == ssl.SSL_ERROR_EOF
+    if isinstance(e, socket.error):
+        return e.errno in (errno.ECONNRESET, errno.EPIPE)
+    return False
+
+
 class ClientBase(object):
     '''
     classdocs
@@ -68,21 +86,41 @@ class ClientBase(object):
         self.require_certificate_authentication = None
         self.useNoSSLFalback=False
 
-    def putRequest(self, req, require_certificate_authentication=None, disable_cookies=False):
-        self.__connect(require_certificate_authentication, disable_cookies)
-        try:
-
-            ret=self.conn.sendRequest(req,"PUT")
-        except httplib.HTTPException as e:
-            raise ClientConnectionError(e,self.host,self.port)
-        except socket.error as e:
-            raise ClientConnectionError(e,self.host,self.port)
-        return ret
+    def putRequest(self, req, require_certificate_authentication=None,
+                   disable_cookies=False, stream=False):
+        return self.__sendRequest(req, "PUT", require_certificate_authentication,
+                                  disable_cookies, stream)
 
     def postRequest(self, req, require_certificate_authentication=None, disable_cookies=False):
+        return self.__sendRequest(req, "POST",
+                                  require_certificate_authentication,
+                                  disable_cookies, False)
+
+    def __sendRequest(self, req, method, require_certificate_authentication,
+                      disable_cookies, stream):
+        """Send a request over a pooled keep-alive connection if there is one.
+           The server may have closed a pooled connection just before it was
+           used: in that case the request is sent again over a new
+           connection. Other failures are not retried, because the server
+           may already have acted on the request."""
         self.__connect(require_certificate_authentication, disable_cookies)
         try:
-            ret=self.conn.sendRequest(req)
+            try:
+                ret=self.conn.sendRequest(req,method,stream)
+            except (httplib.HTTPException, socket.error) as e:
+                if ( not self.conn.reused or
+                     self.conn.response is not None or
+                     not isClosedBeforeRequest(e) ):
+                    raise
+                log.log(cpc.util.log.TRACE,
+                        "Pooled connection to %s:%s failed (%s); reconnecting"%
+                        (self.host, self.port, str(e)))
+                self.conn.abandonSocket()
+                if hasattr(req.msg, 'seek'):
+                    req.msg.seek(0)
+                self.__connect(require_certificate_authentication,
+                               disable_cookies, reuse=False)
+                ret=self.conn.sendRequest(req,method,stream)
         except httplib.HTTPException as e:
             raise ClientConnectionError(e,self.host,self.port)
         except socket.error as e:
@@ -90,17 +128,20 @@ class ClientBase(object):
         return ret
 
     def closeClient(self):
-        self.conn.conn.close()
+        if self.conn.conn is not None:
+            self.conn.conn.close()
 
     # the order in which we determine whether to require certificate from server for authentication is
     # 1, overrides lower priorities : argument require_certificate_authentication
     # 2, if self.require_certificate_authentication is set
     # default to true
-    def __connect(self, require_certificate_authentication=None, disable_cookies=False):
+    def __connect(self, require_certificate_authentication=None,
+                  disable_cookies=False, reuse=True):
 
         '''
         inputs:
              require_certificate_authentication:boolean  requires a certificate from the server
+             reuse:boolean  whether an idle pooled connection may be used
         '''
         if require_certificate_authentication is not None:
             require_certificate_authentication = require_certificate_authentication
@@ -120,7 +161,7 @@ class ClientBase(object):
                 log.log(cpc.util.log.TRACE,"Connecting HTTPS with no cert authentication")
                 self.conn=client_connection.ClientConnectionNoCertRequired(
                             self.conf, disable_cookies)
-            self.conn.connect(self.host,self.port)
+            self.conn.connect(self.host,self.port,reuse)
         except httplib.HTTPException as e:
             raise ClientConnectionError(e,self.host,self.port)
         except socket.error as e:
@@ -57,8 +57,10 @@ class ClientConnectionBase(ConnectionBase):
     """
 
     def __init__(self):
-        ConnectionBase.__init__(self)
         self.cookieHandler = None
+        self.conn = None
+        self.reused = False
+        self.response = None
 
     def prepareHeaders(self,request):
         if not request.headers.has_key('Originating-Client')\
@@ -71,7 +73,9 @@ class ClientConnectionBase(ConnectionBase):
             if cookie is not None:
                 request.headers['cookie'] = cookie
 
-        request.headers["Connection"]= "close"
+        # the connection is put back into the client connection pool once
+        # the response has been read.
+        request.headers["Connection"]= "keep-alive"
         return request
 
 
@@ -82,6 +86,44 @@ class ClientConnectionBase(ConnectionBase):
 
         return response
 
+    def isCertRequired(self):
+        """Whether the server certificate is required; this determines which
+           pooled connections can be used."""
+        raise NotImplementedError("not implemented by subclass")
+
+    def connectFromPool(self,host,port):
+        """Take an idle connection to host:port from the client connection
+           pool. Returns whether there was one."""
+        self.host = host
+        self.port = port
+        self.conn = ClientConnectionPool().getConnection(host, port,
+                                                         self.isCertRequired())
+        self.reused = self.conn is not None
+        self.connected = self.reused
+        return self.reused
+
+    def handleSocket(self):
+        """Put the connection back into the pool if the response has been
+           read completely and the server keeps the connection open."""
+        response = self.response
+        self.response = None
+        if self.conn is None:
+            return
+        if (response is not None and response.isclosed() and
+            not response.will_close and self.conn.sock is not None):
+            ClientConnectionPool().putConnection(self.conn, self.host,
+                                                 self.port,
+                                                 self.isCertRequired())
+        else:
+            self.conn.close()
+        self.conn = None
+
+    def abandonSocket(self):
+        self.response = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
 
 class ClientConnectionRequireCert(ClientConnectionBase):
     """
@@ -90,14 +132,21 @@ class ClientConnectionRequireCert(ClientConnectionBase):
     This one is used by the worker and the client when passing connection bundles
     """
     def __init__(self, conf):
+        ClientConnectionBase.__init__(self)
         self.connected=False
         self.conf = conf
         self.cookieHandler = None # We disallow this for now
 
-    def connect(self,host,port):
+    def isCertRequired(self):
+        return True
 
+    def connect(self,host,port,reuse=True):
+
+        if reuse and self.connectFromPool(host, port):
+            return
         self.host = host
         self.port = port
+        self.reused = False
         privateKey = self.conf.getPrivateKey()
         keyChain = self.conf.getCaChainFile()
         cert = self.conf.getCertFile()
@@ -112,9 +161,6 @@ class ClientConnectionRequireCert(ClientConnectionBase):
         self.conn.connect()
         self.connected=True
 
-    def handleSocket(self):
-        pass
-
 
 
 class ClientConnectionNoCertRequired(ClientConnectionBase):
@@ -127,22 +173,27 @@ class ClientConnectionNoCertRequired(ClientConnectionBase):
 
 
     def __init__(self, conf, disable_cookies=False):
+        ClientConnectionBase.__init__(self)
         self.connected=False
         self.conf = conf
         if not disable_cookies:
             self.cookieHandler = CookieHandler(conf)
         else:
             self.cookieHandler = None
-    def connect(self,host,port):
 
+    def isCertRequired(self):
+        return False
+
+    def connect(self,host,port,reuse=True):
+
+        if reuse and self.connectFromPool(host, port):
+            return
         self.host = host
         self.port = port
+        self.reused = False
 
         log.log(cpc.util.log.TRACE,"Connecting HTTPS with no cert req to host %s, port %s"%(
             self.host,self.port))
         self.conn = HttpsConnectionNoCertReq(self.host,self.port)
         self.conn.connect()
         self.connected=True
-
-    def handleSocket(self):
-        pass
\ No newline at end of file
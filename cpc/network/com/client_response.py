@@ -94,11 +94,13 @@ class ClientResponse(object):
         self.resp=dict()
 
     def __del__(self):
-        self.message.close()
+        if self.message is not None:
+            self.message.close()
  
     def close(self):
         """Close the response if it hasn't already been closed."""
-        self.message.close()
+        if self.message is not None:
+            self.message.close()
 
     def getType(self):
         """Get the content type string of a response."""
@@ -107,3 +109,64 @@ class ClientResponse(object):
     def getRawData(self):
         """Get the raw data for an unprocessed response."""
         return self.message
+
+    def detachRawData(self):
+        """Get the raw data for an unprocessed response, and make the caller
+           responsible for closing it: it is no longer closed together with
+           this response object."""
+        ret=self.message
+        self.message=None
+        return ret
+
+
+class StreamedBody(object):
+    """The body of a streamed response: a file-like object that reads
+       directly from the connection, instead of from a buffered copy of
+       the whole body. Like the buffered (mmap) bodies, len() gives the
+       number of bytes that haven't been read yet."""
+    # the max. number of unread bytes that are read when the body is closed
+    # early, so that the connection can still be reused.
+    drainSize=65536
+    def __init__(self, response, length, finishFunction, abandonFunction):
+        """response = the httplib response object
+           length = the content length
+           finishFunction = the function to call when the body has been read
+                            completely and the connection can be reused
+           abandonFunction = the function to call when the body is closed
+                             before it has been read completely"""
+        self.response=response
+        self.remaining=length
+        self.finishFunction=finishFunction
+        self.abandonFunction=abandonFunction
+        self.closed=False
+
+    def __len__(self):
+        return self.remaining
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("read from closed response body")
+        if size < 0 or size > self.remaining:
+            size=self.remaining
+        if size == 0:
+            return ""
+        ret=self.response.read(size)
+        self.remaining-=len(ret)
+        if len(ret) == 0:
+            # the connection was closed early
+            self.remaining=0
+        return ret
+
+    def close(self):
+        if self.closed:
+            return
+        if self.remaining > 0 and self.remaining <= StreamedBody.drainSize:
+            # it's cheaper to read the rest than to lose the connection.
+            while self.remaining > 0 and len(self.read(self.remaining)) > 0:
+                pass
+        self.closed=True
+        if self.remaining == 0:
+            self.finishFunction()
+        else:
+            self.response.close()
+            self.abandonFunction()
@@ -1,5 +1,5 @@
 import mmap
-from cpc.network.com.client_response import ClientResponse
+from cpc.network.com.client_response import ClientResponse, StreamedBody
 from cpc.util import ClientError, cpc
 
 import logging
@@ -16,6 +16,12 @@ class ConnectionBase:
     def handleSocket(self):
         raise NotImplementedError("Not implemented by subclass")
 
+    def abandonSocket(self):
+        """Close the connection after a streamed response was closed before
+           it was read completely: the connection can't be reused."""
+        if self.conn is not None:
+            self.conn.close()
+
     def prepareHeaders(self,request):
         """
         Creates and adds necessary headers for this connection type
@@ -30,11 +36,20 @@ class ConnectionBase:
     def handleResponseHeaders(self,response):
         raise NotImplementedError("not implemented by subclass")
 
-    def sendRequest(self,req,method="POST"):
+    def sendRequest(self,req,method="POST",stream=False):
+        """Send a request and return the ClientResponse object.
+
+           If stream is True, the body of a successful response is not
+           buffered but read from the connection while it is being used
+           (see StreamedBody); the connection is only released once the
+           response is closed."""
         req = self.prepareHeaders(req)
 
         self.conn.request(method, "/copernicus",req.msg,req.headers)
         response=self.conn.getresponse()
+        # kept so handleSocket() can check whether the connection can be
+        # reused.
+        self.response=response
         if response.status!=200:
             errorStr = "ERROR: %d: %s"%(response.status, response.reason)
             resp_mmap = mmap.mmap(-1, int(len(errorStr)), mmap.ACCESS_WRITE)
@@ -53,6 +68,12 @@ class ConnectionBase:
             log.log(cpc.util.log.TRACE,"Response length is %s"%(length))
 
 
+            if stream and int(length) > 0:
+                headers=dict(response.getheaders())
+                body=StreamedBody(response, int(length), self.handleSocket,
+                                  self.abandonSocket)
+                return ClientResponse(body, headers)
+
             #this covers the case where are reponse only sends back headers
             # as we cannot initialize an mmap object of length 0
             if int(length) == 0:
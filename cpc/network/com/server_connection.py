@@ -100,6 +100,13 @@ class ServerConnection(ConnectionBase):
             self.httpsConnectionPool.putConnection(self.conn,self.node)
             self.conn = None
 
+    def abandonSocket(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+            if self.storeInConnectionPool and self.createConnection==False:
+                self.node.reduceOutboundConnection()
+
 
     def prepareHeaders(self,request):
 
@@ -116,10 +123,11 @@ class ServerConnection(ConnectionBase):
 
 
 
-    def putRequest(self ,req):
+    def putRequest(self ,req, stream=False):
         """
         inputs:
             req:ServerRequest
+            stream:boolean whether to stream the response body
         returns:
             ClientResponse
         """
@@ -127,7 +135,7 @@ class ServerConnection(ConnectionBase):
             log.log(cpc.util.log.TRACE,"Connecting using HTTPS with cert authentication")
             if self.conn == None:
                 self.connect()
-            ret=self.sendRequest(req,"PUT")
+            ret=self.sendRequest(req,"PUT",stream)
         except httplib.HTTPException as e:
             if self.createConnection==False:
                 self.node.reduceOutboundConnection()
@@ -36,6 +36,10 @@ import urlparse
 
 
 log=logging.getLogger(__name__)
+
+# the block size for reading file parts with a known length
+readBlockSize = 65536
+
 #handles parsing of the HTTP methods
 class HttpMethodParser(object):
     '''
@@ -137,7 +141,13 @@ class HttpMethodParser(object):
             if(contentLength):   # If a content length is sent we parse the nice way
                 bytes = int(contentLength)
                 if(ServerRequest.isFile(headers['Content-Disposition'])):
-                    file.write(msgStream.read(bytes))
+                    # copy in blocks, so big files aren't read into memory
+                    while bytes > 0:
+                        buf = msgStream.read(min(bytes, readBlockSize))
+                        if len(buf) == 0:
+                            break
+                        file.write(buf)
+                        bytes -= len(buf)
                     
                 else: 
                     line  = msgStream.read(bytes)
@@ -160,19 +170,16 @@ class HttpMethodParser(object):
                         
                         terminateBoundary = line                                               
                         
+                        if not contentLength:
+                            # strip the CRLF before the boundary
+                            skipBytes = 2
+                            file.truncate(readBytes-skipBytes)
                         file.seek(0)
-                        skipBytes = 2
 
-                        realFile = tempfile.TemporaryFile(mode="w+b")
-                        realFile.write(file.read(readBytes-skipBytes))
-                        
-                        file.close()                        
-                        realFile.seek(0)
-                        
                         #For testing during dev only!!
-                        #runTest(realFile)                                                      
-                        
-                        files[name]= realFile
+                        #runTest(file)
+
+                        files[name]= file
                         break
                     else:
                         readBytes +=len(line)
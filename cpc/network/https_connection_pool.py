@@ -25,6 +25,9 @@ Created on Jul 18, 2011
 import logging
 from Queue import Queue,Empty
 import threading
+import time
+import select
+import socket
 from cpc.util.conf.server_conf import ServerConf
 
 import cpc.util.log
@@ -157,3 +160,93 @@ class ServerConnectionPool(ConnectionPool):
 #        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, max_fails)
         ConnectionPool.putConnection(self,connection,node.getHostname(),
            node.getServerSecurePort())
+
+
+# the max. time in seconds that an unused client connection is kept open
+clientIdleTime = 30
+# the max. number of unused client connections kept for each host, port and
+# authentication mode
+clientMaxIdle = 4
+
+class ClientConnectionPool(ConnectionPool):
+    """
+    Singleton that keeps a pool of idle keep-alive https connections of
+    clients (the command line client, workers and raw server messages), so
+    that a request to a server that was recently contacted doesn't need a
+    new connection and TLS handshake.
+    Connections are kept per host, port and authentication mode. Unlike
+    with server connections, getting a connection never blocks: if there is
+    no usable idle connection, None is returned and the caller creates a
+    new one.
+    """
+    __shared_state = {}
+    def __init__(self):
+        self.__dict__ = self.__shared_state
+
+        if len(self.__shared_state)>0:
+            return
+
+        ConnectionPool.__init__(self)
+        log.log(cpc.util.log.TRACE,"instantiation of client connection pool")
+
+    def getKey(self,host,port,certRequired=True):
+        if certRequired:
+            return "%s:%s:cert"%(host,port)
+        return "%s:%s:nocert"%(host,port)
+
+    def getConnection(self,host,port,certRequired=True):
+        """Get an idle connection, or None if there is no usable one.
+           Connections that have been idle for too long or that were closed
+           by the other side are closed and dropped."""
+        key = self.getKey(host,port,certRequired)
+        now = time.time()
+        while True:
+            with self.listlock:
+                idle = self.pool.get(key)
+                if not idle:
+                    return None
+                # the most recently used connection is the least likely to
+                # have been closed by the server.
+                (connection, idleSince) = idle.pop()
+            if now - idleSince < clientIdleTime and self._isUsable(connection):
+                log.log(cpc.util.log.TRACE,"Reusing connection to host:%s"%
+                        key)
+                return connection
+            connection.close()
+
+    def getAllConnections(self,host,port,certRequired=True):
+        """Take all idle connections for a host, port and authentication
+           mode out of the pool."""
+        key = self.getKey(host,port,certRequired)
+        with self.listlock:
+            idle = self.pool.pop(key, [])
+        return [ connection for (connection, idleSince) in idle ]
+
+    def putConnection(self,connection,host,port,certRequired=True):
+        """Put a connection whose last response was read completely back into
+           the pool."""
+        key = self.getKey(host,port,certRequired)
+        with self.listlock:
+            idle = self.pool.setdefault(key, [])
+            idle.append( (connection, time.time()) )
+            if len(idle) > clientMaxIdle:
+                (connection, idleSince) = idle.pop(0)
+            else:
+                connection = None
+        if connection is not None:
+            connection.close()
+        log.log(cpc.util.log.TRACE,"put back connection in pool for host:%s"%
+                key)
+
+    def _isUsable(self,connection):
+        """Check whether an idle connection is still open: a socket that is
+           readable while no request is outstanding has been closed by the
+           other side."""
+        sock = connection.sock
+        if sock is None:
+            return False
+        try:
+            (r, w, e) = select.select([sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return len(r) == 0
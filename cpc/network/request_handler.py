@@ -19,8 +19,8 @@
 
 
 import BaseHTTPServer
+import select
 import socket
-import mmap
 import logging
 import os
 import uuid
@@ -48,6 +48,12 @@ import cpc.server.message
 import cpc.util.log
 
 
+# the size of the chunks in which file responses are sent
+sendChunkSize = 1024*1024
+# the max. time in seconds to wait for the next request on a kept-alive
+# client connection. This is longer than the time clients keep idle
+# connections in their pool (see https_connection_pool.clientIdleTime).
+keepAliveIdleTime = 60
 
 class handler_base(BaseHTTPServer.BaseHTTPRequestHandler):
     """
@@ -71,6 +77,35 @@ class handler_base(BaseHTTPServer.BaseHTTPRequestHandler):
         self.request.revertSocket = False
 
 
+    def handle(self):
+        """Handle requests until the connection is closed. Kept-alive
+           connections from pooled clients are closed when no new request
+           arrives within keepAliveIdleTime seconds, so they don't tie up a
+           handler thread indefinitely. Persistent connections from other
+           servers are kept open."""
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            if not self._waitForRequest():
+                self.log.log(cpc.util.log.TRACE,
+                             "Closing idle keep-alive connection")
+                break
+            self.handle_one_request()
+
+    def _waitForRequest(self):
+        """Wait for the next request on a kept-alive connection. Returns
+           whether there is one."""
+        if hasattr(self.request, "serverId"):
+            return True
+        if hasattr(self.request, "pending") and self.request.pending() > 0:
+            return True
+        try:
+            (r, w, e) = select.select([self.request], [], [],
+                                      keepAliveIdleTime)
+        except (select.error, socket.error, ValueError):
+            return False
+        return len(r) > 0
+
     def isApplicationRoot(self):
         if(re.search(self.regexp,self.path)):
             return True
@@ -116,9 +151,11 @@ class handler_base(BaseHTTPServer.BaseHTTPRequestHandler):
         #can handle single part and multipart messages
         #take the input and put it into a request object
         #process the message
+        # clients that pool their connections ask for them to be kept open
+        keepAlive=(self.headers.get('connection', '').lower() == 'keep-alive')
         if(self.isApplicationRoot()):
             request = HttpMethodParser.parsePOST(self.headers.dict,self.rfile)
-            self.processMessage(request)
+            self.processMessage(request, closeConnection=not keepAlive)
 
         else:
             self.processMessage() #this is not a valid command i.e we did not find the resource
@@ -320,12 +357,16 @@ class handler_base(BaseHTTPServer.BaseHTTPRequestHandler):
         else:
             self.send_header("Connection",  "keep-alive")
         self.end_headers()
-        if isinstance(rets, mmap.mmap):
-            # we need this because strings don't support reads, and
-            # write expects this.
-            str = rets.read(len(rets))
-            #print str
-            self.wfile.write(str)
+        if not isinstance(rets, basestring):
+            # a file-like object (an mmap or a stream): write it out in
+            # chunks, so it doesn't need to be copied into a string first.
+            remaining = len(rets)
+            while remaining > 0:
+                buf = rets.read(min(remaining, sendChunkSize))
+                if len(buf) == 0:
+                    break
+                self.wfile.write(buf)
+                remaining -= len(buf)
         else:
             self.wfile.write(rets)
         retmsg.close()
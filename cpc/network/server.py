@@ -229,7 +229,9 @@ def runServer(logLevel=None,doFork=True):
             os.dup2(0, 1) # stdout
             os.dup2(0, 2) # stderr
 
-        # now start the server
+        # now start the server. The controller processes are forked first,
+        # so they don't inherit any of the server's threads' state.
+        serverState.startControllerPool()
         serverState.startExecThreads()
         serverLoop(conf, serverState)
 
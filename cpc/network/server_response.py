@@ -76,6 +76,10 @@ class ServerResponse(object):
         if self.file is None:
             return json.dumps(self.resp,default = json_serializer.toJson,
                               indent=4)
+        elif not hasattr(self.file, 'fileno'):
+            # a buffer or stream (such as a forwarded response body) that can
+            # be sent as is: it has a length and is read sequentially.
+            return self.file
         else:
             self.file.seek(0)
             self.mmap= mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
@@ -84,5 +88,7 @@ class ServerResponse(object):
     def close(self):
         if self.mmap is not None:
             self.mmap.close()
+        elif self.file is not None and not hasattr(self.file, 'fileno'):
+            self.file.close()
 
 
@@ -585,6 +585,7 @@ class SCStatus(ProjectServerCommand):
             ret_prj_dict[prj_str]['queue']  = queue
             ret_prj_dict[prj_str]['errors'] = err_list
             ret_prj_dict[prj_str]['warnings'] = warn_list
+            ret_prj_dict[prj_str]['locks'] = prj_obj.getLockStats().toJSON()
             if prj_str == request.session.get('default_project_name', None):
                 ret_prj_dict[prj_str]['default']=True
         ret_dict['projects'] = ret_prj_dict
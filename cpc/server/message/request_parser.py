@@ -112,11 +112,14 @@ scSecureList.add(worker.SCWorkerReady())
 scSecureList.add(worker.SCWorkerReadyForwarded())  
 scSecureList.add(worker.SCCommandFinished())
 scSecureList.add(worker.SCCommandFinishedForward())  
+scSecureList.add(worker.SCCommandResultChunk())
 scSecureList.add(worker.SCCommandFailed())  
 # heartbeat requests
 scSecureList.add(worker.SCWorkerHeartbeat())
 scSecureList.add(worker.SCHeartbeatForwarded())
+scSecureList.add(worker.SCHeartbeatBatchForwarded())
 scSecureList.add(worker.SCDeadWorkerFetch())
+scSecureList.add(worker.SCDeadWorkerFetchBatch())
 # overlay network topology
 scSecureList.add(network.ScAddNode())
 scSecureList.add(network.ScListNodes())
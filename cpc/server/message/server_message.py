@@ -27,6 +27,7 @@ import json
 
 from cpc.network.server_to_server_message import ServerToServerMessage
 from cpc.network.com.input import Input
+from cpc.network.com.file_input import FileInput
 from cpc.network.server_request import ServerRequest
 from cpc.util import json_serializer
 
@@ -53,13 +54,20 @@ class ServerMessage(ServerToServerMessage):
 
     def workerReadyForwardedRequest(self, workerID, archdata, topology,
                                     originatingServer, heartbeatInterval,
-                                    originatingClient=None):
+                                    originatingClient=None, bundle=False,
+                                    haveInputs=None):
+        """Forward a worker-ready request. The response body is streamed:
+           it must be read or closed to release the connection."""
         cmdstring='worker-ready-forward'
         fields = []
         fields.append(Input('cmd', cmdstring))
         fields.append(Input('version', "1"))
         fields.append(Input('worker', archdata))
         fields.append(Input('worker-id', workerID))
+        if bundle:
+            fields.append(Input('bundle', "1"))
+        if haveInputs is not None:
+            fields.append(Input('have-inputs', haveInputs))
         fields.append(Input('heartbeat-interval', str(heartbeatInterval)))
         topologyInput = Input('topology',
             # a json structure that needs to be dumped
@@ -72,7 +80,7 @@ class ServerMessage(ServerToServerMessage):
         if originatingClient is not None:
             headers['originating-client'] = originatingClient
         response= self.putRequest(ServerRequest.prepareRequest(fields, [],
-            headers))
+            headers), stream=True)
         return response
 
 
@@ -131,6 +139,24 @@ class ServerMessage(ServerToServerMessage):
             headers))
         return response
 
+    def heartbeatBatchForwardedRequest(self, workerServer, batchFileobj):
+        """A server-to-server request relaying a batch of heartbeat signals
+           from different workers.
+
+           workerServer = the name of the sending worker server
+           batchFileobj = a file object with the gzipped heartbeat batch
+                          XML"""
+        cmdstring='heartbeat-forward-batch'
+        fields = []
+        fields.append(Input('cmd', cmdstring))
+        fields.append(Input('version', "1"))
+        fields.append(Input('worker_server', workerServer))
+        files = [FileInput('heartbeats', 'heartbeats.xml.gz', batchFileobj)]
+        headers = dict()
+        response= self.putRequest(ServerRequest.prepareRequest(fields, files,
+            headers))
+        return response
+
     def deadWorkerFetchRequest(self, workerDir, runDir):
         """A server-to-sever request for fetching a set of run directories
            from a dead worker's output."""
@@ -147,6 +173,22 @@ class ServerMessage(ServerToServerMessage):
             headers))
         return response
 
+    def deadWorkerFetchBatchRequest(self, runDirs):
+        """A server-to-sever request for fetching the run directories of a
+           set of runs from dead workers' output in one request.
+
+           runDirs = a list of (worker dir, run dir) tuples"""
+        cmdstring='dead-worker-fetch-batch'
+        fields = []
+        fields.append(Input('cmd', cmdstring))
+        fields.append(Input('version', "1"))
+        fields.append(Input('run_dirs', json.dumps(runDirs)))
+        files = []
+        headers = dict()
+        response= self.putRequest(ServerRequest.prepareRequest(fields, files,
+            headers))
+        return response
+
     def pullAssetRequest(self, cmdID, assetType):
         cmdstring='pull-asset'
         fields = []
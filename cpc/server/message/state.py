@@ -85,6 +85,8 @@ class SCServerInfo(ServerCommand):
             info['client_secure_port'] = conf.getClientSecurePort()
         except ServerIdNotFoundException as e:
             info['serverId'] = "ERROR: %s"%e.str
+        info['state_save'] = serverState.getStateSaveStats().toJSON()
+        info['task_queue'] = serverState.getTaskQueue().getStats()
         response.add("",info)
 
 class SCListServerItems(ServerCommand):
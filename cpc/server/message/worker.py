@@ -24,6 +24,7 @@ import tarfile
 import tempfile
 import time
 import shutil
+import zlib
 
 try:
     from cStringIO import StringIO
@@ -33,12 +34,12 @@ except ImportError:
 
 
 
+import cpc.command.platform
 import cpc.command.platform_exec_reader
+import cpc.command.bundle
 import cpc.util
 import cpc.util.log
 
-from cpc.command.worker_matcher import CommandWorkerMatcher
-
 from cpc.network.com.client_response import ProcessedResponse
 from cpc.util import json_serializer
 from cpc.network.node import Nodes
@@ -54,6 +55,10 @@ import cpc.command.heartbeat
 
 log=logging.getLogger(__name__)
 
+# the interval in seconds at which long-polling worker requests check
+# whether the server is quitting
+longPollCheckInterval=5
+
 
 #Child to Parent message
 class WorkerReadyBase(ServerCommand):
@@ -64,27 +69,45 @@ class WorkerReadyBase(ServerCommand):
        the server, not the client."""
 
     def run(self, serverState, request, response):
-        # first read platform capabilities and executables
-        rdr=cpc.command.platform_exec_reader.PlatformExecutableReader()
-        workerData=request.getParam('worker')
         if request.hasParam('worker-id'):
             workerID=request.getParam('worker-id')
         else:
             workerID='(none)'
-        log.debug("Worker platform + executables: %s"%workerData)
-        rdr.readString(workerData,"Worker-reported platform + executables")
+        # first read platform capabilities and executables
+        capCache=serverState.getWorkerCapabilityCache()
+        if request.hasParam('capability-id'):
+            # the worker has registered its capabilities before: it only
+            # sends its platforms with their remaining resources.
+            caps=capCache.get(request.getParam('capability-id'))
+            if caps is None:
+                # the worker will re-send its full description
+                response.headers['capability-unknown']='1'
+                response.add("Unknown capability ID", status="ERROR")
+                return
+            prdr=cpc.command.platform.PlatformReader()
+            prdr.readString(request.getParam('platforms'),
+                            "Worker-reported platforms")
+            platforms=prdr.getPlatforms()
+            workerData=None
+        else:
+            rdr=cpc.command.platform_exec_reader.PlatformExecutableReader()
+            workerData=request.getParam('worker')
+            log.debug("Worker platform + executables: %s"%workerData)
+            rdr.readString(workerData,"Worker-reported platform + executables")
+            platforms=rdr.getPlatforms()
+            caps=capCache.add(rdr.getExecutableList(),
+                              rdr.getWorkerRequirements())
+        response.headers['capability-id']=caps.getID()
         # match queued commands to executables.
-        cwm=CommandWorkerMatcher(rdr.getPlatforms(),
-                                 rdr.getExecutableList(),
-                                 rdr.getWorkerRequirements())
-        cmds=cwm.getWork(serverState.getCmdQueue())
-        if not cwm.isDepleted():
-            # now sleep for 5 seconds to give the dataflow time to react to any
-            # new state.
-            time.sleep(5)
-            cmds.extend(cwm.getWork(serverState.getCmdQueue()))
-        # now check the forwarded variables
+        cwm=caps.getMatcher(platforms)
+        cmdQueue=serverState.getCmdQueue()
+        taskQueue=serverState.getProjectList().getTaskQueue()
         conf=serverState.conf
+        changeCount=cmdQueue.getChangeCount()
+        cmds=cwm.getWork(cmdQueue)
+        self._fill(cwm, cmdQueue, taskQueue, cmds, changeCount,
+                   conf.getWorkerReadyWaitTime())
+        # now check the forwarded variables
         originatingServer=None
         heartbeatInterval=None
         try:
@@ -115,94 +138,165 @@ class WorkerReadyBase(ServerCommand):
             heartbeatInterval = conf.getHeartbeatTime()
         log.debug("worker identified %s"%request.headers['originating-client'] )
 
+        # whether the worker reads command bundles, or only gzipped tar files
+        useBundle=request.hasParam('bundle')
+        # the contents of the input files the worker has cached
+        haveInputs=None
+        if request.hasParam('have-inputs'):
+            haveInputs=request.getParam('have-inputs') or ''
+
+        if len(cmds) == 0:
+            hasJob=self._forward(serverState, request, response, workerID,
+                                 workerData, caps, platforms,
+                                 originatingServer, heartbeatInterval,
+                                 useBundle, haveInputs)
+            if hasJob:
+                return
+            # the worker can wait for work: hold on to the request until
+            # matching commands are queued, or the wait time is over.
+            if request.hasParam('wait') and not self.forwarded:
+                waitTime=min(float(request.getParam('wait')),
+                             conf.getWorkerLongPollTime())
+                deadline=time.time()+waitTime
+                changeCount=cmdQueue.getChangeCount()
+                while (len(cmds) == 0 and not serverState.getQuit() and
+                       time.time() < deadline):
+                    left=min(deadline-time.time(), longPollCheckInterval)
+                    if cmdQueue.waitForChange(changeCount, left):
+                        changeCount=cmdQueue.getChangeCount()
+                        cmds.extend(cwm.getWork(cmdQueue))
+                if len(cmds) > 0:
+                    self._fill(cwm, cmdQueue, taskQueue, cmds, changeCount,
+                               conf.getWorkerReadyWaitTime())
         if len(cmds) > 0:
-            # first add them to the running list so they never get lost
-            runningCmdList=serverState.getRunningCmdList()
-            runningCmdList.add(cmds, originatingServer, heartbeatInterval)
-            # construct the tar file with the workloads.
-            tff=tempfile.TemporaryFile()
+            self._sendCommands(serverState, response, cmds,
+                               originatingServer, heartbeatInterval,
+                               useBundle, haveInputs)
+        else:
+            response.add("No command")
+
+    def _fill(self, cwm, cmdQueue, taskQueue, cmds, changeCount, waitTime):
+        """Give the dataflow time to react to any new state: wait for new
+           commands for as long as there are dataflow tasks pending and
+           the worker isn't filled, for at most waitTime seconds. New
+           commands are added to cmds.
+
+           changeCount = the queue's change count before cmds were taken"""
+        deadline=time.time()+waitTime
+        while not cwm.isDepleted() and taskQueue.hasPending():
+            left=deadline-time.time()
+            if left <= 0:
+                break
+            if cmdQueue.waitForChange(changeCount, left):
+                changeCount=cmdQueue.getChangeCount()
+                cmds.extend(cwm.getWork(cmdQueue))
+
+    def _sendCommands(self, serverState, response, cmds, originatingServer,
+                      heartbeatInterval, useBundle, haveInputs):
+        """Send a list of commands to the worker as a bundle (or a gzipped
+           tar file).
+
+           haveInputs = the newline-separated content hashes of the worker's
+                        cached input files, or None if it has no cache."""
+        conf=serverState.conf
+        # first add them to the running list so they never get lost
+        runningCmdList=serverState.getRunningCmdList()
+        runningCmdList.add(cmds, originatingServer, heartbeatInterval)
+        # make the commands ready
+        dirs=[]
+        for cmd in cmds:
+            log.debug("Adding command id %s to bundle."%cmd.id)
+            # write the command description to the command's directory
+            cmddir=cmd.getDir()
+            if not os.path.exists(cmddir):
+                log.debug("cmddir %s did not exist. Created directory."%cmd.id)
+                os.mkdir(cmddir)
+            arcdir="%s"%(cmd.id)
+            log.debug("cmddir=%s"%cmddir)
+            outf=open(os.path.join(cmddir, "command.xml"), "w")
+            cmd.writeWorkerXML(outf)
+            outf.close()
+            dirs.append( (cmddir, arcdir) )
+        # construct the bundle with the workloads.
+        tff=tempfile.TemporaryFile()
+        if useBundle:
+            if haveInputs is not None:
+                haveHashes=frozenset(haveInputs.split())
+            else:
+                haveHashes=None
+            cpc.command.bundle.writeBundle(tff, dirs,
+                                        conf.getCommandBundleCompression(),
+                                        haveHashes)
+            contentType=cpc.command.bundle.contentType
+        else:
             tf=tarfile.open(fileobj=tff, mode="w:gz")
-            # make the commands ready
-            for cmd in cmds:
-                log.debug("Adding command id %s to tar file."%cmd.id)
-                # write the command description to the command's directory
-                task=cmd.getTask()
-                #log.debug(cmd)
-                project=task.getProject()
-                taskDir = "task_%s"%task.getID()
-                cmddir=cmd.getDir()
-                if not os.path.exists(cmddir):
-                    log.debug("cmddir %s did not exist. Created directory."%cmd.id)
-                    os.mkdir(cmddir)
-                arcdir="%s"%(cmd.id)
-                log.debug("cmddir=%s"%cmddir)
-                outf=open(os.path.join(cmddir, "command.xml"), "w")
-                cmd.writeWorkerXML(outf)
-                outf.close()
+            for (cmddir, arcdir) in dirs:
                 tf.add(cmddir, arcname=arcdir, recursive=True)
-                # set the state of the command.
             tf.close()
             del(tf)
-            tff.seek(0)
-            # now send it back
-            response.setFile(tff,'application/x-tar')
-            #project.writeTasks()
-            # the file is closed after the response is sent.
-            log.info("Did direct worker-ready")
-        else:
-            nodes = conf.getNodes().getNodesByPriority()
-
-            topology = Nodes()
-            if request.hasParam('topology'):
-                topology = json.loads(request.getParam('topology')
-                                      ,object_hook = json_serializer.fromJson)
-
-            thisNode = Node.getSelfNode(conf)
-            thisNode.nodes = conf.getNodes()
-            topology.addNode(thisNode)
-
-            hasJob =False # temporary flag that should be removed
-            for node in nodes:
-                if topology.exists(node.getId()) == False:
-                    clnt=ServerMessage(node.getId())
-
-                    clientResponse=clnt.workerReadyForwardedRequest(workerID,
-                                        workerData,
-                                        topology,
-                                        originatingServer,
-                                        heartbeatInterval,
-                                        request.headers['originating-client'])
-
-                    if clientResponse.getType() == 'application/x-tar':
-
-                        log.log(cpc.util.log.TRACE,
-                                'got work from %s'%
-                                (clientResponse.headers[
-                                     'originating-server-id']))
-                        hasJob=True
-                        # we need to rewrap the message
-
-                        #TODO stupid intermediary step because the mmap form
-                        # clientresponse is prematurely closed
-                        tmp = tempfile.TemporaryFile('w+b')
-
-                        message = clientResponse.getRawData()
-
-                        tmp.write(message.read(len(message)))
-                        tmp.seek(0)
-
-                        #for key in clientResponse.headers:
-                        #    print "%s:%s"%(key,clientResponse.headers[key])
-
-                        response.setFile(tmp,'application/x-tar')
-                        response.headers['originating-server-id']=\
-                                  clientResponse.headers[
-                                      'originating-server-id']
-                    #OPTIMIZE leads to a lot of folding and unfolding of
-                    #packages
-            if not hasJob:
-                response.add("No command")
-            log.info("Did delegated worker-ready")
+            contentType=cpc.command.bundle.tarContentType
+        tff.seek(0)
+        # now send it back
+        response.setFile(tff, contentType)
+        #project.writeTasks()
+        # the file is closed after the response is sent.
+        log.info("Did direct worker-ready")
+
+    def _forward(self, serverState, request, response, workerID, workerData,
+                 caps, platforms, originatingServer, heartbeatInterval,
+                 useBundle, haveInputs):
+        """Forward the worker request to the other servers, and pass on the
+           first one that has work.
+
+           Returns whether work was found."""
+        conf=serverState.conf
+        nodes = conf.getNodes().getNodesByPriority()
+
+        topology = Nodes()
+        if request.hasParam('topology'):
+            topology = json.loads(request.getParam('topology')
+                                  ,object_hook = json_serializer.fromJson)
+
+        thisNode = Node.getSelfNode(conf)
+        thisNode.nodes = conf.getNodes()
+        topology.addNode(thisNode)
+
+        if workerData is None:
+            # other servers get the full description
+            workerData=caps.printWorkerXML(platforms)
+        hasJob =False # temporary flag that should be removed
+        for node in nodes:
+            if topology.exists(node.getId()) == False:
+                clnt=ServerMessage(node.getId())
+
+                clientResponse=clnt.workerReadyForwardedRequest(workerID,
+                                    workerData,
+                                    topology,
+                                    originatingServer,
+                                    heartbeatInterval,
+                                    request.headers['originating-client'],
+                                    useBundle,
+                                    haveInputs)
+
+                if cpc.command.bundle.isContentType(
+                                            clientResponse.getType()):
+
+                    log.log(cpc.util.log.TRACE,
+                            'got work from %s'%
+                            (clientResponse.headers[
+                                 'originating-server-id']))
+                    hasJob=True
+                    # pass the response body on as it is being received:
+                    # it is only read once, when our response is sent.
+                    response.setFile(clientResponse.detachRawData(),
+                                     clientResponse.getType())
+                    response.headers['originating-server-id']=\
+                              clientResponse.headers[
+                                  'originating-server-id']
+                    break
+                clientResponse.close()
+        log.info("Did delegated worker-ready")
+        return hasJob
 
 
 class SCWorkerReady(WorkerReadyBase):
@@ -264,6 +358,10 @@ class CommandFinishedBase(ServerCommand):
         elif request.haveFile('rundata'):
             # backward compatibility
             runfile=request.getFile('rundata')
+        elif request.hasParam('run_data_size') and projServer == selfName:
+            # the run data has been uploaded in chunks
+            runfile=serverState.getRunningCmdList().getResultUpload(cmdID,
+                                        int(request.getParam('run_data_size')))
 
         if projServer != selfName:
             # forward the request using remote assets. Note that the workers
@@ -320,6 +418,27 @@ class SCCommandFinished(CommandFinishedBase):
         self.runLocal(serverState, request, response)
         log.info("Finished command %s"%cmdID)
 
+class SCCommandResultChunk(ServerCommand):
+    """Receive a chunk of a finished command's run data. The chunks are
+       written into the command's directory as they arrive; the upload is
+       completed with a command-finished request with the total size.
+       Without a chunk, the request returns the number of bytes received so
+       far, so an interrupted upload can be resumed."""
+    def __init__(self):
+        ServerCommand.__init__(self, "command-result-chunk")
+
+    def run(self, serverState, request, response):
+        cmdID=request.getParam('cmd_id')
+        runningCmdList=serverState.getRunningCmdList()
+        if request.haveFile('chunk'):
+            offset=int(request.getParam('offset'))
+            size=runningCmdList.addResultChunk(cmdID, offset,
+                                               request.getFile('chunk'),
+                                               request.getParam('checksum'))
+        else:
+            size=runningCmdList.getResultUploadSize(cmdID)
+        response.add('', data={ 'offset' : size })
+
 class SCCommandFailed(CommandFinishedBase):
     """Get notified about a failed run."""
     def __init__(self):
@@ -376,32 +495,22 @@ class SCWorkerHeartbeat(ServerCommand):
         serverState.setWorkerState(WorkerStatus.WORKER_STATUS_CONNECTED,workerID,
                                    request.headers['originating-client'])
         # now iterate over the destinations, and send them their heartbeat
-        # items.
-        # Once we have many workers, this would be a place to pool heartbeat
-        # items and send them as one big request.
+        # items. The relay pools the items for other servers with those of
+        # other workers' heartbeats, and sends them as one request per server.
         faultyItems=[]
+        relay=serverState.getHeartbeatRelay()
+        tickets=[]
         for dest, items in destList.iteritems():
-            if dest == selfName:
-                ret=serverState.getRunningCmdList().ping(workerID, workerDir,
-                                                         iteration, items, True,
-                                                         faultyItems)
-            else:
-                msg=ServerMessage(dest)
-                co=StringIO()
-                co.write('<heartbeat worker_id="%s" worker_server_id="%s">'%
-                         (workerID, selfName))
-                for item in items:
-                    item.writeXML(co)
-                co.write('</heartbeat>')
-                resp = msg.heartbeatForwardedRequest(workerID, workerDir,
-                                                     selfName, iteration,
-                                                     co.getvalue())
-                presp=ProcessedResponse(resp)
-                if presp.getStatus() != "OK":
-                    log.info("Heartbeat response from %s not OK"%dest)
-                    retitems=presp.getData()
-                    for item in retitems:
-                        faultyItems.append(item)
+            if dest != selfName:
+                tickets.append(relay.submit(dest, selfName, workerID,
+                                            workerDir, iteration, items))
+        if selfName in destList:
+            ret=serverState.getRunningCmdList().ping(workerID, workerDir,
+                                                     iteration,
+                                                     destList[selfName], True,
+                                                     faultyItems)
+        for ticket in tickets:
+            faultyItems.extend(relay.wait(ticket))
         if version > 1:
             retData = { 'heartbeat-time' : serverState.conf.
                                                 getHeartbeatTime(),
@@ -442,6 +551,36 @@ class SCHeartbeatForwarded(ServerCommand):
             response.add('Heatbeat NOT OK', status="ERROR", data=faultyItems)
         log.info("Handled %d forwarded heartbeat signal items."%(Nhandled))
 
+class SCHeartbeatBatchForwarded(ServerCommand):
+    """Handle a batch of heartbeat signals of different workers, relayed by
+       their worker server."""
+    def __init__(self):
+        ServerCommand.__init__(self, "heartbeat-forward-batch")
+
+    def run(self, serverState, request, response):
+        batchFile=request.getFile('heartbeats')
+        decomp=zlib.decompressobj(16+zlib.MAX_WBITS)
+        batchXML=decomp.decompress(batchFile.read())+decomp.flush()
+        log.log(cpc.util.log.TRACE, 'batch: %s'%batchXML)
+        hbr=cpc.command.heartbeat.HeartbeatBatchReader()
+        hbr.readString(batchXML, "relayed heartbeat batch")
+        runningCmdList=serverState.getRunningCmdList()
+        # the faulty items of each heartbeat in the batch, by batch index
+        faulty=dict()
+        Nhandled=0
+        for index, (workerID, workerDir, iteration, items) in \
+                enumerate(hbr.getBatch().getHeartbeats()):
+            faultyItems=[]
+            runningCmdList.ping(workerID, workerDir, iteration, items, False,
+                                faultyItems)
+            if len(faultyItems) > 0:
+                faulty[str(index)]=faultyItems
+            Nhandled+=len(items)
+        response.add('', data={ 'heartbeat-time' :
+                                        serverState.conf.getHeartbeatTime(),
+                                'faulty' : faulty })
+        log.info("Handled %d relayed heartbeat signal items."%(Nhandled))
+
 class SCDeadWorkerFetch(ServerCommand):
     """Attempt to fetch the data from a dead worker."""
     def __init__(self):
@@ -479,4 +618,46 @@ class SCDeadWorkerFetch(ServerCommand):
             runDir=request.getParam('run_dir')
             shutil.rmtree(runDir)
 
+class SCDeadWorkerFetchBatch(ServerCommand):
+    """Attempt to fetch the data of a set of runs from dead workers in one
+       request. The run directories are returned in a single tar file, with
+       each run directory in a directory named after its index in the
+       request."""
+    def __init__(self):
+        ServerCommand.__init__(self, "dead-worker-fetch-batch")
+
+    def run(self, serverState, request, response):
+        runDirs=json.loads(request.getParam('run_dirs'))
+        workerDataList=serverState.getWorkerDataList()
+        found=[]
+        tff=tempfile.TemporaryFile()
+        tf=tarfile.open(fileobj=tff, mode="w:gz")
+        for i, (workerDir, runDir) in enumerate(runDirs):
+            try:
+                # check the directory and skip it if not allowed
+                if ( workerDataList.checkDirectory(workerDir, [runDir]) and
+                     os.path.isdir(runDir) ):
+                    tf.add(runDir, arcname="%d"%i, recursive=True)
+                    found.append(runDir)
+            except cpc.util.CpcError as e:
+                log.info("Did not fetch data from dead worker: %s"%str(e))
+        tf.close()
+        del(tf)
+        if len(found) > 0:
+            tff.seek(0)
+            response.setFile(tff,'application/x-tar')
+        else:
+            tff.close()
+        request.setFlag('remove', found)
+        response.add('Returning data')
+        log.info("Fetched data of %d runs from dead workers"%len(found))
+
+    def finish(self, serverState, request):
+        """Now delete the directories associated with the runs that were
+           returned.
+
+           This will only be run if the run() method threw no exception"""
+        for runDir in request.getFlag('remove'):
+            shutil.rmtree(runDir)
+
 
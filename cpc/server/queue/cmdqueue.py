@@ -17,9 +17,14 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
-from collections import deque
-from threading import Lock
+from threading import Lock, Condition
 import logging
+import time
+import heapq
+try:
+    from collections import OrderedDict
+except ImportError:
+    from cpc.util.ordered_dict import OrderedDict
 
 log=logging.getLogger(__name__)
 
@@ -33,6 +38,9 @@ class QueueableItem(object):
     def __init__(self):
         self.active=True
         self.queue=None
+        self.cmdQueue=None
+        # the order in which the item was queued
+        self.queueSeqNr=0
 
     def deactivate(self):
         self.active=False
@@ -48,33 +56,94 @@ class QueueableItem(object):
         self.queue=queue
 
 
+class CmdBucket(OrderedDict):
+    """An ordered dict of queued commands indexed by command ID. A bucket
+       holds the commands of a single priority level that share the same
+       capability key."""
+    def __init__(self, level=None, key=None):
+        OrderedDict.__init__(self)
+        self.level=level
+        self.key=key
+
+
 class CmdQueue(object):
+    """The command queue.
+
+       Commands are held in one level per priority (the highest priority
+       first) and in a bucket of inactive commands. Each priority level is
+       a dict of buckets indexed by the capability key of the commands
+       (see getCapabilityKey()), and each bucket is an ordered dict keyed by
+       command ID, so that commands keep their FIFO order while they can be
+       removed in constant time. Within a priority level, commands are
+       taken in the order in which they were queued, regardless of their
+       bucket: each queued command gets a sequence number, and the bucket
+       whose first command is the oldest goes first.
+
+       Two indices are kept alongside the levels: one with all queued
+       commands by ID, and one with the queued commands of each project.
+       This makes remove(), exists(), activation and deleteByProject()
+       O(1) (or O(k) for k commands of a project) instead of O(N) in the
+       number of queued commands, and it allows getUntil() to skip all
+       commands a worker can't run."""
     PRIO_LOW_BOUND = -30 #Constant
     PRIO_HIGH_BOUND = 30 #Constant
 
     def __init__(self):
-        self.data = []
-        # this is a list of deques with the highest priority queue first.
-        self.queue = [ deque() for x in xrange(CmdQueue.PRIO_LOW_BOUND-1,
-                                               CmdQueue.PRIO_HIGH_BOUND)]
+        # this is a list of dicts of buckets with the highest priority level
+        # first.
+        self.queue = [ dict() for x in
+                       xrange(CmdQueue.PRIO_LOW_BOUND-1,
+                              CmdQueue.PRIO_HIGH_BOUND) ]
         # TODO: finer grained locks. For now we have a single global lock.
         self.lock=Lock()
         # The set of items popped from the queue that were inactive.
-        self.inactiveItems = deque()
+        self.inactiveItems = CmdBucket()
+        # all queued commands (active or inactive), indexed by command ID
+        self.cmdIndex = dict()
+        # the queued commands of each project: a dict of dicts indexed by
+        # project and command ID
+        self.projectIndex = dict()
+        # condition signaled when active commands are added, or when
+        # signal() is called. nChanges counts these events.
+        self.changeCond=Condition(self.lock)
+        self.nChanges=0
+        # the sequence number of the last queued command
+        self.seqNr=0
+
+    @staticmethod
+    def getCapabilityKey(command):
+        """Get the capability key of a command: the tuple of properties
+           that decide whether a worker can run it: (function name,
+           executable name, min. version, max. version, project)."""
+        task=command.getTask()
+        if task is not None:
+            fnName=task.getFunctionName()
+            project=task.project
+        else:
+            fnName=None
+            project=None
+        minVersion=None
+        if command.minVersion is not None:
+            minVersion=command.minVersion.getStr()
+        maxVersion=None
+        if command.maxVersion is not None:
+            maxVersion=command.maxVersion.getStr()
+        return (fnName, command.executable, minVersion, maxVersion, project)
 
     def getSize(self):
         """Count the number of elements in the queue."""
         size=0
         with self.lock:
-            for dq in self.queue:
-                size+=len(dq)
+            for level in self.queue:
+                for dq in level.itervalues():
+                    size+=len(dq)
         return size
 
-    def _getDeque(self, prio):
-        """Low-level function that gets the deque associated with a priority
+    def _getLevel(self, prio):
+        """Low-level function that gets the level associated with a priority
            prio = the priority (out-of-bound priorities are mapped onto maximum
                                 and minimum priorities).
-           returns: a deque. """
+           returns: a dict of buckets indexed by capability key. """
         if prio < CmdQueue.PRIO_LOW_BOUND:
             prio = CmdQueue.PRIO_LOW_BOUND
         if prio > CmdQueue.PRIO_HIGH_BOUND:
@@ -83,6 +152,83 @@ class CmdQueue(object):
         p= (CmdQueue.PRIO_HIGH_BOUND - prio)
         return self.queue[p]
 
+    def _getDeque(self, prio, key):
+        """Low-level function that gets the bucket associated with a priority
+           and a capability key, creating it if it doesn't exist.
+           returns: a CmdBucket. """
+        level=self._getLevel(prio)
+        dq=level.get(key)
+        if dq is None:
+            dq=CmdBucket(level, key)
+            level[key]=dq
+        return dq
+
+    def _getProject(self, command):
+        """Get the project a command belongs to (or None)."""
+        task=command.getTask()
+        if task is None:
+            return None
+        return task.project
+
+    def _insert(self, command, dq):
+        """Non-locking insert of a command into a bucket and the indices."""
+        if command.id in self.cmdIndex:
+            # don't allow a command to be queued twice.
+            self._unlink(self.cmdIndex[command.id])
+        self.seqNr+=1
+        command.queueSeqNr=self.seqNr
+        dq[command.id]=command
+        command.setQueue(self, dq)
+        self.cmdIndex[command.id]=command
+        project=self._getProject(command)
+        if project in self.projectIndex:
+            self.projectIndex[project][command.id]=command
+        else:
+            self.projectIndex[project]={ command.id : command }
+
+    def _removeFromBucket(self, command):
+        """Non-locking removal of a command from its bucket; empty buckets
+           are removed from their priority level."""
+        dq=command.queue
+        if dq is not None and command.id in dq:
+            del dq[command.id]
+            if len(dq) == 0 and dq.level is not None:
+                if dq.level.get(dq.key) is dq:
+                    del dq.level[dq.key]
+
+    def _unlink(self, command):
+        """Non-locking removal of a command from its bucket and the
+           indices."""
+        self._removeFromBucket(command)
+        if self.cmdIndex.get(command.id) is command:
+            del self.cmdIndex[command.id]
+        project=self._getProject(command)
+        pcmds=self.projectIndex.get(project)
+        if pcmds is not None and pcmds.get(command.id) is command:
+            del pcmds[command.id]
+            if len(pcmds) == 0:
+                del self.projectIndex[project]
+        command.setQueue(None, None)
+
+    def _add(self, command):
+        """Non-locking version of add(). Returns whether the command was
+           added as an active command."""
+        if command.active:
+            prio=command.getFullPriority()
+            key=self.getCapabilityKey(command)
+            self._insert(command, self._getDeque(prio, key))
+            return True
+        else:
+            self._insert(command, self.inactiveItems)
+            return False
+
+    def _moveInactive(self, command):
+        """Non-locking move of a command that was found to be inactive
+           to the inactive items."""
+        self._removeFromBucket(command)
+        self.inactiveItems[command.id]=command
+        command.setQueue(self, self.inactiveItems)
+
     def add(self,command):
         """
             description:  puts a command in the queue
@@ -90,42 +236,51 @@ class CmdQueue(object):
             result : command put in queue, queue sorted in priority order of
                      commands, return true
         """
-        ret=False
         # an ID lives for as long as a command is queued/running
         command.tryGenID()
         with self.lock:
-            if command.active:
-                prio=command.getFullPriority()
-                dq=self._getDeque(prio)
-                dq.append(command)
-                command.setQueue(self, dq)
-                ret=True
-            else:
-                self.inactiveItems.append(command)
-                command.setQueue(self, self.inactiveItems)
-                ret=False
+            if self._add(command):
+                self._notifyChange()
         return True
 
+    def _notifyChange(self):
+        """Non-locking notification of threads waiting in waitForChange()"""
+        self.nChanges+=1
+        self.changeCond.notifyAll()
+
+    def signal(self):
+        """Wake up all threads waiting in waitForChange(). Used by the
+           task exec threads to signal that the dataflow has done work that
+           might have changed what can be queued."""
+        with self.lock:
+            self._notifyChange()
+
+    def getChangeCount(self):
+        """Get the current change count, for use with waitForChange()."""
+        with self.lock:
+            return self.nChanges
+
+    def waitForChange(self, changeCount, timeout):
+        """Wait until active commands have been added (or signal() has been
+           called) since getChangeCount() returned changeCount, or until
+           timeout seconds have passed.
+           returns: whether there was a change."""
+        end=time.time()+timeout
+        with self.lock:
+            while self.nChanges == changeCount:
+                left=end-time.time()
+                if left <= 0:
+                    break
+                self.changeCond.wait(left)
+            return self.nChanges != changeCount
+
 
     def remove(self, cmd):
-        """Remove a specific command.
-           NOTE: this is an O(N) operation for N=number of items in the queue"""
-        nremoved=0
+        """Remove a specific command. This is an O(1) operation."""
         with self.lock:
-            dq=cmd.queue
-            if not dq in self.queue:
+            if self.cmdIndex.get(cmd.id) is not cmd:
                 raise QueueError("Tried to remove item from wrong queue.")
-            #for dq in self.queue:
-            n=len(dq)
-            for i in xrange(n):
-                if dq[0] == cmd:
-                    nremoved+=1
-                    dq[0].setQueue(None, None)
-                    dq.popleft()
-                else:
-                    dq.rotate(-1)
-            #if nremoved > 0:
-            #    return
+            self._unlink(cmd)
 
     def get(self):
         """ description: gets a single element with the highest priority from
@@ -136,17 +291,45 @@ class CmdQueue(object):
             """
         #find element with the highest priority
         with self.lock:
-            for dq in self.queue:
-                while len(dq)>0:
-                    item=dq.popleft()
+            for level in self.queue:
+                while len(level)>0:
+                    # the bucket with the oldest command
+                    dq=min(level.itervalues(),
+                           key=lambda dq: dq.itervalues().next().queueSeqNr)
+                    item=dq.itervalues().next()
                     if item.active:
+                        self._unlink(item)
                         return item
                     else:
-                        item.setQueue(self, self.inactiveItems)
-                        self.inactiveItems.append(item)
+                        self._moveInactive(item)
             return None
 
-    def getUntil(self, fn, parm):
+    def _levelItems(self, level, keyFn=None, parm=None):
+        """Non-locking generator of the items of a priority level in the
+           order in which they were queued. The buckets are merged lazily:
+           each bucket's iterator is advanced past an item before the item
+           is yielded, so the yielded item may be removed while iterating.
+           keyFn, parm = as for getUntil(): skip the buckets for which
+                         keyFn(parm, firstItem) is False."""
+        heads=[]
+        for dq in level.itervalues():
+            items=dq.itervalues()
+            first=items.next()
+            if keyFn is not None and not keyFn(parm, first):
+                continue
+            heads.append( (first.queueSeqNr, first, items) )
+        heapq.heapify(heads)
+        while len(heads) > 0:
+            seqNr, item, items=heads[0]
+            try:
+                nextItem=items.next()
+                heapq.heapreplace(heads,
+                                  (nextItem.queueSeqNr, nextItem, items))
+            except StopIteration:
+                heapq.heappop(heads)
+            yield item
+
+    def getUntil(self, fn, parm, keyFn=None):
         """Get a number of items from the queue, based on the output of a
            function (given as parameter).
            fn = the function to test each item with. Should return a tuple of
@@ -156,49 +339,40 @@ class CmdQueue(object):
            parm = a parameter for the function fn. It will be called with
                     fn(parm, queueItem), where queueItem is the queued item
                     being looked at.
+           keyFn = an optional function that is called as
+                   keyFn(parm, queueItem) with the first item of each bucket
+                   of commands that share a capability key. If it returns
+                   False, none of the items in the bucket are looked at.
            returns: the list of items removed from the queue."""
         ret=[]
         cont=True
         with self.lock:
-            for dq in self.queue:
-                n=len(dq)
-                nback=0
-                for i in xrange(n):
-                    if dq[0].active:
-                        cont, doPop=fn(parm, dq[0])
+            for level in self.queue:
+                if len(level) == 0:
+                    continue
+                for item in self._levelItems(level, keyFn, parm):
+                    if item.active:
+                        cont, doPop=fn(parm, item)
                         if doPop:
-                            dq[0].setQueue(None, None)
-                            ret.append(dq.popleft())
-                        else:
-                            dq.rotate(-1)
-                            nback+=1
+                            self._unlink(item)
+                            ret.append(item)
                         if not cont:
                             break
                     else:
-                        # append the inactive item to the inactiveItems queue
-                        dq[0].setQueue(self, self.inactiveItems)
-                        self.inactiveItems.append(dq.popleft())
-                dq.rotate(nback)
+                        # move the inactive item to the inactiveItems
+                        # queue
+                        self._moveInactive(item)
                 if not cont:
                     break
         return ret
 
     def _exists(self, commandID):
         # non-locking version of public exists()
-        #NOTE could be slow
-        for value in self.queue.itervalues():
-            for it in value:
-                if(it.id == commandID):
-                    return True
-        # check the inactive items
-        for it in self.inactiveItems:
-            if(it.id == commandID):
-                return True
-        return False
+        return commandID in self.cmdIndex
 
     def exists(self,commandID):
-        """Check whether commandID exists in the queue.
-           NOTE: this is an O(N) operation for N=number of items in the queue"""
+        """Check whether commandID exists in the queue (either active or
+           inactive). This is an O(1) operation."""
         with self.lock:
             return self._exists(commandID)
 
@@ -206,54 +380,43 @@ class CmdQueue(object):
         """Return a list with all active queued items."""
         ret=[]
         with self.lock:
-            for dq in self.queue:
-                for item in dq:
+            for level in self.queue:
+                for item in self._levelItems(level):
                     if item.active:
                         ret.append(item)
         return ret
 
-
-    def _purgeQueueProject(self, queue, project):
-        """Purge a single queue from a project."""
-        n=len(queue)
-        nremoved=0
-        for i in xrange(n):
-            if queue[0].task.project == project:
-                nremoved+=1
-                queue[0].setQueue(None, None)
-                queue.popleft()
-            else:
-                queue.rotate(-1)
-        return nremoved
-
     def deleteByProject(self, project):
         """Delete all commands related to a project. Returns number of commands
            deleted.
 
-           NOTE: this is an O(N) operation for N=number of items in the queue"""
+           This is an O(k) operation for k=the number of queued commands of
+           the project."""
         nremoved=0
         with self.lock:
-            for dq in self.queue:
-                nremoved+=self._purgeQueueProject(dq, project)
-            nremoved+=self._purgeQueueProject(self.inactiveItems, project)
+            pcmds=self.projectIndex.get(project)
+            if pcmds is not None:
+                for item in pcmds.values():
+                    self._unlink(item)
+                    nremoved+=1
         return nremoved
 
     def _activateCommand(self, command):
         """Activate the command."""
-        if command.queue == self.inactiveItems:
-            with self.lock:
-                self.inactiveItems.remove(command)
-            self.add(command)
+        with self.lock:
+            if (command.queue is self.inactiveItems and
+                command.id in self.inactiveItems):
+                self._unlink(command)
+                if self._add(command):
+                    self._notifyChange()
 
     #Helper function for unit tests
     def indexOfCommand(self,command):
         i=0
         with self.lock:
-            for dq in self.queue:
-                for item in dq:
+            for level in self.queue:
+                for item in self._levelItems(level):
                     if(item == command):
                         return i
                     i+=1
         return None
-
-
@@ -164,19 +164,15 @@ class TaskExecThread(object):
                         self.waiter.releaseAndWait()
                 #log.debug("Waiting for queued task..")
                 task=self.taskQueue.get()
-                if task is not None:
-                    #log.debug("Got queued task.")
-                    (finished, newcmds, cancelcmds)=task.run()
-                    if newcmds is not None:
-                        for cmd in newcmds:
-                            log.debug("Queuing command")
-                            self.cmdQueue.add(cmd)
-                    if cancelcmds is not None:
-                        for cmd in cancelcmds:
-                            log.debug("Canceling command")
-                            self.cmdQueue.remove(cmd)
-                    if finished:
-                        task.handleOutput()
+                try:
+                    if task is not None:
+                        #log.debug("Got queued task.")
+                        self._handleTask(task)
+                finally:
+                    self.taskQueue.taskDone()
+                    if task is not None:
+                        # wake up any worker requests waiting for commands
+                        self.cmdQueue.signal()
             except:
                 fo=StringIO()
                 traceback.print_exception(sys.exc_info()[0], sys.exc_info()[1],
@@ -184,8 +180,33 @@ class TaskExecThread(object):
                 errmsg="Exec thread exception: %s"%(fo.getvalue())
                 log.error(errmsg)
 
+    def _handleTask(self, task):
+        """Run a task and queue or cancel its commands."""
+        # the controller runs without the project's state lock, so that
+        # state saves don't wait for it.
+        (finished, newcmds, cancelcmds)=task.run()
+        # the rest is one change to the project state: a state snapshot
+        # must not contain the task's output without the task being done.
+        with task.project.stateLock.shared:
+            if newcmds is not None:
+                for cmd in newcmds:
+                    log.debug("Queuing command")
+                    self.cmdQueue.add(cmd)
+            if cancelcmds is not None:
+                for cmd in cancelcmds:
+                    log.debug("Canceling command")
+                    self.cmdQueue.remove(cmd)
+            if finished:
+                task.handleOutput()
+
 def taskExecThreadStarter(taskExecThread):
     """Thread starter function for TaskExecThread object."""
     log.debug("Started task exec thread.")
-    taskExecThread.execLoop()
+    # exec threads queue new tasks themselves; registering them as
+    # consumers keeps them from all blocking on a full task queue.
+    taskExecThread.taskQueue.registerConsumer()
+    try:
+        taskExecThread.execLoop()
+    finally:
+        taskExecThread.taskQueue.unregisterConsumer()
 
@@ -23,6 +23,11 @@ import shutil
 import os
 import sys
 import traceback
+import hashlib
+import heapq
+import itertools
+import tarfile
+import Queue
 try:
     from cStringIO import StringIO
 except ImportError:
@@ -34,6 +39,7 @@ import cpc.util
 import cpc.command.heartbeat
 #from cpc.util.conf.server_conf import ServerConf
 from cpc.server.message.server_message import ServerMessage
+from cpc.network.com.client_response import ProcessedResponse
 
 log=logging.getLogger(__name__)
 
@@ -43,6 +49,12 @@ class RunningCmdListNotFoundError(cpc.util.CpcError):
 
 class RunningCmdListError(cpc.util.CpcError):
     pass
+
+# the name of the partial run data upload file in a command's directory
+resultUploadName="_run_data.part"
+# the block size for reading uploaded run data chunks
+resultChunkReadSize=65536
+
 class WorkerDataListError(cpc.util.CpcError):
     pass
 
@@ -103,7 +115,11 @@ class RunningCommand(object):
         """Get the expiry time relative to now (which the current time
            in seconds obtained through time.time()"""
         # calculate how long we can sleep before we need to check again.
-        return int(self.lastHeard + 2*self.heartbeatInterval - now)
+        return int(self.getExpiryTime() - now)
+
+    def getExpiryTime(self):
+        """Get the absolute time at which the heartbeat expires."""
+        return self.lastHeard + 2*self.heartbeatInterval
 
     def toJSON(self):
         ret=dict()
@@ -193,6 +209,8 @@ class RunningCmdList(object):
     # at which worker failures can cause data requests to worker servers if
     # they can be bundled.
     rateLimitTime = 5
+    # The number of threads that recover the data of dead commands.
+    recoveryThreads = 4
 
     def __init__(self, conf, cmdQueue, workerData):
         """Initialize the object with an empty list."""
@@ -206,9 +224,22 @@ class RunningCmdList(object):
         self.conf=conf
         self.cmdQueue=cmdQueue
         self.runningCommands=dict()
+        # A heap of (expiry time, sequence nr, RunningCommand) tuples with
+        # one entry for each running command. Pings only update the
+        # running command; when its entry comes up, it is put back with
+        # the new expiry time. Entries of commands that are no longer
+        # running are dropped when they come up.
+        self.expiryHeap=[]
+        self.heapSeq=itertools.count()
         self.workerData=workerData
         self.lock=threading.Lock()
         self.thread=None
+        # the queue of lists of dead running commands to recover, and the
+        # threads that handle them.
+        self.recoveryQueue=Queue.Queue()
+        self.recoveryThreadList=[]
+        # the worker servers that don't take batched dead worker fetches
+        self.unbatchedServers=set()
 
 
     def startHeartbeatThread(self):
@@ -218,6 +249,17 @@ class RunningCmdList(object):
         # up once other threads stop
         self.thread.daemon=True
         self.thread.start()
+        for i in range(self.recoveryThreads):
+            th=threading.Thread(target=recoveryThread, args=(self,))
+            th.daemon=True
+            th.start()
+            self.recoveryThreadList.append(th)
+
+    def _pushExpiry(self, rc):
+        """Put a running command in the expiry heap. Assumes self.lock is
+           held."""
+        heapq.heappush(self.expiryHeap, (rc.getExpiryTime(),
+                                         self.heapSeq.next(), rc))
 
     def add(self, cmds, workerServer, heartbeatInterval):
         """Add a set of commands sent to a specific worker."""
@@ -230,6 +272,7 @@ class RunningCmdList(object):
                 rc=RunningCommand(cmd, None, None, None, workerServer,
                                   heartbeatInterval)
                 self.runningCommands[cmd.id] = rc
+                self._pushExpiry(rc)
                 cmd.setRunning(True, workerServer)
 
     def remove(self, cmd):
@@ -242,6 +285,82 @@ class RunningCmdList(object):
             del self.runningCommands[cmd.id]
             cmd.setRunning(False)
 
+    def _getResultUploadName(self, cmdID):
+        """Get the file name of the partial result upload of a running
+           command."""
+        with self.lock:
+            if cmdID not in self.runningCommands:
+                raise RunningCmdListNotFoundError(cmdID)
+            cmd=self.runningCommands[cmdID].cmd
+        return os.path.join(cmd.getDir(), resultUploadName)
+
+    def getResultUploadSize(self, cmdID):
+        """Get the number of bytes of a command's run data that have been
+           uploaded so far."""
+        fname=self._getResultUploadName(cmdID)
+        if not os.path.exists(fname):
+            return 0
+        return os.path.getsize(fname)
+
+    def addResultChunk(self, cmdID, offset, chunkFile, checksum):
+        """Add a chunk of a command's run data to its partial upload, which
+           is written directly into the command's directory.
+
+           cmdID = the command ID
+           offset = the offset of the chunk in the run data. Anything
+                    uploaded beyond this offset is discarded.
+           chunkFile = the file object with the chunk data
+           checksum = the SHA1 hex digest of the chunk data
+           Returns the number of bytes uploaded so far: the offset of the
+           next chunk."""
+        fname=self._getResultUploadName(cmdID)
+        size=0
+        if os.path.exists(fname):
+            size=os.path.getsize(fname)
+        if offset > size:
+            # a chunk is missing: the uploader must resume from size.
+            return size
+        sha=hashlib.sha1()
+        chunkFile.seek(0)
+        while True:
+            buf=chunkFile.read(resultChunkReadSize)
+            if len(buf) == 0:
+                break
+            sha.update(buf)
+        if sha.hexdigest() != checksum:
+            raise RunningCmdListError("Checksum mismatch in run data chunk "
+                                      "at offset %d for command %s"%
+                                      (offset, cmdID))
+        chunkFile.seek(0)
+        if size > 0:
+            outf=open(fname, "r+b")
+        else:
+            outf=open(fname, "wb")
+        try:
+            outf.seek(offset)
+            outf.truncate(offset)
+            shutil.copyfileobj(chunkFile, outf, resultChunkReadSize)
+            outf.flush()
+            os.fsync(outf.fileno())
+            size=outf.tell()
+        finally:
+            outf.close()
+        return size
+
+    def getResultUpload(self, cmdID, size):
+        """Get the completed run data upload of a command as an open file.
+
+           cmdID = the command ID
+           size = the expected size of the run data"""
+        fname=self._getResultUploadName(cmdID)
+        if not os.path.exists(fname) or os.path.getsize(fname) != size:
+            raise RunningCmdListError("Incomplete run data upload for "
+                                      "command %s"%cmdID)
+        runfile=open(fname, "rb")
+        # the open file can still be read; the upload is done with.
+        os.remove(fname)
+        return runfile
+
     def handleFinished(self, cmdID, returncode, cputime, runfile):
         """Handle a finished command (successful or otherwise), with optional
            runfile
@@ -278,17 +397,20 @@ class RunningCmdList(object):
         #if runfile is not None:
         #    log.debug("extracting file for %s to dir %s"%(cmd.id,cmd.getDir()))
         #    cpc.util.file.extractSafely(cmd.getDir(), fileobj=runfile)
-        # run the task
+        # run the task. Like in the task exec threads, the controller runs
+        # without the project's state lock, and the rest is one change to
+        # the project state.
         if task is not None:
             (finished, newcmds, cancelcmds) = task.run(cmd)
-        if cancelcmds is not None:
-            for ccmd in cancelcmds:
-                self.cmdQueue.remove(ccmd)
-        if newcmds is not None:
-            for ncmd in newcmds:
-                self.cmdQueue.add(ncmd)
-        if finished:
-            task.handleOutput()
+            with task.project.stateLock.shared:
+                if cancelcmds is not None:
+                    for ccmd in cancelcmds:
+                        self.cmdQueue.remove(ccmd)
+                if newcmds is not None:
+                    for ncmd in newcmds:
+                        self.cmdQueue.add(ncmd)
+                if finished:
+                    task.handleOutput()
 
     def getCmdList(self):
         """Return a list with all running commands as command objects."""
@@ -357,16 +479,41 @@ class RunningCmdList(object):
     def writeState(self):
         pass
 
-    def _fetchRemoteRunFiles(self, rc):
-        """Get the result files from a remote run directory to a local
-            command directory.
-            Return true if successful. May throw exception in case of failure"""
-        if rc.haveData:
+    def _fetchRemoteRunFiles(self, workerServer, rcs):
+        """Get the result files from remote run directories on a worker
+            server to their local command directories.
+            Returns the list of running commands whose files were fetched.
+            May throw exception in case of failure"""
+        rcs=[ rc for rc in rcs if rc.haveData ]
+        if len(rcs) == 0:
+            return []
+        with self.lock:
+            batched=not (workerServer in self.unbatchedServers)
+        if len(rcs) > 1 and batched:
+            log.debug("Fetching %d remote results directories from %s"%
+                      (len(rcs), workerServer))
+            msg=ServerMessage(workerServer)
+            resp=msg.deadWorkerFetchBatchRequest([ (rc.workerDir, rc.runDir)
+                                                   for rc in rcs ])
+            if resp.getType() == "application/x-tar":
+                return self._extractBatch(resp.getRawData(), rcs)
+            presp=ProcessedResponse(resp)
+            message=presp.getMessage()
+            if ( presp.getStatus() == "OK" or message is None or
+                 not message.startswith("Unknown command") ):
+                # nothing could be fetched
+                return []
+            log.info("Server %s doesn't take batched dead worker fetches"%
+                     workerServer)
+            with self.lock:
+                self.unbatchedServers.add(workerServer)
+        ret=[]
+        for rc in rcs:
             log.debug("Fetching remote results directory %s to %s"%
                       (rc.runDir, rc.cmd.getDir()))
             # the data is remote: we must fetch data through a
             # server-to-server command.
-            msg=ServerMessage(rc.workerServer)
+            msg=ServerMessage(workerServer)
             resp=msg.deadWorkerFetchRequest(rc.workerDir, rc.runDir)
             if resp.getType() == "application/x-tar":
                 # untar the return data and  use it.
@@ -374,8 +521,33 @@ class RunningCmdList(object):
                 log.debug("extracting file for %s to dir %s"%
                           (rc.cmd.id,rc.cmd.getDir()))
                 cpc.util.file.extractSafely(rc.cmd.getDir(), fileobj=runfile)
-                return True
-        return False
+                ret.append(rc)
+        return ret
+
+    def _extractBatch(self, runfile, rcs):
+        """Extract the tar file of a batched dead worker fetch: the run
+           directory of each command is in a directory named after its
+           index in rcs. Returns the list of running commands with data."""
+        found=set()
+        tf=tarfile.open(fileobj=runfile, mode='r:gz')
+        try:
+            for member in tf.getmembers():
+                (index, sep, name)=member.name.partition('/')
+                if name == "":
+                    name="."
+                if ( os.path.isabs(name) or
+                     os.path.normpath(name).startswith("..") ):
+                    continue
+                try:
+                    rc=rcs[int(index)]
+                except (ValueError, IndexError):
+                    continue
+                member.name=name
+                tf.extract(member, rc.cmd.getDir())
+                found.add(int(index))
+        finally:
+            tf.close()
+        return [ rcs[i] for i in sorted(found) ]
 
     def _moveRunFiles(self, rc):
         """Move the result files from a local run directory to a local
@@ -436,59 +608,90 @@ class RunningCmdList(object):
         """Check the heartbeat times and deal with dead jobs.
            interval = the max. heartbeat interval
            Returns the time of the first heartbeat expiry."""
+        todelete=[]
         with self.lock:
-            # The maximum first expiry time is the server heartbeat interval
-            todelete=[]
-            firstExpiry=interval
             now=time.time()
-            for rc in self.runningCommands.itervalues():
-                expiry = rc.expiry(now)
-                if expiry < 0:
-                    todelete.append(rc)
-                elif expiry < firstExpiry:
-                    firstExpiry = expiry + 1
-            # first remove the expired running commands from the
-            # running list
-            for rc in todelete:
+            while len(self.expiryHeap) > 0:
+                (expiryTime, seq, rc)=self.expiryHeap[0]
+                if self.runningCommands.get(rc.cmd.id) is not rc:
+                    # the command is no longer running
+                    heapq.heappop(self.expiryHeap)
+                    continue
+                if expiryTime > now:
+                    break
+                heapq.heappop(self.expiryHeap)
+                if rc.getExpiryTime() > now:
+                    # it has been pinged since it was put in the heap
+                    self._pushExpiry(rc)
+                    continue
+                # remove the expired running command from the running list
                 del self.runningCommands[rc.cmd.id]
                 rc.cmd.setRunning(False)
-        # then handle their failure
-        if len(todelete)>0:
-            # first try to get the data
-            for rc in todelete:
-                finishedReported=False
-                # TODO: consolidate all requests for each worker server into
-                # one request
+                todelete.append(rc)
+            # The maximum first expiry time is the server heartbeat interval
+            firstExpiry=interval
+            if len(self.expiryHeap) > 0:
+                firstExpiry=min(firstExpiry, int(self.expiryHeap[0][0]-now)+1)
+        # then handle their failure: the commands on the same worker server
+        # are recovered together, and local commands one by one.
+        remote=dict()
+        for rc in todelete:
+            if rc.isLocal:
+                self._queueRecovery([rc])
+            elif rc.workerServer in remote:
+                remote[rc.workerServer].append(rc)
+            else:
+                remote[rc.workerServer]=[rc]
+        for rcs in remote.itervalues():
+            self._queueRecovery(rcs)
+        return firstExpiry
+
+    def _queueRecovery(self, rcs):
+        """Queue a list of dead running commands on the same worker server
+           for recovery of their data."""
+        if len(self.recoveryThreadList) > 0:
+            self.recoveryQueue.put(rcs)
+        else:
+            self.recover(rcs)
+
+    def recover(self, rcs):
+        """Try to get the data of a list of dead running commands on the
+           same worker server, and handle them as finished. Commands
+           without data are queued again."""
+        finished=set()
+        try:
+            if rcs[0].isLocal:
+                # the data is local. Copy the directories
+                withData=[ rc for rc in rcs if self._moveRunFiles(rc) ]
+            else:
+                withData=self._fetchRemoteRunFiles(rcs[0].workerServer, rcs)
+            for rc in withData:
                 try:
-                    if not rc.isLocal:
-                        haveDir=self._fetchRemoteRunFiles(rc)
-                    else:
-                        # the data is local. Copy the directory
-                        haveDir=self._moveRunFiles(rc)
-                    if haveDir:
-                        self._handleFinishedCmd(rc.cmd, None, 0)
-                        finishedReported=True
+                    self._handleFinishedCmd(rc.cmd, None, 0)
+                    finished.add(rc)
                 except cpc.util.CpcError as e:
                     log.error(e.__str__())
-                except:
-                    # we can ignore these, because they are simply associated
-                    # with fetching output data.
-                    fo=StringIO()
-                    traceback.print_exception(sys.exc_info()[0],
-                                              sys.exc_info()[1],
-                                              sys.exc_info()[2], file=fo)
-                    log.error("Heartbeat exception: %s"%(fo.getvalue()))
-                finally:
-                    if not finishedReported:
-                        log.info(
-                               "Running command %s died: didn't get its data."%
-                               rc.cmd.id)
-                        # just add it back into the queue
-                        self.cmdQueue.add(rc.cmd)
-                    else:
-                        log.info("Running command %s died: got its data."%
-                                 rc.cmd.id)
-        return firstExpiry
+        except cpc.util.CpcError as e:
+            log.error(e.__str__())
+        except:
+            # we can ignore these, because they are simply associated
+            # with fetching output data.
+            fo=StringIO()
+            traceback.print_exception(sys.exc_info()[0],
+                                      sys.exc_info()[1],
+                                      sys.exc_info()[2], file=fo)
+            log.error("Heartbeat exception: %s"%(fo.getvalue()))
+        finally:
+            for rc in rcs:
+                if rc in finished:
+                    log.info("Running command %s died: got its data."%
+                             rc.cmd.id)
+                else:
+                    log.info(
+                           "Running command %s died: didn't get its data."%
+                           rc.cmd.id)
+                    # just add it back into the queue
+                    self.cmdQueue.add(rc.cmd)
 
 def heartbeatServerThread(runningCommandList, conf):
     """The hearbeat thread's endless loop.
@@ -514,3 +717,16 @@ def heartbeatServerThread(runningCommandList, conf):
             errmsg="Exception in heartbeat thread: %s"%(fo.getvalue())
             log.error(errmsg)
 
+def recoveryThread(runningCommandList):
+    """The loop of a thread that recovers the data of dead commands.
+       runningCommandList = the running command list to recover for."""
+    while True:
+        rcs=runningCommandList.recoveryQueue.get()
+        try:
+            runningCommandList.recover(rcs)
+        except Exception as e:
+            fo=StringIO()
+            traceback.print_exception(sys.exc_info()[0],
+                                      sys.exc_info()[1],
+                                      sys.exc_info()[2], file=fo)
+            log.error("Exception in recovery thread: %s"%(fo.getvalue()))
@@ -0,0 +1,164 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2012, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+
+import threading
+import tempfile
+import zlib
+import logging
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+
+import cpc.util
+import cpc.command.heartbeat
+from cpc.network.com.client_response import ProcessedResponse
+from cpc.server.message.server_message import ServerMessage
+
+log=logging.getLogger(__name__)
+
+
+class HeartbeatRelayError(cpc.util.CpcError):
+    pass
+
+
+class _PendingBatch(object):
+    """A batch of heartbeat signals waiting to be sent to one server."""
+    def __init__(self):
+        self.batch=cpc.command.heartbeat.HeartbeatBatch()
+        self.done=threading.Event()
+        # a dict of batch index -> list of faulty command IDs
+        self.faulty=dict()
+        self.error=None
+
+
+class HeartbeatRelay(object):
+    """Relays worker heartbeat signals to the project servers of their
+       commands.
+
+       Instead of sending one request per worker heartbeat to each server,
+       the heartbeat signals for a server are collected for a short time
+       (conf. option heartbeat_relay_window) and sent together as one
+       compressed request. The faulty items that the server returns for
+       each heartbeat are handed back to the heartbeat they came from."""
+    def __init__(self, conf):
+        self.conf=conf
+        self.lock=threading.Lock()
+        # the batches being collected, indexed by destination server
+        self.pending=dict()
+        # the servers that don't take batched heartbeats
+        self.unbatchedServers=set()
+
+    def submit(self, dest, workerServer, workerID, workerDir, iteration,
+               items):
+        """Queue a worker's heartbeat items for a server.
+
+           Returns a ticket to pass to wait()."""
+        with self.lock:
+            pending=self.pending.get(dest)
+            if pending is None:
+                pending=_PendingBatch()
+                self.pending[dest]=pending
+                timer=threading.Timer(self.conf.getHeartbeatRelayWindow()/
+                                      1000., self._flush,
+                                      args=(dest, workerServer, pending))
+                timer.daemon=True
+                timer.start()
+            index=pending.batch.add(workerID, workerDir, iteration, items)
+        return (pending, index)
+
+    def wait(self, ticket):
+        """Wait until the heartbeat of a ticket from submit() has been
+           relayed.
+
+           Returns the list of command IDs of faulty items."""
+        (pending, index)=ticket
+        pending.done.wait()
+        if pending.error is not None:
+            raise HeartbeatRelayError(pending.error)
+        return pending.faulty.get(index, [])
+
+    def _flush(self, dest, workerServer, pending):
+        """Send a batch of heartbeats; run from its timer thread."""
+        with self.lock:
+            if self.pending.get(dest) is pending:
+                del self.pending[dest]
+            batched=not (dest in self.unbatchedServers)
+        try:
+            if batched:
+                batched=self._sendBatch(dest, workerServer, pending)
+                if not batched:
+                    with self.lock:
+                        self.unbatchedServers.add(dest)
+            if not batched:
+                self._sendSeparately(dest, workerServer, pending)
+        except Exception as e:
+            log.info("Error relaying heartbeats to %s: %s"%(dest, str(e)))
+            pending.error="Error relaying heartbeats to %s: %s"%(dest, str(e))
+        pending.done.set()
+
+    def _sendBatch(self, dest, workerServer, pending):
+        """Send a batch as a single request. Returns False if the server
+           doesn't take batched heartbeats."""
+        co=StringIO()
+        pending.batch.writeXML(co, workerServer)
+        tff=tempfile.TemporaryFile()
+        try:
+            comp=zlib.compressobj(6, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+            tff.write(comp.compress(co.getvalue()))
+            tff.write(comp.flush())
+            msg=ServerMessage(dest)
+            resp=msg.heartbeatBatchForwardedRequest(workerServer, tff)
+        finally:
+            tff.close()
+        presp=ProcessedResponse(resp)
+        if presp.getStatus() != "OK":
+            message=presp.getMessage()
+            if message is not None and message.startswith("Unknown command"):
+                log.info("Server %s doesn't take batched heartbeats"%dest)
+                return False
+            raise HeartbeatRelayError(message)
+        faulty=presp.getData()['faulty']
+        for index, cmdIDs in faulty.iteritems():
+            pending.faulty[int(index)]=cmdIDs
+        log.debug("Relayed %d heartbeats to %s"%
+                  (len(pending.batch.getHeartbeats()), dest))
+        return True
+
+    def _sendSeparately(self, dest, workerServer, pending):
+        """Send each heartbeat in a batch as a separate request, for servers
+           that don't take batched heartbeats."""
+        for index, (workerID, workerDir, iteration, items) in \
+                enumerate(pending.batch.getHeartbeats()):
+            co=StringIO()
+            co.write('<heartbeat worker_id="%s" worker_server_id="%s">'%
+                     (workerID, workerServer))
+            for item in items:
+                item.writeXML(co)
+            co.write('</heartbeat>')
+            msg=ServerMessage(dest)
+            resp = msg.heartbeatForwardedRequest(workerID, workerDir,
+                                                 workerServer, iteration,
+                                                 co.getvalue())
+            presp=ProcessedResponse(resp)
+            if presp.getStatus() != "OK":
+                log.info("Heartbeat response from %s not OK"%dest)
+                pending.faulty[index]=presp.getData()
@@ -126,12 +126,18 @@ class ProjectList(object):
         with self.lock:
             self._writeState(filename)
 
-    def writeFullState(self, projectListFilename):
-        """Write out each project's state."""
+    def writeFullState(self, projectListFilename, full=False):
+        """Write out each project's state. If full is True, full state
+           snapshots are written instead of journal entries.
+
+           Returns the total time in seconds that the projects' transactions
+           were held up."""
+        blockedTime=0.
         with self.lock:
             self._writeState(projectListFilename)
             for proj in self.projects.itervalues():
-                proj.writeState()
+                blockedTime+=proj.writeState(full)
+        return blockedTime
 
     #def writeProjectTasks(self, serverState):
     #    with self.lock:
@@ -34,16 +34,62 @@ from cpc.util.conf.server_conf import ServerConf
 import projectlist
 import cpc.server.queue
 import heartbeat
+import heartbeat_relay
 import cpc.server.queue
 import cpc.util.plugin
+import cpc.dataflow.controller_pool
+import cpc.dataflow.controller_host
+import cpc.dataflow.file_store
 import localassets
 import remoteassets
+import worker_capabilities
 from cpc.util.worker_state import WorkerState
 from cpc.server.state.session import SessionHandler
 from cpc.network.broadcast_message import BroadcastMessage
 
 log=logging.getLogger(__name__)
 
+
+class StateSaveStats(object):
+    """Timing statistics of the periodic state saves."""
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.nSaves=0
+        # the time it took to write the state
+        self.lastDuration=0.
+        self.maxDuration=0.
+        self.totalDuration=0.
+        # the time the dataflow transactions were held up by the state save
+        self.lastBlocked=0.
+        self.maxBlocked=0.
+        self.totalBlocked=0.
+
+    def add(self, duration, blocked):
+        """Add the timings of a single state save.
+           duration = the total time taken by the save
+           blocked = the time the dataflow was held up by the save"""
+        with self.lock:
+            self.nSaves+=1
+            self.lastDuration=duration
+            self.maxDuration=max(self.maxDuration, duration)
+            self.totalDuration+=duration
+            self.lastBlocked=blocked
+            self.maxBlocked=max(self.maxBlocked, blocked)
+            self.totalBlocked+=blocked
+
+    def toJSON(self):
+        with self.lock:
+            ret=dict()
+            ret['saves']=self.nSaves
+            ret['last_duration']=self.lastDuration
+            ret['max_duration']=self.maxDuration
+            ret['total_duration']=self.totalDuration
+            ret['last_blocked']=self.lastBlocked
+            ret['max_blocked']=self.maxBlocked
+            ret['total_blocked']=self.totalBlocked
+            return ret
+
+
 class ServerState:
     """Maintains the server state. Must provide synchronized access
        because the server is threaded.
@@ -61,13 +107,19 @@ class ServerState:
         self.projectlist=projectlist.ProjectList(conf, self.cmdQueue)
         self.taskExecThreads=None
         self.workerDataList=heartbeat.WorkerDataList()
+        self.workerCapabilityCache=\
+                worker_capabilities.WorkerCapabilityCache()
         self.runningCmdList=heartbeat.RunningCmdList(conf, self.cmdQueue,
                                                      self.workerDataList)
+        self.heartbeatRelay=heartbeat_relay.HeartbeatRelay(conf)
         self.localAssets=localassets.LocalAssets()
         self.remoteAssets=remoteassets.RemoteAssets()
         self.sessionHandler=SessionHandler()
         self.workerStates = dict()
         self.stateSaveThread=None
+        # serializes state writes
+        self.stateWriteLock=threading.Lock()
+        self.stateSaveStats=StateSaveStats()
         self.updateThread = None
         self.keepAliveThread = None
         self.reestablishConnectionThread = None
@@ -76,11 +128,28 @@ class ServerState:
         self.readableSockets = []
 
 
+    def startControllerPool(self):
+        """Start the controller process pool. This must be done before
+           any threads are started: the pool's processes are forked from
+           the server process."""
+        cpc.dataflow.controller_pool.startPool(
+                                        self.conf.getControllerProcesses())
+
     def startExecThreads(self):
         """Start the exec threads."""
-        self.taskExecThreads=cpc.server.queue.TaskExecThreads(self.conf, 1,
+        nControllerProcesses=self.conf.getControllerProcesses()
+        cpc.dataflow.controller_host.setMaxTasks(
+                                        self.conf.getControllerProcessTasks())
+        cpc.dataflow.controller_host.setTimeout(
+                                    self.conf.getControllerProcessTimeout())
+        # each controller process gets an exec thread to wait for it; one
+        # more runs the in-process tasks.
+        self.taskExecThreads=cpc.server.queue.TaskExecThreads(self.conf,
+                                                1+nControllerProcesses,
                                                 self.projectlist.getTaskQueue(),
                                                 self.cmdQueue)
+        # the projects' file stores queue files until now.
+        cpc.dataflow.file_store.startThreads()
         self.stateSaveThread=threading.Thread(target=stateSaveLoop,
                                               args=(self, self.conf, ))
         self.stateSaveThread.daemon=True
@@ -114,7 +183,10 @@ class ServerState:
         """set the quit state to true"""
         with self.quitlock:
             self.taskExecThreads.stop()
-            self._write()
+            with self.stateWriteLock:
+                self._write(full=True)
+            cpc.dataflow.controller_pool.stopPool()
+            cpc.dataflow.controller_host.stopHosts()
             self.quit=True
             doProfile = self.conf.getProfiling()
             if doProfile:
@@ -160,32 +232,42 @@ class ServerState:
         """Get the running command list."""
         return self.runningCmdList
 
+    def getHeartbeatRelay(self):
+        """Get the heartbeat relay for heartbeats to other servers."""
+        return self.heartbeatRelay
+
     def getWorkerDataList(self):
         """Get the worker directory list."""
         return self.workerDataList
 
+    def getWorkerCapabilityCache(self):
+        """Get the cache of worker capabilities."""
+        return self.workerCapabilityCache
+
     def getCmdLocation(self, cmdID):
         """Get the argument command location."""
         return  self.runningCmdList.getLocation(cmdID)
 
     def write(self):
-        """Write the full server state out to all appropriate files."""
-        # we go through all these motions to make sure that nothing prevents
-        # the server from starting up again.
-        self.taskExecThreads.acquire()
-        try:
-            self.taskExecThreads.pause()
+        """Write the full server state out to all appropriate files.
+
+           The task exec threads keep running: each project only holds up
+           its transactions while its changed state is collected."""
+        with self.stateWriteLock:
             self._write()
-            self.taskExecThreads.cont()
-        finally:
-            self.taskExecThreads.release()
+
+    def getStateSaveStats(self):
+        """Get the state save timing statistics."""
+        return self.stateSaveStats
+
+    def getTaskQueue(self):
+        """Get the dataflow task queue."""
+        return self.projectlist.getTaskQueue()
 
     def saveProject(self,project):
-        self.taskExecThreads.acquire()
         conf = ServerConf()
-        try:
-            self.taskExecThreads.pause()
-            self._write()
+        with self.stateWriteLock:
+            self._write(full=True)
             projectFolder = "%s/%s"%(conf.getRunDir(),project)
             if(os.path.isdir(projectFolder)):
                 #tar the project folder but keep the old files also, this is
@@ -200,20 +282,19 @@ class ServerState:
                 del(tf)
                 tff.seek(0)
                 os.remove(stateBackupFile)
-                self.taskExecThreads.cont()
             else:
-                self.taskExecThreads.cont()
                 raise Exception("Project does not exist")
-        finally:
-            self.taskExecThreads.release()
 
         return tff
 
-    def _write(self):
-        self.projectlist.writeFullState(self.conf.getProjectFile())
+    def _write(self, full=False):
+        startTime=time.time()
+        blockedTime=self.projectlist.writeFullState(self.conf.getProjectFile(),
+                                                    full)
         #self.taskQueue.writeFullState(self.conf.getTaskFile())
         #self.projectlist.writeState(self.conf.getProjectFile())
         self.runningCmdList.writeState()
+        self.stateSaveStats.add(time.time()-startTime, blockedTime)
 
     def read(self):
         self.projectlist.readState(self, self.conf.getProjectFile())
@@ -0,0 +1,131 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Cached worker capabilities.
+
+   A worker reports its platforms, executables and requirements with its
+   first worker-ready request. The parsed executable list and requirements
+   don't change during the worker's lifetime, so they are kept here under a
+   capability ID: a fingerprint of the executables and requirements. The
+   server sends that ID back, and later requests only carry the ID and the
+   worker's platforms with their currently remaining resources."""
+
+import collections
+import hashlib
+import threading
+import logging
+import xml.sax.saxutils
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from cpc.command.worker_matcher import CommandWorkerMatcher
+
+
+log=logging.getLogger(__name__)
+
+
+# the max. number of distinct worker capabilities to keep
+maxCacheEntries=1024
+
+
+class WorkerCapabilities(object):
+    """The immutable capabilities of a worker: its executables and
+       requirements."""
+    def __init__(self, executableList, workerReqDict):
+        self.executableList=executableList
+        self.workerReqDict=workerReqDict
+        self.exeXML=executableList.printPartialXML()
+        co=StringIO()
+        for key in sorted(workerReqDict.iterkeys()):
+            co.write('  <option key=%s value=%s/>\n'%
+                     (xml.sax.saxutils.quoteattr(key),
+                      xml.sax.saxutils.quoteattr(workerReqDict[key])))
+        self.reqXML=co.getvalue()
+        self.id=hashlib.sha1(self.exeXML+'\n'+self.reqXML).hexdigest()
+        # the executable lookups, shared between the matchers of all
+        # requests with these capabilities.
+        self.execIDs=dict()
+
+    def getID(self):
+        return self.id
+
+    def getMatcher(self, platforms):
+        """Get a new command-worker matcher for a request.
+
+           platforms = the worker's platforms with their remaining
+                       resources."""
+        return CommandWorkerMatcher(platforms, self.executableList,
+                                    self.workerReqDict, self.execIDs)
+
+    def printWorkerXML(self, platforms):
+        """Re-create the full worker description as sent by the worker, for
+           requests that are forwarded to other servers."""
+        co=StringIO()
+        co.write('<?xml version="1.0"?>\n')
+        co.write('<worker-request>\n')
+        co.write('<worker-arch-capabilities>\n')
+        for platform in platforms:
+            platform.writeXML(co)
+        co.write('\n')
+        co.write(self.exeXML)
+        co.write('\n</worker-arch-capabilities>')
+        co.write('\n<worker-requirements>\n')
+        co.write(self.reqXML)
+        co.write('</worker-requirements>\n')
+        co.write('</worker-request>\n')
+        return co.getvalue()
+
+
+class WorkerCapabilityCache(object):
+    """The worker capabilities known to this server, indexed by capability
+       ID. The least recently used capabilities are dropped when there are
+       more than maxCacheEntries; workers then re-send their full
+       description."""
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.capabilities=collections.OrderedDict()
+
+    def add(self, executableList, workerReqDict):
+        """Add the capabilities of a worker.
+
+           Returns the WorkerCapabilities object, which may be one added
+           before with the same executables and requirements."""
+        caps=WorkerCapabilities(executableList, workerReqDict)
+        with self.lock:
+            existing=self.capabilities.pop(caps.getID(), None)
+            if existing is not None:
+                caps=existing
+            self.capabilities[caps.getID()]=caps
+            while len(self.capabilities) > maxCacheEntries:
+                self.capabilities.popitem(last=False)
+        return caps
+
+    def get(self, capabilityID):
+        """Get the capabilities with a capability ID, or None if they're not
+           (or no longer) known."""
+        with self.lock:
+            caps=self.capabilities.pop(capabilityID, None)
+            if caps is not None:
+                self.capabilities[capabilityID]=caps
+        if caps is None:
+            log.debug("Unknown worker capability ID %s"%capabilityID)
+        return caps
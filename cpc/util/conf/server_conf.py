@@ -206,6 +206,11 @@ class ServerConf(conf_base.Conf):
         self._add('heartbeat_file', "heartbeatlist.xml",
                   "Heartbeat monitor list", False,
                   relTo='conf_dir')
+        # The time in milliseconds during which worker heartbeats are
+        # collected to relay them to another server as a single request.
+        self._add('heartbeat_relay_window', 500,
+                  "Time in ms to collect heartbeats to relay as one request",
+                  True, validation='\d+')
 
         # Task exec queue size. If it exceeds this size, the dataflow
         # propagation blocks.
@@ -213,6 +218,46 @@ class ServerConf(conf_base.Conf):
                   "Dataflow execution task queue size",
                   True, validation='\d+')
 
+        # The maximum time a worker-ready request waits for the dataflow to
+        # queue more commands if the worker isn't filled.
+        self._add('worker_ready_wait_time', 5,
+                  "Max. time in seconds a worker request waits for new commands",
+                  True, validation='\d+')
+        # The maximum time a worker-ready request from a worker that asks
+        # for it is held open until matching commands are queued.
+        self._add('worker_long_poll_time', 60,
+                  "Max. time in seconds a long-polling worker request is held",
+                  True, validation='\d+')
+        # The number of processes to run CPU-bound python controllers in.
+        self._add('controller_processes', 0,
+                  "Number of processes for CPU-bound controllers (0=none)",
+                  True, validation='\d+')
+        # The number of tasks a persistent external controller process runs
+        # before it is replaced by a new one.
+        self._add('controller_process_tasks', 100,
+                  "Number of tasks per persistent controller process (0=no persistent processes)",
+                  True, validation='\d+')
+        # The max. time a task may take in a persistent external controller
+        # process before the process is killed.
+        self._add('controller_process_timeout', 3600,
+                  "Max. time in seconds for a task in a persistent controller process (0=no limit)",
+                  True, validation='\d+')
+        # The number of incremental project state saves (journal entries)
+        # between full state snapshots.
+        self._add('state_journal_size', 10,
+                  "Number of journaled state saves between full state snapshots",
+                  True, validation='\d+')
+        # Whether to compress the files in the command bundles sent to
+        # workers. Files that are already compressed are never recompressed.
+        self._add('command_bundle_compression', 'gzip',
+                  "Compression of command bundle files (gzip or none)",
+                  True, allowedValues=['gzip', 'none'])
+        # Whether to keep the project files that values refer to in a
+        # content-addressed store, so identical files are kept only once.
+        self._add('project_file_store', 'false',
+                  "Deduplicate project files through a content-addressed store of hard links. Identical files then share their contents: files that values refer to must be replaced, not written to in place",
+                  True, allowedValues=['false', 'true'])
+
                 #static configuration
         self._add('web_root', 'web',
                   "The directory where html,js and css files are located")
@@ -450,7 +495,43 @@ class ServerConf(conf_base.Conf):
 
     def getTaskQueueSize(self):
         with self.lock:
-            return self.conf['task_queue_size'].get()
+            return int(self.conf['task_queue_size'].get())
+
+    def getWorkerReadyWaitTime(self):
+        with self.lock:
+            return int(self.conf['worker_ready_wait_time'].get())
+
+    def getWorkerLongPollTime(self):
+        with self.lock:
+            return int(self.conf['worker_long_poll_time'].get())
+
+    def getControllerProcesses(self):
+        with self.lock:
+            return int(self.conf['controller_processes'].get())
+
+    def getControllerProcessTasks(self):
+        with self.lock:
+            return int(self.conf['controller_process_tasks'].get())
+
+    def getControllerProcessTimeout(self):
+        with self.lock:
+            return int(self.conf['controller_process_timeout'].get())
+
+    def getHeartbeatRelayWindow(self):
+        with self.lock:
+            return int(self.conf['heartbeat_relay_window'].get())
+
+    def getStateJournalSize(self):
+        with self.lock:
+            return int(self.conf['state_journal_size'].get())
+
+    def getCommandBundleCompression(self):
+        with self.lock:
+            return self.conf['command_bundle_compression'].get() != 'none'
+
+    def getProjectFileStore(self):
+        with self.lock:
+            return self.conf['project_file_store'].get() == 'true'
 
     def getWebRootPath(self):
         return os.path.join(self.execBasedir,self.get('web_root'))
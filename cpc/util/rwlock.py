@@ -0,0 +1,121 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import threading
+import time
+
+
+class ReadWriteLock(object):
+    """A lock that can be held by any number of readers at the same time,
+       or by a single writer. Waiting writers take precedence over new
+       readers, so a writer can't be starved by a steady stream of readers.
+
+       The lock is reentrant: a thread that holds it (either way) can
+       acquire it as a reader again, even while a writer is waiting, and
+       the writer can acquire it as a writer again. A reader can't become
+       a writer without releasing the lock first.
+
+       The lock is used through its two lock-like members:
+       with rwlock.shared:
+           ...
+       with rwlock.exclusive:
+           ..."""
+    def __init__(self):
+        self.cond=threading.Condition(threading.Lock())
+        # the number of readers holding the lock
+        self.nReaders=0
+        # the number of writers waiting for the lock
+        self.nWaitingWriters=0
+        # the thread that holds the lock as a writer, and how many times
+        self.writer=None
+        self.nWrites=0
+        # the per-thread number of times the lock is held as a reader
+        self.local=threading.local()
+        self.shared=_LockSide(self.acquireShared, self.releaseShared)
+        self.exclusive=_LockSide(self.acquireExclusive, self.releaseExclusive)
+
+    def acquireShared(self):
+        """Acquire the lock as a reader."""
+        nShared=getattr(self.local, 'nShared', 0)
+        if nShared == 0 and self.writer is not threading.currentThread():
+            with self.cond:
+                while self.writer is not None or self.nWaitingWriters > 0:
+                    self.cond.wait()
+                self.nReaders+=1
+            self.local.counted=True
+        elif nShared == 0:
+            # the writer reading: it already excludes everyone else.
+            self.local.counted=False
+        self.local.nShared=nShared+1
+
+    def releaseShared(self):
+        """Release a reader's hold on the lock."""
+        self.local.nShared-=1
+        if self.local.nShared == 0 and self.local.counted:
+            with self.cond:
+                self.nReaders-=1
+                if self.nReaders == 0:
+                    self.cond.notifyAll()
+
+    def acquireExclusive(self):
+        """Acquire the lock as a writer.
+
+           Returns the time in seconds spent waiting for the lock."""
+        startTime=time.time()
+        if self.writer is threading.currentThread():
+            self.nWrites+=1
+            return 0.
+        if getattr(self.local, 'nShared', 0) > 0:
+            raise RuntimeError("Can't acquire a read-write lock as a writer "
+                               "while holding it as a reader")
+        with self.cond:
+            self.nWaitingWriters+=1
+            try:
+                while self.writer is not None or self.nReaders > 0:
+                    self.cond.wait()
+            finally:
+                self.nWaitingWriters-=1
+            self.writer=threading.currentThread()
+            self.nWrites=1
+        return time.time()-startTime
+
+    def releaseExclusive(self):
+        """Release a writer's hold on the lock."""
+        self.nWrites-=1
+        if self.nWrites == 0:
+            with self.cond:
+                self.writer=None
+                self.cond.notifyAll()
+
+
+class _LockSide(object):
+    """One side (shared or exclusive) of a ReadWriteLock, with the interface
+       of a normal lock."""
+    def __init__(self, acquireFn, releaseFn):
+        self.acquire=acquireFn
+        self.release=releaseFn
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+        return False
+
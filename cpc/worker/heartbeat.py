@@ -136,14 +136,13 @@ class HeartbeatSender(object):
         self.cmdsChanged=False
         with self.runCondVar:
             # first write the items to xml
-            cmds=self.worker._getWorkloads()
+            cmds=self.worker._getHeartbeatWorkloads()
             co=StringIO()
             co.write('<heartbeat worker_id="%s">'%self.workerID)
             for item in cmds:
-                if item.running:
-                    item.hbi.writeXML(co)
-                    for subwl in item.joinedTo:
-                        subwl.hbi.writeXML(co)
+                item.hbi.writeXML(co)
+                for subwl in item.joinedTo:
+                    subwl.hbi.writeXML(co)
             co.write("</heartbeat>")
         clnt=WorkerMessage()
         resp=clnt.workerHeartbeatRequest(self.workerID, self.workerDir, 
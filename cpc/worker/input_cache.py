@@ -0,0 +1,129 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""The worker's cache of command input files, by content hash.
+
+   Many commands share large inputs (run input files, topologies,
+   checkpoints, index files). The worker tells the server which contents it
+   has cached with each request for work, and the server then sends only
+   references for those files (see cpc.command.bundle). Cached files are
+   hard-linked into the run directories, and made read-only so that a
+   command can't change the cached contents by writing to its inputs in
+   place."""
+
+import collections
+import os
+import shutil
+import stat
+import logging
+
+
+log=logging.getLogger(__name__)
+
+
+class InputCache(object):
+    """A size-bounded, content-addressed cache of command input files. The
+       least recently used files are removed first.
+
+       Not thread-safe: the worker only uses it from its polling thread."""
+    def __init__(self, cacheDir, maxSize):
+        """Initialize an empty cache.
+
+           cacheDir = the directory to keep the cached files in
+           maxSize = the max. total size in bytes of the cached files"""
+        self.dir=cacheDir
+        self.maxSize=maxSize
+        # the (size, mtime) of the cached files, by hash, in LRU order
+        self.entries=collections.OrderedDict()
+        self.totalSize=0
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        # keep the files cached by an earlier run of the worker
+        for contentHash in os.listdir(self.dir):
+            st=os.stat(self._path(contentHash))
+            self.entries[contentHash]=(st.st_size, st.st_mtime)
+            self.totalSize+=st.st_size
+
+    def _path(self, contentHash):
+        return os.path.join(self.dir, contentHash)
+
+    def _check(self, contentHash):
+        """Check whether a cached file is unchanged, and remove it if it
+           isn't."""
+        entry=self.entries.get(contentHash)
+        if entry is None:
+            return False
+        try:
+            st=os.stat(self._path(contentHash))
+            if (st.st_size, st.st_mtime) == entry:
+                return True
+        except OSError:
+            pass
+        log.info("Cached input %s has changed; removing it"%contentHash)
+        self._remove(contentHash)
+        return False
+
+    def _remove(self, contentHash):
+        (size, mtime)=self.entries.pop(contentHash)
+        self.totalSize-=size
+        try:
+            os.remove(self._path(contentHash))
+        except OSError:
+            pass
+
+    def getHashes(self):
+        """Get the list of the content hashes of the cached files."""
+        return [ contentHash for contentHash in self.entries.keys()
+                 if self._check(contentHash) ]
+
+    def link(self, contentHash, filename):
+        """Put a cached file in place as filename, as a hard link if
+           possible.
+
+           Returns whether the file was in the cache."""
+        if not self._check(contentHash):
+            return False
+        try:
+            os.link(self._path(contentHash), filename)
+        except OSError:
+            shutil.copy2(self._path(contentHash), filename)
+        # mark it as the most recently used one
+        self.entries[contentHash]=self.entries.pop(contentHash)
+        return True
+
+    def add(self, contentHash, filename):
+        """Add a file with a given content hash to the cache."""
+        if self._check(contentHash):
+            self.entries[contentHash]=self.entries.pop(contentHash)
+            return
+        path=self._path(contentHash)
+        try:
+            os.link(filename, path)
+        except OSError:
+            shutil.copy2(filename, path)
+        os.chmod(path, stat.S_IRUSR|stat.S_IRGRP|stat.S_IROTH)
+        st=os.stat(path)
+        self.entries[contentHash]=(st.st_size, st.st_mtime)
+        self.totalSize+=st.st_size
+
+    def trim(self):
+        """Remove the least recently used files until the cache is no larger
+           than its max. size."""
+        while self.totalSize > self.maxSize and len(self.entries) > 0:
+            self._remove(next(iter(self.entries)))
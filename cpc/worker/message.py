@@ -50,20 +50,47 @@ class WorkerMessage(ClientBase):
         self.privateKey = self.conf.getPrivateKey()
         self.keychain = self.conf.getCaChainFile()
 
-    def workerRequest(self, workerID, archdata):
+    def workerRequest(self, workerID, archdata, capabilityID=None,
+                      platforms=None, wait=None, haveInputs=None):
+        """Ask for work. The worker describes itself either with archdata,
+           the full description of its platforms, executables and
+           requirements, or with the capability ID that the server returned
+           for an earlier full description, together with platforms: the
+           list of platforms with their remaining resources.
+
+           If wait is set, the server may hold the request for up to wait
+           seconds until there is work. haveInputs is the newline-separated
+           list of content hashes of the worker's cached input files; if it
+           is set, those files are not sent again."""
         cmdstring='worker-ready'
         fields = []
         fields.append(Input('cmd', cmdstring))
         fields.append(Input('version', "1"))
-        fields.append(Input('worker', archdata))
+        if capabilityID is not None:
+            fields.append(Input('capability-id', capabilityID))
+            fields.append(Input('platforms', platforms))
+        else:
+            fields.append(Input('worker', archdata))
         fields.append(Input('worker-id', workerID))
+        if wait is not None:
+            fields.append(Input('wait', str(wait)))
+        if haveInputs is not None:
+            fields.append(Input('have-inputs', haveInputs))
+        # we read command bundles, and extract them while they arrive.
+        fields.append(Input('bundle', "1"))
         headers = dict()
         response= self.putRequest(ServerRequest.prepareRequest(fields, [],
-                                                               headers))
+                                                               headers),
+                                  stream=True)
         return response
     
     def commandFinishedRequest(self, cmdID, origServer, returncode, cputime, 
-                               jobTarFileobj):
+                               jobTarFileobj, uploadedSize=None):
+        """Signal that a command has finished. The run data is either sent
+           as jobTarFileobj, or has been uploaded with
+           commandResultChunkRequest(), in which case uploadedSize is its
+           total size. Without either, the command is handed back without
+           having run, and the server queues it again."""
         cmdstring='command-finished'
         fields = []
         fields.append(Input('cmd', cmdstring))
@@ -73,8 +100,13 @@ class WorkerMessage(ClientBase):
         if returncode is not None:
             fields.append(Input('return_code', str(returncode)))
         fields.append(Input('used_cpu_time', str(cputime)))
-        jobTarFileobj.seek(0)
-        files = [FileInput('run_data','cmd.tar.gz',jobTarFileobj)]
+        if jobTarFileobj is not None:
+            jobTarFileobj.seek(0)
+            files = [FileInput('run_data','cmd.tar.gz',jobTarFileobj)]
+        else:
+            files = []
+            if uploadedSize is not None:
+                fields.append(Input('run_data_size', str(uploadedSize)))
         headers = dict()
         # TODO we directly forward to the originating server. We don't have to
         # because there's active relaying, but for now this simplifies things
@@ -84,6 +116,31 @@ class WorkerMessage(ClientBase):
                                                                files, headers))
         return response
     
+    def commandResultChunkRequest(self, cmdID, origServer, offset=None,
+                                  chunkFileobj=None, checksum=None):
+        """Upload a chunk of a command's run data to its project server.
+           Without a chunk, only asks for the number of bytes received so
+           far.
+
+           offset = the offset of the chunk in the run data
+           chunkFileobj = a file object with the chunk data
+           checksum = the SHA1 hex digest of the chunk data"""
+        cmdstring='command-result-chunk'
+        fields = []
+        fields.append(Input('cmd', cmdstring))
+        fields.append(Input('version', "1"))
+        fields.append(Input('cmd_id', cmdID))
+        files = []
+        if chunkFileobj is not None:
+            fields.append(Input('offset', str(offset)))
+            fields.append(Input('checksum', checksum))
+            files.append(FileInput('chunk', 'chunk', chunkFileobj))
+        headers = dict()
+        headers['server-id'] = origServer
+        response= self.putRequest(ServerRequest.prepareRequest(fields,
+                                                               files, headers))
+        return response
+
     def workerHeartbeatRequest(self, workerID, workerDir, first, last, changed,
                                heartbeatItemsXML):
         cmdstring='worker-heartbeat'                   
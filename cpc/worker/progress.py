@@ -0,0 +1,90 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Estimates of the fraction completed of running workloads.
+
+   The worker uses these to ask for new work shortly before a running
+   workload finishes. Estimates are made by executable name; workloads
+   without an estimator have no known progress."""
+
+import glob
+import os
+import re
+import logging
+
+
+log=logging.getLogger(__name__)
+
+
+# the number of bytes to read from the start and the end of log files
+logHeadSize=256*1024
+logTailSize=64*1024
+
+_nstepsRe=re.compile(r'^\s*nsteps\s*=\s*(-?\d+)', re.MULTILINE)
+_initStepRe=re.compile(r'^\s*init[-_]step\s*=\s*(\d+)', re.MULTILINE)
+_stepRe=re.compile(r'^\s*Step\s+Time.*\n\s*(\d+)\s', re.MULTILINE)
+
+
+def mdrunProgress(workload, state):
+    """Get the fraction completed of an mdrun run from its log file: the
+       last step written to the log, relative to init-step and nsteps.
+
+       workload = the workload
+       state = a dict with information to keep between calls"""
+    logs=glob.glob(os.path.join(workload.rundir, "md*.log"))
+    if len(logs) == 0:
+        return None
+    logName=max(logs, key=os.path.getmtime)
+    try:
+        inf=open(logName, 'r')
+        try:
+            if state.get('log') != logName:
+                head=inf.read(logHeadSize)
+                nsteps=_nstepsRe.search(head)
+                initStep=_initStepRe.search(head)
+                if nsteps is None:
+                    return None
+                state['log']=logName
+                state['nsteps']=int(nsteps.group(1))
+                state['init_step']=int(initStep.group(1)) if initStep else 0
+            inf.seek(0, os.SEEK_END)
+            inf.seek(max(0, inf.tell()-logTailSize))
+            steps=_stepRe.findall(inf.read())
+        finally:
+            inf.close()
+    except IOError:
+        return None
+    if len(steps) == 0 or state['nsteps'] <= 0:
+        return None
+    return (float(int(steps[-1])-state['init_step'])/state['nsteps'])
+
+# the progress estimators, by executable name
+estimators={ 'gromacs/mdrun' : mdrunProgress }
+
+
+def getFractionCompleted(workload, state):
+    """Get the estimated fraction completed of a running workload, or None
+       if it isn't known.
+
+       workload = the workload
+       state = a dict with information to keep between calls"""
+    estimator=estimators.get(workload.cmd.executable)
+    if estimator is None:
+        return None
+    return estimator(workload, state)
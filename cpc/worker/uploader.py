@@ -0,0 +1,72 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import sys
+import logging
+import threading
+import traceback
+import Queue
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+
+log=logging.getLogger(__name__)
+
+
+class ResultUploader(object):
+    """Returns the results of finished workloads to their servers in the
+       background, so the worker can run new work in the meantime. At most
+       a fixed number of uploads run at the same time."""
+    def __init__(self, nThreads, doneFunction):
+        """Initialize the uploader.
+
+           nThreads = the max. number of simultaneous uploads
+           doneFunction = the function to call with each workload after its
+                          results have been returned (or failed to be)."""
+        self.queue=Queue.Queue()
+        self.doneFunction=doneFunction
+        self.threads=[]
+        for i in range(nThreads):
+            th=threading.Thread(target=self._uploadLoop)
+            th.daemon=True
+            th.start()
+            self.threads.append(th)
+
+    def add(self, workload):
+        """Queue a finished workload for returning its results."""
+        self.queue.put(workload)
+
+    def _uploadLoop(self):
+        while True:
+            workload=self.queue.get()
+            try:
+                workload.returnResults()
+            except:
+                # the server will find out about the command through the
+                # missing heartbeats.
+                fo=StringIO()
+                traceback.print_exception(sys.exc_info()[0],
+                                          sys.exc_info()[1],
+                                          sys.exc_info()[2], file=fo)
+                log.error("Error returning results of %s: %s"%
+                          (workload.cmd.id, fo.getvalue()))
+            finally:
+                self.doneFunction(workload)
@@ -28,10 +28,13 @@ import time
 
 import cpc.util.file
 import cpc.command
+import cpc.command.bundle
 from cpc.command.platform_reservation import PlatformReservation
 from cpc.util.plugin import PlatformPlugin
 import workload
 import heartbeat
+import uploader
+import input_cache
 from cpc.worker.message import WorkerMessage
 
 log=logging.getLogger(__name__)
@@ -41,6 +44,22 @@ class WorkerError(cpc.util.CpcError):
     pass
 
 
+# the max. time in seconds the server may hold a request for work until
+# there is work
+longPollTime=60
+# the min. time in seconds between requests for work that return no work
+minPollInterval=30
+# the fraction completed of a running workload at which to ask for the
+# work that will replace it
+prefetchFraction=0.95
+# the interval in seconds at which to check running workloads' progress
+prefetchCheckInterval=30
+# the max. number of results to return at the same time
+maxUploads=2
+# the max. size in bytes of the cache of command input files
+inputCacheSize=4*1024*1024*1024
+
+
 # variables for the signal handler associated with workers
 signalHandlerLock=threading.Lock() # the lock for the workers list
 signalHandlerWorkers=[] # the list of workers to shutdown
@@ -166,7 +185,23 @@ class Worker(object):
             sys.exit(1)
 
         self._printAvailableExes()
+        # the ID under which the server knows our executables and
+        # requirements, once it has told us.
+        self.capabilityID=None
         self.workloads=[]
+        # workloads received by the polling thread that haven't started yet
+        self.newWorkloads=[]
+        # the earliest time to ask for work again
+        self.nextPollTime=0
+        # the exception info of an error in the polling thread
+        self.pollError=None
+        # the workloads whose results are being returned
+        self.uploads=[]
+        self.uploader=uploader.ResultUploader(maxUploads, self._uploadDone)
+        # the cache of input files, by content
+        self.inputCache=input_cache.InputCache(os.path.join(self.mainDir,
+                                                            "input_cache"),
+                                               inputCacheSize)
         self.iteration=0
         self.acceptCommands = True
         # install the signal handler
@@ -180,11 +215,6 @@ class Worker(object):
         return self.mainDir
 
 
-    def _getWorkloads(self):
-        """Get the list of workloads, assuming a locked runCondVar."""
-        return self.workloads
-
-
     def killWorkload(self, cmdID):
         """Kill a workload by command ID."""
         with self.runCondVar:
@@ -204,105 +234,208 @@ class Worker(object):
                 log.debug("Error in killWorkload %s"%cmdID)
 
     def run(self):
-        """Ask for tasks until told to quit."""
-        noWorkSeconds=0
+        """Ask for tasks until told to quit.
+
+           Work is asked for in a separate thread (see _pollLoop()) that
+           holds a long-polling request to the server whenever there are
+           free resources, or when a running workload is nearly finished.
+           This loop reacts to new workloads from that thread and to
+           finished workloads as soon as they happen. The resources of a
+           finished workload are released right away; its results are
+           returned in the background by the ResultUploader."""
+        # the time since which we've had no workloads
+        idleSince=None
+        pollThread=threading.Thread(target=self._pollLoop)
+        pollThread.daemon=True
+        pollThread.start()
         while not self.quit:
-            # send a request for a command to run
-            startWaitingTime=time.time()
             with self.runCondVar:
+                while not self._haveEvents():
+                    # check whether there is work. If not, start counting
+                    # the amount of time we waited.
+                    if self._haveWorkloads():
+                        idleSince=None
+                    elif idleSince is None:
+                        idleSince=time.time()
+                    timeout=None
+                    if self.quitSeconds is not None and idleSince is not None:
+                        timeout=idleSince+self.quitSeconds-time.time()
+                        if timeout <= 0:
+                            log.info("No work for %d seconds. Quitting."%
+                                     self.quitSeconds)
+                            # signal quit.
+                            self.acceptCommands=False
+                            self.runCondVar.notifyAll()
+                            break
+                    self.runCondVar.wait(timeout)
+                if self.pollError is not None:
+                    (errType, errValue, errTraceback)=self.pollError
+                    raise errType, errValue, errTraceback
                 acceptCommands=self.acceptCommands
-            if acceptCommands:
-                resp=self._obtainCommands()
-                # and extract the command and run directory
-                workloads=self._extractCommands(resp)
-                log.info("Got %d commands."%len(workloads))
-                for workload in workloads:
-                    log.info("cmd ID=%s"%workload.cmd.id)
-                    # Check whether we have the neccesary executable.
-                    # (If not, we need to ask for it)
-                    if workload.executable is None:
-                        # TODO: implement getting the executable
-                        log.error("Found no executable!")
-                        raise WorkerError("Executable not found")
-                    workload.reservePlatform()
-                if len(workloads)>0:
-                    # We first prepare
-                    self._prepareWorkloads(workloads)
-                    # add the new workloads to our lists
+                # prefetched workloads wait until their resources are freed
+                workloads=[]
+                unstarted=[]
+                for workload in self.newWorkloads:
+                    if not acceptCommands:
+                        unstarted.append(workload)
+                    elif workload.platform.canReserveCmdResources(
+                                                            workload.cmd):
+                        workload.reservePlatform()
+                        workloads.append(workload)
+                for workload in workloads + unstarted:
+                    self.newWorkloads.remove(workload)
+                self.uploads.extend(unstarted)
+                finishedWorkloads=[ workload for workload in self.workloads
+                                    if not workload.running ]
+            for workload in unstarted:
+                # we're quitting: hand them back without running them.
+                self.uploader.add(workload)
+            if len(workloads)>0:
+                # We first prepare
+                self._prepareWorkloads(workloads)
+                # add the new workloads to our lists
+                with self.runCondVar:
                     self.workloads.extend(workloads)
-                    self.heartbeat.addWorkloads(workloads)
-                    # Now we run.
-                    log.debug("Running workloads: %d"%len(self.workloads))
-                    #hb=heartbeat.Heartbeat(cmd.id, origServer, rundir)
-                    # just before starting to run, we again check whether we
-                    # should.
-                    with self.runCondVar:
-                        acceptCommands=self.acceptCommands
-                    if acceptCommands:
-                        for workload in workloads:
-                            workload.run(self.plugin, self.args)
-            # now wait until a workload finishes
-            finishedWorkloads = []
-            self.runCondVar.acquire()
-            continueWaiting=True
-            while continueWaiting:
-                haveFinishedWorkloads=False
-                for workload in self.workloads:
-                    if not workload.running:
-                        haveFinishedWorkloads=True
-                        break
-                if self.acceptCommands and not haveFinishedWorkloads:
-                    haveRemainingResources=self._haveRemainingResources()
-                    if haveRemainingResources:
-                        log.info("Have free resources. Waiting 30 seconds")
-                        self.runCondVar.wait(30)
-                        continueWaiting=False
-                    else:
-                        # we can't ask for new jobs, so we wait indefinitely
-                        self.runCondVar.wait()
-                else:
-                    continueWaiting=False
-                # now sleep one second to make sure that jobs stopping around
-                # the same time are reported back at once.
-                time.sleep(1)
-                # loop over all workloads
-                for workload in self.workloads:
-                    if not workload.running:
-                        finishedWorkloads.append(workload)
-                        log.info("Command id %s finished"%workload.cmd.id)
-                        continueWaiting=False
-                    #else:
-                    #    log.debug("Command %s still running"%workload.cmd.id)
-                #log.debug("End of waiting loop")
-            #log.debug("Out of waiting loop")
-            self.runCondVar.release()
-            stopWaitingTime=time.time()
-            # check whether there was work to do. If not, start counting
-            # the amount of time we waited.
-            if len(self.workloads) == 0:
-                noWorkSeconds += stopWaitingTime-startWaitingTime
-                if ( ( self.quitSeconds is not None ) and
-                     ( noWorkSeconds > self.quitSeconds ) ):
-                    with self.runCondVar:
-                        # signal quit.
-                        self.acceptCommands=False
-            else:
-                noWorkSeconds = 0
+                self.heartbeat.addWorkloads(workloads)
+                # Now we run.
+                log.debug("Running workloads: %d"%len(self.workloads))
+                # just before starting to run, we again check whether we
+                # should.
+                with self.runCondVar:
+                    acceptCommands=self.acceptCommands
+                if acceptCommands:
+                    for workload in workloads:
+                        workload.run(self.plugin, self.args)
             # now deal with finished workloads.
             for workload in finishedWorkloads:
+                log.info("Command id %s finished"%workload.cmd.id)
                 workload.finish(self.plugin, self.args)
-                workload.returnResults()
-                workload.releasePlatform()
             if len(finishedWorkloads)>0:
-                self.heartbeat.delWorkloads(finishedWorkloads)
+                with self.runCondVar:
+                    for workload in finishedWorkloads:
+                        workload.releasePlatform()
+                        self.workloads.remove(workload)
+                    self.uploads.extend(finishedWorkloads)
+                    # the freed resources can be used right away
+                    self.nextPollTime=0
+                    self.runCondVar.notifyAll()
                 for workload in finishedWorkloads:
-                    self.workloads.remove(workload)
+                    self.uploader.add(workload)
             with self.runCondVar:
-                acceptCommands=self.acceptCommands
-            if not acceptCommands and len(self.workloads)==0:
-                self.quit = True
+                if not self.acceptCommands and not self._haveWorkloads():
+                    self.quit = True
+                    self.runCondVar.notifyAll()
         self.heartbeat.stop()
 
+    def _haveWorkloads(self):
+        """Check whether there are any workloads, running or not, assuming
+           a locked runCondVar."""
+        return (len(self.workloads) > 0 or len(self.newWorkloads) > 0 or
+                len(self.uploads) > 0)
+
+    def _haveEvents(self):
+        """Check whether the main loop has anything to do, assuming a locked
+           runCondVar."""
+        if self.pollError is not None:
+            return True
+        for workload in self.newWorkloads:
+            if ( not self.acceptCommands or
+                 workload.platform.canReserveCmdResources(workload.cmd) ):
+                return True
+        for workload in self.workloads:
+            if not workload.running:
+                return True
+        return not self.acceptCommands and not self._haveWorkloads()
+
+    def _uploadDone(self, workload):
+        """Called by the ResultUploader when a workload's results have been
+           returned."""
+        with self.runCondVar:
+            self.uploads.remove(workload)
+            self.runCondVar.notifyAll()
+        self.heartbeat.delWorkloads([workload])
+
+    def _getHeartbeatWorkloads(self):
+        """Get the workloads the server should hear about, assuming a locked
+           runCondVar: the running ones, the ones that haven't started yet
+           and the ones whose results are being returned."""
+        ret=[ workload for workload in self.workloads if workload.running ]
+        ret.extend(self.newWorkloads)
+        ret.extend(self.uploads)
+        return ret
+
+    def _pollLoop(self):
+        """Ask the server for work whenever there are free resources, or
+           soon will be, and hand the workloads to run(). Runs in its own
+           thread."""
+        while True:
+            with self.runCondVar:
+                while True:
+                    if self.quit or not self.acceptCommands:
+                        return
+                    platforms=None
+                    if len(self.newWorkloads) == 0:
+                        if self._haveRemainingResources():
+                            platforms=self.remainingPlatforms
+                        else:
+                            platforms=self._getPrefetchPlatforms()
+                    if platforms is not None:
+                        left=self.nextPollTime-time.time()
+                        if left <= 0:
+                            break
+                        self.runCondVar.wait(left)
+                    else:
+                        # we can't ask for new jobs, so we wait until
+                        # resources are released, or nearly so.
+                        self.runCondVar.wait(prefetchCheckInterval)
+                platformsXML=u''
+                for platform in platforms:
+                    platformsXML+=platform.printXML()
+            startTime=time.time()
+            try:
+                resp=self._obtainCommands(platformsXML)
+                # and extract the command and run directory
+                workloads=self._extractCommands(resp)
+            except:
+                with self.runCondVar:
+                    self.pollError=sys.exc_info()
+                    self.runCondVar.notifyAll()
+                return
+            log.info("Got %d commands."%len(workloads))
+            for workload in workloads:
+                log.info("cmd ID=%s"%workload.cmd.id)
+            with self.runCondVar:
+                if len(workloads) == 0:
+                    # servers that don't hold our request return right
+                    # away; don't ask again too soon.
+                    self.nextPollTime=startTime+minPollInterval
+                self.newWorkloads.extend(workloads)
+                self.runCondVar.notifyAll()
+
+    def _getPrefetchPlatforms(self):
+        """Get the platforms with the resources that will be available when
+           the running workloads that are nearly finished (see
+           prefetchFraction) are done, or None if there are no such
+           workloads. Assumes a locked runCondVar."""
+        platforms=None
+        for workload in self.workloads:
+            if not workload.running:
+                continue
+            fraction=workload.getFractionCompleted()
+            if fraction is None or fraction < prefetchFraction:
+                continue
+            log.debug("Command %s is %.2f complete: prefetching work"%
+                      (workload.cmd.id, fraction))
+            if platforms is None:
+                platforms=copy.deepcopy(self.remainingPlatforms)
+            for wl in [ workload ] + workload.joinedTo:
+                for platform in platforms:
+                    if platform.name == wl.platform.name:
+                        platform.releaseCmdResources(wl.cmd)
+        if platforms is None or not self._haveResources(platforms):
+            return None
+        return platforms
+
 
     def cleanup(self):
         shutil.rmtree(self.mainDir)
@@ -349,15 +482,37 @@ class Worker(object):
 
         log.debug("Found %d executables."%(len(self.exelist.executables)))
 
-    def _obtainCommands(self):
+    def _obtainCommands(self, platformsXML):
         """Obtain a command from the up-most server given a list of
-           platforms and exelist. Returns the client response object."""
+           platforms and exelist. Returns the client response object.
+
+           platformsXML = the platforms with their available resources"""
+        runreq_clnt=WorkerMessage()
+        # the contents we don't need to be sent again
+        haveInputs=u'\n'.join(self.inputCache.getHashes())
+        if self.capabilityID is not None:
+            # the server knows our executables: only send the platforms
+            # with their remaining resources.
+            req=u'<platform-list>\n'
+            req+=platformsXML
+            req+=u'</platform-list>\n'
+            resp=runreq_clnt.workerRequest(self.id, None,
+                                           capabilityID=self.capabilityID,
+                                           platforms=req,
+                                           wait=longPollTime,
+                                           haveInputs=haveInputs)
+            if not resp.headers.has_key('capability-unknown'):
+                return resp
+            # the server has forgotten about us.
+            log.debug("Server doesn't know capability ID %s"%
+                      self.capabilityID)
+            resp.close()
+            self.capabilityID=None
         # Send a run request with our arch+binaries
         req=u'<?xml version="1.0"?>\n'
         req+=u'<worker-request>\n'
         req+=u'<worker-arch-capabilities>\n'
-        for platform in self.remainingPlatforms:
-            req+=platform.printXML()
+        req+=platformsXML
         req+='\n'
         req+=self.exelist.printPartialXML()
         req+=u'\n</worker-arch-capabilities>'
@@ -368,8 +523,11 @@ class Worker(object):
         req+=u'</worker-requirements>\n'
         req+=u'</worker-request>\n'
         log.debug('request string is: %s'%req)
-        runreq_clnt=WorkerMessage()
-        resp=runreq_clnt.workerRequest(self.id,req)
+        resp=runreq_clnt.workerRequest(self.id, req, wait=longPollTime,
+                                       haveInputs=haveInputs)
+        # servers that cache our capabilities tell us their ID.
+        if resp.headers.has_key('capability-id'):
+            self.capabilityID=resp.headers['capability-id']
         #print "Got %s"%(resp.read(len(resp)))
         return resp
 
@@ -378,7 +536,7 @@ class Worker(object):
             Returns a list of Workloads."""
         workloads=[]
         log.debug("Response type=%s"%resp.getType())
-        if resp.getType() == "application/x-tar":
+        if cpc.command.bundle.isContentType(resp.getType()):
             if resp.headers.has_key('originating-server-id'):
                 origServer=resp.headers['originating-server-id']
             else:
@@ -393,7 +551,14 @@ class Worker(object):
             rundir=os.path.join(self.mainDir, "%d"%self.iteration)
             log.debug("run directory: %s"%rundir)
             #os.mkdir(rundir)
-            cpc.util.file.extractSafely(rundir, fileobj=resp.getRawData())
+            missing=cpc.command.bundle.extractBundle(rundir,
+                                                     resp.getRawData(),
+                                                     self.inputCache)
+            self.inputCache.trim()
+            # the command directories with inputs that were removed from the
+            # input cache after we asked for work.
+            missingDirs=set([ os.path.normpath(name).split('/')[0]
+                              for name in missing ])
             # get the commands.
             i=0
             for subdir in os.listdir(rundir):
@@ -409,6 +574,17 @@ class Worker(object):
                     log.debug("Received job. Command is: %s"%inf.read())
                     inf.close()
                     cmd=cr.getCommands()[0]
+                    if subdir in missingDirs:
+                        # hand the command back, so the server queues it
+                        # again. The next request doesn't list the missing
+                        # inputs, so they will be sent along.
+                        log.info("Handing back cmd id %s: cached inputs "
+                                 "not found"%cmd.id)
+                        shutil.rmtree(cmddir, ignore_errors=True)
+                        clnt=WorkerMessage()
+                        clnt.commandFinishedRequest(cmd.id, origServer,
+                                                    None, 0, None)
+                        continue
                     (exe, pf)=self._findExecutable(cmd)
                     if (exe is None):
                         raise WorkerError("Executable not found")
@@ -418,7 +594,7 @@ class Worker(object):
                                                        exe, pf, id,
                                                        self.runCondVar))
                     i+=1
-            resp.close()
+        resp.close()
         self.iteration+=1
         return workloads
 
@@ -470,7 +646,12 @@ class Worker(object):
            returns: True if none of the resources have been depleted, False
                     otherwise
            """
-        for platform in self.remainingPlatforms:
+        return self._haveResources(self.remainingPlatforms)
+
+    def _haveResources(self, platforms):
+        """Check whether none of the resources of a list of platforms have
+           been depleted."""
+        for platform in platforms:
             for rsrc in platform.getMaxResources().itervalues():
                 if rsrc.value <= 0:
                     return False
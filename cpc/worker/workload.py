@@ -32,6 +32,7 @@ import threading
 import traceback
 import time
 import copy
+import hashlib
 try:
     from cStringIO import StringIO
 except ImportError:
@@ -44,8 +45,11 @@ from  cpc.command import RunVars
 from  cpc.command import RunVarReader
 import cpc.client
 from cpc.command.platform_reservation import PlatformReservation
+import cpc.command.heartbeat
 import cpc.worker
 from cpc.worker.message import *
+import progress
+from cpc.network.com.client_response import ProcessedResponse
 
 log=logging.getLogger(__name__)
 
@@ -57,6 +61,11 @@ splock=threading.Lock()
 class WorkloadError(cpc.util.CpcError):
     pass
 
+# the size of the chunks in which run data is uploaded
+resultChunkSize=4*1024*1024
+# the max. number of consecutive failed run data upload attempts
+resultUploadRetries=10
+
 class WorkLoad(object):
     """The description of a single command with run directory and originating
        server."""
@@ -86,12 +95,16 @@ class WorkLoad(object):
         # the following data should be protected by a lock, given by the worker:
         self.joinedTo=[] # the workloads that this workload joins
         self.running=False
+        # whether the workload has been started (on its own or joined)
+        self.started=False
         self.failed=False # whether the run caused an exception
         self.realTimeSpent=0
         self.args=None # the argument list for low level run
         # the return code
         self.returncode=None
         self.subprocess=None
+        # progress estimate data, see getFractionCompleted()
+        self.progressState=dict()
 
 
     def canJoin(self, other):
@@ -193,33 +206,107 @@ class WorkLoad(object):
         return retstr
 
     def returnResults(self):
-        with self.condVar:
-            log.debug("Returning run data for cmd id %s"%self.cmd.id)
-            tff=tempfile.TemporaryFile()
-            outputFiles=self.cmd.getOutputFiles()
-            tf=tarfile.open(fileobj=tff, mode="w:gz")
-            if outputFiles is None or len(outputFiles)==0:
-                tf.add(self.rundir, arcname=".", recursive=True)
-            else:
-                outputFiles.append('stdout')
-                outputFiles.append('stderr')
-                for name in outputFiles:
-                    fname=os.path.join(self.rundir,name)
-                    if os.path.exists(fname):
-                        tf.add(fname, arcname=name, recursive=False)
-            tf.close()
-            del(tf)
-            tff.seek(0)
+        """Send the run data back to the originating server. Doesn't use
+           the worker's lock, so it can run in the background.
+
+           A workload that was never started is handed back without run
+           data, so the server queues its command again."""
+        if not self.started:
+            log.info("Handing back unstarted cmd id %s"%self.cmd.id)
             shutil.rmtree(self.rundir, ignore_errors=True)
-            # and send it back 
-            clnt= WorkerMessage()
-            # the cmddir, taskID and projectID together define a unique command.
-            clnt.commandFinishedRequest(self.cmd.id, self.originatingServer, 
-                                        self.returncode, self._getCputime(), 
-                                        tff)
-            tff.close()
+            clnt=WorkerMessage()
+            clnt.commandFinishedRequest(self.cmd.id, self.originatingServer,
+                                        None, 0, None)
             for workload in self.joinedTo:
                 workload.returnResults()
+            return
+        log.debug("Returning run data for cmd id %s"%self.cmd.id)
+        tff=tempfile.TemporaryFile()
+        outputFiles=self.cmd.getOutputFiles()
+        tf=tarfile.open(fileobj=tff, mode="w:gz")
+        if outputFiles is None or len(outputFiles)==0:
+            tf.add(self.rundir, arcname=".", recursive=True)
+        else:
+            outputFiles.append('stdout')
+            outputFiles.append('stderr')
+            for name in outputFiles:
+                fname=os.path.join(self.rundir,name)
+                if os.path.exists(fname):
+                    tf.add(fname, arcname=name, recursive=False)
+        tf.close()
+        del(tf)
+        tff.seek(0)
+        shutil.rmtree(self.rundir, ignore_errors=True)
+        # and send it back 
+        clnt= WorkerMessage()
+        uploadedSize=self._uploadResults(tff)
+        # the cmddir, taskID and projectID together define a unique command.
+        if uploadedSize is not None:
+            clnt.commandFinishedRequest(self.cmd.id,
+                                        self.originatingServer,
+                                        self.returncode,
+                                        self._getCputime(), None,
+                                        uploadedSize)
+        else:
+            clnt.commandFinishedRequest(self.cmd.id,
+                                        self.originatingServer,
+                                        self.returncode,
+                                        self._getCputime(), tff)
+        tff.close()
+        for workload in self.joinedTo:
+            workload.returnResults()
+
+    def _uploadResults(self, tff):
+        """Upload the run data in tff to the originating server in chunks,
+           resuming from where the server is after a failed chunk.
+
+           Returns the size of the uploaded run data, or None if the server
+           doesn't take chunked uploads."""
+        tff.seek(0, os.SEEK_END)
+        size=tff.tell()
+        offset=None
+        nFailures=0
+        while True:
+            try:
+                clnt=WorkerMessage()
+                if offset is None:
+                    # ask the server where to (re)start
+                    resp=clnt.commandResultChunkRequest(self.cmd.id,
+                                                     self.originatingServer)
+                    presp=ProcessedResponse(resp)
+                    if not presp.isOK():
+                        if nFailures == 0:
+                            log.debug("No chunked upload for %s: %s"%
+                                      (self.cmd.id, presp.getMessage()))
+                            return None
+                        raise WorkloadError(presp.getMessage())
+                    offset=presp.getData()['offset']
+                if offset >= size:
+                    return size
+                tff.seek(offset)
+                data=tff.read(resultChunkSize)
+                chunkf=tempfile.TemporaryFile()
+                try:
+                    chunkf.write(data)
+                    resp=clnt.commandResultChunkRequest(self.cmd.id,
+                                                 self.originatingServer,
+                                                 offset, chunkf,
+                                                 hashlib.sha1(data).hexdigest())
+                finally:
+                    chunkf.close()
+                presp=ProcessedResponse(resp)
+                if not presp.isOK():
+                    raise WorkloadError(presp.getMessage())
+                offset=presp.getData()['offset']
+                nFailures=0
+            except cpc.util.CpcError as e:
+                nFailures+=1
+                if nFailures > resultUploadRetries:
+                    raise
+                log.info("Run data upload for %s failed (%s); retrying"%
+                         (self.cmd.id, str(e)))
+                time.sleep(min(2**nFailures, 60))
+                offset=None
 
     def run(self, plugin, pluginArgs):
         """Run the workload in a separate thread. Signal the condvar when
@@ -246,6 +333,9 @@ class WorkLoad(object):
             if self.running:
                 raise cpc.util.CpcError("workload already running.")
             self.running=True
+            self.started=True
+            for workload in self.joinedTo:
+                workload.started=True
         # start the thread in which to run.
         th=threading.Thread(target=runThreadFn, args=(self,))
         th.daemon=True
@@ -255,6 +345,11 @@ class WorkLoad(object):
         with self.condVar:
             return self.running
 
+    def getFractionCompleted(self):
+        """Get the estimated fraction completed of the running workload, or
+           None if it isn't known."""
+        return progress.getFractionCompleted(self, self.progressState)
+
     def finish(self, plugin, pluginArgs):
         """Run the platform plugin with finish when needed."""
         global splock
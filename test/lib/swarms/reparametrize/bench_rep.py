@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Grant Rotskoff, Bjorn Wesen, Erik Lindahl and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+# Benchmark for the string reparametrization: compares the NumPy version in
+# cpc.lib.swarms.string_rep with the external rep.cc helper (run 'make' in
+# cpc/lib/swarms first) and with the original pure python version, on a
+# random string.
+#
+# Usage, from within the copernicus base directory:
+#   PYTHONPATH=. python test/lib/swarms/reparametrize/bench_rep.py \
+#       [-p npoints] [-c ncvs] [-i iterations] [--python]
+# The pure python version is O(points^3*CVs) per iteration, so it is only run
+# with --python.
+
+import argparse
+import os
+import random
+import time
+
+import numpy
+
+from cpc.lib.swarms import string_rep
+from cpc.lib.swarms import reparametrize
+from test.unit.lib.test_string_rep import py_rep_pts, makeString
+
+
+def bench(name, repfn, pts, iters):
+    """Time iters reparametrization iterations with repfn.
+
+       Returns the final points."""
+    startTime = time.time()
+    adjusted = pts
+    for i in range(iters):
+        (maxspread, adjusted) = repfn(adjusted)
+    elapsed = time.time() - startTime
+    print('%-8s %10.4f s/iteration   final maxspread %g' %
+          (name, elapsed / iters, maxspread))
+    return adjusted
+
+def maxDiff(a, b):
+    return float(numpy.max(numpy.abs(numpy.asarray(a) - numpy.asarray(b))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='String reparametrization benchmark')
+    parser.add_argument('-p', '--points', type=int, default=100,
+                        help='number of string points')
+    parser.add_argument('-c', '--cvs', type=int, default=4000,
+                        help='number of CVs per point')
+    parser.add_argument('-i', '--iterations', type=int, default=5,
+                        help='number of iterations to time')
+    parser.add_argument('--python', action='store_true',
+                        help='also time the original pure python version')
+    args = parser.parse_args()
+
+    random.seed(1)
+    pts = makeString(args.points, args.cvs)
+    print('%d points, %d CVs, %d iterations' % (args.points, args.cvs,
+                                                args.iterations))
+    result = bench('numpy', string_rep.rep_pts, pts, args.iterations)
+
+    if os.path.exists(os.path.join(os.path.dirname(os.path.realpath(
+                                    reparametrize.__file__)), 'rep')):
+        extResult = bench('rep.cc', reparametrize.ext_rep_pts, pts,
+                          args.iterations)
+        print('  max. difference to numpy: %g' % maxDiff(result, extResult))
+    else:
+        print('rep.cc   not built; run make to include it')
+
+    if args.python:
+        pyResult = bench('python', py_rep_pts, pts, args.iterations)
+        print('  max. difference to numpy: %g' % maxDiff(result, pyResult))
+
+
+if __name__ == "__main__":
+    main()
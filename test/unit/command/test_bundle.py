@@ -0,0 +1,131 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+# 
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published 
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+
+import unittest
+import os
+import shutil
+import tarfile
+import tempfile
+from cpc.command import bundle
+from cpc.worker.input_cache import InputCache
+
+
+class StreamOnly(object):
+    """A file object that can only be read sequentially, like a network
+       stream."""
+    def __init__(self, data):
+        self.data=data
+        self.pos=0
+
+    def read(self, size=-1):
+        if size < 0:
+            size=len(self.data)-self.pos
+        ret=self.data[self.pos:self.pos+size]
+        self.pos+=len(ret)
+        return ret
+
+
+class TestBundle(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.mkdtemp()
+        self.src=os.path.join(self.dir, "src")
+        os.makedirs(os.path.join(self.src, "sub"))
+        self.files={ "command.xml" : "<command/>\n"*100,
+                     "topol.tpr" : os.urandom(1000),
+                     os.path.join("sub", "conf.gro") : "1 SOL OW\n"*1000 }
+        for name, content in self.files.iteritems():
+            outf=open(os.path.join(self.src, name), "wb")
+            outf.write(content)
+            outf.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _roundTrip(self, compress, haveHashes=None, inputCache=None,
+                   dest="dest"):
+        tff=tempfile.TemporaryFile()
+        bundle.writeBundle(tff, [ (self.src, "cmd_1") ], compress, haveHashes)
+        tff.seek(0)
+        data=tff.read()
+        tff.close()
+        dest=os.path.join(self.dir, dest)
+        bundle.extractBundle(dest, StreamOnly(data), inputCache)
+        for name, content in self.files.iteritems():
+            inf=open(os.path.join(dest, "cmd_1", name), "rb")
+            self.assertEquals(inf.read(), content)
+            inf.close()
+        return data
+
+    def testCompressed(self):
+        data=self._roundTrip(True)
+        # the already-compressed file is stored as is, the others aren't.
+        self.assertTrue(data.find(self.files["topol.tpr"]) >= 0)
+        self.assertTrue(data.find(self.files["command.xml"]) < 0)
+
+    def testUncompressed(self):
+        data=self._roundTrip(False)
+        self.assertTrue(data.find(self.files["command.xml"]) >= 0)
+
+    def testTarGz(self):
+        tff=tempfile.TemporaryFile()
+        tf=tarfile.open(fileobj=tff, mode="w:gz")
+        tf.add(self.src, arcname="cmd_1", recursive=True)
+        tf.close()
+        tff.seek(0)
+        dest=os.path.join(self.dir, "dest")
+        bundle.extractBundle(dest, StreamOnly(tff.read()))
+        tff.close()
+        self.assertTrue(os.path.exists(os.path.join(dest, "cmd_1", "sub",
+                                                    "conf.gro")))
+
+    def testInputCache(self):
+        content=os.urandom(bundle.minHashSize)
+        self.files["state.cpt"]=content
+        outf=open(os.path.join(self.src, "state.cpt"), "wb")
+        outf.write(content)
+        outf.close()
+        cache=InputCache(os.path.join(self.dir, "cache"), 1024*1024)
+        # the first time, the large file is sent and cached
+        self._roundTrip(True, frozenset(), cache)
+        hashes=cache.getHashes()
+        self.assertEquals(hashes,
+                          [ bundle.getFileHash(os.path.join(self.src,
+                                                            "state.cpt")) ])
+        # the second time, it's taken from the cache
+        data=self._roundTrip(True, frozenset(hashes), cache, "dest2")
+        self.assertTrue(data.find(content) < 0)
+        # a reference to a file that isn't cached (any more) is left out,
+        # and reported
+        cache=InputCache(os.path.join(self.dir, "cache2"), 1024*1024)
+        tff=tempfile.TemporaryFile()
+        bundle.writeBundle(tff, [ (self.src, "cmd_1") ], True,
+                           frozenset(hashes))
+        tff.seek(0)
+        dest=os.path.join(self.dir, "dest3")
+        missing=bundle.extractBundle(dest, StreamOnly(tff.read()), cache)
+        tff.close()
+        self.assertEquals(missing, [ "cmd_1/state.cpt" ])
+        self.assertFalse(os.path.exists(os.path.join(dest, "cmd_1",
+                                                     "state.cpt")))
+        self.assertTrue(os.path.exists(os.path.join(dest, "cmd_1",
+                                                    "command.xml")))
+        # without an input cache, a reference is an error
+        self.assertRaises(bundle.BundleError, self._roundTrip, True,
+                          frozenset(hashes), None, "dest4")
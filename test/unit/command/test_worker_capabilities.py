@@ -0,0 +1,106 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+
+from cpc.command.platform_exec_reader import PlatformExecutableReader
+from cpc.command.platform import PlatformReader
+from cpc.server.state.worker_capabilities import WorkerCapabilityCache
+
+
+def platformXML(cores):
+    return ('<platform name="smp" arch="x86_64">\n'
+            ' <resources>\n'
+            '  <max>\n'
+            '   <resource name="cores" value="%d"/>\n'
+            '  </max>\n'
+            '  <min/>\n'
+            '  <pref/>\n'
+            ' </resources>\n'
+            '</platform>\n'%cores)
+
+def workerXML(cores, project=None):
+    ret=('<?xml version="1.0"?>\n<worker-request>\n'
+         '<worker-arch-capabilities>\n')
+    ret+=platformXML(cores)
+    ret+=('<executable name="gromacs/mdrun" platform="smp" arch="x86_64" '
+          'version="4.6" id="mdrun-smp" />\n'
+          '</worker-arch-capabilities>\n<worker-requirements>\n')
+    if project is not None:
+        ret+='  <option key="project" value="%s"/>\n'%project
+    ret+='</worker-requirements>\n</worker-request>\n'
+    return ret
+
+def readWorker(data):
+    rdr=PlatformExecutableReader()
+    rdr.readString(data, "test")
+    return rdr
+
+
+class FakeCommand(object):
+    def __init__(self, executable):
+        self.executable=executable
+        self.minVersion=None
+        self.maxVersion=None
+
+
+class TestWorkerCapabilities(unittest.TestCase):
+    def setUp(self):
+        self.cache=WorkerCapabilityCache()
+
+    def add(self, data):
+        rdr=readWorker(data)
+        return (self.cache.add(rdr.getExecutableList(),
+                               rdr.getWorkerRequirements()),
+                rdr.getPlatforms())
+
+    def testID(self):
+        (caps, platforms)=self.add(workerXML(8))
+        # the remaining resources are not part of the capabilities
+        (caps2, platforms2)=self.add(workerXML(2))
+        self.assertEqual(caps.getID(), caps2.getID())
+        self.assertTrue(caps2 is caps)
+        (caps3, platforms3)=self.add(workerXML(8, "proj"))
+        self.assertNotEqual(caps.getID(), caps3.getID())
+        self.assertTrue(self.cache.get(caps3.getID()) is caps3)
+        self.assertEqual(self.cache.get("nonexistent"), None)
+
+    def testForwardedXML(self):
+        (caps, platforms)=self.add(workerXML(8, "proj"))
+        rdr=readWorker(caps.printWorkerXML(platforms))
+        self.assertEqual(rdr.getWorkerRequirements(), {'project' : 'proj'})
+        self.assertEqual(rdr.getPlatforms()[0].getMaxResource('cores'), 8)
+        self.assertEqual(rdr.getExecutableList().printPartialXML(),
+                         caps.executableList.printPartialXML())
+
+    def testMatcher(self):
+        (caps, platforms)=self.add(workerXML(8))
+        prdr=PlatformReader()
+        prdr.readString('<platform-list>\n%s</platform-list>\n'%
+                        platformXML(4), "test")
+        cwm=caps.getMatcher(prdr.getPlatforms())
+        self.assertEqual(cwm.usePlatform.getMaxResource('cores'), 4)
+        self.assertEqual(cwm.getExecID(FakeCommand("gromacs/mdrun")),
+                         "mdrun-smp")
+        self.assertEqual(cwm.getExecID(FakeCommand("gromacs/grompp")), None)
+        # the lookups are shared with the next request's matcher
+        cwm2=caps.getMatcher(platforms)
+        self.assertEqual(len(cwm2.execIDs), 2)
+        self.assertEqual(cwm2.getExecID(FakeCommand("gromacs/mdrun")),
+                         "mdrun-smp")
@@ -0,0 +1,123 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import os
+import shutil
+import tempfile
+import time
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from cpc.dataflow import controller_host
+
+
+# a controller that reports its process and the environment it got, and
+# then changes the environment like the msm controller does.
+controllerScript='''import os
+import sys
+inp=sys.stdin.read()
+if inp == "die":
+    os._exit(3)
+elif inp == "hang":
+    import time
+    time.sleep(60)
+sys.stdout.write("%d %s %s"%(os.getpid(), os.environ.get("OMP_NUM_THREADS"),
+                             inp))
+sys.stderr.write("done")
+os.environ["OMP_NUM_THREADS"]="4"
+'''
+
+class TestFrames(unittest.TestCase):
+    def testFrames(self):
+        outf=StringIO()
+        frames=[ "", "one line", "two\nlines\n", "\n12\n" ]
+        for frame in frames:
+            controller_host.writeFrame(outf, frame)
+        inf=StringIO(outf.getvalue())
+        for frame in frames:
+            self.assertEqual(controller_host.readFrame(inf), frame)
+        # the end of the stream
+        self.assertEqual(controller_host.readFrame(inf), None)
+
+    def testBrokenFrames(self):
+        self.assertRaises(controller_host.ControllerHostError,
+                          controller_host.readFrame, StringIO("10\nshort"))
+        self.assertRaises(controller_host.ControllerHostError,
+                          controller_host.readFrame, StringIO("x\n"))
+
+
+class TestControllerHost(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.mkdtemp()
+        self.script=os.path.join(self.dir, "controller.py")
+        outf=open(self.script, "w")
+        outf.write(controllerScript)
+        outf.close()
+        controller_host.setMaxTasks(2)
+
+    def tearDown(self):
+        controller_host.stopHosts()
+        controller_host.setMaxTasks(0)
+        controller_host.setTimeout(0)
+        shutil.rmtree(self.dir)
+
+    def _run(self, inp):
+        return controller_host.run("test", self.script, self.dir, inp)
+
+    def testRecycle(self):
+        (ret, stdout1, stderr)=self._run("a")
+        self.assertEqual(ret, 0)
+        self.assertEqual(stderr, "done")
+        (ret, stdout2, stderr)=self._run("b")
+        (ret, stdout3, stderr)=self._run("c")
+        pid1, env1, inp1=stdout1.split()
+        pid2, env2, inp2=stdout2.split()
+        pid3, env3, inp3=stdout3.split()
+        self.assertEqual((inp1, inp2, inp3), ("a", "b", "c"))
+        # the second task runs in the same process, the third in a new one
+        # after controller_process_tasks tasks.
+        self.assertEqual(pid1, pid2)
+        self.assertNotEqual(pid2, pid3)
+        self.assertNotEqual(int(pid1), os.getpid())
+        # the environment is restored after each task
+        self.assertEqual((env1, env2, env3), ("None", "None", "None"))
+
+    def testDyingHost(self):
+        (ret, stdout, stderr)=self._run("a")
+        pid=stdout.split()[0]
+        (ret, stdout, stderr)=self._run("die")
+        self.assertEqual(ret, 1)
+        self.assertTrue(stderr.find("died") >= 0)
+        # the next task gets a new process
+        (ret, stdout, stderr)=self._run("b")
+        self.assertEqual(ret, 0)
+        self.assertNotEqual(stdout.split()[0], pid)
+
+    def testTimeout(self):
+        controller_host.setTimeout(1)
+        start=time.time()
+        (ret, stdout, stderr)=self._run("hang")
+        self.assertTrue(time.time()-start < 30)
+        self.assertEqual(ret, 1)
+        self.assertTrue(stderr.find("timed out") >= 0)
+        (ret, stdout, stderr)=self._run("a")
+        self.assertEqual(ret, 0)
@@ -0,0 +1,94 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import os
+import shutil
+import tempfile
+import xml.etree.ElementTree as ElementTree
+import cpc.lib
+from cpc.dataflow import vtype
+from cpc.dataflow import value
+from cpc.dataflow import run
+from cpc.dataflow import atomic
+from cpc.dataflow import controller_pool
+
+
+class TestControllerPool(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        controller_pool.startPool(1)
+
+    @classmethod
+    def tearDownClass(cls):
+        controller_pool.stopPool()
+
+    def setUp(self):
+        self.dir=tempfile.mkdtemp()
+        self.fn=atomic.ExtendedFunctionFunction("extended_err")
+        self.fn.setFunction("cpc.lib._test.extended_err", "cpc.lib._test")
+        self.fn.setCpuBound(True)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _input(self, a, b):
+        recType=vtype.RecordType("extended_err:in", vtype.recordType)
+        recType.addMember("a", vtype.floatType, False, False, False)
+        recType.addMember("b", vtype.floatType, False, False, False)
+        inputs=value.Value(None, recType)
+        inputs.getSubValue(['a'])._set(a)
+        inputs.getSubValue(['b'])._set(b)
+        return run.FunctionRunInput(inputs, outputDir=self.dir,
+                                    persistentDir=self.dir)
+
+    def testRun(self):
+        self.assertTrue(controller_pool.hasPool())
+        inp=self._input(1., 2.)
+        self.fn.run(inp)
+        fo=inp.getFunctionOutput()
+        self.assertEqual(fo.errMsg, None)
+        self.assertEqual([ (out.name, out.val.value) for out in fo.outputs ],
+                         [ ("a", 3.) ])
+        # the controller ran in the pool process, but wrote its files here
+        self.assertTrue(os.path.exists(os.path.join(self.dir,
+                                                    "persistent.dat")))
+
+    def testError(self):
+        inp=self._input(-1., -2.)
+        self.fn.run(inp)
+        fo=inp.getFunctionOutput()
+        self.assertEqual(fo.errMsg, "A was negative!")
+        self.assertEqual(fo.warnMsg, "B was negative!")
+
+    def testCpuBoundControllers(self):
+        # the controllers that run gromacs tools or concatenate trajectories
+        # opt in to the pool.
+        importFile=os.path.join(os.path.dirname(cpc.lib.__file__),
+                                "gromacs", "_import.xml")
+        cpuBound=set()
+        for fn in ElementTree.parse(importFile).getroot().findall('function'):
+            controller=fn.find('controller')
+            if (controller is not None and
+                controller.get('cpu_bound') == "true"):
+                cpuBound.add(fn.get('id'))
+        self.assertEqual(cpuBound, set([ "g_energy", "trjconv",
+                                         "trjconv_split", "eneconv",
+                                         "pdb2gmx", "g_bar",
+                                         "concat_parts" ]))
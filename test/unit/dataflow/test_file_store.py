@@ -0,0 +1,132 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import os
+import shutil
+import stat
+import tempfile
+import threading
+from cpc.dataflow import value
+from cpc.dataflow import file_store
+
+
+class TestFileStore(unittest.TestCase):
+    def setUp(self):
+        file_store.startThreads()
+        self.dir=tempfile.mkdtemp()
+        self.content=os.urandom(file_store.minStoreSize)
+        for name in [ "run_0000", "run_0001" ]:
+            os.mkdir(os.path.join(self.dir, name))
+            self._write(os.path.join(name, "confout.gro"), self.content)
+        self._write("small.mdp", "nsteps = 100\n")
+        self.store=file_store.FileStore(self.dir)
+        self.fileList=value.FileList(self.dir, self.store)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, name, content):
+        outf=open(os.path.join(self.dir, name), "wb")
+        outf.write(content)
+        outf.close()
+
+    def _path(self, name):
+        return os.path.join(self.dir, name)
+
+    def _nBlobs(self):
+        ret=0
+        for dirpath, dirnames, filenames in os.walk(
+                                os.path.join(self.dir, file_store.storeDirName)):
+            ret+=len([ fn for fn in filenames if fn != file_store.indexName ])
+        return ret
+
+    def testDedup(self):
+        f0=self.fileList.getFile(os.path.join("run_0000", "confout.gro"))
+        f1=self.fileList.getFile(os.path.join("run_0001", "confout.gro"))
+        self.fileList.getFile("small.mdp")
+        self.store.wait()
+        self.assertTrue(os.path.samefile(f0.getAbsoluteName(),
+                                         f1.getAbsoluteName()))
+        self.assertEqual(open(f1.getAbsoluteName(), "rb").read(), self.content)
+        self.assertEqual(self._nBlobs(), 1)
+        self.assertEqual(self.store.getHash("small.mdp"), None)
+        # stored files keep their permissions.
+        self.assertTrue(os.stat(f1.getAbsoluteName()).st_mode & stat.S_IWUSR)
+        # the blob is removed with the last file that uses it.
+        f0.rmRef()
+        self.assertEqual(self._nBlobs(), 1)
+        f1.rmRef()
+        self.assertEqual(self._nBlobs(), 0)
+
+    def testRestart(self):
+        f0=self.fileList.getFile(os.path.join("run_0000", "confout.gro"))
+        self.fileList.getFile(os.path.join("run_0001", "confout.gro"))
+        self.store.wait()
+        name=f0.getName()
+        contentHash=self.store.getHash(name)
+        self.assertNotEqual(contentHash, None)
+        # a file that was removed while the server was down
+        os.remove(self._path(os.path.join("run_0001", "confout.gro")))
+        store=file_store.FileStore(self.dir)
+        self.assertEqual(store.getHash(name), contentHash)
+        self.assertEqual(store.getHash(os.path.join("run_0001",
+                                                    "confout.gro")), None)
+        fileList=value.FileList(self.dir, store)
+        fileList.getFile(name).rmRef()
+        self.assertEqual(self._nBlobs(), 0)
+        # the removal is in the index too.
+        store=file_store.FileStore(self.dir)
+        self.assertEqual(store.getHash(name), None)
+
+    def testBackgroundHashing(self):
+        # files are hashed by the store's thread, not by the caller of
+        # getFile()
+        hashing=threading.Event()
+        release=threading.Event()
+        getFileHash=file_store.getFileHash
+        def blockingHash(path):
+            hashing.set()
+            release.wait()
+            return getFileHash(path)
+        file_store.getFileHash=blockingHash
+        try:
+            f0=self.fileList.getFile(os.path.join("run_0000", "confout.gro"))
+            self.assertTrue(hashing.wait(10))
+            self.assertEqual(self.store.getHash(f0.getName()), None)
+            # a file that goes out of use while it is hashed isn't stored
+            f0.rmRef()
+            release.set()
+            self.store.wait()
+        finally:
+            file_store.getFileHash=getFileHash
+        self.assertEqual(self.store.getHash(f0.getName()), None)
+        self.assertEqual(self._nBlobs(), 0)
+
+    def testDeferredThreads(self):
+        # files brought into use before the server has forked are queued
+        # until the store's thread may run.
+        file_store._threadsStarted=False
+        store=file_store.FileStore(self.dir)
+        fileList=value.FileList(self.dir, store)
+        f0=fileList.getFile(os.path.join("run_0000", "confout.gro"))
+        self.assertEqual(store.thread, None)
+        file_store.startThreads()
+        store.wait()
+        self.assertNotEqual(store.getHash(f0.getName()), None)
@@ -0,0 +1,182 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import os
+import shutil
+import tempfile
+import xml.etree.ElementTree as ElementTree
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from cpc.dataflow import keywords
+from cpc.dataflow import journal
+
+
+class FakeNetwork(object):
+    def __init__(self, parent):
+        self.parent=parent
+        self.instances=[]
+        self.actives=[]
+
+    def getParentInstance(self):
+        return self.parent
+
+    def writeXML(self, outf, indent=0):
+        outf.write('<network>\n')
+        for inst in self.instances:
+            inst.writeXML(outf, indent+1)
+        for ai in self.actives:
+            ai.writeXML(outf, indent+1)
+        outf.write('</network>\n')
+
+class FakeInstance(object):
+    """An (explicit) instance in a network."""
+    def __init__(self, name):
+        self.name=name
+
+    def writeXML(self, outf, indent=0):
+        outf.write('<instance id="%s" function="test:fn"/>\n'%self.name)
+
+class FakeActive(object):
+    """An active instance with a state, a value and, for network functions,
+       a subnet."""
+    def __init__(self, name, parent=None, hasSubnet=False):
+        self.name=name
+        self.parent=parent
+        self.state="held"
+        self.value=0
+        if hasSubnet:
+            self.subnet=FakeNetwork(self)
+        else:
+            self.subnet=None
+
+    def getCanonicalName(self):
+        if self.parent is None:
+            return self.name
+        return self.parent.getCanonicalName()+keywords.InstSep+self.name
+
+    def writeXML(self, outf, indent=0, writeSubnet=True):
+        outf.write('<active id="%s" state="%s" seqnr="0">\n'%
+                   (self.name, self.state))
+        outf.write('<inputs><value v="%d"/></inputs>\n'%self.value)
+        if writeSubnet and self.subnet is not None:
+            self.subnet.writeXML(outf, indent+1)
+        outf.write('<tasks/>\n')
+        outf.write('</active>\n')
+
+
+def normalize(elem):
+    """A comparable form of an XML element, without whitespace."""
+    return (elem.tag, sorted(elem.attrib.items()),
+            [ normalize(child) for child in elem ])
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.mkdtemp()
+        self.snapshotName=os.path.join(self.dir, "_state.xml")
+        self.journal=journal.StateJournal(os.path.join(self.dir,
+                                                       "_state.journal"))
+        self.topNet=FakeNetwork(None)
+        self.a=FakeActive("a", hasSubnet=True)
+        self.b=FakeActive("b", self.a)
+        self.a.subnet.actives.append(self.b)
+        self.topNet.actives.append(self.a)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _fullState(self, snapshotID=None):
+        co=StringIO()
+        if snapshotID is None:
+            co.write('<cpc version="3">\n')
+        else:
+            co.write('<cpc version="3" journal="%s">\n'%snapshotID)
+        self.topNet.writeXML(co)
+        co.write('</cpc>\n')
+        return co.getvalue()
+
+    def _snapshot(self):
+        snapshotID=self.journal.startSnapshot()
+        outf=open(self.snapshotName, 'w')
+        outf.write(self._fullState(snapshotID))
+        outf.close()
+        self.journal.finishSnapshot(snapshotID)
+        return snapshotID
+
+    def _save(self):
+        (entry, n)=self.journal.collectEntry()
+        self.assertNotEqual(entry, None)
+        self.journal.appendEntry(entry)
+
+    def _assertReplayed(self):
+        replayed=self.journal.replay(self.snapshotName)
+        self.assertNotEqual(replayed, None)
+        root=ElementTree.parse(replayed).getroot()
+        del root.attrib['journal']
+        self.assertEqual(normalize(root),
+                         normalize(ElementTree.fromstring(self._fullState())))
+
+    def testRoundTrip(self):
+        self._snapshot()
+        self.assertFalse(self.journal.hasEntries())
+        self.a.value=1
+        self.journal.markChanged(self.a)
+        self._save()
+        # a new instance in the subnet of a, with its own active instance.
+        self.a.subnet.instances.append(FakeInstance("c"))
+        self.journal.addNetworkItem(self.a.subnet, FakeInstance("c"))
+        c=FakeActive("c", self.a)
+        c.value=3
+        self.a.subnet.actives.append(c)
+        self.journal.markChanged(c)
+        self.b.state="finished"
+        self.journal.markChanged(self.b)
+        self._save()
+        self.assertTrue(self.journal.hasEntries())
+        self._assertReplayed()
+        # nothing changed: no entry
+        self.assertEqual(self.journal.collectEntry(), (None, 0))
+
+    def testTornEntry(self):
+        self._snapshot()
+        self.a.value=1
+        self.journal.markChanged(self.a)
+        self._save()
+        # a write of the next entry that was interrupted
+        outf=open(self.journal.filename, 'a')
+        outf.write('%s<active-update path="a">\n<active id="a" st'%
+                   journal.entryStart)
+        outf.close()
+        self._assertReplayed()
+
+    def testMismatchedSnapshot(self):
+        self._snapshot()
+        self.a.value=1
+        self.journal.markChanged(self.a)
+        self._save()
+        # a new snapshot that was written without a new journal
+        snapshotID=self.journal.startSnapshot()
+        outf=open(self.snapshotName, 'w')
+        outf.write(self._fullState(snapshotID))
+        outf.close()
+        self.assertEqual(self.journal.replay(self.snapshotName), None)
@@ -0,0 +1,134 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import threading
+import time
+import cpc.util.rwlock
+from cpc.dataflow import transaction
+
+
+class FakeNetworkLock(object):
+    """A reentrant lock that knows which thread holds it."""
+    def __init__(self):
+        self.lock=threading.RLock()
+        self.owner=None
+        self.count=0
+
+    def acquire(self):
+        self.lock.acquire()
+        self.owner=threading.currentThread()
+        self.count+=1
+
+    def release(self):
+        self.count-=1
+        if self.count == 0:
+            self.owner=None
+        self.lock.release()
+
+    def isOwned(self):
+        return self.owner is threading.currentThread()
+
+class FakeNetwork(object):
+    def __init__(self, lockOrder):
+        self.lockOrder=lockOrder
+        self.networkLock=FakeNetworkLock()
+
+    def getNetworkLock(self):
+        return self.networkLock
+
+class FakeActiveInstance(object):
+    def __init__(self, activeNetwork, lockOrder):
+        self.activeNetwork=activeNetwork
+        self.lockOrder=lockOrder
+        self.outputLock=threading.Lock()
+        # whether the network lock was held for each input update
+        self.locked=[]
+
+    def handleNewInput(self, sourceTag, seqNr):
+        self.locked.append(self.activeNetwork.getNetworkLock().isOwned())
+        # give other transactions a chance to run
+        time.sleep(0)
+
+class FakeSetValue(object):
+    """A new value that affects the input of a list of instances."""
+    def __init__(self, affected):
+        self.itemName="value"
+        self.affected=affected
+
+    def findAffected(self, affectedOutputAIs, affectedInputAIs):
+        affectedInputAIs.update(self.affected)
+
+    def set(self, project, sourceTag):
+        pass
+
+class FakeProject(object):
+    def __init__(self, network):
+        self.network=network
+        self.stateLock=cpc.util.rwlock.ReadWriteLock()
+        self.lockStats=transaction.LockStats()
+
+
+class TestTransactionLocks(unittest.TestCase):
+    def setUp(self):
+        # a top-level network with an instance that has a subnetwork
+        self.top=FakeNetwork((0,))
+        self.subnet=FakeNetwork((0, 1))
+        self.project=FakeProject(self.top)
+        self.topAI=FakeActiveInstance(self.top, 1)
+        self.subnetAI=FakeActiveInstance(self.subnet, 2)
+
+    def _transaction(self, activeNetwork, affected):
+        tr=transaction.Transaction(self.project, None, activeNetwork, None)
+        tr.setValues=[ FakeSetValue(affected) ]
+        return tr
+
+    def testParentNetworkLocked(self):
+        # a transaction in the subnetwork that reaches the parent network
+        # through the subnet outputs.
+        self._transaction(self.subnet, [ self.subnetAI, self.topAI ]).run()
+        self.assertEqual(self.subnetAI.locked, [ True ])
+        self.assertEqual(self.topAI.locked, [ True ])
+        # and one in the parent network that reaches into the subnetwork.
+        self._transaction(self.top, [ self.topAI, self.subnetAI ]).run()
+        self.assertEqual(self.subnetAI.locked, [ True, True ])
+        self.assertEqual(self.topAI.locked, [ True, True ])
+        self.assertEqual(self.top.networkLock.count, 0)
+        self.assertEqual(self.subnet.networkLock.count, 0)
+
+    def testConcurrentTransactions(self):
+        # transactions that lock the same networks from opposite ends
+        # don't deadlock.
+        def runTransactions(activeNetwork, affected):
+            for i in range(200):
+                self._transaction(activeNetwork, affected).run()
+        threads=[ threading.Thread(target=runTransactions,
+                                   args=(self.subnet, [ self.subnetAI,
+                                                        self.topAI ])),
+                  threading.Thread(target=runTransactions,
+                                   args=(self.top, [ self.topAI,
+                                                     self.subnetAI ])) ]
+        for th in threads:
+            th.daemon=True
+            th.start()
+        for th in threads:
+            th.join(30)
+            self.assertFalse(th.isAlive())
+        self.assertEqual(self.topAI.locked, [ True ]*400)
+        self.assertEqual(self.subnetAI.locked, [ True ]*400)
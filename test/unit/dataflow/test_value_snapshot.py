@@ -0,0 +1,94 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+# 
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published 
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+
+import unittest
+import shutil
+import tempfile
+from cpc.dataflow import vtype
+from cpc.dataflow import value
+from cpc.dataflow import active_value
+
+
+class TestValueSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.mkdtemp()
+        self.fileList=value.FileList(self.dir)
+        self.arrayType=vtype.ArrayType("int_array", vtype.arrayType,
+                                       memberType=vtype.intType)
+        self.recType=vtype.RecordType("test:in", vtype.recordType)
+        self.recType.addMember("n", vtype.intType, False, False, False)
+        self.recType.addMember("conf", vtype.fileType, False, False, False)
+        self.recType.addMember("values", self.arrayType, False, False, False)
+        self.val=active_value.ActiveValue(None, self.recType,
+                                          selfName="test:in",
+                                          fileList=self.fileList)
+        self.val.getSubValue(['n'])._set(1)
+        self.val.getSubValue(['conf'])._set("conf.gro", vtype.fileType)
+        for i in range(3):
+            self.val.getCreateSubValue(['values', '+'])._set(i)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testSharing(self):
+        snap1=self.val.getSnapshot()
+        snap2=self.val.getSnapshot()
+        self.assertTrue(snap1 is snap2)
+        self.val.getSubValue(['n'])._set(2)
+        snap3=self.val.getSnapshot()
+        self.assertFalse(snap3 is snap1)
+        self.assertEqual(snap1.getSubValue(['n']).get(), 1)
+        self.assertEqual(snap3.getSubValue(['n']).get(), 2)
+        # unchanged sub-values are shared
+        self.assertTrue(snap1.getSubValue(['values']) is
+                        snap3.getSubValue(['values']))
+        self.assertEqual(snap3.getSubValue(['values', 1]).getFullName(),
+                         ".values[1]")
+
+    def testUpdated(self):
+        self.val.getSubValue(['values', 2]).markUpdated(True)
+        snap1=self.val.getSnapshot()
+        self.val.setUpdated(False)
+        self.assertTrue(snap1.getSubValue(['values', 2]).isUpdated())
+        self.assertTrue(snap1.isUpdated())
+        snap2=self.val.getSnapshot()
+        self.assertFalse(snap2.hasUpdates())
+        self.assertTrue(snap1.getSubValue(['n']) is snap2.getSubValue(['n']))
+
+    def testAppend(self):
+        snap1=self.val.getSnapshot()
+        self.val.getCreateSubValue(['values', '+'])._set(3)
+        snap2=self.val.getSnapshot()
+        self.assertEqual(len(snap1.getSubValue(['values']).value), 3)
+        self.assertEqual(len(snap2.getSubValue(['values']).value), 4)
+
+    def testFileRefs(self):
+        fileValue=self.val.getSubValue(['conf']).fileValue
+        self.assertEqual(fileValue.refs, 1)
+        snap1=self.val.getSnapshot()
+        snap2=self.val.getSnapshot()
+        # the cached snapshot holds one reference for both users
+        self.assertEqual(fileValue.refs, 2)
+        self.val.getSubValue(['conf'])._set("other.gro", vtype.fileType)
+        self.assertEqual(fileValue.refs, 1)
+        snap1.destroy()
+        self.assertEqual(fileValue.refs, 1)
+        snap2.destroy()
+        self.assertEqual(fileValue.refs, 0)
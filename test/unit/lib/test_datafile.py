@@ -0,0 +1,115 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import os
+import shutil
+import tempfile
+from cpc.lib.gromacs import datafile
+
+
+class TestDataFile(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.mkdtemp()
+        datafile.clearCache()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, name, content):
+        filename=os.path.join(self.dir, name)
+        outf=open(filename, "w")
+        outf.write(content)
+        outf.close()
+        return filename
+
+    def testRegularXvg(self):
+        fn=self._write("energy.xvg",
+                       '# a comment\n'
+                       '@    title "Energy"\n'
+                       '@ s0 legend "Potential"\n'
+                       '    0.000  -1.5  2\n'
+                       '    1.000  -2.5  3\n'
+                       '&\n'
+                       '    2.000  -3.5  4\n')
+        data=datafile.readXvg(fn)
+        self.assertEqual(data.tolist(), [ [ 0., -1.5, 2. ],
+                                          [ 1., -2.5, 3. ],
+                                          [ 2., -3.5, 4. ] ])
+        # the result is cached and shared
+        self.assertTrue(datafile.readXvg(fn) is data)
+        self.assertFalse(data.flags.writeable)
+
+    def testRaggedXvg(self):
+        # lines with different numbers of fields are an error
+        fn=self._write("ragged.xvg",
+                       '0 1 2\n'
+                       '3 4\n'
+                       '5 6 7\n')
+        self.assertRaises(datafile.DataFileError, datafile.readXvg, fn)
+        fn=self._write("long.xvg",
+                       '0 1 2\n'
+                       '3 4 5 6\n')
+        self.assertRaises(datafile.DataFileError, datafile.readXvg, fn)
+        fn=self._write("short.xvg", '0 1\n3 4\n')
+        self.assertRaises(datafile.DataFileError, datafile.readDihedralXvg,
+                          fn)
+
+    def testPartialLastLine(self):
+        # a file that is still being written: the last line is left out
+        fn=self._write("partial.xvg",
+                       '@ s0 legend "Potential"\n'
+                       '    0.000  -1.5  2\n'
+                       '    1.000  -2.5  3\n'
+                       '    2.000  -3.')
+        data=datafile.readXvg(fn)
+        self.assertEqual(data.tolist(), [ [ 0., -1.5, 2. ],
+                                          [ 1., -2.5, 3. ] ])
+
+    def testDihedralXvg(self):
+        fn=self._write("rama.xvg",
+                       '@    title "Ramachandran Plot"\n'
+                       '  -60.0  -45.0  ARG-8\n'
+                       '  -70.0  140.0  GLY-9\n'
+                       '  -65.0  -40.0  ARG-8\n')
+        (angles, residues)=datafile.readDihedralXvg(fn)
+        self.assertEqual(angles.tolist(), [ [ -60., -45. ], [ -70., 140. ],
+                                            [ -65., -40. ] ])
+        self.assertEqual(residues.tolist(), [ 8, 9, 8 ])
+        self.assertEqual(datafile.selectResidues(residues, [ 8 ]).tolist(),
+                         [ True, False, True ])
+
+    def testItpSection(self):
+        fn=self._write("res.itp",
+                       '[ moleculetype ]\n'
+                       'Protein 3\n'
+                       '[ dihedral_restraints ]\n'
+                       ';  ai   aj   ak   al  type  phi  dphi  kfac\n'
+                       '   23   25   27   34    1  -76.5    0  KFAC\n'
+                       '   25   27   34   36    1  140.0    0  KFAC ; psi\n'
+                       '#ifdef POSRES\n'
+                       '   34   36   38   45    1  -60.0    0  KFAC\n'
+                       '#endif\n'
+                       '\n'
+                       '[ position_restraints ]\n'
+                       '    1    1  1000  1000  1000  1000\n')
+        vals=datafile.readItpSection(fn, 'dihedral_restraints', 5)
+        self.assertEqual(vals.tolist(), [ -76.5, 140., -60. ])
+        self.assertEqual(datafile.readItpSection(fn, 'angles', 5).tolist(),
+                         [])
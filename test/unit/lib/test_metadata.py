@@ -0,0 +1,129 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import os
+import shutil
+import stat
+import struct
+import tempfile
+from cpc.lib.gromacs import metadata
+
+
+# a stand-in for gmxdump that counts its runs
+gmxdumpScript='''#!/bin/sh
+echo run >> "%(dir)s/runs"
+if [ "$1" = "-cp" ]; then
+    echo "step = 12345"
+    echo "output filename = traj.part0003.xtc"
+    echo "output filename = traj.part0007.trr"
+else
+    echo "   nsteps                         = 5000"
+    echo "   init-step                      = 100"
+fi
+'''
+
+def xdrString(s):
+    return struct.pack('>I', len(s))+s+'\x00'*(((len(s)+3) & ~3)-len(s))
+
+def checkpointHeader(fileVersion, step):
+    """Make the start of a checkpoint file."""
+    ret=struct.pack('>i', metadata.cptMagic)
+    for s in [ "VERSION 4.6.7", "today", "user", "host", "mdrun", "now" ]:
+        ret+=xdrString(s)
+    ret+=struct.pack('>i', fileVersion)
+    if fileVersion >= 13:
+        ret+=struct.pack('>i', 0)
+    if fileVersion >= 12:
+        ret+=xdrString("node")
+    # atoms, T-coupling groups
+    ret+=struct.pack('>ii', 3000, 2)
+    for minVersion in [ 10, 11, 14 ]:
+        if fileVersion >= minVersion:
+            ret+=struct.pack('>i', 1)
+    # integrator, simulation part
+    ret+=struct.pack('>ii', 0, 2)
+    if fileVersion >= 5:
+        ret+=struct.pack('>iI', step >> 32, step & 0xffffffff)
+    else:
+        ret+=struct.pack('>i', step)
+    return ret+'\x00'*64
+
+
+class FakeCommands(object):
+    def __init__(self, gmxdump):
+        self.gmxdump=gmxdump
+
+
+class TestMetadata(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.mkdtemp()
+        script=os.path.join(self.dir, "gmxdump")
+        outf=open(script, 'w')
+        outf.write(gmxdumpScript%{ 'dir' : self.dir })
+        outf.close()
+        os.chmod(script, stat.S_IRWXU)
+        self.cmdnames=FakeCommands(script)
+        metadata.clearCache()
+
+    def tearDown(self):
+        metadata.clearCache()
+        shutil.rmtree(self.dir)
+
+    def _write(self, name, content):
+        filename=os.path.join(self.dir, name)
+        outf=open(filename, 'wb')
+        outf.write(content)
+        outf.close()
+        return filename
+
+    def _nRuns(self):
+        try:
+            return len(open(os.path.join(self.dir, "runs")).readlines())
+        except IOError:
+            return 0
+
+    def testCheckpointStep(self):
+        fn=self._write("state.cpt", checkpointHeader(17, 5*2**32+7))
+        self.assertEqual(metadata.readCheckpointStep(fn), 5*2**32+7)
+        fn=self._write("old.cpt", checkpointHeader(4, 2500))
+        self.assertEqual(metadata.readCheckpointStep(fn), 2500)
+        # the header is read without gmxdump
+        self.assertEqual(metadata.getCheckpointStep(self.cmdnames, fn), 2500)
+        self.assertEqual(self._nRuns(), 0)
+
+    def testUnreadableCheckpoint(self):
+        fn=self._write("bad.cpt", "x"*100)
+        self.assertEqual(metadata.readCheckpointStep(fn), None)
+        fn=self._write("short.cpt", checkpointHeader(17, 100)[:60])
+        self.assertEqual(metadata.readCheckpointStep(fn), None)
+
+    def testGmxdumpFallback(self):
+        fn=self._write("bad.cpt", "x"*100)
+        self.assertEqual(metadata.getCheckpointStep(self.cmdnames, fn), 12345)
+        self.assertEqual(metadata.getCheckpointFileNumber(self.cmdnames, fn),
+                         7)
+        # gmxdump is only run once per file version
+        self.assertEqual(self._nRuns(), 1)
+        self.assertEqual(metadata.getCheckpointStep(self.cmdnames, fn), 12345)
+        self.assertEqual(self._nRuns(), 1)
+        fn=self._write("topol.tpr", "tpr")
+        self.assertEqual(metadata.getTprSteps(self.cmdnames, fn), (5000, 100))
+        self.assertEqual(metadata.getTprSteps(self.cmdnames, fn), (5000, 100))
+        self.assertEqual(self._nRuns(), 2)
@@ -0,0 +1,100 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import random
+import numpy
+from cpc.lib.swarms import string_rep
+
+
+# The original pure python reparametrization of the swarms scripts, as a
+# reference.
+def dist(v1, v2):
+    return sum([ (y-x)**2 for x, y in zip(v1, v2) ])**(.5)
+
+def L(n, path):
+    if n == 0:
+        return 1
+    pathlength=0
+    for i in range(n-1):
+        pathlength+=dist(path[i], path[i+1])
+    return pathlength
+
+def s(m, path):
+    R=len(path)-1
+    return (m-1)*L(R, path)/(R-1)
+
+def py_rep_pts(newpts):
+    adjusted=[ newpts[0], newpts[len(newpts)-1] ]
+    for i in range(2, len(newpts)):
+        k=2
+        while (L(k-1, newpts) >= s(i, newpts) or
+               s(i, newpts) > L(k, newpts)):
+            k+=1
+        d=dist(newpts[k-2], newpts[k-1])
+        v=[ (y-x)/d for x, y in zip(newpts[k-2], newpts[k-1]) ]
+        reppt=[ x+(s(i, newpts)-L(k-1, newpts))*vi
+                for x, vi in zip(newpts[k-2], v) ]
+        adjusted.insert(i-1, reppt)
+    return [ string_rep.spread(numpy.array(adjusted)), adjusted ]
+
+def makeString(npoints, ncvs):
+    """Make a noisy string between two random points, with the padding
+       point at the end."""
+    start=[ random.uniform(-3.0, 3.0) for c in range(ncvs) ]
+    end=[ random.uniform(-3.0, 3.0) for c in range(ncvs) ]
+    pts=[]
+    for p in range(npoints):
+        f=float(p)/(npoints-1)
+        pts.append([ a+f*(b-a)+random.gauss(0.0, 0.05)
+                     for a, b in zip(start, end) ])
+    pts.append([ 0.0 ]*ncvs)
+    return pts
+
+
+class TestStringRep(unittest.TestCase):
+    def setUp(self):
+        random.seed(1)
+
+    def testRepPts(self):
+        pts=makeString(12, 6)
+        (spread, adjusted)=string_rep.rep_pts(pts)
+        (pySpread, pyAdjusted)=py_rep_pts(pts)
+        self.assertTrue(numpy.max(numpy.abs(adjusted-
+                                            numpy.array(pyAdjusted))) < 1e-12)
+        self.assertAlmostEqual(spread, pySpread, 12)
+        # the end points and the padding point stay where they are
+        self.assertEqual(adjusted[0].tolist(), pts[0])
+        self.assertEqual(adjusted[-1].tolist(), pts[-1])
+
+    def testReparametrizeString(self):
+        pts=makeString(20, 10)
+        (spread, niters, adjusted)=string_rep.reparametrize_string(pts, 5,
+                                                                   None)
+        self.assertEqual(niters, 5)
+        pyAdjusted=pts
+        for i in range(niters+1):
+            (pySpread, pyAdjusted)=py_rep_pts(pyAdjusted)
+        self.assertTrue(numpy.max(numpy.abs(adjusted-
+                                            numpy.array(pyAdjusted))) < 1e-12)
+        self.assertAlmostEqual(spread, pySpread, 12)
+        # the points are (nearly) equidistant
+        dists=numpy.sqrt(numpy.sum(numpy.diff(adjusted[:-1], axis=0)**2,
+                                   axis=1))
+        self.assertTrue(numpy.max(dists)-numpy.min(dists) < 1e-3)
@@ -0,0 +1,176 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import os
+import shutil
+import struct
+import tempfile
+from cpc.dataflow import run
+from cpc.dataflow import task
+from cpc.lib.gromacs import trajparts
+from cpc.lib.gromacs.mdrun import extractData
+
+
+def xtcFrame(step, time, natoms):
+    """Make a synthetic xtc frame. Frames with more than 9 atoms have a
+       (meaningless) compressed coordinate block."""
+    ret=struct.pack('>iiif', 1995, natoms, step, time)
+    ret+=struct.pack('>9f', *([ 3., 0., 0., 0., 3., 0., 0., 0., 3. ]))
+    ret+=struct.pack('>i', natoms)
+    if natoms <= 9:
+        ret+=struct.pack('>%df'%(3*natoms), *([ 0.5 ]*(3*natoms)))
+    else:
+        # precision, min. and max. ints, small index
+        ret+=struct.pack('>f3i3ii', 1000., 0, 0, 0, 10, 10, 10, 5)
+        # 5 bytes of compressed data, padded to 8
+        ret+=struct.pack('>i', 5)+'\x01'*5+'\x00'*3
+    return ret
+
+def trrFrame(step, time, natoms, double=False):
+    """Make a synthetic trr frame with a box and coordinates."""
+    if double:
+        fmt, realSize='d', 8
+    else:
+        fmt, realSize='f', 4
+    version="GMX_trn_file"
+    ret=struct.pack('>iii', 1993, len(version)+1, len(version))
+    ret+=version
+    boxSize=9*realSize
+    xSize=3*natoms*realSize
+    ret+=struct.pack('>13i', 0, 0, boxSize, 0, 0, 0, 0, xSize, 0, 0,
+                     natoms, step, 0)
+    ret+=struct.pack('>2%s'%fmt, time, 0.)
+    ret+=struct.pack('>%d%s'%(9+3*natoms, fmt), *([ 1. ]*(9+3*natoms)))
+    return ret
+
+
+class TestScan(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, name, content):
+        filename=os.path.join(self.dir, name)
+        dirname=os.path.dirname(filename)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        outf=open(filename, 'wb')
+        outf.write(content)
+        outf.close()
+        return filename
+
+    def testXtc(self):
+        fn=self._write("small.xtc", "".join([ xtcFrame(i*5, i*10., 3)
+                                              for i in range(3) ]))
+        self.assertEqual(trajparts.scanXtc(fn), (3, 0., 20.))
+        fn=self._write("large.xtc", "".join([ xtcFrame(i*5, 100.+i*10., 20)
+                                              for i in range(4) ]))
+        self.assertEqual(trajparts.scanXtc(fn), (4, 100., 130.))
+        self.assertEqual(trajparts.scanXtc(self._write("empty.xtc", "")),
+                         (0, None, None))
+
+    def testBrokenXtc(self):
+        content=xtcFrame(0, 0., 20)+xtcFrame(5, 10., 20)
+        fn=self._write("truncated.xtc", content[:-70])
+        self.assertEqual(trajparts.scanXtc(fn), None)
+        fn=self._write("notxtc.xtc", "x"*200)
+        self.assertEqual(trajparts.scanXtc(fn), None)
+
+    def testTrr(self):
+        fn=self._write("single.trr", "".join([ trrFrame(i, i*2., 4)
+                                               for i in range(3) ]))
+        self.assertEqual(trajparts.scanTrr(fn), (3, 0., 4.))
+        fn=self._write("double.trr", "".join([ trrFrame(i, 1.+i, 4, True)
+                                               for i in range(2) ]))
+        self.assertEqual(trajparts.scanTrr(fn), (2, 1., 2.))
+        fn=self._write("truncated.trr", trrFrame(0, 0., 4)[:40])
+        self.assertEqual(trajparts.scanTrr(fn), None)
+        fn=self._write("nottrr.trr", "x"*200)
+        self.assertEqual(trajparts.scanTrr(fn), None)
+
+    def testManifest(self):
+        self._write(os.path.join("run_000", "traj.part0001.xtc"),
+                    "".join([ xtcFrame(i, i*10., 3) for i in range(3) ]))
+        self._write(os.path.join("run_001", "traj.part0002.xtc"),
+                    "".join([ xtcFrame(i, 30.+i*10., 3) for i in range(2) ]))
+        self._write(os.path.join("run_001", "ener.part0002.edr"), "edr")
+        manifest=trajparts.updateManifest(self.dir)
+        self.assertEqual(sorted(manifest.getKinds()), [ 'edr', 'xtc' ])
+        self.assertEqual([ os.path.basename(fn) for fn in
+                           manifest.getParts('xtc') ],
+                         [ "traj.part0001.xtc", "traj.part0002.xtc" ])
+        self.assertEqual(manifest.getTimeRange('xtc'), (0., 40.))
+        self.assertEqual([ part['frames'] for part in
+                           manifest.getPartInfo('xtc') ], [ 3, 2 ])
+        # the edr parts are listed, but not read
+        self.assertEqual(manifest.getTimeRange('edr'), None)
+        # nothing changed
+        self.assertFalse(manifest.update(self.dir))
+        # the manifest is read back with the same parts
+        manifest2=trajparts.readManifest(os.path.join(self.dir,
+                                                      trajparts.manifestName))
+        self.assertEqual(manifest2.getPartInfo('xtc'),
+                         manifest.getPartInfo('xtc'))
+
+    def testVanishingPart(self):
+        self._write(os.path.join("run_000", "traj.part0001.xtc"),
+                    xtcFrame(0, 0., 3))
+        gone=os.path.join(self.dir, "run_001", "traj.part0002.xtc")
+        collectParts=trajparts.collectParts
+        def listGone(persDir, pattern):
+            ret=collectParts(persDir, pattern)
+            if pattern == trajparts.partPatterns['xtc']:
+                ret.append(gone)
+            return ret
+        trajparts.collectParts=listGone
+        try:
+            manifest=trajparts.updateManifest(self.dir)
+        finally:
+            trajparts.collectParts=collectParts
+        self.assertEqual([ os.path.basename(fn) for fn in
+                           manifest.getParts('xtc') ],
+                         [ "traj.part0001.xtc" ])
+
+    def testFinishedRun(self):
+        persDir=os.path.join(self.dir, "_persistence")
+        outDir=os.path.join(self.dir, "_run_0000")
+        os.mkdir(outDir)
+        self._write(os.path.join(persDir, "run_000", "traj.part0001.xtc"),
+                    "".join([ xtcFrame(i, i*10., 3) for i in range(3) ]))
+        self._write(os.path.join(persDir, "run_001", "traj.part0002.xtc"),
+                    "".join([ xtcFrame(i, 30.+i*10., 3) for i in range(2) ]))
+        confout=self._write(os.path.join(persDir, "run_001",
+                                         "confout.part0002.gro"), "gro")
+        fo=run.FunctionRunOutput()
+        extractData([ confout ], outDir, persDir, fo, False)
+        # the run directories are removed when the task is finished
+        task.removePersistenceSubdirs(persDir)
+        self.assertFalse(os.path.exists(os.path.join(persDir, "run_000")))
+        partsName=[ out.val.value for out in fo.outputs
+                    if out.name == 'parts' ][0]
+        manifest=trajparts.readManifest(partsName)
+        parts=manifest.getParts('xtc')
+        self.assertEqual([ os.path.basename(fn) for fn in parts ],
+                         [ "traj.part0001.xtc", "traj.part0002.xtc" ])
+        self.assertEqual([ trajparts.scanXtc(fn) for fn in parts ],
+                         [ (3, 0., 20.), (2, 30., 40.) ])
+        self.assertEqual(manifest.getTimeRange('xtc'), (0., 40.))
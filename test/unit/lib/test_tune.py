@@ -0,0 +1,113 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import os
+import json
+import shutil
+import tempfile
+from cpc.lib.gromacs import tune
+
+
+class FakeCommands(object):
+    """Stands in for cmds.GromacsCommands, which needs Gromacs."""
+    def __init__(self):
+        self.mdrun="mdrun"
+
+class FakeCores(object):
+    def __init__(self):
+        self.cores=None
+    def set(self, name, value):
+        self.cores=value
+
+class FakeResources(object):
+    def __init__(self):
+        self.min=FakeCores()
+        self.max=FakeCores()
+
+
+class TestTune(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.mkdtemp()
+        self.confFile=os.path.join(self.dir, "conf.gro")
+        outf=open(self.confFile, "w")
+        outf.write("test system\n5000\n")
+        for i in range(3):
+            outf.write("    1SOL     OW%5d   0.126   1.624   1.679\n"%(i+1))
+        outf.write("   5.00000   5.00000   5.00000\n")
+        outf.close()
+        self.trials=[]
+        self.orig=(tune.cmds.GromacsCommands, tune.mdrunVersion,
+                   tune.tryRuns)
+        tune.cmds.GromacsCommands=FakeCommands
+        tune.mdrunVersion=lambda cmdnames: "%s 4.6.7"%cmdnames.mdrun
+        tune.tryRuns=self._tryRuns
+        tune._cache.clear()
+
+    def tearDown(self):
+        (tune.cmds.GromacsCommands, tune.mdrunVersion, tune.tryRuns)=self.orig
+        tune._cache.clear()
+        shutil.rmtree(self.dir)
+
+    def _tryRuns(self, tprFile, testRunDir, candidateList, Navail):
+        """Pretend that runs with up to 6 cores work."""
+        self.trials.append(candidateList)
+        return (max([ n for n in candidateList if n <= 6 ]), "")
+
+    def _tune(self, Nmax=None):
+        rsrc=FakeResources()
+        tune.tune(rsrc, self.confFile, "topol.tpr", self.dir, Nmax, self.dir)
+        self.assertEqual(rsrc.min.cores, 1)
+        return rsrc.max.cores
+
+    def testCandidates(self):
+        self.assertEqual(tune.candidates(1), [ 1 ])
+        self.assertEqual(tune.candidates(8), [ 8, 6, 4, 3, 2, 1 ])
+        self.assertEqual(tune.candidates(12), [ 12, 8, 6, 4, 3, 2, 1 ])
+        # no counts of 32 or more, and no counts with few prime factors
+        self.assertEqual(tune.candidates(40), [ 30, 28, 27, 24, 20, 18, 16,
+                                                12, 8, 6, 4, 3, 2, 1 ])
+
+    def testCacheKey(self):
+        (N, box)=tune.readConf(self.confFile)
+        self.assertEqual((N, box), (5000, [ 5., 5., 5. ]))
+        self.assertEqual(tune.cacheKey(N, box, "mdrun 4.6.7"),
+                         "5000 5.000 5.000 5.000 mdrun 4.6.7")
+        # a different version gives a different key
+        self.assertNotEqual(tune.cacheKey(N, box, "mdrun 4.6.7"),
+                            tune.cacheKey(N, box, "gmx mdrun 5.0"))
+
+    def testCachedResult(self):
+        self.assertEqual(self._tune(), 6)
+        self.assertEqual(len(self.trials), 1)
+        # the result is kept in the project directory
+        inf=open(os.path.join(self.dir, tune.cacheFilename))
+        self.assertEqual(json.load(inf),
+                         { "5000 5.000 5.000 5.000 mdrun 4.6.7" : 6 })
+        inf.close()
+        # and used without new trials, also after a restart
+        self.assertEqual(self._tune(), 6)
+        tune._cache.clear()
+        self.assertEqual(self._tune(), 6)
+        self.assertEqual(len(self.trials), 1)
+        # a re-tune with a given max. number of cores replaces the result
+        self.assertEqual(self._tune(Nmax=4), 4)
+        self.assertEqual(self.trials[-1], [ 4, 3, 2, 1 ])
+        self.assertEqual(self._tune(), 4)
+        self.assertEqual(len(self.trials), 2)
@@ -0,0 +1,198 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import errno
+import httplib
+import logging
+import socket
+import time
+
+import cpc.network.https_connection_pool as https_connection_pool
+from cpc.network.https_connection_pool import ClientConnectionPool
+from cpc.network.com.client_base import ClientBase, ClientConnectionError
+import cpc.network.request_handler as request_handler
+
+
+class FakeConnection(object):
+    """A pooled connection with a real socket, so the pool can check
+       whether the other side has closed it."""
+    def __init__(self):
+        (self.sock, self.peer)=socket.socketpair()
+        self.closed=False
+
+    def close(self):
+        self.closed=True
+        self.sock.close()
+        self.peer.close()
+
+
+class TestClientConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.pool=ClientConnectionPool()
+        self.host="pool-test-host"
+        self.connections=[]
+
+    def tearDown(self):
+        self.pool.getAllConnections(self.host, 1)
+        for conn in self.connections:
+            if not conn.closed:
+                conn.close()
+
+    def _new(self):
+        conn=FakeConnection()
+        self.connections.append(conn)
+        return conn
+
+    def testReuse(self):
+        self.assertEqual(self.pool.getConnection(self.host, 1), None)
+        conns=[ self._new(), self._new() ]
+        for conn in conns:
+            self.pool.putConnection(conn, self.host, 1)
+        # the most recently used one first; other modes and ports are
+        # kept separately.
+        self.assertEqual(self.pool.getConnection(self.host, 1, False), None)
+        self.assertEqual(self.pool.getConnection(self.host, 2), None)
+        self.assertTrue(self.pool.getConnection(self.host, 1) is conns[1])
+        self.assertTrue(self.pool.getConnection(self.host, 1) is conns[0])
+        self.assertEqual(self.pool.getConnection(self.host, 1), None)
+
+    def testClosedByServer(self):
+        conn=self._new()
+        self.pool.putConnection(conn, self.host, 1)
+        conn.peer.close()
+        self.assertEqual(self.pool.getConnection(self.host, 1), None)
+        self.assertTrue(conn.closed)
+
+    def testIdleTime(self):
+        conn=self._new()
+        self.pool.putConnection(conn, self.host, 1)
+        oldIdleTime=https_connection_pool.clientIdleTime
+        https_connection_pool.clientIdleTime=0
+        try:
+            self.assertEqual(self.pool.getConnection(self.host, 1), None)
+        finally:
+            https_connection_pool.clientIdleTime=oldIdleTime
+        self.assertTrue(conn.closed)
+
+    def testMaxIdle(self):
+        conns=[ self._new() for i in
+                range(https_connection_pool.clientMaxIdle+1) ]
+        for conn in conns:
+            self.pool.putConnection(conn, self.host, 1)
+        # the oldest one is closed.
+        self.assertTrue(conns[0].closed)
+        self.assertFalse(any(conn.closed for conn in conns[1:]))
+
+
+class FakeClientConnection(object):
+    """A client connection whose requests fail with a list of errors."""
+    def __init__(self, reused, errors, gotResponse=False):
+        self.reused=reused
+        self.errors=errors
+        self.gotResponse=gotResponse
+        self.response=None
+        self.nSent=0
+
+    def sendRequest(self, req, method, stream):
+        self.nSent+=1
+        if len(self.errors) > 0:
+            if self.gotResponse:
+                self.response=object()
+            raise self.errors.pop(0)
+        return "response"
+
+    def abandonSocket(self):
+        pass
+
+
+class FakeRequest(object):
+    msg=""
+
+
+class TestClientReconnect(unittest.TestCase):
+    def _client(self, conns):
+        client=ClientBase("host", 1, None)
+        connList=list(conns)
+        def connect(require_certificate_authentication=None,
+                    disable_cookies=False, reuse=True):
+            client.conn=connList.pop(0)
+        client._ClientBase__connect=connect
+        return client
+
+    def testClosedPooledConnection(self):
+        for error in [ httplib.BadStatusLine(""),
+                       socket.error(errno.ECONNRESET, "reset"),
+                       socket.error(errno.EPIPE, "broken pipe") ]:
+            new=FakeClientConnection(False, [])
+            client=self._client([ FakeClientConnection(True, [error]), new ])
+            self.assertEqual(client.putRequest(FakeRequest()), "response")
+            self.assertEqual(new.nSent, 1)
+
+    def testNoRetry(self):
+        # new connections, timeouts and failures after part of the response
+        # was received are not retried: the server may have acted on them.
+        cases=[ FakeClientConnection(False, [httplib.BadStatusLine("")]),
+                FakeClientConnection(True, [socket.timeout("timed out")]),
+                FakeClientConnection(True, [httplib.BadStatusLine("HTTP/")]),
+                FakeClientConnection(True,
+                                     [socket.error(errno.ECONNRESET, "reset")],
+                                     gotResponse=True) ]
+        for conn in cases:
+            new=FakeClientConnection(False, [])
+            client=self._client([ conn, new ])
+            self.assertRaises(ClientConnectionError, client.putRequest,
+                              FakeRequest())
+            self.assertEqual(new.nSent, 0)
+
+
+class IdleHandler(request_handler.handler_base):
+    """A request handler on a socket that doesn't handle requests."""
+    def __init__(self, request):
+        self.request=request
+        self.log=logging.getLogger(__name__)
+
+
+class ServerSocket(object):
+    """A socket of a persistent connection from another server."""
+    serverId="server"
+
+
+class TestKeepAliveIdle(unittest.TestCase):
+    def setUp(self):
+        (self.sock, self.peer)=socket.socketpair()
+        self.handler=IdleHandler(self.sock)
+        self.oldIdleTime=request_handler.keepAliveIdleTime
+        request_handler.keepAliveIdleTime=0.1
+
+    def tearDown(self):
+        request_handler.keepAliveIdleTime=self.oldIdleTime
+        self.sock.close()
+        self.peer.close()
+
+    def testIdleClient(self):
+        startTime=time.time()
+        self.assertFalse(self.handler._waitForRequest())
+        self.assertTrue(time.time()-startTime < 5)
+        self.peer.sendall("POST /copernicus HTTP/1.1\r\n")
+        self.assertTrue(self.handler._waitForRequest())
+
+    def testPersistentServerConnection(self):
+        # persistent connections from other servers are never timed out.
+        self.assertTrue(IdleHandler(ServerSocket())._waitForRequest())
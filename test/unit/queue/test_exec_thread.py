@@ -0,0 +1,175 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import shutil
+import tempfile
+import threading
+import time
+import Queue
+import cpc.util.rwlock
+from cpc.dataflow import run
+from cpc.dataflow import task
+from cpc.dataflow import transaction
+from cpc.server.queue.exec_thread import TaskExecThread
+
+
+class FakeProject(object):
+    def __init__(self, basedir):
+        self.basedir=basedir
+        self.stateLock=cpc.util.rwlock.ReadWriteLock()
+        self.lockStats=transaction.LockStats()
+
+    def getName(self):
+        return "project"
+
+class FakeInstance(object):
+    def getName(self):
+        return "instance"
+
+class FakeActiveInstance(object):
+    def __init__(self):
+        self.instance=FakeInstance()
+        self.runLock=None
+        self.outputLock=threading.Lock()
+        self.persDir="pers"
+        self.removed=[]
+
+    def getCanonicalName(self):
+        return "instance"
+    def getNet(self):
+        return None
+    def markChanged(self):
+        pass
+    def removeTask(self, tsk):
+        self.removed.append(tsk)
+
+class FakeCommand(object):
+    def setTask(self, tsk):
+        self.task=tsk
+
+class FakeFunction(object):
+    """A controller that runs until it is released."""
+    def __init__(self, cmd=None):
+        self.cmd=cmd
+        self.started=threading.Event()
+        self.release=threading.Event()
+
+    def getLib(self):
+        return None
+    def getName(self):
+        return "fn"
+
+    def run(self, fnInput):
+        self.started.set()
+        self.release.wait()
+        if self.cmd is not None:
+            fnInput.getFunctionOutput().addCommand(self.cmd)
+
+class FakeTaskQueue(object):
+    def __init__(self):
+        self.queue=Queue.Queue()
+    def registerConsumer(self):
+        pass
+    def unregisterConsumer(self):
+        pass
+    def put(self, tsk):
+        self.queue.put(tsk)
+    def putNone(self):
+        self.queue.put(None)
+    def get(self):
+        return self.queue.get()
+    def taskDone(self):
+        self.queue.task_done()
+
+class FakeCmdQueue(object):
+    def __init__(self):
+        self.cmds=[]
+    def add(self, cmd):
+        self.cmds.append(cmd)
+    def remove(self, cmd):
+        self.cmds.remove(cmd)
+    def signal(self):
+        pass
+
+
+class TestTaskExecThread(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.mkdtemp()
+        self.project=FakeProject(self.dir)
+        self.ai=FakeActiveInstance()
+        self.taskQueue=FakeTaskQueue()
+        self.cmdQueue=FakeCmdQueue()
+        self.thread=TaskExecThread(self.taskQueue, self.cmdQueue)
+
+    def tearDown(self):
+        self.fn.release.set()
+        self.thread.doStop()
+        self.thread.queueNone()
+        self.thread.thread.join(5)
+        shutil.rmtree(self.dir)
+
+    def _queue(self, fn):
+        self.fn=fn
+        fnInput=run.FunctionRunInput(outputDir=self.dir,
+                                     persistentDir=self.dir)
+        tsk=task.Task(self.project, self.ai, fn, fnInput, 0, 1)
+        self.taskQueue.put(tsk)
+        self.assertTrue(fn.started.wait(5))
+        return tsk
+
+    def _save(self):
+        """Take the state lock like a state save does, in another thread.
+           Returns whether it got the lock in time."""
+        acquired=threading.Event()
+        def save():
+            self.project.stateLock.acquireExclusive()
+            acquired.set()
+        th=threading.Thread(target=save)
+        th.daemon=True
+        th.start()
+        th.join(5)
+        return acquired.isSet()
+
+    def testControllerDoesntBlockSave(self):
+        fn=FakeFunction()
+        tsk=self._queue(fn)
+        # the controller is still running
+        self.assertTrue(self._save())
+        # but its output waits for the save to finish
+        fn.release.set()
+        time.sleep(0.2)
+        self.assertEqual(self.ai.removed, [])
+        self.project.stateLock.releaseExclusive()
+        self.taskQueue.queue.join()
+        self.assertEqual(self.ai.removed, [ tsk ])
+
+    def testQueueCommands(self):
+        cmd=FakeCommand()
+        fn=FakeFunction(cmd)
+        tsk=self._queue(fn)
+        self.assertTrue(self._save())
+        fn.release.set()
+        time.sleep(0.2)
+        self.assertEqual(self.cmdQueue.cmds, [])
+        self.project.stateLock.releaseExclusive()
+        self.taskQueue.queue.join()
+        self.assertEqual(self.cmdQueue.cmds, [ cmd ])
+        self.assertEqual(tsk.getCommands(), [ cmd ])
+        self.assertEqual(self.ai.removed, [])
@@ -18,48 +18,202 @@
 
 
 import unittest
+import logging
 import random
-from threading import Thread
-from cpc.server.task import Task
-from cpc.server.queue import Queue
+import time
+import threading
+from cpc.server.queue import CmdQueue, QueueError, QueueableItem
 
+log=logging.getLogger(__name__)
+
+
+class FakeTask(object):
+    def __init__(self, project, priority, functionName="fn"):
+        self.project=project
+        self.priority=priority
+        self.functionName=functionName
+
+    def getFunctionName(self):
+        return self.functionName
+
+class FakeCommand(QueueableItem):
+    """A minimal stand-in for cpc.command.Command."""
+    def __init__(self, id, task, executable="mdrun"):
+        QueueableItem.__init__(self)
+        self.id=id
+        self.task=task
+        self.executable=executable
+        self.minVersion=None
+        self.maxVersion=None
+        self.addPriority=0
+
+    def tryGenID(self):
+        pass
+
+    def getTask(self):
+        return self.task
+
+    def getFullPriority(self):
+        return self.task.priority + self.addPriority
 
 
 class TestQueue(unittest.TestCase):
     
     
     def setUp(self):
-        self.queue = Queue()
-    
-   
+        self.queue = CmdQueue()
+        self.projects = [ "project_%d"%i for i in range(10) ]
+
     def testAddHundredThousand(self):
-        num = 1000000
-
-        tasks = self.generateTasks(num)
-
-        def addToq(task):
-            self.queue.add(task)    
-
-        for i  in range(num):
-            Thread(target=addToq,args=(tasks[i],)).start()
-        
-        ''' verify that they are sorted in priority order '''
-        ''' verify that there exists 100 elements in the queue '''
-        self.assertEquals(self.queue.size,num)      
-  
-        
-      
-    def generateTasks(self,num):
+        num = 100000
+
+        cmds = self.generateCommands(num)
+
+        start=time.time()
+        for cmd in cmds:
+            self.queue.add(cmd)
+        tAdd=time.time()-start
+        self.assertEquals(self.queue.getSize(),num)
+
+        # removing, looking up and purging is independent of queue size
+        start=time.time()
+        for cmd in cmds[:num/2]:
+            self.assertTrue(self.queue.exists(cmd.id))
+            self.queue.remove(cmd)
+            self.assertFalse(self.queue.exists(cmd.id))
+        tRemove=time.time()-start
+        self.assertEquals(self.queue.getSize(),num-num/2)
+
+        start=time.time()
+        nremoved=0
+        for project in self.projects:
+            nremoved+=self.queue.deleteByProject(project)
+        tPurge=time.time()-start
+        self.assertEquals(nremoved, num-num/2)
+        self.assertEquals(self.queue.getSize(),0)
+        log.debug("%d commands: add %.3fs, remove+exists %.3fs, purge %.3fs"%
+                  (num, tAdd, tRemove, tPurge))
+
+    def testPriorityOrder(self):
+        cmds = self.generateCommands(1000)
+        for cmd in cmds:
+            self.queue.add(cmd)
+        prio=CmdQueue.PRIO_HIGH_BOUND
+        n=0
+        while True:
+            cmd=self.queue.get()
+            if cmd is None:
+                break
+            self.assertTrue(cmd.getFullPriority() <= prio)
+            prio=cmd.getFullPriority()
+            n+=1
+        self.assertEquals(n, 1000)
+
+    def testFifoOrder(self):
+        # commands of the same priority come out in the order they were
+        # queued, whichever bucket they are in.
+        cmds=[]
+        for i in range(100):
+            task=FakeTask(self.projects[i%3], 0, "fn_%d"%(i%7))
+            cmds.append(FakeCommand("cmd_%d"%i, task))
+        for cmd in cmds:
+            self.queue.add(cmd)
+        self.assertEquals(self.queue.list(), cmds)
+        self.assertEquals(self.queue.indexOfCommand(cmds[10]), 10)
+        got=[ self.queue.get() for i in range(50) ]
+        self.assertEquals(got, cmds[:50])
+        ret=self.queue.getUntil(lambda parm, item: (True, True), None)
+        self.assertEquals(ret, cmds[50:])
+
+    def testRemoveWhileIterating(self):
+        # getUntil() removes items from the buckets it is iterating over
+        cmds=[]
+        for i in range(60):
+            task=FakeTask(self.projects[i%2], 0, "fn_%d"%(i%3))
+            cmds.append(FakeCommand("cmd_%d"%i, task))
+        for cmd in cmds:
+            self.queue.add(cmd)
+        seen=[]
+        def takeEven(parm, item):
+            seen.append(item)
+            return (len(seen) < 40, int(item.id[4:])%2 == 0)
+        ret=self.queue.getUntil(takeEven, None)
+        self.assertEquals(seen, cmds[:40])
+        self.assertEquals(ret, cmds[:40:2])
+        self.assertEquals(self.queue.list(), cmds[1:40:2]+cmds[40:])
+        # a poll that takes one command stops there
+        seen=[]
+        def takeOne(parm, item):
+            seen.append(item)
+            return (False, True)
+        ret=self.queue.getUntil(takeOne, None)
+        self.assertEquals(ret, [ cmds[1] ])
+        self.assertEquals(seen, [ cmds[1] ])
+        self.assertEquals(self.queue.getSize(), 39)
+
+    def testNoStarvation(self):
+        # a project whose commands keep coming in doesn't hold back the
+        # commands of another project that were queued earlier.
+        busy=FakeTask(self.projects[0], 0)
+        other=FakeTask(self.projects[1], 0)
+        self.queue.add(FakeCommand("busy_0", busy))
+        self.queue.add(FakeCommand("other_0", other))
+        got=[]
+        for i in range(1, 5):
+            self.queue.add(FakeCommand("busy_%d"%i, busy))
+            got.append(self.queue.get().id)
+        self.assertEquals(got, [ "busy_0", "other_0", "busy_1", "busy_2" ])
+
+    def testInactive(self):
+        cmds = self.generateCommands(10)
+        for cmd in cmds:
+            self.queue.add(cmd)
+        cmds[0].deactivate()
+        self.assertEquals(len(self.queue.list()), 9)
+        # inactive commands are skipped by getUntil, but still exist
+        ret=self.queue.getUntil(lambda parm, item: (True, True), None)
+        self.assertEquals(len(ret), 9)
+        self.assertTrue(self.queue.exists(cmds[0].id))
+        cmds[0].activate()
+        self.assertEquals(self.queue.get(), cmds[0])
+        self.assertRaises(QueueError, self.queue.remove, cmds[0])
+
+    def testCapabilityKeys(self):
+        cmds = self.generateCommands(1000)
+        for i, cmd in enumerate(cmds):
+            if i%100 == 0:
+                cmd.executable="grompp"
+            self.queue.add(cmd)
+        visited=[]
+        def fn(parm, item):
+            visited.append(item)
+            return (True, True)
+        def keyFn(parm, item):
+            return item.executable == "grompp"
+        ret=self.queue.getUntil(fn, None, keyFn)
+        # only the commands in matching buckets are looked at
+        self.assertEquals(len(ret), 10)
+        self.assertEquals(len(visited), 10)
+        self.assertEquals(self.queue.getSize(), 990)
+
+    def testWaitForChange(self):
+        changeCount=self.queue.getChangeCount()
+        # nothing happens: we time out
+        self.assertFalse(self.queue.waitForChange(changeCount, 0.1))
+        cmds = self.generateCommands(1)
+        timer=threading.Timer(0.1, self.queue.add, args=(cmds[0],))
+        timer.start()
+        start=time.time()
+        self.assertTrue(self.queue.waitForChange(changeCount, 10))
+        self.assertTrue(time.time()-start < 5)
+        timer.join()
+
+    def generateCommands(self,num):
         list = []        
         for i in range(num):
-            task = Task()
-            task.id = i
-            task.priority = random.randint(Queue.PRIO_LOW_BOUND,Queue.PRIO_HIGH_BOUND)
-            list.append(task) 
-                
+            prio=random.randint(CmdQueue.PRIO_LOW_BOUND,
+                                CmdQueue.PRIO_HIGH_BOUND)
+            task=FakeTask(random.choice(self.projects), prio)
+            list.append(FakeCommand("cmd_%d"%i, task))
         return list
-        
-  
-            
-            
-        
+
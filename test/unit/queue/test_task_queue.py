@@ -0,0 +1,169 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+# 
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published 
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import time
+from cpc.util.conf.server_conf import ServerConf
+from cpc.dataflow.task import TaskQueue
+
+
+class FakeProject(object):
+    def __init__(self, name):
+        self.name=name
+
+    def getName(self):
+        return self.name
+
+class FakeTask(object):
+    def __init__(self, project, priority, nr=0):
+        self.project=project
+        self.priority=priority
+        self.nr=nr
+
+
+class TestTaskQueue(unittest.TestCase):
+    def setUp(self):
+        self.confDir=tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.confDir, 'server'))
+        open(os.path.join(self.confDir, 'server', 'server.conf'), 'w').close()
+        self.conf=ServerConf(confdir=self.confDir)
+        self.conf.set('task_queue_size', '4')
+        self.queue=TaskQueue(None)
+        self.projects=[ FakeProject("project_%d"%i) for i in range(3) ]
+
+    def tearDown(self):
+        shutil.rmtree(self.confDir)
+
+    def testPriority(self):
+        self.queue.put(FakeTask(self.projects[0], 0))
+        self.queue.put(FakeTask(self.projects[0], 2))
+        self.queue.put(FakeTask(self.projects[0], 1))
+        self.assertEquals(self.queue.get().priority, 2)
+        self.assertEquals(self.queue.get().priority, 1)
+        self.assertEquals(self.queue.get().priority, 0)
+        self.assertTrue(self.queue.empty())
+
+    def testProjectRoundRobin(self):
+        for i in range(3):
+            self.queue.put(FakeTask(self.projects[0], 0, i))
+        self.queue.put(FakeTask(self.projects[1], 0, 0))
+        self.assertEquals(self.queue.getProjectSize("project_0"), 3)
+        order=[ (task.project.getName(), task.nr) for task in
+                [ self.queue.get() for i in range(4) ] ]
+        self.assertEquals(order, [ ("project_0", 0), ("project_1", 0),
+                                   ("project_0", 1), ("project_0", 2) ])
+        self.assertEquals(self.queue.getStats()['max_depth'], 4)
+
+    def testNone(self):
+        self.queue.put(FakeTask(self.projects[0], 0))
+        self.queue.putNone()
+        self.assertEquals(self.queue.get(), None)
+        self.queue.taskDone()
+        self.assertTrue(self.queue.hasPending())
+        self.assertNotEquals(self.queue.get(), None)
+        self.queue.taskDone()
+        self.assertFalse(self.queue.hasPending())
+
+    def testBackpressure(self):
+        for i in range(4):
+            self.queue.put(FakeTask(self.projects[0], 0, i))
+        # a blocked producer continues once a task is taken out.
+        th=threading.Thread(target=self.queue.put,
+                            args=(FakeTask(self.projects[1], 0),))
+        th.start()
+        th.join(0.2)
+        self.assertTrue(th.isAlive())
+        self.queue.get()
+        th.join(5)
+        self.assertFalse(th.isAlive())
+        self.assertEquals(self.queue.getStats()['blocked_puts'], 1)
+
+    def testLastConsumerNeverBlocks(self):
+        for i in range(4):
+            self.queue.put(FakeTask(self.projects[0], 0, i))
+        self.queue.registerConsumer()
+        try:
+            # the only consumer must not wait for itself.
+            self.queue.put(FakeTask(self.projects[1], 0))
+        finally:
+            self.queue.unregisterConsumer()
+        self.assertEquals(self.queue.getStats()['depth'], 5)
+
+    def testConsumerHoldingLocks(self):
+        for i in range(4):
+            self.queue.put(FakeTask(self.projects[0], 0, i))
+        # a consumer that queues a task while it holds a lock that the
+        # consumer that would empty the queue needs. A third consumer is
+        # busy elsewhere.
+        dataflowLock=threading.Lock()
+        drainerReady=threading.Event()
+        idleReady=threading.Event()
+        blockedPut=threading.Event()
+        done=threading.Event()
+        def producer():
+            self.queue.registerConsumer()
+            try:
+                drainerReady.wait()
+                idleReady.wait()
+                with dataflowLock:
+                    blockedPut.set()
+                    self.queue.put(FakeTask(self.projects[1], 0))
+            finally:
+                self.queue.unregisterConsumer()
+        def drainer():
+            self.queue.registerConsumer()
+            drainerReady.set()
+            try:
+                blockedPut.wait()
+                with dataflowLock:
+                    while not self.queue.empty():
+                        self.queue.get()
+            finally:
+                self.queue.unregisterConsumer()
+        def idle():
+            self.queue.registerConsumer()
+            idleReady.set()
+            try:
+                done.wait()
+            finally:
+                self.queue.unregisterConsumer()
+        idleThread=threading.Thread(target=idle)
+        idleThread.start()
+        oldTimeout=TaskQueue.putTimeout
+        TaskQueue.putTimeout=0.2
+        try:
+            threads=[ threading.Thread(target=producer),
+                      threading.Thread(target=drainer) ]
+            startTime=time.time()
+            for th in threads:
+                th.start()
+            for th in threads:
+                th.join(5)
+            self.assertFalse(any(th.isAlive() for th in threads))
+            self.assertTrue(time.time()-startTime < 5)
+            self.assertTrue(self.queue.empty())
+        finally:
+            TaskQueue.putTimeout=oldTimeout
+            done.set()
+            idleThread.join()
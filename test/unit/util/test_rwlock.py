@@ -0,0 +1,124 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import threading
+import time
+
+from cpc.util.rwlock import ReadWriteLock
+
+
+class TestReadWriteLock(unittest.TestCase):
+    def setUp(self):
+        self.lock=ReadWriteLock()
+
+    def _start(self, fn):
+        th=threading.Thread(target=fn)
+        th.daemon=True
+        th.start()
+        return th
+
+    def _waitForWriter(self):
+        for i in range(500):
+            with self.lock.cond:
+                if self.lock.nWaitingWriters > 0:
+                    return
+            time.sleep(0.01)
+        self.fail("writer didn't start waiting")
+
+    def testSharedReaders(self):
+        self.lock.acquireShared()
+        acquired=threading.Event()
+        def reader():
+            with self.lock.shared:
+                acquired.set()
+        th=self._start(reader)
+        self.assertTrue(acquired.wait(5))
+        th.join(5)
+        self.lock.releaseShared()
+
+    def testWriterPreference(self):
+        order=[]
+        self.lock.acquireShared()
+        def writer():
+            with self.lock.exclusive:
+                order.append("writer")
+        def reader():
+            with self.lock.shared:
+                order.append("reader")
+        wth=self._start(writer)
+        self._waitForWriter()
+        # a new reader waits behind the waiting writer.
+        rth=self._start(reader)
+        time.sleep(0.1)
+        self.assertEqual(order, [])
+        self.lock.releaseShared()
+        wth.join(5)
+        rth.join(5)
+        self.assertEqual(order, [ "writer", "reader" ])
+
+    def testReentrantShared(self):
+        done=threading.Event()
+        def writer():
+            with self.lock.exclusive:
+                done.set()
+        self.lock.acquireShared()
+        wth=self._start(writer)
+        self._waitForWriter()
+        # a reader that already holds the lock doesn't wait for the writer
+        with self.lock.shared:
+            with self.lock.shared:
+                pass
+        self.assertFalse(done.isSet())
+        self.lock.releaseShared()
+        self.assertTrue(done.wait(5))
+        wth.join(5)
+
+    def testReentrantExclusive(self):
+        acquired=threading.Event()
+        def reader():
+            with self.lock.shared:
+                acquired.set()
+        with self.lock.exclusive:
+            with self.lock.exclusive:
+                with self.lock.shared:
+                    pass
+            # the outer hold still keeps other threads out.
+            rth=self._start(reader)
+            self.assertFalse(acquired.wait(0.1))
+        self.assertTrue(acquired.wait(5))
+        rth.join(5)
+        # a reader can't become a writer.
+        with self.lock.shared:
+            self.assertRaises(RuntimeError, self.lock.acquireExclusive)
+        self.assertEqual(self.lock.nReaders, 0)
+
+    def testReleaseOnException(self):
+        def fail(side):
+            with side:
+                raise ValueError()
+        self.assertRaises(ValueError, fail, self.lock.shared)
+        self.assertEqual(self.lock.nReaders, 0)
+        self.assertRaises(ValueError, fail, self.lock.exclusive)
+        self.assertEqual(self.lock.writer, None)
+        # both sides can be acquired again
+        self.assertTrue(self.lock.acquireExclusive() >= 0)
+        self.lock.releaseExclusive()
+        with self.lock.shared:
+            pass
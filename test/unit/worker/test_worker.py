@@ -0,0 +1,116 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from cpc.command import Command
+from cpc.command import Resource
+from cpc.command import bundle
+from cpc.worker import worker
+from cpc.worker.input_cache import InputCache
+
+
+class FakePlatform(object):
+    def getMaxResources(self):
+        return { 'cores' : Resource('cores', 4) }
+
+class FakeResponse(object):
+    """A server response with a command bundle."""
+    def __init__(self, data):
+        self.data=data
+        self.headers={ 'originating-server-id' : "server" }
+
+    def getType(self):
+        return bundle.contentType
+
+    def getRawData(self):
+        return StringIO(self.data)
+
+    def close(self):
+        pass
+
+class FakeWorkerMessage(object):
+    """Records the command finished requests instead of sending them."""
+    finished=[]
+    def commandFinishedRequest(self, cmdID, origServer, returncode, cputime,
+                               jobTarFileobj, uploadedSize=None):
+        FakeWorkerMessage.finished.append( (cmdID, returncode,
+                                            jobTarFileobj is not None) )
+
+
+class TestExtractCommands(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.mkdtemp()
+        self.origWorkerMessage=worker.WorkerMessage
+        worker.WorkerMessage=FakeWorkerMessage
+        FakeWorkerMessage.finished=[]
+        # a worker without a server, plugin or executables
+        self.worker=worker.Worker.__new__(worker.Worker)
+        self.worker.mainDir=os.path.join(self.dir, "worker")
+        os.mkdir(self.worker.mainDir)
+        self.worker.iteration=0
+        self.worker.runCondVar=threading.Condition()
+        self.worker.inputCache=InputCache(os.path.join(self.dir, "cache"),
+                                          1024*1024)
+        self.worker._findExecutable=lambda cmd: ("mdrun", FakePlatform())
+
+    def tearDown(self):
+        worker.WorkerMessage=self.origWorkerMessage
+        shutil.rmtree(self.dir)
+
+    def _cmdDir(self, cmdID, content):
+        cmddir=os.path.join(self.dir, cmdID)
+        os.mkdir(cmddir)
+        outf=open(os.path.join(cmddir, "command.xml"), "w")
+        cmd=Command(None, "mdrun", [], id=cmdID)
+        cmd.setReserved('cores', 1)
+        cmd.writeWorkerXML(outf)
+        outf.close()
+        outf=open(os.path.join(cmddir, "state.cpt"), "wb")
+        outf.write(content)
+        outf.close()
+        return cmddir
+
+    def testMissingCachedInput(self):
+        content=os.urandom(bundle.minHashSize)
+        cmddirs=[ (self._cmdDir("cmd_1", content), "cmd_1"),
+                  (self._cmdDir("cmd_2", os.urandom(100)), "cmd_2") ]
+        contentHash=bundle.getFileHash(os.path.join(cmddirs[0][0],
+                                                    "state.cpt"))
+        tff=tempfile.TemporaryFile()
+        # the server thinks the worker has the checkpoint, but it's gone
+        bundle.writeBundle(tff, cmddirs, True, frozenset([ contentHash ]))
+        tff.seek(0)
+        workloads=self.worker._extractCommands(FakeResponse(tff.read()))
+        tff.close()
+        # the command with the missing input is handed back; the other one
+        # runs
+        self.assertEqual([ wl.cmd.id for wl in workloads ], [ "cmd_2" ])
+        self.assertEqual(FakeWorkerMessage.finished,
+                         [ ("cmd_1", None, False) ])
+        self.assertFalse(os.path.exists(os.path.join(self.worker.mainDir,
+                                                     "0", "cmd_1")))
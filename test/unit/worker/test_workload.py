@@ -0,0 +1,91 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011-2015, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+
+from cpc.command import Resource
+from cpc.worker import workload
+
+
+class FakeCommand(object):
+    def __init__(self, cmdID):
+        self.id=cmdID
+
+    def getReserved(self, name):
+        return 1
+
+    def getOutputFiles(self):
+        return None
+
+class FakePlatform(object):
+    def getMaxResources(self):
+        return { 'cores' : Resource('cores', 4) }
+
+class FakeWorkerMessage(object):
+    """Records the command finished requests instead of sending them."""
+    finished=[]
+    def commandFinishedRequest(self, cmdID, origServer, returncode, cputime,
+                               jobTarFileobj, uploadedSize=None):
+        FakeWorkerMessage.finished.append( (cmdID, returncode,
+                                            jobTarFileobj is not None,
+                                            uploadedSize) )
+
+
+class TestWorkload(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.mkdtemp()
+        self.origWorkerMessage=workload.WorkerMessage
+        workload.WorkerMessage=FakeWorkerMessage
+        FakeWorkerMessage.finished=[]
+
+    def tearDown(self):
+        workload.WorkerMessage=self.origWorkerMessage
+        shutil.rmtree(self.dir)
+
+    def _workload(self, cmdID):
+        rundir=os.path.join(self.dir, cmdID)
+        os.mkdir(rundir)
+        outf=open(os.path.join(rundir, "command.xml"), "w")
+        outf.write("<command/>\n")
+        outf.close()
+        return workload.WorkLoad(self.dir, FakeCommand(cmdID), rundir,
+                                 "server", None, FakePlatform(), 0,
+                                 threading.Condition())
+
+    def testUnstarted(self):
+        wl=self._workload("cmd_1")
+        # a prefetched workload that never ran is handed back without run
+        # data, so the server queues it again.
+        wl.returnResults()
+        self.assertEqual(FakeWorkerMessage.finished,
+                         [ ("cmd_1", None, False, None) ])
+        self.assertFalse(os.path.exists(wl.rundir))
+
+    def testStarted(self):
+        wl=self._workload("cmd_2")
+        wl.started=True
+        wl.returncode=0
+        wl._uploadResults=lambda tff: None
+        wl.returnResults()
+        self.assertEqual(FakeWorkerMessage.finished,
+                         [ ("cmd_2", 0, True, None) ])